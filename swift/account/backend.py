@@ -18,14 +18,18 @@ Pluggable Back-end for Account Server
 
 from uuid import uuid4
 import time
-import cPickle as pickle
 
 import sqlite3
 
 from swift.common.utils import Timestamp
-from swift.common.db import DatabaseBroker, utf8encode
+from swift.common.db import DatabaseBroker, utf8encode, prefix_end_marker, \
+    can_rollup, get_rollup_query, ROLLUP_MAX_PLAIN, LISTING_BATCH_SIZE
 
 DATADIR = 'accounts'
+#: SQL of listing queries; see AccountBroker._get_listing_query
+LISTING_QUERIES = {}
+#: SQL of delimiter listing queries; see AccountBroker._list_delimited
+ROLLUP_QUERIES = {}
 
 
 POLICY_STAT_TRIGGER_SCRIPT = """
@@ -52,6 +56,32 @@ POLICY_STAT_TRIGGER_SCRIPT = """
 """
 
 
+def make_container_record(name, put_timestamp, delete_timestamp,
+                          object_count, bytes_used, storage_policy_index):
+    """
+    Build the container row that AccountBroker.merge_items takes.
+
+    :param name: name of the container
+    :param put_timestamp: put_timestamp of the container
+    :param delete_timestamp: delete_timestamp of the container
+    :param object_count: number of objects in the container
+    :param bytes_used: number of bytes used by the container
+    :param storage_policy_index:  the storage policy for this container
+    :returns: dict of the container row
+    """
+    if delete_timestamp > put_timestamp and \
+            object_count in (None, '', 0, '0'):
+        deleted = 1
+    else:
+        deleted = 0
+    return {'name': name, 'put_timestamp': put_timestamp,
+            'delete_timestamp': delete_timestamp,
+            'object_count': object_count,
+            'bytes_used': bytes_used,
+            'deleted': deleted,
+            'storage_policy_index': storage_policy_index}
+
+
 class AccountBroker(DatabaseBroker):
     """Encapsulates working with an account database."""
     db_type = 'account'
@@ -203,9 +233,10 @@ class AccountBroker(DatabaseBroker):
                 status_changed_at = ?
             WHERE delete_timestamp < ? """, (timestamp, timestamp, timestamp))
 
-    def _commit_puts_load(self, item_list, entry):
-        """See :func:`swift.common.db.DatabaseBroker._commit_puts_load`"""
-        loaded = pickle.loads(entry.decode('base64'))
+    def make_record_from_pickle(self, loaded):
+        """
+        See :func:`swift.common.db.DatabaseBroker.make_record_from_pickle`
+        """
         # check to see if the update includes policy_index or not
         (name, put_timestamp, delete_timestamp, object_count, bytes_used,
          deleted) = loaded[:6]
@@ -215,14 +246,13 @@ class AccountBroker(DatabaseBroker):
             # legacy support during upgrade until first non legacy storage
             # policy is defined
             storage_policy_index = 0
-        item_list.append(
-            {'name': name,
-             'put_timestamp': put_timestamp,
-             'delete_timestamp': delete_timestamp,
-             'object_count': object_count,
-             'bytes_used': bytes_used,
-             'deleted': deleted,
-             'storage_policy_index': storage_policy_index})
+        return {'name': name,
+                'put_timestamp': put_timestamp,
+                'delete_timestamp': delete_timestamp,
+                'object_count': object_count,
+                'bytes_used': bytes_used,
+                'deleted': deleted,
+                'storage_policy_index': storage_policy_index}
 
     def empty(self):
         """
@@ -254,18 +284,9 @@ class AccountBroker(DatabaseBroker):
         :param bytes_used: number of bytes used by the container
         :param storage_policy_index:  the storage policy for this container
         """
-        if delete_timestamp > put_timestamp and \
-                object_count in (None, '', 0, '0'):
-            deleted = 1
-        else:
-            deleted = 0
-        record = {'name': name, 'put_timestamp': put_timestamp,
-                  'delete_timestamp': delete_timestamp,
-                  'object_count': object_count,
-                  'bytes_used': bytes_used,
-                  'deleted': deleted,
-                  'storage_policy_index': storage_policy_index}
-        self.put_record(record)
+        self.put_record(make_container_record(
+            name, put_timestamp, delete_timestamp, object_count, bytes_used,
+            storage_policy_index))
 
     def _is_deleted_info(self, status, container_count, delete_timestamp,
                          put_timestamp):
@@ -365,6 +386,31 @@ class AccountBroker(DatabaseBroker):
                 FROM account_stat
             ''').fetchone())
 
+    def _get_listing_query(self, conn, marker_op, has_end_marker):
+        """
+        Get the SQL for a page of a listing, the very same text for each
+        shape of query so that sqlite can reuse its prepared statements.
+
+        :param marker_op: comparison of names to the marker, '>' or '>=', or
+                          None if there is no marker
+        :param has_end_marker: whether names are limited by an end marker
+        :returns: the query; its arguments are the marker if marker_op, the
+                  end marker if has_end_marker, and the limit
+        """
+        key = (self.get_db_version(conn) >= 1, marker_op, has_end_marker)
+        query = LISTING_QUERIES.get(key)
+        if query is None:
+            clauses = ['deleted = 0' if key[0] else '+deleted = 0']
+            if marker_op:
+                clauses.append('name %s ?' % marker_op)
+            if has_end_marker:
+                clauses.append('name < ?')
+            query = LISTING_QUERIES[key] = (
+                'SELECT name, object_count, bytes_used, 0 '
+                'FROM container WHERE %s ORDER BY name LIMIT ?' %
+                ' AND '.join(clauses))
+        return query
+
     def list_containers_iter(self, limit, marker, end_marker, prefix,
                              delimiter):
         """
@@ -385,67 +431,128 @@ class AccountBroker(DatabaseBroker):
         self._commit_puts_stale_ok()
         if delimiter and not prefix:
             prefix = ''
-        orig_marker = marker
+        if prefix:
+            prefix_end = prefix_end_marker(prefix)
+            if prefix_end and (not end_marker or prefix_end < end_marker):
+                end_marker = prefix_end
         with self.get() as conn:
-            results = []
-            while len(results) < limit:
-                query = """
-                    SELECT name, object_count, bytes_used, 0
-                    FROM container
-                    WHERE deleted = 0 AND """
-                query_args = []
+            if delimiter:
+                return self._list_delimited(conn, limit, marker, end_marker,
+                                            prefix, delimiter)
+            query_args = []
+            if marker and marker >= prefix:
+                marker_op = '>'
+                query_args.append(marker)
+            elif prefix:
+                marker_op = '>='
+                query_args.append(prefix)
+            else:
+                marker_op = None
+            if end_marker:
+                query_args.append(end_marker)
+            query_args.append(limit)
+            curs = conn.execute(
+                self._get_listing_query(conn, marker_op, bool(end_marker)),
+                query_args)
+            curs.row_factory = None
+            if not prefix:
+                return [r for r in curs]
+            return [r for r in curs if r[0].startswith(prefix)]
+
+    def _list_delimited(self, conn, limit, marker, end_marker, prefix,
+                        delimiter):
+        """
+        The part of list_containers_iter for listings with a delimiter.
+        Names are scanned up to the first common prefix, then listed with
+        get_rollup_query so that runs of common prefixes take one query
+        rather than one each, until the names run plain again.
+        """
+        where = 'deleted = 0' if self.get_db_version(conn) >= 1 \
+            else '+deleted = 0'
+        after_delimiter = chr(ord(delimiter) + 1)
+        params = {'prefix': prefix, 'delimiter': delimiter,
+                  'after_delimiter': after_delimiter, 'after_name': '\x01',
+                  'min_end': 1, 'end_marker': end_marker,
+                  'max_plain': ROLLUP_MAX_PLAIN}
+        use_rollup = can_rollup(delimiter)
+        orig_marker = marker
+        if marker and marker >= prefix:
+            marker_op = '>'
+        else:
+            marker_op, marker = '>=', prefix
+        results = []
+        rollup = False
+        while len(results) < limit:
+            count = limit - len(results)
+            if rollup:
+                key = (where, marker_op, bool(end_marker))
+                query = ROLLUP_QUERIES.get(key)
+                if query is None:
+                    # deleted is 0 for every row listed, as is_subdir is
+                    query = ROLLUP_QUERIES[key] = get_rollup_query(
+                        'container', ('name', 'object_count', 'bytes_used',
+                                      'deleted'),
+                        where, marker_op, bool(end_marker))
+                params['marker'] = marker
+                params['limit'] = count
+                curs = conn.execute(query, params)
+            else:
+                query_args = [marker]
                 if end_marker:
-                    query += ' name < ? AND'
                     query_args.append(end_marker)
-                if marker and marker >= prefix:
-                    query += ' name > ? AND'
-                    query_args.append(marker)
-                elif prefix:
-                    query += ' name >= ? AND'
-                    query_args.append(prefix)
-                if self.get_db_version(conn) < 1:
-                    query += ' +deleted = 0'
-                else:
-                    query += ' deleted = 0'
-                query += ' ORDER BY name LIMIT ?'
-                query_args.append(limit - len(results))
-                curs = conn.execute(query, query_args)
-                curs.row_factory = None
-
-                if prefix is None:
-                    # A delimiter without a specified prefix is ignored
-                    return [r for r in curs]
-                if not delimiter:
-                    if not prefix:
-                        # It is possible to have a delimiter but no prefix
-                        # specified. As above, the prefix will be set to the
-                        # empty string, so avoid performing the extra work to
-                        # check against an empty prefix.
-                        return [r for r in curs]
-                    else:
-                        return [r for r in curs if r[0].startswith(prefix)]
-
-                # We have a delimiter and a prefix (possibly empty string) to
-                # handle
-                rowcount = 0
-                for row in curs:
-                    rowcount += 1
-                    marker = name = row[0]
-                    if len(results) >= limit or not name.startswith(prefix):
-                        curs.close()
-                        return results
-                    end = name.find(delimiter, len(prefix))
-                    if end > 0:
-                        marker = name[:end] + chr(ord(delimiter) + 1)
-                        dir_name = name[:end + 1]
-                        if dir_name != orig_marker:
-                            results.append([dir_name, 0, 0, 1])
-                        curs.close()
-                        break
+                query_args.append(count)
+                curs = conn.execute(
+                    self._get_listing_query(conn, marker_op,
+                                            bool(end_marker)), query_args)
+            curs.row_factory = None
+            rowcount = plain = 0
+            for row in curs:
+                rowcount += 1
+                name = row[0]
+                if not name.startswith(prefix):
+                    curs.close()
+                    return results
+                end = name.find(delimiter, len(prefix))
+                if end <= 0:
+                    plain += 1
+                    marker_op, marker = '>', name
                     results.append(row)
-                if not rowcount:
+                    continue
+                plain = 0
+                marker_op, marker = '>=', name[:end] + after_delimiter
+                dir_name = name[:end + 1]
+                if dir_name != orig_marker:
+                    results.append([dir_name, 0, 0, 1])
+                if not rollup:
+                    curs.close()
+                    rollup = use_rollup
+                    break
+            else:
+                if rollup and plain >= ROLLUP_MAX_PLAIN:
+                    rollup = False
+                elif rowcount < count:
                     break
-            return results
+        return results
+
+    def iter_containers(self, limit, marker, end_marker, prefix, delimiter,
+                        batch_size=LISTING_BATCH_SIZE):
+        """
+        Iterate over the same containers as list_containers_iter, listing
+        batch_size of them at a time.  The first rows can be used before the
+        rest are read, and the DB is left alone between batches.
+
+        :param batch_size: max number of rows to list at a time
+        """
+        while limit > 0:
+            count = min(limit, batch_size)
+            batch = self.list_containers_iter(count, marker, end_marker,
+                                              prefix, delimiter)
+            for row in batch:
+                yield row
+            if len(batch) < count:
+                break
+            limit -= count
+            marker = batch[-1][0]
 
     def merge_items(self, item_list, source=None):
         """
@@ -21,7 +21,8 @@ from swift import gettext_ as _
 from eventlet import Timeout
 
 import swift.common.db
-from swift.account.backend import AccountBroker, DATADIR
+from swift.account.backend import AccountBroker, DATADIR, \
+    make_container_record
 from swift.account.utils import account_listing_response, get_response_headers
 from swift.common.db import DatabaseConnectionError, DatabaseAlreadyExists
 from swift.common.request_helpers import get_param, get_listing_content_type, \
@@ -31,7 +32,7 @@ from swift.common.utils import get_logger, hash_path, public, \
     json, timing_stats, replication, get_log_line
 from swift.common.constraints import check_mount, valid_timestamp, check_utf8
 from swift.common import constraints
-from swift.common.db_replicator import ReplicatorRpc
+from swift.common.db_replicator import ReplicatorRpc, load_replicate_args
 from swift.common.base_storage_server import BaseStorageServer
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, \
     HTTPCreated, HTTPForbidden, HTTPInternalServerError, \
@@ -162,6 +163,68 @@ class AccountController(BaseStorageServer):
             else:
                 return HTTPAccepted(request=req)
 
+    @public
+    @timing_stats()
+    def UPDATE(self, req):
+        """
+        Handle HTTP UPDATE request: a JSON list of container rows to be
+        merged into the account in one go.  Used by container updaters to
+        batch up their reports.
+        """
+        drive, part, account = split_and_validate_path(req, 3)
+        if self.mount_check and not check_mount(self.root, drive):
+            return HTTPInsufficientStorage(drive=drive, request=req)
+        if 'x-timestamp' not in req.headers:
+            timestamp = Timestamp(time.time())
+        else:
+            timestamp = valid_timestamp(req)
+        container_policy_index = \
+            req.headers.get('X-Backend-Storage-Policy-Index', 0)
+        try:
+            items = json.load(req.environ['wsgi.input'])
+            if not isinstance(items, list):
+                raise ValueError('Expected a list of container rows')
+            items = [self._validate_update_item(item, container_policy_index)
+                     for item in items]
+        except (ValueError, TypeError, KeyError) as err:
+            return HTTPBadRequest(body=str(err), content_type='text/plain',
+                                  request=req)
+        broker = self._get_account_broker(drive, part, account)
+        if account.startswith(self.auto_create_account_prefix) and \
+                not os.path.exists(broker.db_file):
+            try:
+                broker.initialize(timestamp.internal)
+            except DatabaseAlreadyExists:
+                pass
+        if not os.path.exists(broker.db_file):
+            return HTTPNotFound(request=req)
+        if req.headers.get('x-account-override-deleted', 'no').lower() != \
+                'yes' and broker.is_deleted():
+            return HTTPNotFound(request=req)
+        if items:
+            broker.merge_items(items)
+        return HTTPAccepted(request=req)
+
+    def _validate_update_item(self, item, policy_index):
+        """
+        Check and normalize a container row from an UPDATE request body.
+
+        :param item: dict with the put_container arguments of a container
+        :param policy_index: storage policy index for rows without one
+        :returns: the container row to merge
+        :raises ValueError: if the row is not valid
+        """
+        name = item['name']
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if not name or '/' in name or not check_utf8(name):
+            raise ValueError('Invalid container name %r' % (name,))
+        return make_container_record(
+            name, Timestamp(item['put_timestamp']).internal,
+            Timestamp(item['delete_timestamp']).internal,
+            int(item['object_count']), int(item['bytes_used']),
+            int(item.get('storage_policy_index', policy_index)))
+
     @public
     @timing_stats()
     def HEAD(self, req):
@@ -226,7 +289,7 @@ class AccountController(BaseStorageServer):
         if self.mount_check and not check_mount(self.root, drive):
             return HTTPInsufficientStorage(drive=drive, request=req)
         try:
-            args = json.load(req.environ['wsgi.input'])
+            args = load_replicate_args(req)
         except ValueError as err:
             return HTTPBadRequest(body=str(err), content_type='text/plain')
         ret = self.replicator_rpc.dispatch(post_args, args)
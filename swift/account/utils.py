@@ -13,9 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import time
 from xml.sax import saxutils
 
+from swift.common.request_helpers import set_listing_body, \
+    LISTING_SERIALIZE_BATCH
 from swift.common.swob import HTTPOk, HTTPNoContent
 from swift.common.utils import json, Timestamp
 from swift.common.storage_policy import POLICIES
@@ -37,6 +40,9 @@ class FakeAccountBroker(object):
     def list_containers_iter(self, *_, **__):
         return []
 
+    def iter_containers(self, *_, **__):
+        return iter([])
+
     @property
     def metadata(self):
         return {}
@@ -68,6 +74,49 @@ def get_response_headers(broker):
     return resp_headers
 
 
+def _json_listing(account_list):
+    """
+    Serialize an account listing to JSON a batch of records at a time.
+
+    :param account_list: iterator of the records
+    """
+    yield '['
+    separator = ''
+    while True:
+        data = []
+        for (name, object_count, bytes_used, is_subdir) in \
+                itertools.islice(account_list, LISTING_SERIALIZE_BATCH):
+            if is_subdir:
+                data.append({'subdir': name})
+            else:
+                data.append({'name': name, 'count': object_count,
+                             'bytes': bytes_used})
+        if not data:
+            break
+        yield separator + json.dumps(data)[1:-1]
+        separator = ', '
+    yield ']'
+
+
+def _xml_listing(account, account_list):
+    """
+    Serialize an account listing to XML a record at a time.
+
+    :param account: name of the account
+    :param account_list: iterator of the records
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<account name=%s>\n' % saxutils.quoteattr(account)
+    for (name, object_count, bytes_used, is_subdir) in account_list:
+        if is_subdir:
+            yield '<subdir name=%s />\n' % saxutils.quoteattr(name)
+        else:
+            yield '<container><name>%s</name><count>%s</count>' \
+                '<bytes>%s</bytes></container>\n' % \
+                (saxutils.escape(name), object_count, bytes_used)
+    yield '</account>'
+
+
 def account_listing_response(account, req, response_content_type, broker=None,
                              limit='', marker='', end_marker='', prefix='',
                              delimiter=''):
@@ -76,39 +125,22 @@ def account_listing_response(account, req, response_content_type, broker=None,
 
     resp_headers = get_response_headers(broker)
 
-    account_list = broker.list_containers_iter(limit, marker, end_marker,
-                                               prefix, delimiter)
+    account_list = iter(broker.iter_containers(limit, marker, end_marker,
+                                               prefix, delimiter))
     if response_content_type == 'application/json':
-        data = []
-        for (name, object_count, bytes_used, is_subdir) in account_list:
-            if is_subdir:
-                data.append({'subdir': name})
-            else:
-                data.append({'name': name, 'count': object_count,
-                             'bytes': bytes_used})
-        account_list = json.dumps(data)
+        body = _json_listing(account_list)
     elif response_content_type.endswith('/xml'):
-        output_list = ['<?xml version="1.0" encoding="UTF-8"?>',
-                       '<account name=%s>' % saxutils.quoteattr(account)]
-        for (name, object_count, bytes_used, is_subdir) in account_list:
-            if is_subdir:
-                output_list.append(
-                    '<subdir name=%s />' % saxutils.quoteattr(name))
-            else:
-                item = '<container><name>%s</name><count>%s</count>' \
-                       '<bytes>%s</bytes></container>' % \
-                       (saxutils.escape(name), object_count, bytes_used)
-                output_list.append(item)
-        output_list.append('</account>')
-        account_list = '\n'.join(output_list)
+        body = _xml_listing(account, account_list)
     else:
-        if not account_list:
+        first = next(account_list, None)
+        if first is None:
             resp = HTTPNoContent(request=req, headers=resp_headers)
             resp.content_type = response_content_type
             resp.charset = 'utf-8'
             return resp
-        account_list = '\n'.join(r[0] for r in account_list) + '\n'
-    ret = HTTPOk(body=account_list, request=req, headers=resp_headers)
+        body = ('%s\n' % r[0] for r in itertools.chain([first], account_list))
+    ret = HTTPOk(request=req, headers=resp_headers)
+    set_listing_body(ret, body)
     ret.content_type = response_content_type
     ret.charset = 'utf-8'
     return ret
@@ -27,9 +27,11 @@ from time import time
 import optparse
 import math
 
+from array import array
 from swift.common import exceptions
 from swift.common.ring import RingBuilder, Ring
 from swift.common.ring.builder import MAX_BALANCE
+from swift.common.ring.ring import get_ring_format_version
 from swift.common.ring.utils import validate_args, \
     validate_and_normalize_ip, build_dev_from_opts, \
     parse_builder_ring_filename_args, parse_search_value, \
@@ -47,6 +49,28 @@ global argv, backup_dir, builder, builder_file, ring_file
 argv = backup_dir = builder = builder_file = ring_file = None
 
 
+def _add_format_version_option(parser):
+    parser.add_option('--format-version', type='choice', choices=['1', '2'],
+                      help='Ring file format to write: 1 is gzipped, 2 is '
+                      'uncompressed and can be memory mapped by servers. '
+                      'Defaults to the format of the existing ring file, '
+                      'or 1 if there is none.')
+
+
+def _ring_format_version(options):
+    """
+    Pick the format to write the ring file in.
+    """
+    if options.format_version:
+        return int(options.format_version)
+    if exists(ring_file):
+        try:
+            return max(get_ring_format_version(ring_file), 1)
+        except Exception:
+            pass
+    return 1
+
+
 def format_device(dev):
     """
     Format a device for display.
@@ -838,7 +862,9 @@ swift-ring-builder <builder_file> rebalance [options]
         parser.add_option('-s', '--seed', help="seed to use for rebalance")
         parser.add_option('-d', '--debug', action='store_true',
                           help="print debug information")
+        _add_format_version_option(parser)
         options, args = parser.parse_args(argv)
+        format_version = _ring_format_version(options)
 
         def get_seed(index):
             if options.seed:
@@ -922,9 +948,10 @@ swift-ring-builder <builder_file> rebalance [options]
             status = EXIT_WARNING
         ts = time()
         builder.get_ring().save(
-            pathjoin(backup_dir, '%d.' % ts + basename(ring_file)))
+            pathjoin(backup_dir, '%d.' % ts + basename(ring_file)),
+            format_version=format_version)
         builder.save(pathjoin(backup_dir, '%d.' % ts + basename(argv[1])))
-        builder.get_ring().save(ring_file)
+        builder.get_ring().save(ring_file, format_version=format_version)
         builder.save(argv[1])
         exit(status)
 
@@ -1016,12 +1043,17 @@ swift-ring-builder <builder_file> validate
 
     def write_ring():
         """
-swift-ring-builder <builder_file> write_ring
+swift-ring-builder <builder_file> write_ring [--format-version <version>]
     Just rewrites the distributable ring file. This is done automatically after
     a successful rebalance, so really this is only useful after one or more
     'set_info' calls when no rebalance is needed but you want to send out the
-    new device information.
+    new device information, or to change the ring file format.
         """
+        usage = Commands.write_ring.__doc__.strip()
+        parser = optparse.OptionParser(usage)
+        _add_format_version_option(parser)
+        options, args = parser.parse_args(argv)
+        format_version = _ring_format_version(options)
         ring_data = builder.get_ring()
         if not ring_data._replica2part2dev_id:
             if ring_data.devs:
@@ -1031,8 +1063,9 @@ swift-ring-builder <builder_file> write_ring
             else:
                 print 'Warning: Writing an empty ring'
         ring_data.save(
-            pathjoin(backup_dir, '%d.' % time() + basename(ring_file)))
-        ring_data.save(ring_file)
+            pathjoin(backup_dir, '%d.' % time() + basename(ring_file)),
+            format_version=format_version)
+        ring_data.save(ring_file, format_version=format_version)
         exit(EXIT_SUCCESS)
 
     def write_builder():
@@ -1067,7 +1100,9 @@ swift-ring-builder <ring_file> write_builder [min_part_hours]
             'devs': ring.devs,
             'devs_changed': False,
             'version': 0,
-            '_replica2part2dev': ring._replica2part2dev_id,
+            # copy, in case the rows are mapped from a version 2 ring file
+            '_replica2part2dev': [array('H', part2dev_id) for part2dev_id
+                                  in ring._replica2part2dev_id],
             '_last_part_moves_epoch': None,
             '_last_part_moves': None,
             '_last_part_gather_start': 0,
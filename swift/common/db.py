@@ -23,6 +23,8 @@ from uuid import uuid4
 import sys
 import time
 import errno
+import struct
+import zlib
 import cPickle as pickle
 from swift import gettext_ as _
 from tempfile import mkstemp
@@ -45,12 +47,209 @@ BROKER_TIMEOUT = 25
 PICKLE_PROTOCOL = 2
 #: Max number of pending entries
 PENDING_CAP = 131072
+#: Header of a binary .pending entry: a marker byte that never shows up in the
+#: base64 text of legacy, colon delimited entries, the pickle's length and the
+#: pickle's CRC32
+PENDING_HEADER = struct.Struct('!cII')
+PENDING_BINARY_MARKER = '\x00'
+#: Longest pickle a binary .pending entry may hold; longer ones are corrupt
+PENDING_MAX_ENTRY = 65536
+#: Bytes to read from a .pending file at a time when committing it
+PENDING_CHUNK_SIZE = 65536
+#: Max number of .pending entries to merge into the DB in one transaction
+PENDING_COMMIT_BATCH = 250
+#: Oldest sqlite with the recursive queries that get_rollup_query makes
+ROLLUP_MIN_SQLITE_VERSION = (3, 8, 3)
+#: Rows without a common prefix after which a delimiter listing goes back
+#: from get_rollup_query to a plain scan
+ROLLUP_MAX_PLAIN = 16
+#: Rows listed at a time by the streaming listings of the brokers
+LISTING_BATCH_SIZE = 1000
+
+
+def pack_pending_entry(entry):
+    """
+    Frame a pickle as a binary .pending entry.
+
+    :param entry: the pickle
+    :returns: the entry, ready to be appended to a .pending file
+    """
+    return PENDING_HEADER.pack(PENDING_BINARY_MARKER, len(entry),
+                               zlib.crc32(entry) & 0xffffffff) + entry
+
+
+def iter_pending_entries(fp, chunk_size=PENDING_CHUNK_SIZE, offset=0):
+    """
+    Read the entries of a .pending file a chunk at a time.  A .pending file
+    may hold both binary entries, a PENDING_HEADER then a pickle, and legacy
+    entries, a colon then a base64 encoded pickle.
+
+    A binary entry that is cut short, or whose length or checksum is wrong,
+    is skipped up to the next PENDING_BINARY_MARKER, so only that entry is
+    lost and not every one after it.
+
+    :param fp: .pending file opened for reading
+    :param chunk_size: number of bytes to read at a time
+    :param offset: position in the file that fp is reading from
+    :returns: iterator of (binary, entry, end) tuples; binary is True for a
+              pickle, False for the base64 text of a legacy entry and None
+              for the bytes of a corrupt binary entry, and end is the
+              position in the file just past the entry
+    """
+    buf = ''
+    pos = 0
+    # where the run of corrupt bytes being skipped started, if any
+    bad = None
+    while True:
+        chunk = fp.read(chunk_size)
+        buf += chunk
+        while pos < len(buf):
+            if buf[pos] == PENDING_BINARY_MARKER:
+                valid = False
+                if len(buf) - pos >= PENDING_HEADER.size:
+                    _junk, length, crc = PENDING_HEADER.unpack_from(buf, pos)
+                    end = pos + PENDING_HEADER.size + length
+                    if length > PENDING_MAX_ENTRY:
+                        pass
+                    elif end > len(buf):
+                        if chunk:
+                            break
+                    else:
+                        entry = buf[pos + PENDING_HEADER.size:end]
+                        valid = zlib.crc32(entry) & 0xffffffff == crc
+                elif chunk:
+                    break
+                if not valid:
+                    # try again from the next marker
+                    if bad is None:
+                        bad = pos
+                    pos = buf.find(PENDING_BINARY_MARKER, pos + 1)
+                    if pos < 0:
+                        pos = len(buf)
+                    continue
+                if bad is not None:
+                    yield None, buf[bad:pos], offset + pos
+                    bad = None
+                yield True, entry, offset + end
+            else:
+                # a legacy entry runs up to wherever the next entry starts
+                ends = [i for i in (buf.find(':', pos + 1),
+                                    buf.find(PENDING_BINARY_MARKER, pos + 1))
+                        if i >= 0]
+                if ends:
+                    end = min(ends)
+                elif chunk:
+                    break
+                else:
+                    end = len(buf)
+                entry = buf[pos:end]
+                if entry.startswith(':'):
+                    entry = entry[1:]
+                if entry:
+                    yield False, entry, offset + end
+            pos = end
+        keep = pos if bad is None else bad
+        buf = buf[keep:]
+        offset += keep
+        pos -= keep
+        if bad is not None:
+            bad = 0
+        if not chunk:
+            if bad is not None:
+                yield None, buf, offset + len(buf)
+            return
 
 
 def utf8encode(*args):
     return [(s.encode('utf8') if isinstance(s, unicode) else s) for s in args]
 
 
+def prefix_end_marker(prefix):
+    """
+    Get the end marker of a listing of names that start with prefix: the
+    smallest name that sorts after all of them.
+
+    :param prefix: a utf-8 encoded prefix
+    :returns: the end marker, or None if no name sorts after the prefix
+    """
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def can_rollup(delimiter):
+    """
+    Check if a listing with this delimiter can use get_rollup_query.
+
+    :param delimiter: a one byte delimiter
+    """
+    return sqlite3.sqlite_version_info >= ROLLUP_MIN_SQLITE_VERSION and \
+        0 < ord(delimiter) < 127
+
+
+def get_rollup_query(table, columns, where, marker_op, has_end_marker):
+    """
+    Build a delimiter listing query that finds each row with a recursive
+    skip-scan: after a name with the delimiter past the prefix, the next
+    name looked for is the first one after everything under that name's
+    common prefix.  A page of common prefixes is a single query, rather than
+    a query for each of them.
+
+    The first row under each common prefix stands in for it.  Seeking row by
+    row is slower than a plain scan, so the query stops after :max_plain
+    rows in a row without a common prefix, as well as after :limit rows or
+    the last row.  Named parameters:
+
+        * marker: where the listing starts, compared with marker_op
+        * end_marker: names must be less than this, if has_end_marker
+        * prefix, delimiter: as for the listing; delimiter is one ascii byte
+        * after_delimiter: the byte after the delimiter
+        * after_name: '\\x01', which comes right after a name
+        * min_end: delimiters at an offset less than this into a name do not
+          make a common prefix
+        * max_plain: max number of rows in a row without a common prefix
+        * limit: max number of rows
+        * plus any used in where
+
+    :param table: table to list, with a name column
+    :param columns: list of columns of table to return
+    :param where: SQL condition on rows of table that may be listed
+    :param marker_op: '>' or '>='
+    :param has_end_marker: whether to limit names by end_marker
+    :returns: the SQL query
+    """
+    bound = ' AND name < :end_marker' if has_end_marker else ''
+    # position of the delimiter in rollup.name past the prefix, 1 based
+    found = 'instr(substr(rollup.name, length(:prefix) + 1), :delimiter)'
+    common = '%s > 0 AND length(:prefix) + %s - 1 >= :min_end' % (
+        found, found)
+    return '''
+        WITH RECURSIVE rollup(name, plain) AS (
+            SELECT (SELECT name FROM %(table)s
+                    WHERE %(where)s AND name %(op)s :marker%(bound)s
+                    ORDER BY name LIMIT 1), 0
+            UNION ALL
+            SELECT (SELECT name FROM %(table)s
+                    WHERE %(where)s AND name >= CASE WHEN %(common)s
+                        THEN substr(rollup.name, 1,
+                                    length(:prefix) + %(found)s - 1) ||
+                            :after_delimiter
+                        ELSE rollup.name || :after_name END%(bound)s
+                    ORDER BY name LIMIT 1),
+                CASE WHEN %(common)s THEN 0 ELSE rollup.plain + 1 END
+            FROM rollup WHERE rollup.name IS NOT NULL AND
+                (%(common)s OR rollup.plain + 1 < :max_plain)
+            LIMIT :limit)
+        SELECT %(columns)s FROM rollup CROSS JOIN %(table)s
+        ON %(table)s.name = rollup.name
+        WHERE %(where)s ORDER BY %(table)s.name
+    ''' % {'table': table, 'where': where, 'op': marker_op, 'bound': bound,
+           'found': found, 'common': common,
+           'columns': ', '.join('%s.%s' % (table, column)
+                                for column in columns)}
+
+
 def utf8encodekeys(metadata):
     uni_keys = [k for k in metadata if isinstance(k, unicode)]
     for k in uni_keys:
@@ -201,6 +400,7 @@ class DatabaseBroker(object):
         self.conn = None
         self.db_file = db_file
         self.pending_file = self.db_file + '.pending'
+        self.pending_checkpoint_file = self.pending_file + '.checkpoint'
         self.pending_timeout = pending_timeout or 10
         self.stale_reads_ok = stale_reads_ok
         self.db_dir = os.path.dirname(db_file)
@@ -298,6 +498,7 @@ class DatabaseBroker(object):
                     raise DatabaseAlreadyExists(self.db_file)
                 renamer(tmp_db_file, self.db_file)
             self.conn = get_db_connection(self.db_file, self.timeout)
+            self.mark_dirty()
         else:
             self.conn = conn
 
@@ -316,6 +517,15 @@ class DatabaseBroker(object):
         with self.get() as conn:
             self._delete_db(conn, timestamp)
             conn.commit()
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        """
+        Called after changes that may need reporting to the DB's parent, such
+        as its timestamps or, once merged, its rows.  The default
+        implementation does nothing.
+        """
+        pass
 
     def possibly_quarantine(self, exc_type, exc_value, exc_traceback):
         """
@@ -469,6 +679,7 @@ class DatabaseBroker(object):
                 self._update_status_changed_at(conn, timestamp.internal)
 
             conn.commit()
+        self.mark_dirty()
 
     def get_items_since(self, start, count):
         """
@@ -486,6 +697,25 @@ class DatabaseBroker(object):
             curs.row_factory = dict_factory
             return [r for r in curs]
 
+    def get_item_rows_since(self, start, count):
+        """
+        Like :meth:`get_items_since`, but gives the rows as they come from
+        the cursor rather than as dicts, which is cheaper to build and to
+        encode for large batches.
+
+        :param start: start ROWID
+        :param count: number to get
+        :returns: tuple of (list of column names, list of row tuples)
+        """
+        self._commit_puts_stale_ok()
+        with self.get() as conn:
+            curs = conn.execute('''
+                SELECT * FROM %s WHERE ROWID > ? ORDER BY ROWID ASC LIMIT ?
+            ''' % self.db_contains_type, (start, count))
+            curs.row_factory = None
+            rows = curs.fetchall()
+            return [col[0] for col in curs.description], rows
+
     def get_sync(self, id, incoming=True):
         """
         Gets the most recent sync point for a server from the sync table.
@@ -569,71 +799,158 @@ class DatabaseBroker(object):
             if pending_size > PENDING_CAP:
                 self._commit_puts([record])
             else:
+                entry = pickle.dumps(self.make_tuple_for_pickle(record),
+                                     protocol=PICKLE_PROTOCOL)
                 with open(self.pending_file, 'a+b') as fp:
-                    # Colons aren't used in base64 encoding; so they are our
-                    # delimiter
-                    fp.write(':')
-                    fp.write(pickle.dumps(
-                        self.make_tuple_for_pickle(record),
-                        protocol=PICKLE_PROTOCOL).encode('base64'))
+                    fp.write(pack_pending_entry(entry))
                     fp.flush()
+                if not pending_size:
+                    # later records are committed along with this one
+                    self.mark_dirty()
 
-    def _commit_puts(self, item_list=None):
+    def _commit_puts(self, item_list=None, max_batches=None):
         """
         Scan for .pending files and commit the found records by feeding them
         to merge_items(). Assume that lock_parent_directory has already been
         called.
 
+        Records are merged PENDING_COMMIT_BATCH at a time, so no one
+        transaction holds the DB for long.  How far into the .pending file
+        the merged records go is saved after each batch; should the commit
+        not finish, the next one picks up from there.
+
         :param item_list: A list of items to commit in addition to .pending
+        :param max_batches: if given, stop after merging this many full
+                            batches, leaving the rest of the .pending file
+                            for a later commit
+        :returns: True if the .pending file is fully committed
         """
         if self.db_file == ':memory:' or not os.path.exists(self.pending_file):
-            return
+            return True
         if item_list is None:
             item_list = []
         self._preallocate()
         if not os.path.getsize(self.pending_file):
             if item_list:
                 self.merge_items(item_list)
-            return
+            return True
         with open(self.pending_file, 'r+b') as fp:
-            for entry in fp.read().split(':'):
-                if entry:
-                    try:
-                        self._commit_puts_load(item_list, entry)
-                    except Exception:
-                        self.logger.exception(
-                            _('Invalid pending entry %(file)s: %(entry)s'),
-                            {'file': self.pending_file, 'entry': entry})
-            if item_list:
-                self.merge_items(item_list)
+            offset = self._get_pending_checkpoint()
+            checkpointed = offset is not None
+            offset = offset or 0
+            fp.seek(offset)
+            batch = []
+            for binary, entry, end in iter_pending_entries(fp, offset=offset):
+                try:
+                    if binary:
+                        batch.append(self.make_record_from_pickle(
+                            pickle.loads(entry)))
+                    elif binary is None:
+                        raise ValueError('Corrupt pending entry')
+                    else:
+                        self._commit_puts_load(batch, entry)
+                except Exception:
+                    self.logger.exception(
+                        _('Invalid pending entry %(file)s: %(entry)r'),
+                        {'file': self.pending_file, 'entry': entry})
+                if len(batch) >= PENDING_COMMIT_BATCH:
+                    self.merge_items(batch)
+                    batch = []
+                    self._set_pending_checkpoint(end)
+                    checkpointed = True
+                    if max_batches is not None:
+                        max_batches -= 1
+                        if max_batches <= 0:
+                            return False
+                    sleep()
+            batch.extend(item_list)
+            if batch:
+                self.merge_items(batch)
+            if checkpointed:
+                # every record is in the DB; the checkpoint has to go before
+                # the records it counted, or it would skip later records
+                self._set_pending_checkpoint(None)
             try:
                 os.ftruncate(fp.fileno(), 0)
             except OSError as err:
                 if err.errno != errno.ENOENT:
                     raise
+        return True
+
+    def _get_pending_checkpoint(self):
+        """
+        Get how far into the .pending file records were merged by a commit
+        that did not finish.
+
+        :returns: offset into the .pending file to commit records from, or
+                  None if there is no checkpoint
+        """
+        try:
+            with open(self.pending_checkpoint_file, 'rb') as fp:
+                offset = int(fp.read())
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            return 0
+        if 0 <= offset <= os.path.getsize(self.pending_file):
+            return offset
+        return 0
+
+    def _set_pending_checkpoint(self, offset):
+        """
+        Save how far into the .pending file records have been merged.
+
+        :param offset: offset into the .pending file, or None to remove the
+                       checkpoint
+        """
+        if offset is None:
+            try:
+                os.unlink(self.pending_checkpoint_file)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            return
+        with open(self.pending_checkpoint_file, 'wb') as fp:
+            fp.write(str(offset))
+            fp.flush()
+            os.fsync(fp.fileno())
 
     def _commit_puts_stale_ok(self):
         """
         Catch failures of _commit_puts() if broker is intended for
         reading of stats, and thus does not care for pending updates.
+
+        The .pending lock is only held for one batch of records at a time,
+        so writers appending to the .pending file and other readers get a
+        turn in between.  Once past what was pending when the commit began,
+        the rest is committed under one lock, so busy writers can not keep
+        the commit going forever.
         """
         if self.db_file == ':memory:' or not os.path.exists(self.pending_file):
             return
         try:
-            with lock_parent_directory(self.pending_file,
-                                       self.pending_timeout):
-                self._commit_puts()
+            pending_size = os.path.getsize(self.pending_file)
+            while True:
+                with lock_parent_directory(self.pending_file,
+                                           self.pending_timeout):
+                    offset = self._get_pending_checkpoint() or 0
+                    if self._commit_puts(
+                            max_batches=1 if offset < pending_size else None):
+                        break
+                sleep()
         except LockTimeout:
             if not self.stale_reads_ok:
                 raise
 
     def _commit_puts_load(self, item_list, entry):
         """
-        Unmarshall the :param:entry and append it to :param:item_list.
-        This is implemented by a particular broker to be compatible
-        with its :func:`merge_items`.
+        Unmarshall the :param:entry, the base64 text of a legacy pending
+        pickle, and append it to :param:item_list.
         """
-        raise NotImplementedError
+        item_list.append(self.make_record_from_pickle(
+            pickle.loads(entry.decode('base64'))))
 
     def make_tuple_for_pickle(self, record):
         """
@@ -642,6 +959,14 @@ class DatabaseBroker(object):
         """
         raise NotImplementedError
 
+    def make_record_from_pickle(self, data):
+        """
+        Turn a tuple from a pending pickle back into a db record dict.
+        This is implemented by a particular broker to be compatible
+        with its :func:`merge_items`.
+        """
+        raise NotImplementedError
+
     def merge_syncs(self, sync_points, incoming=True):
         """
         Merge a list of sync points with the incoming sync table.
@@ -869,6 +1194,7 @@ class DatabaseBroker(object):
                 ' WHERE put_timestamp < ?' % self.db_type,
                 (timestamp, timestamp))
             conn.commit()
+        self.mark_dirty()
 
     def update_status_changed_at(self, timestamp):
         """
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import os
 import random
 import math
@@ -20,11 +21,15 @@ import time
 import shutil
 import uuid
 import errno
+import heapq
 import re
+import struct
+import zlib
 from contextlib import contextmanager
 from swift import gettext_ as _
 
 from eventlet import GreenPool, sleep, Timeout
+from eventlet.semaphore import Semaphore
 from eventlet.green import subprocess
 
 import swift.common.db
@@ -34,16 +39,26 @@ from swift.common.utils import get_logger, whataremyips, storage_directory, \
     unlink_older_than, dump_recon_cache, rsync_ip, ismount, json, Timestamp
 from swift.common import ring
 from swift.common.ring.utils import is_local_device
-from swift.common.http import HTTP_NOT_FOUND, HTTP_INSUFFICIENT_STORAGE
+from swift.common.http import HTTP_NOT_FOUND, HTTP_INSUFFICIENT_STORAGE, \
+    HTTP_BAD_REQUEST, is_success
 from swift.common.bufferedhttp import BufferedHTTPConnection
 from swift.common.exceptions import DriveNotMounted
 from swift.common.daemon import Daemon
 from swift.common.swob import Response, HTTPNotFound, HTTPNoContent, \
-    HTTPAccepted, HTTPBadRequest
+    HTTPAccepted, HTTPBadRequest, HTTPConflict
 
 
 DEBUG_TIMINGS_THRESHOLD = 10
 
+#: Content-Type of REPLICATE requests whose body is a stream of frames; see
+#: :func:`encode_frame`
+FRAMED_CONTENT_TYPE = 'application/x-swift-replicate-frames'
+#: Largest compressed frame a server will read
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+#: zlib level frames are compressed with; rows compress well even at the
+#: fastest level
+FRAME_COMPRESS_LEVEL = 1
+
 
 def quarantine_db(object_file, server_type):
     """
@@ -110,6 +125,73 @@ def roundrobin_datadirs(datadirs):
                 its.remove(it)
 
 
+def encode_frame(obj):
+    """
+    Encode an object as a frame of a framed REPLICATE request body: its
+    zlib-compressed JSON, after the length of that as a 4-byte big-endian
+    integer.
+
+    :param obj: json-encodable object
+    :returns: the frame as a string
+    """
+    data = zlib.compress(json.dumps(obj), FRAME_COMPRESS_LEVEL)
+    return struct.pack('!I', len(data)) + data
+
+
+def _read_exactly(fp, size):
+    data = ''
+    while len(data) < size:
+        chunk = fp.read(size - len(data))
+        if not chunk:
+            raise ValueError('Frame truncated')
+        data += chunk
+    return data
+
+
+def iter_frames(fp):
+    """
+    Decode the frames of a framed REPLICATE request body, one at a time as
+    they are read.
+
+    :param fp: file-like object to read the body from
+    :returns: generator of the decoded objects
+    :raises ValueError: if a frame is not valid
+    """
+    while True:
+        header = fp.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            header += _read_exactly(fp, 4 - len(header))
+        size = struct.unpack('!I', header)[0]
+        if size > MAX_FRAME_SIZE:
+            raise ValueError('Frame of %d bytes is too big' % size)
+        try:
+            yield json.loads(zlib.decompress(_read_exactly(fp, size)))
+        except zlib.error as err:
+            raise ValueError('Invalid frame: %s' % err)
+
+
+def load_replicate_args(req):
+    """
+    Get the args of a REPLICATE request, as taken by
+    :meth:`ReplicatorRpc.dispatch`.  A framed body gives the args in its
+    first frame, followed by an iterator of the rest of its frames.
+
+    :param req: swob.Request
+    :returns: list of args
+    :raises ValueError: if the body is not valid
+    """
+    if req.headers.get('Content-Type') != FRAMED_CONTENT_TYPE:
+        return json.load(req.environ['wsgi.input'])
+    frames = iter_frames(req.environ['wsgi.input'])
+    for args in frames:
+        if not isinstance(args, list):
+            raise ValueError('Expected a list of args')
+        return args + [frames]
+    raise ValueError('No args')
+
+
 class ReplConnection(BufferedHTTPConnection):
     """
     Helper to simplify REPLICATEing to a remote server.
@@ -143,6 +225,36 @@ class ReplConnection(BufferedHTTPConnection):
                 _('ERROR reading HTTP response from %s'), self.node)
             return None
 
+    def replicate_framed(self, args, frames, timeout=None):
+        """
+        Make a framed HTTP REPLICATE request: the args and then each frame
+        are sent as they come, without waiting on a response in between.
+
+        :param args: list of json-encodable args
+        :param frames: iterable of frames, as made by :func:`encode_frame`
+        :param timeout: seconds to wait on each send and on the response
+
+        :returns: bufferedhttp response object
+        """
+        try:
+            with Timeout(timeout):
+                self.putrequest('REPLICATE', self.path)
+                self.putheader('Content-Type', FRAMED_CONTENT_TYPE)
+                self.putheader('Transfer-Encoding', 'chunked')
+                self.endheaders()
+            for frame in itertools.chain([encode_frame(args)], frames):
+                with Timeout(timeout):
+                    self.send('%x\r\n%s\r\n' % (len(frame), frame))
+            with Timeout(timeout):
+                self.send('0\r\n\r\n')
+                response = self.getresponse()
+                response.data = response.read()
+            return response
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('ERROR reading HTTP response from %s'), self.node)
+            return None
+
 
 class Replicator(Daemon):
     """
@@ -155,13 +267,34 @@ class Replicator(Daemon):
         self.root = conf.get('devices', '/srv/node')
         self.mount_check = config_true_value(conf.get('mount_check', 'true'))
         self.port = int(conf.get('bind_port', self.default_port))
-        concurrency = int(conf.get('concurrency', 8))
-        self.cpool = GreenPool(size=concurrency)
+        self.concurrency = int(conf.get('concurrency', 8))
+        self.cpool = GreenPool(size=self.concurrency)
+        self.per_device_concurrency = int(
+            conf.get('per_device_concurrency', 0))
+        self.full_sweep_interval = float(conf.get('full_sweep_interval',
+                                                  3600))
+        self.priority_window = max(1, int(conf.get('priority_window', 1000)))
+        self.last_full_sweep = 0
+        self._full_sweep = True
+        # number of full sweeps begun; entries below are tagged with it so
+        # the ones for dbs that have gone can be dropped after a full sweep
+        self._sweep = 0
+        # db file -> (sweep, hash of stat key and primary node ids, hash of
+        # primary node ids and sync args) as of the last time the db synced
+        # with all of its peers
+        self._synced = {}
+        # db file -> sweep, for dbs that failed to sync with one of their
+        # peers
+        self._failed = {}
         swift_dir = conf.get('swift_dir', '/etc/swift')
         self.ring = ring.Ring(swift_dir, ring_name=self.server_type)
         self._local_device_ids = set()
         self.per_diff = int(conf.get('per_diff', 1000))
         self.max_diffs = int(conf.get('max_diffs') or 100)
+        self.stream_diffs = config_true_value(conf.get('stream_diffs', 'no'))
+        self.sync_method = conf.get('sync_method') or 'rsync'
+        if self.sync_method not in ('rsync', 'http'):
+            raise ValueError('Unknown sync_method: %s' % self.sync_method)
         self.interval = int(conf.get('interval') or
                             conf.get('run_pause') or 30)
         self.vm_test_mode = config_true_value(conf.get('vm_test_mode', 'no'))
@@ -184,7 +317,8 @@ class Replicator(Daemon):
         self.stats = {'attempted': 0, 'success': 0, 'failure': 0, 'ts_repl': 0,
                       'no_change': 0, 'hashmatch': 0, 'rsync': 0, 'diff': 0,
                       'remove': 0, 'empty': 0, 'remote_merge': 0,
-                      'start': time.time(), 'diff_capped': 0}
+                      'start': time.time(), 'diff_capped': 0, 'skip': 0,
+                      'snapshot': 0}
 
     def _report_stats(self):
         """Report the current stats to the logs."""
@@ -207,7 +341,7 @@ class Replicator(Daemon):
         self.logger.info(' '.join(['%s:%s' % item for item in
                          self.stats.items() if item[0] in
                          ('no_change', 'hashmatch', 'rsync', 'diff', 'ts_repl',
-                          'empty', 'diff_capped')]))
+                          'empty', 'diff_capped', 'skip', 'snapshot')]))
 
     def _rsync_file(self, db_file, remote_file, whole_file=True):
         """
@@ -266,7 +400,63 @@ class Replicator(Daemon):
             response = http.replicate(replicate_method, local_id)
         return response and response.status >= 200 and response.status < 300
 
-    def _usync_db(self, point, broker, http, remote_id, local_id):
+    def _snapshot_db(self, broker, device, http, info):
+        """
+        Sync a whole db over HTTP rather than rsync.  The rows up to the
+        db's max_row are streamed in one framed REPLICATE request, in
+        compressed batches of per_diff rows and then the sync table, and the
+        remote builds a new db from them.  The remote keeps what it merged of
+        a snapshot that was cut short, and the next one picks up from there.
+
+        Falls back to :meth:`_rsync_db` if the remote does not take
+        snapshots.
+
+        :param broker: DB broker object of DB to be synced
+        :param device: device to sync to
+        :param http: ReplConnection object
+        :param info: replication info of the DB to be synced
+
+        :returns: boolean indicating completion and success
+        """
+        self.stats['snapshot'] += 1
+        self.logger.increment('snapshots')
+        with Timeout(self.node_timeout):
+            response = http.replicate('snapshot_point', info['id'])
+        if not response:
+            return False
+        point = -1
+        if is_success(response.status):
+            point = json.loads(response.data)['point']
+            self.logger.debug('Resuming snapshot to %s at %s',
+                              http.host, point)
+        sync_table = broker.get_syncs()
+
+        def frames():
+            start = point
+            while start < info['max_row']:
+                columns, rows = broker.get_item_rows_since(
+                    start, self.per_diff)
+                if not rows:
+                    break
+                yield encode_frame([columns, rows])
+                start = rows[-1][columns.index('ROWID')]
+            yield encode_frame({'syncs': sync_table})
+
+        response = http.replicate_framed(
+            ['merge_snapshot', info['id'], info], frames(),
+            timeout=self.node_timeout)
+        if response and response.status in (HTTP_BAD_REQUEST,
+                                            HTTP_NOT_FOUND):
+            # servers from before snapshots can't parse the body or don't
+            # know the op
+            self.logger.debug('Snapshot refused by %s; rsyncing', http.host)
+            self.stats['rsync'] += 1
+            self.logger.increment('rsyncs')
+            return self._rsync_db(broker, device, http, info['id'])
+        return self._check_response(http, response)
+
+    def _usync_db(self, point, broker, http, remote_id, local_id,
+                  capped=True):
         """
         Sync a db by sending all records since the last sync.
 
@@ -275,6 +465,8 @@ class Replicator(Daemon):
         :param http: ReplConnection object for the remote server
         :param remote_id: database id for the remote replica
         :param local_id: database id for the local replica
+        :param capped: if False, all the records are streamed in one framed
+                       request rather than up to max_diffs batches
 
         :returns: boolean indicating completion and success
         """
@@ -283,24 +475,15 @@ class Replicator(Daemon):
         self.logger.debug('Syncing chunks with %s, starting at %s',
                           http.host, point)
         sync_table = broker.get_syncs()
-        objects = broker.get_items_since(point, self.per_diff)
-        diffs = 0
-        while len(objects) and diffs < self.max_diffs:
-            diffs += 1
-            with Timeout(self.node_timeout):
-                response = http.replicate('merge_items', objects, local_id)
-            if not response or response.status >= 300 or response.status < 200:
-                if response:
-                    self.logger.error(_('ERROR Bad response %(status)s from '
-                                        '%(host)s'),
-                                      {'status': response.status,
-                                       'host': http.host})
-                return False
-            # replication relies on db order to send the next merge batch in
-            # order with no gaps
-            point = objects[-1]['ROWID']
-            objects = broker.get_items_since(point, self.per_diff)
-        if objects:
+        if self.stream_diffs or not capped:
+            sent = self._send_framed_diffs(point, broker, http, local_id,
+                                           capped)
+        else:
+            sent = self._send_diffs(point, broker, http, local_id)
+        if not sent:
+            return False
+        point, caught_up = sent
+        if not caught_up:
             self.logger.debug(
                 'Synchronization for %s has fallen more than '
                 '%s rows behind; moving on and will try again next pass.',
@@ -317,6 +500,82 @@ class Replicator(Daemon):
                 return True
         return False
 
+    def _check_response(self, http, response):
+        """
+        :returns: True if the response is a success, otherwise logs it and
+                  returns False
+        """
+        if not response or response.status >= 300 or response.status < 200:
+            if response:
+                self.logger.error(_('ERROR Bad response %(status)s from '
+                                    '%(host)s'),
+                                  {'status': response.status,
+                                   'host': http.host})
+            return False
+        return True
+
+    def _send_diffs(self, point, broker, http, local_id):
+        """
+        Send the records since point to the remote, a REPLICATE request for
+        each batch of per_diff records, up to max_diffs batches.
+
+        :returns: tuple of (last ROWID sent, whether all records were sent),
+                  or None if a request failed
+        """
+        objects = broker.get_items_since(point, self.per_diff)
+        diffs = 0
+        while len(objects) and diffs < self.max_diffs:
+            diffs += 1
+            with Timeout(self.node_timeout):
+                response = http.replicate('merge_items', objects, local_id)
+            if not self._check_response(http, response):
+                return None
+            # replication relies on db order to send the next merge batch in
+            # order with no gaps
+            point = objects[-1]['ROWID']
+            objects = broker.get_items_since(point, self.per_diff)
+        return point, not objects
+
+    def _send_framed_diffs(self, point, broker, http, local_id, capped=True):
+        """
+        Send the records since point to the remote in one framed REPLICATE
+        request, with a compressed frame of rows for each batch of per_diff
+        records, up to max_diffs batches unless not capped.  Batches are
+        read from the DB as the request is sent and merged by the remote as
+        they arrive, so no batch waits on a round trip for the one before
+        it.
+
+        Falls back to :meth:`_send_diffs` if the remote does not take framed
+        requests.
+
+        :returns: tuple of (last ROWID sent, whether all records were sent),
+                  or None if the request failed
+        """
+        progress = {'point': point, 'caught_up': True}
+
+        def frames():
+            batches = xrange(self.max_diffs) if capped else itertools.count()
+            for _junk in batches:
+                columns, rows = broker.get_item_rows_since(
+                    progress['point'], self.per_diff)
+                if not rows:
+                    return
+                yield encode_frame([columns, rows])
+                progress['point'] = rows[-1][columns.index('ROWID')]
+            progress['caught_up'] = not broker.get_item_rows_since(
+                progress['point'], 1)[1]
+
+        response = http.replicate_framed(['merge_item_rows', local_id],
+                                         frames(), timeout=self.node_timeout)
+        if response and response.status == HTTP_BAD_REQUEST:
+            # servers from before framed requests can't parse the body
+            self.logger.debug('Framed sync refused by %s; sending batches '
+                              'one at a time', http.host)
+            return self._send_diffs(point, broker, http, local_id)
+        if not self._check_response(http, response):
+            return None
+        return progress['point'], progress['caught_up']
+
     def _in_sync(self, rinfo, info, broker, local_sync):
         """
         Determine whether or not two replicas of a databases are considered
@@ -386,6 +645,8 @@ class Replicator(Daemon):
 
     def _handle_sync_response(self, node, response, info, broker, http):
         if response.status == HTTP_NOT_FOUND:  # completely missing, rsync
+            if self.sync_method == 'http':
+                return self._snapshot_db(broker, node, http, info)
             self.stats['rsync'] += 1
             self.logger.increment('rsyncs')
             return self._rsync_db(broker, node, http, info['id'])
@@ -397,8 +658,13 @@ class Replicator(Daemon):
             if self._in_sync(rinfo, info, broker, local_sync):
                 return True
             # if the difference in rowids between the two differs by
-            # more than 50%, rsync then do a remote merge.
+            # more than 50%, rsync then do a remote merge, or stream every
+            # row that's missing in one go.
             if rinfo['max_row'] / float(info['max_row']) < 0.5:
+                if self.sync_method == 'http':
+                    return self._usync_db(max(rinfo['point'], local_sync),
+                                          broker, http, rinfo['id'],
+                                          info['id'], capped=False)
                 self.stats['remote_merge'] += 1
                 self.logger.increment('remote_merges')
                 return self._rsync_db(broker, node, http, info['id'],
@@ -434,6 +700,9 @@ class Replicator(Daemon):
             broker = self.brokerclass(object_file, pending_timeout=30)
             broker.reclaim(now - self.reclaim_age,
                            now - (self.reclaim_age * 2))
+            # stat before reading, so any change made after the read shows
+            # up in the stat of the next pass
+            stat_key = self._stat_key(object_file)
             info = broker.get_replication_info()
             bpart = self.ring.get_part(
                 info['account'], info.get('container'))
@@ -456,6 +725,7 @@ class Replicator(Daemon):
                 self.logger.exception(_('ERROR reading db %s'), object_file)
             self.stats['failure'] += 1
             self.logger.increment('failures')
+            self._failed[object_file] = self._sweep
             return
         # The db is considered deleted if the delete_timestamp value is greater
         # than the put_timestamp, and there are no objects.
@@ -472,6 +742,19 @@ class Replicator(Daemon):
         nodes = self.ring.get_part_nodes(int(partition))
         if shouldbehere:
             shouldbehere = bool([n for n in nodes if n['id'] == node_id])
+        node_ids = tuple(n['id'] for n in nodes)
+        synced = self._synced.get(object_file)
+        if shouldbehere and not self._full_sweep and \
+                object_file not in self._failed and synced and \
+                synced[2] == hash((node_ids, self._gather_sync_args(info))):
+            # nothing has changed that the peers need since it last synced
+            # with all of them
+            self._synced[object_file] = (
+                synced[0], hash((stat_key, node_ids)), synced[2])
+            self.stats['skip'] += 1
+            self.logger.increment('skips')
+            self.logger.timing_since('timing', start_time)
+            return
         # See Footnote [1] for an explanation of the repl_nodes assignment.
         i = 0
         while i < len(nodes) and nodes[i]['id'] != node_id:
@@ -497,12 +780,132 @@ class Replicator(Daemon):
         except (Exception, Timeout):
             self.logger.exception('UNHANDLED EXCEPTION: in post replicate '
                                   'hook for %s', broker.db_file)
+        if all(responses):
+            self._failed.pop(object_file, None)
+            if shouldbehere:
+                self._record_synced(broker, info, node_ids)
+        else:
+            self._failed[object_file] = self._sweep
         if not shouldbehere and all(responses):
             # If the db shouldn't be on this node and has been successfully
             # synced to all of its peers, it can be removed.
             self.delete_db(broker)
         self.logger.timing_since('timing', start_time)
 
+    def _stat_key(self, object_file):
+        """
+        Get a key that changes whenever a DB or its .pending file is written
+        to, without opening the DB.
+        """
+        key = []
+        for path in (object_file, object_file + '.pending'):
+            try:
+                st = os.stat(path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                key.append(None)
+            else:
+                key.append((st.st_mtime, st.st_size))
+        return tuple(key)
+
+    def _record_synced(self, broker, info, node_ids):
+        """
+        Note that a DB synced with all of its peers, unless it changed while
+        it was syncing.
+
+        :param broker: DB broker of the DB
+        :param info: replication info the DB was synced with
+        :param node_ids: ids of the primary nodes of the DB
+        """
+        self._synced.pop(broker.db_file, None)
+        try:
+            sync_args = self._gather_sync_args(info)
+            stat_key = self._stat_key(broker.db_file)
+            new_info = broker.get_replication_info()
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR reading db %s'), broker.db_file)
+            return
+        if self._gather_sync_args(new_info) == sync_args:
+            # only hashes are kept, as there is an entry for every db
+            self._synced[broker.db_file] = (
+                self._sweep, hash((stat_key, node_ids)),
+                hash((node_ids, sync_args)))
+
+    def _prioritize(self, partition, object_file, node_id):
+        """
+        Get where a DB goes in the replication queue of its device.
+
+        :param partition: partition of the DB
+        :param object_file: DB file name
+        :param node_id: node id of the device the DB is on
+        :returns: 0 for DBs that failed to sync last time or are on handoff
+                  devices, 1 for DBs that changed since they last synced
+                  with all their peers, 2 for the rest, or None if the DB
+                  need not be replicated this pass
+        """
+        if object_file in self._failed:
+            return 0
+        try:
+            node_ids = tuple(
+                n['id'] for n in self.ring.get_part_nodes(int(partition)))
+        except ValueError:
+            return 0
+        if node_id not in node_ids:
+            return 0
+        synced = self._synced.get(object_file)
+        if not synced or \
+                synced[1] != hash((self._stat_key(object_file), node_ids)):
+            return 1
+        if self._full_sweep:
+            return 2
+        return None
+
+    def _replicate_device(self, datadir, node_id, semaphore):
+        """
+        Replicate the DBs on a device as it is walked, using workers from
+        the shared pool.  The DBs are queued in order of priority, but only
+        priority_window of them at a time, so replication starts before the
+        walk ends and the queue stays small.
+
+        :param datadir: path to the device's datadir
+        :param node_id: node id of the device
+        :param semaphore: semaphore limiting the DBs on the device replicated
+                          at once, so a slow device doesn't hold up all the
+                          workers
+        """
+        queue = []
+        order = itertools.count()
+
+        def replicate(part, object_file, node_id):
+            try:
+                self._replicate_object(part, object_file, node_id)
+            finally:
+                semaphore.release()
+
+        def replicate_next():
+            _junk, _junk, part, object_file, node_id = heapq.heappop(queue)
+            semaphore.acquire()
+            self.cpool.spawn_n(replicate, part, object_file, node_id)
+
+        for part, object_file, node_id in roundrobin_datadirs(
+                [(datadir, node_id)]):
+            try:
+                priority = self._prioritize(part, object_file, node_id)
+            except (Exception, Timeout):
+                self.logger.exception(_('ERROR checking db %s'), object_file)
+                priority = 0
+            if priority is None:
+                self.stats['skip'] += 1
+                self.logger.increment('skips')
+                continue
+            heapq.heappush(queue, (priority, order.next(), part, object_file,
+                                   node_id))
+            if len(queue) >= self.priority_window:
+                replicate_next()
+        while queue:
+            replicate_next()
+
     def delete_db(self, broker):
         object_file = broker.db_file
         hash_dir = os.path.dirname(object_file)
@@ -559,11 +962,35 @@ class Replicator(Daemon):
                 if os.path.isdir(datadir):
                     self._local_device_ids.add(node['id'])
                     dirs.append((datadir, node['id']))
-        self.logger.info(_('Beginning replication run'))
-        for part, object_file, node_id in roundrobin_datadirs(dirs):
-            self.cpool.spawn_n(
-                self._replicate_object, part, object_file, node_id)
+        begin = time.time()
+        self._full_sweep = \
+            begin - self.last_full_sweep >= self.full_sweep_interval
+        if self._full_sweep:
+            self.logger.info(_('Beginning replication run'))
+        else:
+            self.logger.info(_('Beginning replication run of changed dbs'))
+        if self._full_sweep:
+            self._sweep += 1
+        # every device draws on the same pool of workers, but only takes
+        # its share of them
+        concurrency = min(self.concurrency, self.per_device_concurrency or
+                          max(1, self.concurrency // max(1, len(dirs))))
+        device_pool = GreenPool(size=max(1, len(dirs)))
+        for datadir, node_id in dirs:
+            device_pool.spawn_n(self._replicate_device, datadir, node_id,
+                                Semaphore(concurrency))
+        device_pool.waitall()
         self.cpool.waitall()
+        if self._full_sweep:
+            self.last_full_sweep = begin
+            # a full sweep replicates every db, so the entries it didn't
+            # touch are for dbs that have gone
+            for object_file in [f for f, v in self._synced.iteritems()
+                                if v[0] != self._sweep]:
+                del self._synced[object_file]
+            for object_file in [f for f, v in self._failed.iteritems()
+                                if v != self._sweep]:
+                del self._failed[object_file]
         self.logger.info(_('Replication run OVER'))
         self._report_stats()
 
@@ -606,6 +1033,10 @@ class ReplicatorRpc(object):
                                hsh + '.db')
         if op == 'rsync_then_merge':
             return self.rsync_then_merge(drive, db_file, args)
+        if op == 'snapshot_point':
+            return self.snapshot_point(drive, db_file, args)
+        if op == 'merge_snapshot':
+            return self.merge_snapshot(drive, db_file, args)
         if op == 'complete_rsync':
             return self.complete_rsync(drive, db_file, args)
         else:
@@ -709,6 +1140,21 @@ class ReplicatorRpc(object):
         broker.merge_items(args[0], args[1])
         return HTTPAccepted()
 
+    def merge_item_rows(self, broker, args):
+        """
+        Merge the frames of rows of a framed REPLICATE request, each as it is
+        read, so the sync point advances with every frame merged.
+        """
+        try:
+            local_id, frames = args
+            for columns, rows in frames:
+                if rows:
+                    broker.merge_items(
+                        [dict(zip(columns, row)) for row in rows], local_id)
+        except (ValueError, TypeError, KeyError) as err:
+            return HTTPBadRequest(body=str(err))
+        return HTTPAccepted()
+
     def complete_rsync(self, drive, db_file, args):
         old_filename = os.path.join(self.root, drive, 'tmp', args[0])
         if os.path.exists(db_file):
@@ -737,6 +1183,88 @@ class ReplicatorRpc(object):
         renamer(old_filename, db_file)
         return HTTPNoContent()
 
+    def _snapshot_file(self, drive, remote_id):
+        return os.path.join(self.root, drive, 'tmp', remote_id + '.snapshot')
+
+    def snapshot_point(self, drive, db_file, args):
+        """
+        Get the last row merged of a snapshot of a remote db that was cut
+        short, for the next snapshot to start after.
+        """
+        snapshot_file = self._snapshot_file(drive, args[0])
+        if not os.path.exists(snapshot_file):
+            return HTTPNotFound()
+        broker = self.broker_class(snapshot_file)
+        return Response(json.dumps({'point': broker.get_sync(args[0])}))
+
+    def merge_snapshot(self, drive, db_file, args):
+        """
+        Build a db from the frames of a framed REPLICATE request of rows from
+        a remote db, ended by a frame of its sync table, and move it into
+        place.  The db is built in the device's tmp dir, where it is kept if
+        the request is cut short.  If the db was made while the snapshot was
+        streamed, the snapshot's rows are merged into it instead.
+        """
+        if os.path.exists(db_file):
+            return HTTPConflict()
+        try:
+            remote_id, info, frames = args
+            broker = self.broker_class(
+                self._snapshot_file(drive, remote_id),
+                account=info['account'], container=info.get('container'))
+            if not os.path.exists(broker.db_file):
+                broker.initialize(info['put_timestamp'],
+                                  info.get('storage_policy_index'))
+            for frame in frames:
+                if isinstance(frame, dict):
+                    sync_table = frame['syncs']
+                    break
+                columns, rows = frame
+                if rows:
+                    broker.merge_items(
+                        [dict(zip(columns, row)) for row in rows], remote_id)
+            else:
+                return HTTPBadRequest(body='Snapshot ended early')
+        except (ValueError, TypeError, KeyError) as err:
+            return HTTPBadRequest(body=str(err))
+        broker.merge_syncs(sync_table)
+        broker.merge_timestamps(info['created_at'], info['put_timestamp'],
+                                info['delete_timestamp'])
+        if info['metadata']:
+            broker.update_metadata(json.loads(info['metadata']))
+        # the same lock DatabaseBroker.initialize makes a db under
+        with lock_parent_directory(db_file, broker.pending_timeout):
+            exists = os.path.exists(db_file)
+            if not exists:
+                renamer(broker.db_file, db_file)
+        existing_broker = self.broker_class(db_file)
+        if exists:
+            self._merge_snapshot_into(broker, existing_broker, info)
+            os.unlink(broker.db_file)
+        # the snapshot was built where no dirty journal is kept
+        existing_broker.mark_dirty()
+        return HTTPNoContent()
+
+    def _merge_snapshot_into(self, broker, existing_broker, info):
+        """
+        Merge the rows and sync points of a snapshot into a db that was made
+        while it was streamed, rather than replace the db and any rows merged
+        into it since.
+        """
+        point = -1
+        objects = broker.get_items_since(point, 1000)
+        while len(objects):
+            existing_broker.merge_items(objects)
+            point = objects[-1]['ROWID']
+            objects = broker.get_items_since(point, 1000)
+            sleep()
+        existing_broker.merge_syncs(broker.get_syncs())
+        existing_broker.merge_timestamps(
+            info['created_at'], info['put_timestamp'],
+            info['delete_timestamp'])
+        if info['metadata']:
+            existing_broker.update_metadata(json.loads(info['metadata']))
+
 # Footnote [1]:
 #   This orders the nodes so that, given nodes a b c, a will contact b then c,
 # b will contact c then a, and c will contact a then b -- in other words, each
@@ -260,6 +260,45 @@ def direct_delete_container_object(node, part, account, container, obj,
                                     node, part, path, resp)
 
 
+def direct_update_container(node, part, account, container, items,
+                            conn_timeout=5, response_timeout=15,
+                            headers=None):
+    """
+    Merge a batch of object rows into a container with one UPDATE request.
+
+    :param node: node dictionary from the ring
+    :param part: partition the container is on
+    :param account: account name
+    :param container: container name
+    :param items: list of object row dicts, each with the keys name,
+                  created_at, size, content_type, etag and deleted, and
+                  optionally storage_policy_index
+    :param conn_timeout: timeout in seconds for establishing the connection
+    :param response_timeout: timeout in seconds for getting the response
+    :param headers: additional headers to include in the request
+    """
+    if headers is None:
+        headers = {}
+
+    have_x_timestamp = 'x-timestamp' in (k.lower() for k in headers)
+    body = json.dumps(items)
+    headers = gen_headers(headers, add_ts=(not have_x_timestamp))
+    headers['Content-Type'] = 'application/json'
+    headers['Content-Length'] = str(len(body))
+
+    path = '/%s/%s' % (account, container)
+    with Timeout(conn_timeout):
+        conn = http_connect(node['ip'], node['port'], node['device'], part,
+                            'UPDATE', path, headers=headers)
+    with Timeout(response_timeout):
+        conn.send(body)
+        resp = conn.getresponse()
+        resp.read()
+    if not is_success(resp.status):
+        raise DirectClientException('Container', 'UPDATE',
+                                    node, part, path, resp)
+
+
 def direct_head_object(node, part, account, container, obj, conn_timeout=5,
                        response_timeout=15, headers=None):
     """
@@ -31,11 +31,17 @@ from swift.common.constraints import FORMAT2CONTENT_TYPE
 from swift.common.exceptions import ListingIterError, SegmentError
 from swift.common.http import is_success
 from swift.common.swob import (HTTPBadRequest, HTTPNotAcceptable,
-                               HTTPServiceUnavailable)
+                               HTTPServiceUnavailable, HeaderKeyDict)
 from swift.common.utils import split_path, validate_device_partition
 from swift.common.wsgi import make_subrequest
 
 
+#: Bytes of a listing body that are sent at a time; see set_listing_body
+LISTING_CHUNK_SIZE = 65536
+#: Records of a listing that the servers serialize at a time
+LISTING_SERIALIZE_BATCH = 1000
+
+
 def get_param(req, name, default=None):
     """
     Get parameters from an HTTP request ensuring proper handling UTF-8
@@ -249,6 +255,77 @@ def copy_header_subset(from_r, to_r, condition):
             to_r.headers[k] = v
 
 
+def get_container_update_row(op, obj, headers):
+    """
+    Translate the headers of a container update for an object into the
+    object row it would leave in the container, as taken by a container
+    server's UPDATE verb.
+
+    :param op: the method of the container update (PUT or DELETE)
+    :param obj: the object name
+    :param headers: the headers of the container update
+    :returns: an object row dict, or None if the update cannot be sent as
+              a row
+    """
+    headers = HeaderKeyDict(headers)
+    try:
+        if op == 'PUT':
+            row = {'name': obj, 'created_at': headers['x-timestamp'],
+                   'size': int(headers['x-size']),
+                   'content_type': headers['x-content-type'],
+                   'etag': headers['x-etag'], 'deleted': 0}
+        elif op == 'DELETE':
+            row = {'name': obj, 'created_at': headers['x-timestamp'],
+                   'size': 0, 'content_type': 'application/deleted',
+                   'etag': 'noetag', 'deleted': 1}
+        else:
+            return None
+        row['storage_policy_index'] = int(headers.get(
+            'X-Backend-Storage-Policy-Index', 0))
+    except (KeyError, ValueError):
+        return None
+    return row
+
+
+def iter_listing_chunks(parts, chunk_size=LISTING_CHUNK_SIZE):
+    """
+    Join up the strings of a listing body into chunks of at least chunk_size
+    bytes, bar the last one.
+
+    :param parts: iterable of strings
+    :param chunk_size: number of bytes to gather before yielding them
+    """
+    buf = []
+    buffered = 0
+    for part in parts:
+        buf.append(part)
+        buffered += len(part)
+        if buffered >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+    yield ''.join(buf)
+
+
+def set_listing_body(resp, parts, chunk_size=LISTING_CHUNK_SIZE):
+    """
+    Give a response a listing body made of the strings in parts.  A body of
+    less than chunk_size is set whole, with a Content-Length; a longer one
+    is sent on as the parts come, a chunk at a time, rather than being built
+    up first.
+
+    :param resp: a swob.Response
+    :param parts: iterable of strings
+    :param chunk_size: number of bytes to send at a time
+    """
+    chunks = iter_listing_chunks(parts, chunk_size)
+    first = next(chunks)
+    if len(first) < chunk_size:
+        resp.body = first
+    else:
+        resp.app_iter = itertools.chain([first], chunks)
+
+
 def close_if_possible(maybe_closable):
     close_method = getattr(maybe_closable, 'close', None)
     if callable(close_method):
@@ -19,11 +19,13 @@ import errno
 import itertools
 import logging
 import math
+import operator
 import random
 import cPickle as pickle
 
 from array import array
 from collections import defaultdict
+from hashlib import md5
 from time import time
 
 from swift.common import exceptions
@@ -33,6 +35,14 @@ from swift.common.ring.utils import tiers_for_dev, build_tier_tree, \
 
 MAX_BALANCE = 999.99
 
+try:
+    # python 2.7+
+    from itertools import compress
+except ImportError:
+    # python 2.6
+    def compress(data, selectors):
+        return (d for d, s in itertools.izip(data, selectors) if s)
+
 
 try:
     # python 2.7+
@@ -44,6 +54,30 @@ except ImportError:
             pass
 
 
+def _replica2part2dev_checksum(replica2part2dev):
+    checksum = md5()
+    for part2dev in replica2part2dev:
+        checksum.update('%d:' % len(part2dev))
+        checksum.update(part2dev.tostring())
+    return checksum.hexdigest()
+
+
+def _count_dev_ids(replica2part2dev):
+    """
+    Count how many times each device id appears in some replica2part2dev
+    style arrays.
+
+    :returns: list where the item at index dev_id is the count for dev_id
+    """
+    counts = [0] * (max(max(part2dev) + 1 if part2dev else 0
+                        for part2dev in replica2part2dev) if replica2part2dev
+                    else 0)
+    for part2dev in replica2part2dev:
+        for dev_id in part2dev:
+            counts[dev_id] += 1
+    return counts
+
+
 class RingBuilder(object):
     """
     Used to build swift.common.ring.RingData instances to be written to disk
@@ -104,6 +138,9 @@ class RingBuilder(object):
 
         self._dispersion_graph = {}
         self.dispersion = 0.0
+        # what _build_dispersion_graph needs to recount only the partitions
+        # a rebalance moves
+        self._dispersion_state = None
         self._remove_devs = []
         self._ring = None
 
@@ -150,6 +187,7 @@ class RingBuilder(object):
             self._last_part_moves = builder._last_part_moves
             self._last_part_gather_start = builder._last_part_gather_start
             self._remove_devs = builder._remove_devs
+            self._dispersion_state = None
         else:
             self.part_power = builder['part_power']
             self.replicas = builder['replicas']
@@ -165,6 +203,7 @@ class RingBuilder(object):
             self._last_part_gather_start = builder['_last_part_gather_start']
             self._dispersion_graph = builder.get('_dispersion_graph', {})
             self.dispersion = builder.get('dispersion')
+            self._dispersion_state = builder.get('_dispersion_state')
             self._remove_devs = builder['_remove_devs']
         self._ring = None
 
@@ -194,6 +233,7 @@ class RingBuilder(object):
                 '_last_part_gather_start': self._last_part_gather_start,
                 '_dispersion_graph': self._dispersion_graph,
                 'dispersion': self.dispersion,
+                '_dispersion_state': self._dispersion_state,
                 '_remove_devs': self._remove_devs}
 
     def change_min_part_hours(self, min_part_hours):
@@ -434,61 +474,212 @@ class RingBuilder(object):
             old_replica2part2dev if provided
         """
 
-        # Since we're going to loop over every replica of every part we'll
-        # also count up changed_parts if old_replica2part2dev is passed in
-        old_replica2part2dev = old_replica2part2dev or []
-        # Compare the partition allocation before and after the rebalance
-        # Only changed device ids are taken into account; devices might be
-        # "touched" during the rebalance, but actually not really moved
-        changed_parts = 0
-
+        # The graph is built a replica at a time from whole arrays (see
+        # _count_dispersion) instead of part by part. After a rebalance, the
+        # state saved along with the previous graph lets just the moved
+        # partitions be recounted, as long as it still matches the ring.
         int_replicas = int(math.ceil(self.replicas))
         max_allowed_replicas = self._build_max_replicas_by_tier()
-        parts_at_risk = 0
-
-        tfd = {}
+        max_replicas = dict(max_allowed_replicas)
+        tfd = dict((dev['id'], tiers_for_dev(dev))
+                   for dev in self._iter_devs())
 
-        dispersion_graph = {}
-        # go over all the devices holding each replica part by part
-        for part_id, dev_ids in enumerate(
-                itertools.izip(*self._replica2part2dev)):
-            # count the number of replicas of this part for each tier of each
-            # device, some devices may have overlapping tiers!
-            replicas_at_tier = defaultdict(int)
-            for rep_id, dev in enumerate(iter(
-                    self.devs[dev_id] for dev_id in dev_ids)):
-                if dev['id'] not in tfd:
-                    tfd[dev['id']] = tiers_for_dev(dev)
-                for tier in tfd[dev['id']]:
-                    replicas_at_tier[tier] += 1
-                # IndexErrors will be raised if the replicas are increased or
-                # decreased, and that actually means the partition has changed
-                try:
-                    old_device = old_replica2part2dev[rep_id][part_id]
-                except IndexError:
-                    changed_parts += 1
-                    continue
+        changed_parts = 0
+        moved_parts = set()
+        old_replica2part2dev = old_replica2part2dev or []
+        for replica, part2dev in enumerate(self._replica2part2dev):
+            if replica >= len(old_replica2part2dev):
+                changed_parts += len(part2dev)
+                moved_parts.update(xrange(len(part2dev)))
+                continue
+            old_part2dev = old_replica2part2dev[replica]
+            moved = list(compress(itertools.count(),
+                                  itertools.imap(operator.ne, part2dev,
+                                                 old_part2dev)))
+            changed_parts += len(moved) + max(
+                0, len(part2dev) - len(old_part2dev))
+            moved_parts.update(moved)
+            moved_parts.update(xrange(min(len(part2dev), len(old_part2dev)),
+                                      max(len(part2dev), len(old_part2dev))))
+        for old_part2dev in old_replica2part2dev[
+                len(self._replica2part2dev):]:
+            moved_parts.update(xrange(len(old_part2dev)))
+
+        state = self._dispersion_state
+        if (state and old_replica2part2dev and
+                len(old_replica2part2dev) == int_replicas and
+                state['checksum'] == _replica2part2dev_checksum(
+                    old_replica2part2dev) and
+                state['max_replicas'] == max_replicas and
+                all(state['tiers'].get(dev_id, tiers) == tiers
+                    for dev_id, tiers in tfd.iteritems())):
+            dispersion_graph = dict(
+                (tier, list(replica_counts))
+                for tier, replica_counts in self._dispersion_graph.items())
+            parts = sorted(moved_parts)
+            old_tfd = dict(state['tiers'])
+            old_tfd.update(tfd)
+            old_counts, _junk = self._count_dispersion(
+                old_replica2part2dev, parts, old_tfd, max_allowed_replicas)
+            counts, at_risk = self._count_dispersion(
+                self._replica2part2dev, parts, tfd, max_allowed_replicas)
+            for tier, replica_counts in old_counts.iteritems():
+                graph = dispersion_graph[tier]
+                for replicas, count in enumerate(replica_counts):
+                    graph[replicas] -= count
+            for tier, replica_counts in counts.iteritems():
+                graph = dispersion_graph.setdefault(tier, [0] * (
+                    int_replicas + 1))
+                for replicas, count in enumerate(replica_counts):
+                    graph[replicas] += count
+            at_risk.update(set(state['at_risk']) - moved_parts)
+            for tier, graph in dispersion_graph.items():
+                graph[0] = self.parts - sum(graph[1:])
+                if graph[0] == self.parts:
+                    del dispersion_graph[tier]
+        else:
+            counts, at_risk = self._count_dispersion(
+                self._replica2part2dev, None, tfd, max_allowed_replicas)
+            dispersion_graph = {}
+            for tier, replica_counts in counts.iteritems():
+                dispersion_graph[tier] = [self.parts - sum(replica_counts)] + \
+                    replica_counts[1:]
 
-                if old_device != dev['id']:
-                    changed_parts += 1
-            part_at_risk = False
-            # update running totals for each tiers' number of parts with a
-            # given replica count
-            for tier, replicas in replicas_at_tier.items():
-                if tier not in dispersion_graph:
-                    dispersion_graph[tier] = [self.parts] + [0] * int_replicas
-                dispersion_graph[tier][0] -= 1
-                dispersion_graph[tier][replicas] += 1
-                if replicas > max_allowed_replicas[tier]:
-                    part_at_risk = True
-            # this part may be at risk in multiple tiers, but we only count it
-            # as at_risk once
-            if part_at_risk:
-                parts_at_risk += 1
         self._dispersion_graph = dispersion_graph
-        self.dispersion = 100.0 * parts_at_risk / self.parts
+        self.dispersion = 100.0 * len(at_risk) / self.parts
+        self._dispersion_state = {
+            'checksum': _replica2part2dev_checksum(self._replica2part2dev),
+            'max_replicas': max_replicas,
+            'tiers': tfd,
+            'at_risk': array('I', sorted(at_risk)),
+        }
         return changed_parts
 
+    def _count_dispersion(self, replica2part2dev, parts, tfd,
+                          max_allowed_replicas):
+        """
+        Count how many of the given partitions have each number of replicas
+        in every tier, and find the ones with more replicas in some tier than
+        it should have.
+
+        Rather than walking the partitions one by one, each replica's
+        assignment is translated into tier numbers with map(), the replicas
+        in each tier are summed up from the replicas on each device, and
+        partitions with more than one replica in the same tier are found by
+        comparing whole replicas pairwise. Only those partitions are counted
+        individually, grouped by the tiers their replicas are in; there are
+        either few of them or few distinct groups of them.
+
+        :param replica2part2dev: the assignment to count
+        :param parts: sorted list of partitions to count, or None for all
+        :param tfd: dict of device id to tiers_for_dev() of the device, for
+                    every device in replica2part2dev
+        :param max_allowed_replicas: result of _build_max_replicas_by_tier()
+        :returns: a tuple of (counts, at_risk); counts maps every tier with
+                  replicas of the partitions in it to a list where
+                  counts[tier][n] is how many partitions have n replicas in
+                  the tier (counts[tier][0] is always 0), and at_risk is the
+                  set of partitions at risk
+        """
+        replica_count = len(replica2part2dev)
+        if parts is None:
+            num_parts = self.parts
+            columns = replica2part2dev
+        else:
+            num_parts = len(parts)
+            columns = []
+            for part2dev in replica2part2dev:
+                if len(part2dev) == self.parts:
+                    columns.append(map(part2dev.__getitem__, parts))
+                else:
+                    # parts is sorted, so the partitions missing this
+                    # replica all come at the end
+                    columns.append([part2dev[part] for part in parts
+                                    if part < len(part2dev)])
+
+        dev_replicas = dict((dev_id, replicas) for dev_id, replicas
+                            in enumerate(_count_dev_ids(columns)) if replicas)
+        counts = {}
+        at_risk = set()
+        if not dev_replicas:
+            return counts, at_risk
+        for depth in xrange(1, max(len(tfd[d]) for d in dev_replicas) + 1):
+            # number the tiers at this depth; missing replicas get numbers
+            # of their own that never match anything
+            tier_list = []
+            tier_numbers = {}
+            dev2tier = {}
+            for dev_id in dev_replicas:
+                tier = tfd[dev_id][depth - 1]
+                if tier not in tier_numbers:
+                    tier_numbers[tier] = len(tier_list)
+                    tier_list.append(tier)
+                dev2tier[dev_id] = tier_numbers[tier]
+            num_tiers = len(tier_list)
+            tier_columns = []
+            for replica, column in enumerate(columns):
+                tier_column = map(dev2tier.__getitem__, column)
+                tier_column.extend(
+                    [num_tiers + replica] * (num_parts - len(tier_column)))
+                tier_columns.append(tier_column)
+
+            tier_replicas = [0] * num_tiers
+            for dev_id, replicas in dev_replicas.iteritems():
+                tier_replicas[dev2tier[dev_id]] += replicas
+            # a tier may not allow even one replica (no weight)
+            no_room = set(number for number, tier in enumerate(tier_list)
+                          if max_allowed_replicas[tier] < 1)
+            if no_room:
+                for tier_column in tier_columns:
+                    at_risk.update(compress(
+                        itertools.count(),
+                        itertools.imap(no_room.__contains__, tier_column)))
+
+            # partitions with more than one replica in the same tier
+            crowded = set()
+            for i in xrange(replica_count):
+                for j in xrange(i + 1, replica_count):
+                    crowded.update(compress(
+                        itertools.count(),
+                        itertools.imap(operator.eq, tier_columns[i],
+                                       tier_columns[j])))
+            crowded = sorted(crowded)
+            placements = zip(*[map(tier_column.__getitem__, crowded)
+                               for tier_column in tier_columns])
+            sorted_placements = sorted(placements)
+            crowded_replicas = defaultdict(lambda: [0] * (replica_count + 1))
+            risky_placements = set()
+            for placement in set(placements):
+                num_crowded = (
+                    bisect.bisect_right(sorted_placements, placement) -
+                    bisect.bisect_left(sorted_placements, placement))
+                for number in set(placement):
+                    if number >= num_tiers:
+                        continue
+                    replicas = placement.count(number)
+                    if replicas > max_allowed_replicas[tier_list[number]]:
+                        risky_placements.add(placement)
+                    if replicas > 1:
+                        crowded_replicas[number][replicas] += num_crowded
+                        # the parts were all counted as single replicas
+                        crowded_replicas[number][1] -= replicas * num_crowded
+            if risky_placements:
+                at_risk.update(compress(crowded, itertools.imap(
+                    risky_placements.__contains__, placements)))
+
+            for number, tier in enumerate(tier_list):
+                replica_counts = [0] * (replica_count + 1)
+                replica_counts[1] = tier_replicas[number]
+                if number in crowded_replicas:
+                    for replicas, count in enumerate(
+                            crowded_replicas[number]):
+                        replica_counts[replicas] += count
+                counts[tier] = replica_counts
+
+        if parts is not None:
+            at_risk = set(parts[i] for i in at_risk)
+        return counts, at_risk
+
     def validate(self, stats=False):
         """
         Validate the ring.
@@ -525,13 +716,15 @@ class RingBuilder(object):
             # dev_usage[dev_id] will equal the number of partitions assigned to
             # that device.
             dev_usage = array('I', (0 for _junk in xrange(dev_len)))
-            for part2dev in self._replica2part2dev:
-                for dev_id in part2dev:
-                    dev_usage[dev_id] += 1
+            for dev_id, count in enumerate(
+                    _count_dev_ids(self._replica2part2dev)[:dev_len]):
+                dev_usage[dev_id] = count
 
-        for part, replica in self._each_part_replica():
-            dev_id = self._replica2part2dev[replica][part]
-            if dev_id >= dev_len or not self.devs[dev_id]:
+        for replica, part2dev in enumerate(self._replica2part2dev):
+            unallocated = [dev_id for dev_id in set(part2dev)
+                           if dev_id >= dev_len or not self.devs[dev_id]]
+            if unallocated:
+                part = min(part2dev.index(dev_id) for dev_id in unallocated)
                 raise exceptions.RingValidationError(
                     "Partition %d, replica %d was not allocated "
                     "to a device." %
@@ -781,21 +974,17 @@ class RingBuilder(object):
         # as a hot-spot).
         tfd = {}
 
-        tiers_by_len = defaultdict(set)
+        tiers_by_parent = defaultdict(set)
         for dev in self._iter_devs():
             tiers = tiers_for_dev(dev)
             tfd[dev['id']] = tiers
             for tier in tiers:
-                tiers_by_len[len(tier)].add(tier)
-
-        tiers_by_len = dict((length, list(tiers))
-                            for length, tiers in tiers_by_len.items())
+                tiers_by_parent[tier[:-1]].add(tier)
 
         sibling_tiers = {}
-        for length, tiers in tiers_by_len.items():
-            for i, tier in enumerate(tiers):
-                sibling_tiers[tier] = [t for t in (tiers[:i] + tiers[(i + 1):])
-                                       if t[:-1] == tier[:-1]]
+        for tiers in tiers_by_parent.values():
+            for tier in tiers:
+                sibling_tiers[tier] = [t for t in tiers if t != tier]
 
         # First we gather partitions from removed devices. Since removed
         # devices usually indicate device failures, we have no choice but to
@@ -803,7 +992,7 @@ class RingBuilder(object):
         # choices will skip other replicas of the same partition if possible.
         removed_dev_parts = defaultdict(list)
         if self._remove_devs:
-            dev_ids = [d['id'] for d in self._remove_devs if d['parts']]
+            dev_ids = set(d['id'] for d in self._remove_devs if d['parts'])
             if dev_ids:
                 for part, replica in self._each_part_replica():
                     dev_id = self._replica2part2dev[replica][part]
@@ -819,12 +1008,31 @@ class RingBuilder(object):
         spread_out_parts = defaultdict(list)
         max_allowed_replicas = self._build_max_replicas_by_tier()
         wanted_parts_for_tier = self._get_available_parts()
+        dispersion_checks = self._dispersion_checks(tfd, max_allowed_replicas)
         moved_parts = 0
-        for part in xrange(self.parts):
+        for part, dev_ids in enumerate(
+                itertools.izip_longest(*self._replica2part2dev)):
             # Only move one replica at a time if possible.
             if part in removed_dev_parts:
                 continue
 
+            # Most partitions are already spread out well enough; rule
+            # those out cheaply before counting replicas tier by tier.
+            # Partitions missing a partial replica just get counted.
+            for tier_index, max_replicas in dispersion_checks:
+                if None in dev_ids:
+                    break
+                tiers = map(tier_index.__getitem__, dev_ids)
+                if None in tiers:
+                    break
+                if max_replicas == 1:
+                    if len(set(tiers)) < len(tiers):
+                        break
+                elif max(map(tiers.count, tiers)) > max_replicas:
+                    break
+            else:
+                continue
+
             # First, add up the count of replicas at each tier for each
             # partition.
             # replicas_at_tier was a "lambda: 0" defaultdict, but profiling
@@ -906,7 +1114,11 @@ class RingBuilder(object):
         start += random.randint(0, self.parts / 2)  # GRAH PEP8!!!
 
         self._last_part_gather_start = start
+        overweight_dev_ids = set(dev['id'] for dev in self._iter_devs()
+                                 if dev['parts_wanted'] < 0)
         for replica, part2dev in enumerate(self._replica2part2dev):
+            if not overweight_dev_ids:
+                break
             # If we've got a partial replica, start may be out of
             # range. Scale it down so that we get a similar movement
             # pattern (but scaled down) on sequential runs.
@@ -914,19 +1126,22 @@ class RingBuilder(object):
 
             for part in itertools.chain(xrange(this_start, len(part2dev)),
                                         xrange(0, this_start)):
+                if part2dev[part] not in overweight_dev_ids:
+                    continue
                 if self._last_part_moves[part] < self.min_part_hours:
                     continue
                 if part in removed_dev_parts or part in spread_out_parts:
                     continue
                 dev = self.devs[part2dev[part]]
-                if dev['parts_wanted'] < 0:
-                    self._last_part_moves[part] = 0
-                    dev['parts_wanted'] += 1
-                    dev['parts'] -= 1
-                    reassign_parts[part].append(replica)
-                    self.logger.debug(
-                        "Gathered %d/%d from dev %d [weight]",
-                        part, replica, dev['id'])
+                self._last_part_moves[part] = 0
+                dev['parts_wanted'] += 1
+                dev['parts'] -= 1
+                reassign_parts[part].append(replica)
+                self.logger.debug(
+                    "Gathered %d/%d from dev %d [weight]",
+                    part, replica, dev['id'])
+                if dev['parts_wanted'] >= 0:
+                    overweight_dev_ids.discard(dev['id'])
 
         reassign_parts.update(spread_out_parts)
         reassign_parts.update(removed_dev_parts)
@@ -963,12 +1178,25 @@ class RingBuilder(object):
                                replicas_to_replace may be shared for multiple
                                partitions, so be sure you do not modify it.
         """
-        fudge_available_in_tier = defaultdict(int)
-        parts_available_in_tier = defaultdict(int)
+        # Tiers are numbered, with the root tier () as 0, so the per-tier
+        # counters and the tier tree can live in flat lists instead of
+        # dicts keyed by tier tuples; dev['tiers'] holds the numbers of
+        # tiers_for_dev(dev).
+        tier_numbers = {(): 0}
+        tier2parent = [None]
         for dev in self._iter_devs():
             dev['sort_key'] = self._sort_key_for(dev)
-            tiers = tiers_for_dev(dev)
-            dev['tiers'] = tiers
+            tiers = []
+            for tier in tiers_for_dev(dev):
+                if tier not in tier_numbers:
+                    tier_numbers[tier] = len(tier2parent)
+                    tier2parent.append(tier_numbers[tier[:-1]])
+                tiers.append(tier_numbers[tier])
+            dev['tiers'] = tuple(tiers)
+
+        fudge_available_in_tier = [0] * len(tier2parent)
+        parts_available_in_tier = [0] * len(tier2parent)
+        for dev in self._iter_devs():
             # Note: this represents how many partitions may be assigned to a
             # given tier (region/zone/server/disk). It does not take into
             # account how many partitions a given tier wants to shed.
@@ -984,7 +1212,7 @@ class RingBuilder(object):
             fudge = max(int(math.ceil(
                 (dev['parts_wanted'] + dev['parts']) * self.overload)),
                 0)
-            for tier in tiers:
+            for tier in dev['tiers']:
                 fudge_available_in_tier[tier] += (wanted + fudge)
                 parts_available_in_tier[tier] += wanted
 
@@ -992,22 +1220,23 @@ class RingBuilder(object):
             sorted((d for d in self._iter_devs() if d['weight']),
                    key=lambda x: x['sort_key'])
 
-        tier2devs = defaultdict(list)
-        tier2sort_key = defaultdict(tuple)
-        tier2dev_sort_key = defaultdict(list)
+        # A tier's sort key is the sort key of its hungriest drive; only
+        # the device tiers need to map back to the drive itself.
+        tier2dev = {}
+        tier2sort_key = [()] * len(tier2parent)
+        tier2children_sets = defaultdict(set)
         max_tier_depth = 0
         for dev in available_devs:
+            tier2dev[dev['tiers'][-1]] = dev
             for tier in dev['tiers']:
-                tier2devs[tier].append(dev)  # <-- starts out sorted!
-                tier2dev_sort_key[tier].append(dev['sort_key'])
-                tier2sort_key[tier] = dev['sort_key']
-                if len(tier) > max_tier_depth:
-                    max_tier_depth = len(tier)
+                tier2sort_key[tier] = dev['sort_key']  # <-- sorted devs!
+                tier2children_sets[tier2parent[tier]].add(tier)
+            if len(dev['tiers']) > max_tier_depth:
+                max_tier_depth = len(dev['tiers'])
 
-        tier2children_sets = build_tier_tree(available_devs)
         tier2children = defaultdict(list)
         tier2children_sort_key = {}
-        tiers_list = [()]
+        tiers_list = [0]
         depth = 1
         while depth <= max_tier_depth:
             new_tiers_list = []
@@ -1025,20 +1254,19 @@ class RingBuilder(object):
             # Gather up what other tiers (regions, zones, ip/ports, and
             # devices) the replicas not-to-be-moved are in for this part.
             other_replicas = defaultdict(int)
-            occupied_tiers_by_tier_len = defaultdict(set)
             for replica in self._replicas_for_part(part):
                 if replica not in replace_replicas:
                     dev = self.devs[self._replica2part2dev[replica][part]]
                     for tier in dev['tiers']:
                         other_replicas[tier] += 1
-                        occupied_tiers_by_tier_len[len(tier)].add(tier)
 
             for replica in replace_replicas:
                 # Find a new home for this replica
-                tier = ()
+                tier = 0
                 depth = 1
                 while depth <= max_tier_depth:
                     roomiest_tier = fudgiest_tier = None
+                    roomiest_replicas = fudgiest_replicas = None
                     # Order the tiers by how many replicas of this
                     # partition they already have. Then, of the ones
                     # with the smallest number of replicas and that have
@@ -1061,97 +1289,76 @@ class RingBuilder(object):
                     # This used to be a cute, recursive function, but it's been
                     # unrolled for performance.
 
-                    # We sort the tiers here so that, when we look for a tier
-                    # with the lowest number of replicas, the first one we
-                    # find is the one with the hungriest drive (i.e. drive
-                    # with the largest sort_key value). This lets us
-                    # short-circuit the search while still ensuring we get the
-                    # right tier.
-                    candidates_with_replicas = \
-                        occupied_tiers_by_tier_len[len(tier) + 1]
-
-                    # Among the tiers with room for more partitions,
-                    # find one with the smallest possible number of
-                    # replicas already in it, breaking ties by which one
-                    # has the hungriest drive.
-                    candidates_with_room = [
-                        t for t in tier2children[tier]
-                        if parts_available_in_tier[t] > 0]
-                    candidates_with_fudge = set([
-                        t for t in tier2children[tier]
-                        if fudge_available_in_tier[t] > 0])
-                    candidates_with_fudge.update(candidates_with_room)
-
-                    if candidates_with_room:
-                        if len(candidates_with_room) > \
-                           len(candidates_with_replicas):
-                            # There exists at least one tier with room for
-                            # another partition and 0 other replicas already
-                            # in it, so we can use a faster search. The else
-                            # branch's search would work here, but it's
-                            # significantly slower.
-                            roomiest_tier = max(
-                                (t for t in candidates_with_room
-                                 if other_replicas[t] == 0),
-                                key=tier2sort_key.__getitem__)
-                        else:
-                            roomiest_tier = max(
-                                candidates_with_room,
-                                key=lambda t: (-other_replicas[t],
-                                               tier2sort_key[t]))
-                    else:
-                        roomiest_tier = None
-
-                    fudgiest_tier = max(candidates_with_fudge,
-                                        key=lambda t: (-other_replicas[t],
-                                                       tier2sort_key[t]))
+                    # The children of each tier are kept sorted by the sort
+                    # key of their hungriest drive, so walking them from the
+                    # hungriest end means the first tier found with the
+                    # smallest number of replicas is also the one with the
+                    # hungriest drive. Once a tier with room and no replicas
+                    # of this partition turns up, nothing later in the walk
+                    # can beat it and the search stops early.
+                    children = tier2children[tier]
+                    for t in reversed(children):
+                        replicas_in_t = other_replicas.get(t, 0)
+                        if parts_available_in_tier[t] > 0:
+                            if roomiest_tier is None or \
+                                    replicas_in_t < roomiest_replicas:
+                                roomiest_tier = t
+                                roomiest_replicas = replicas_in_t
+                        elif fudge_available_in_tier[t] <= 0:
+                            continue
+                        if fudgiest_tier is None or \
+                                replicas_in_t < fudgiest_replicas:
+                            fudgiest_tier = t
+                            fudgiest_replicas = replicas_in_t
+                        if roomiest_replicas == 0:
+                            break
+                    if fudgiest_tier is None:
+                        # Nowhere has room, even counting overload; settle
+                        # for the best dispersion among all the children.
+                        fudgiest_tier = max(
+                            children, key=lambda t: (-other_replicas.get(t, 0),
+                                                     tier2sort_key[t]))
+                        fudgiest_replicas = other_replicas.get(
+                            fudgiest_tier, 0)
 
                     if (roomiest_tier is None or
-                        (other_replicas[roomiest_tier] >
-                         other_replicas[fudgiest_tier])):
+                            roomiest_replicas > fudgiest_replicas):
                         tier = fudgiest_tier
                     else:
                         tier = roomiest_tier
                     depth += 1
 
-                dev = tier2devs[tier][-1]
+                dev = tier2dev[tier]
                 dev['parts_wanted'] -= 1
                 dev['parts'] += 1
-                old_sort_key = dev['sort_key']
-                new_sort_key = dev['sort_key'] = self._sort_key_for(dev)
+                tier_sort_key = dev['sort_key'] = self._sort_key_for(dev)
                 for tier in dev['tiers']:
                     parts_available_in_tier[tier] -= 1
                     fudge_available_in_tier[tier] -= 1
                     other_replicas[tier] += 1
-                    occupied_tiers_by_tier_len[len(tier)].add(tier)
 
-                    index = bisect.bisect_left(tier2dev_sort_key[tier],
+                # Now jiggle tier2children values to keep them sorted, from
+                # the device tier up. The last of a tier's sorted children
+                # holds its hungriest drive, so a tier whose sort key does
+                # not change leaves all of its ancestors as they were.
+                for tier in reversed(dev['tiers']):
+                    old_sort_key = tier2sort_key[tier]
+                    if tier_sort_key == old_sort_key:
+                        break
+                    tier2sort_key[tier] = tier_sort_key
+
+                    parent_tier = tier2parent[tier]
+                    sibling_sort_keys = tier2children_sort_key[parent_tier]
+                    index = bisect.bisect_left(sibling_sort_keys,
                                                old_sort_key)
-                    tier2devs[tier].pop(index)
-                    tier2dev_sort_key[tier].pop(index)
-
-                    new_index = bisect.bisect_left(tier2dev_sort_key[tier],
-                                                   new_sort_key)
-                    tier2devs[tier].insert(new_index, dev)
-                    tier2dev_sort_key[tier].insert(new_index, new_sort_key)
-
-                    new_last_sort_key = tier2dev_sort_key[tier][-1]
-                    tier2sort_key[tier] = new_last_sort_key
-
-                    # Now jiggle tier2children values to keep them sorted
-                    parent_tier = tier[0:-1]
-                    index = bisect.bisect_left(
-                        tier2children_sort_key[parent_tier],
-                        old_sort_key)
                     popped = tier2children[parent_tier].pop(index)
-                    tier2children_sort_key[parent_tier].pop(index)
+                    sibling_sort_keys.pop(index)
 
-                    new_index = bisect.bisect_left(
-                        tier2children_sort_key[parent_tier],
-                        new_last_sort_key)
+                    new_index = bisect.bisect_left(sibling_sort_keys,
+                                                   tier_sort_key)
                     tier2children[parent_tier].insert(new_index, popped)
-                    tier2children_sort_key[parent_tier].insert(
-                        new_index, new_last_sort_key)
+                    sibling_sort_keys.insert(new_index, tier_sort_key)
+                    tier_sort_key = sibling_sort_keys[-1]
 
                 self._replica2part2dev[replica][part] = dev['id']
                 self.logger.debug(
@@ -1232,6 +1439,51 @@ class RingBuilder(object):
         mr.update(walk_tree((), self.replicas))
         return mr
 
+    def _dispersion_checks(self, tfd, max_allowed_replicas):
+        """
+        Returns a list of (tier_index, max_replicas) pairs that together
+        are a sufficient test for a partition being spread out enough.
+
+        tier_index is a list, indexed by device id, of the tier each device
+        is in at one tier depth (None for devices without weight, whose
+        tiers allow no replicas at all), and max_replicas is the smallest
+        number of replicas allowed in any tier at that depth. Depths at
+        which every tier may hold all of a partition's replicas are left
+        out, as are the ones below the first depth that allows only one
+        replica per tier, since replicas in distinct tiers stay distinct
+        all the way down.
+
+        A partition whose devices pass every check has no tier with more
+        replicas than _build_max_replicas_by_tier() allows.
+
+        :param tfd: dict of device id to tiers_for_dev() of that device
+        :param max_allowed_replicas: result of _build_max_replicas_by_tier()
+        """
+        replica_count = int(math.ceil(self.replicas))
+        checks = []
+        depth = 1
+        while True:
+            tier_index = [None] * len(self.devs)
+            max_replicas = None
+            for dev in self._iter_devs():
+                tiers = tfd[dev['id']]
+                if depth > len(tiers):
+                    return checks
+                if not dev['weight']:
+                    continue
+                tier = tiers[depth - 1]
+                tier_index[dev['id']] = tier
+                if max_replicas is None or \
+                        max_allowed_replicas[tier] < max_replicas:
+                    max_replicas = max_allowed_replicas[tier]
+            if max_replicas is None:
+                return checks
+            if max_replicas < replica_count:
+                checks.append((tier_index, max_replicas))
+                if max_replicas <= 1:
+                    return checks
+            depth += 1
+
     def _devs_for_part(self, part):
         """
         Returns a list of devices for a specified partition.
@@ -15,7 +15,10 @@
 
 import array
 import cPickle as pickle
+import ctypes
 import inspect
+import mmap
+import sys
 from collections import defaultdict
 from gzip import GzipFile
 from os.path import getmtime
@@ -24,13 +27,54 @@ from time import time
 import os
 from io import BufferedReader
 from hashlib import md5
-from itertools import chain
+from itertools import chain, izip
+from operator import itemgetter
 from tempfile import NamedTemporaryFile
 
-from swift.common.utils import hash_path, validate_configuration, json
+from swift.common.utils import hash_path, validate_configuration, json, \
+    LRUCache
 from swift.common.ring.utils import tiers_for_dev
 
 
+V2_HEADER_LEN = 10  # magic, version and JSON length
+
+
+def _v2_padded_len(length):
+    return (length + 7) & ~7
+
+
+def _part2dev_id_bytes(part2dev_id):
+    """
+    Get the raw bytes of a replica2part2dev_id row, which may be an array or
+    a ctypes array mapped from a version 2 ring file.
+    """
+    if isinstance(part2dev_id, array.array):
+        return part2dev_id.tostring()
+    return array.array('H', part2dev_id).tostring()
+
+
+def get_ring_format_version(filename):
+    """
+    Find out which format a serialized ring file uses.
+
+    :param filename: path to a ring file
+    :returns: 2 for the uncompressed format, 1 for the gzipped format and 0
+              for an old-style pickled ring
+    """
+    with open(filename, 'rb') as ring_file:
+        magic = ring_file.read(6)
+    if magic[:4] == 'R1NG':
+        return struct.unpack('!H', magic[4:])[0]
+    gz_file = GzipFile(filename, 'rb')
+    try:
+        magic = gz_file.read(6)
+    finally:
+        gz_file.close()
+    if magic[:4] == 'R1NG':
+        return struct.unpack('!H', magic[4:])[0]
+    return 0
+
+
 class RingData(object):
     """Partitioned consistent hashing ring data (used for serialization)."""
 
@@ -55,13 +99,68 @@ class RingData(object):
         return ring_dict
 
     @classmethod
-    def load(cls, filename):
+    def deserialize_v2(cls, ring_file, mmap_file=False):
+        """
+        Read the uncompressed version 2 format.
+
+        :param ring_file: file object positioned just past the magic and
+                          version
+        :param mmap_file: if True, the replica2part2dev_id rows are views
+                          into a private mapping of the file rather than
+                          copies, so that every process that loads the same
+                          ring shares the page cache
+        :returns: a dict with keys devs, part_shift and replica2part2dev_id
+        """
+        json_len, = struct.unpack('!I', ring_file.read(4))
+        ring_dict = json.loads(ring_file.read(json_len))
+        offset = _v2_padded_len(V2_HEADER_LEN + json_len)
+        partition_count = 1 << (32 - ring_dict['part_shift'])
+        lengths = ring_dict.get('replica_lengths') or \
+            [partition_count] * ring_dict['replica_count']
+        swap = ring_dict.get('byteorder', sys.byteorder) != sys.byteorder
+        ring_dict['replica2part2dev_id'] = []
+        if mmap_file and not swap:
+            # ctypes needs a writable buffer, so map copy-on-write; pages
+            # that are only ever read stay shared with the page cache
+            mapped = mmap.mmap(ring_file.fileno(), 0,
+                               access=mmap.ACCESS_COPY)
+            for length in lengths:
+                ring_dict['replica2part2dev_id'].append(
+                    (ctypes.c_uint16 * length).from_buffer(mapped, offset))
+                offset += 2 * length
+        else:
+            ring_file.seek(offset)
+            for length in lengths:
+                part2dev_id = array.array('H', ring_file.read(2 * length))
+                if swap:
+                    part2dev_id.byteswap()
+                ring_dict['replica2part2dev_id'].append(part2dev_id)
+        return ring_dict
+
+    @classmethod
+    def load(cls, filename, mmap_file=False):
         """
         Load ring data from a file.
 
         :param filename: Path to a file serialized by the save() method.
+        :param mmap_file: map the partition assignments of a version 2 ring
+                          into memory instead of copying them; see
+                          :func:`deserialize_v2`
         :returns: A RingData instance containing the loaded data.
         """
+        with open(filename, 'rb') as ring_file:
+            magic = ring_file.read(4)
+            if magic == 'R1NG':
+                # Uncompressed, so it must be version 2 or later
+                version, = struct.unpack('!H', ring_file.read(2))
+                if version == 2:
+                    ring_data = cls.deserialize_v2(ring_file,
+                                                   mmap_file=mmap_file)
+                    return RingData(ring_data['replica2part2dev_id'],
+                                    ring_data['devs'],
+                                    ring_data['part_shift'])
+                raise Exception('Unknown ring format version %d' % version)
+
         gz_file = GzipFile(filename, 'rb')
         # Python 2.6 GzipFile doesn't support BufferedIO
         if hasattr(gz_file, '_checkReadable'):
@@ -96,30 +195,64 @@ class RingData(object):
         file_obj.write(struct.pack('!I', json_len))
         file_obj.write(json_text)
         for part2dev_id in ring['replica2part2dev_id']:
-            file_obj.write(part2dev_id.tostring())
+            file_obj.write(_part2dev_id_bytes(part2dev_id))
+
+    def serialize_v2(self, file_obj):
+        """
+        Write the uncompressed version 2 format, which can be memory mapped
+        by :func:`deserialize_v2`.
+
+        The layout is the magic and version, a length prefixed JSON header,
+        zero padding up to an 8 byte boundary and then the raw
+        replica2part2dev_id rows, in the byte order named in the header.
+        """
+        file_obj.write(struct.pack('!4sH', 'R1NG', 2))
+        ring = self.to_dict()
+        json_encoder = json.JSONEncoder(sort_keys=True)
+        json_text = json_encoder.encode(
+            {'devs': ring['devs'], 'part_shift': ring['part_shift'],
+             'replica_count': len(ring['replica2part2dev_id']),
+             'replica_lengths': [len(part2dev_id) for part2dev_id in
+                                 ring['replica2part2dev_id']],
+             'byteorder': sys.byteorder})
+        json_len = len(json_text)
+        file_obj.write(struct.pack('!I', json_len))
+        file_obj.write(json_text)
+        file_obj.write('\x00' * (_v2_padded_len(V2_HEADER_LEN + json_len) -
+                                 V2_HEADER_LEN - json_len))
+        for part2dev_id in ring['replica2part2dev_id']:
+            file_obj.write(_part2dev_id_bytes(part2dev_id))
 
-    def save(self, filename, mtime=1300507380.0):
+    def save(self, filename, mtime=1300507380.0, format_version=1):
         """
         Serialize this RingData instance to disk.
 
         :param filename: File into which this instance should be serialized.
         :param mtime: time used to override mtime for gzip, default or None
                       if the caller wants to include time
+        :param format_version: 1 for the gzipped format, 2 for the
+                               uncompressed format that can be memory mapped
         """
-        # Override the timestamp so that the same ring data creates
-        # the same bytes on disk. This makes a checksum comparison a
-        # good way to see if two rings are identical.
-        #
-        # This only works on Python 2.7; on 2.6, we always get the
-        # current time in the gzip output.
+        if format_version not in (1, 2):
+            raise ValueError('Unknown ring format version %r' %
+                             (format_version,))
         tempf = NamedTemporaryFile(dir=".", prefix=filename, delete=False)
-        if 'mtime' in inspect.getargspec(GzipFile.__init__).args:
-            gz_file = GzipFile(filename, mode='wb', fileobj=tempf,
-                               mtime=mtime)
+        if format_version == 2:
+            self.serialize_v2(tempf)
         else:
-            gz_file = GzipFile(filename, mode='wb', fileobj=tempf)
-        self.serialize_v1(gz_file)
-        gz_file.close()
+            # Override the timestamp so that the same ring data creates
+            # the same bytes on disk. This makes a checksum comparison a
+            # good way to see if two rings are identical.
+            #
+            # This only works on Python 2.7; on 2.6, we always get the
+            # current time in the gzip output.
+            if 'mtime' in inspect.getargspec(GzipFile.__init__).args:
+                gz_file = GzipFile(filename, mode='wb', fileobj=tempf,
+                                   mtime=mtime)
+            else:
+                gz_file = GzipFile(filename, mode='wb', fileobj=tempf)
+            self.serialize_v1(gz_file)
+            gz_file.close()
         tempf.flush()
         os.fsync(tempf.fileno())
         tempf.close()
@@ -132,15 +265,57 @@ class RingData(object):
                 'part_shift': self._part_shift}
 
 
+class _HandoffNodes(object):
+    """
+    Memoizes the handoff nodes a get_more_nodes generator has produced so
+    far, so the sequence can be replayed by later callers and only extended
+    as far as anyone actually consumes it.
+    """
+
+    def __init__(self, nodes_iter):
+        self.nodes = []
+        self._nodes_iter = nodes_iter
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self.nodes):
+                yield self.nodes[i]
+            elif self._nodes_iter is None:
+                return
+            else:
+                try:
+                    node = next(self._nodes_iter)
+                except StopIteration:
+                    self._nodes_iter = None
+                    return
+                self.nodes.append(node)
+                yield node
+            i += 1
+
+
 class Ring(object):
     """
     Partitioned consistent hashing ring.
 
     :param serialized_path: path to serialized RingData instance
     :param reload_time: time interval in seconds to check for a ring change
+    :param ring_name: name of the ring, used to build the file name
+    :param precompute_part_nodes: if True, build a table of device id tuples
+                                  for every partition whenever the ring is
+                                  (re)loaded, so that primary node lookups
+                                  are a single index operation; this costs
+                                  memory in proportion to the partition
+                                  count
+    :param handoff_cache_size: number of partitions whose handoff node
+                               sequences are cached, 0 to disable
     """
 
-    def __init__(self, serialized_path, reload_time=15, ring_name=None):
+    _part2dev_ids = None
+    _handoff_cache = None
+
+    def __init__(self, serialized_path, reload_time=15, ring_name=None,
+                 precompute_part_nodes=False, handoff_cache_size=0):
         # can't use the ring unless HASH_PATH_SUFFIX is set
         validate_configuration()
         if ring_name:
@@ -149,12 +324,17 @@ class Ring(object):
         else:
             self.serialized_path = os.path.join(serialized_path)
         self.reload_time = reload_time
+        self.precompute_part_nodes = precompute_part_nodes
+        if handoff_cache_size > 0:
+            # entries are dropped whenever the ring changes, not by age
+            self._handoff_cache = LRUCache(maxsize=handoff_cache_size,
+                                           maxtime=float('inf'))
         self._reload(force=True)
 
     def _reload(self, force=False):
         self._rtime = time() + self.reload_time
         if force or self.has_changed():
-            ring_data = RingData.load(self.serialized_path)
+            ring_data = RingData.load(self.serialized_path, mmap_file=True)
             self._mtime = getmtime(self.serialized_path)
             self._devs = ring_data.devs
             # NOTE(akscram): Replication parameters like replication_ip
@@ -208,6 +388,13 @@ class Ring(object):
         for tiers in self.tiers_by_length:
             tiers.sort()
 
+        self._part2dev_ids = None
+        if self.precompute_part_nodes:
+            self._part2dev_ids = tuple(self._get_part_nodes_many(
+                xrange(self.partition_count)))
+        if self._handoff_cache is not None:
+            self._handoff_cache.reset()
+
     @property
     def replica_count(self):
         """Number of replicas (full or partial) used in the ring."""
@@ -235,6 +422,12 @@ class Ring(object):
         return getmtime(self.serialized_path) != self._mtime
 
     def _get_part_nodes(self, part):
+        if self._part2dev_ids is not None:
+            if part >= len(self._part2dev_ids):
+                return []
+            devs = self._devs
+            return [dict(devs[dev_id], index=i) for i, dev_id in
+                    enumerate(self._part2dev_ids[part])]
         part_nodes = []
         seen_ids = set()
         for r2p2d in self._replica2part2dev_id:
@@ -308,6 +501,70 @@ class Ring(object):
         part = self.get_part(account, container, obj)
         return part, self._get_part_nodes(part)
 
+    def get_parts_many(self, names):
+        """
+        Get the partitions for many account/container/object names at once.
+
+        This is equivalent to calling :func:`get_part` for each name, but
+        only checks for a ring reload once and avoids the per-call overhead,
+        which adds up for callers that look up names in tight loops.
+
+        :param names: iterable of name tuples, each one of (account,),
+                      (account, container) or (account, container, obj)
+        :returns: list of partition numbers, in the same order as names
+        """
+        if time() > self._rtime:
+            self._reload()
+        part_shift = self._part_shift
+        unpack_from = struct.Struct('>I').unpack_from
+        return [unpack_from(hash_path(*name, raw_digest=True))[0] >> part_shift
+                for name in names]
+
+    def get_part_nodes_many(self, parts):
+        """
+        Get the ids of the devices responsible for many partitions at once.
+
+        Unlike :func:`get_part_nodes` no node dicts are built; each
+        partition maps to a tuple of device ids in replica order, with a
+        device responsible for more than one replica only listed once. Use
+        ``ring.devs[dev_id]`` to get at the device itself.
+
+        :param parts: iterable of partition numbers
+        :returns: list of tuples of device ids, in the same order as parts
+        """
+        if time() > self._rtime:
+            self._reload()
+        if self._part2dev_ids is not None:
+            return [self._part2dev_ids[part] for part in parts]
+        return self._get_part_nodes_many(parts)
+
+    def _get_part_nodes_many(self, parts):
+        parts = list(parts)
+        if not parts:
+            return []
+        partition_count = self.partition_count
+        columns = []
+        for r2p2d in self._replica2part2dev_id:
+            if len(r2p2d) == partition_count:
+                column = itemgetter(*parts)(r2p2d)
+                columns.append((column,) if len(parts) == 1 else column)
+            else:
+                # a partial replica; some parts don't have a device in it
+                columns.append([r2p2d[part] if part < len(r2p2d) else None
+                                for part in parts])
+        part_dev_ids = []
+        for dev_ids in izip(*columns):
+            if None in dev_ids or len(set(dev_ids)) != len(dev_ids):
+                seen_ids = set()
+                unique_ids = []
+                for dev_id in dev_ids:
+                    if dev_id is not None and dev_id not in seen_ids:
+                        unique_ids.append(dev_id)
+                        seen_ids.add(dev_id)
+                dev_ids = tuple(unique_ids)
+            part_dev_ids.append(dev_ids)
+        return part_dev_ids
+
     def get_more_nodes(self, part):
         """
         Generator to get extra nodes for a partition for hinted handoff.
@@ -324,6 +581,19 @@ class Ring(object):
         """
         if time() > self._rtime:
             self._reload()
+        if self._handoff_cache is None:
+            return self._get_more_nodes(part)
+        cache = self._handoff_cache
+        link = cache.mapping.get((part,))
+        handoffs = None
+        if link is not None:
+            handoffs = cache.get_cached(link, part)
+        if handoffs is None:
+            handoffs = cache.set_cache(
+                _HandoffNodes(self._get_more_nodes(part)), part)
+        return iter(handoffs)
+
+    def _get_more_nodes(self, part):
         primary_nodes = self._get_part_nodes(part)
 
         used = set(d['id'] for d in primary_nodes)
@@ -223,15 +223,18 @@ class BaseStoragePolicy(object):
         """
         pass
 
-    def load_ring(self, swift_dir):
+    def load_ring(self, swift_dir, **ring_kwargs):
         """
         Load the ring for this policy immediately.
 
         :param swift_dir: path to rings
+        :param ring_kwargs: extra keyword arguments for
+                            :class:`~swift.common.ring.Ring`
         """
         if self.object_ring:
             return
-        self.object_ring = Ring(swift_dir, ring_name=self.ring_name)
+        self.object_ring = Ring(swift_dir, ring_name=self.ring_name,
+                                **ring_kwargs)
 
         # Validate ring to make sure it conforms to policy requirements
         self._validate_ring()
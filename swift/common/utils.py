@@ -1769,7 +1769,7 @@ def hash_path(account, container=None, object=None, raw_digest=False):
 
 
 @contextmanager
-def lock_path(directory, timeout=10, timeout_class=None):
+def lock_path(directory, timeout=10, timeout_class=None, name=None):
     """
     Context manager that acquires a lock on a directory.  This will block until
     the lock can be acquired, or the timeout time has expired (whichever occurs
@@ -1785,11 +1785,15 @@ def lock_path(directory, timeout=10, timeout_class=None):
         lock cannot be granted within the timeout. Will be
         constructed as timeout_class(timeout, lockpath). Default:
         LockTimeout
+    :param name: lock a separate hidden file named after this, so that
+        unrelated users of the same directory don't hold each other up
     """
     if timeout_class is None:
         timeout_class = swift.common.exceptions.LockTimeout
     mkdirs(directory)
     lockpath = '%s/.lock' % directory
+    if name:
+        lockpath += '-%s' % name
     fd = os.open(lockpath, os.O_WRONLY | os.O_CREAT)
     sleep_time = 0.01
     slower_sleep_time = max(timeout * 0.01, sleep_time)
@@ -16,20 +16,34 @@
 Pluggable Back-ends for Container Server
 """
 
+import errno
 import os
 from uuid import uuid4
 import time
-import cPickle as pickle
+from swift import gettext_ as _
 
 import sqlite3
+from eventlet import Timeout
 
-from swift.common.utils import Timestamp
-from swift.common.db import DatabaseBroker, utf8encode
+from swift.common.utils import Timestamp, lock_file, mkdirs
+from swift.common.db import DatabaseBroker, utf8encode, prefix_end_marker, \
+    can_rollup, get_rollup_query, ROLLUP_MAX_PLAIN, LISTING_BATCH_SIZE
 
 
 SQLITE_ARG_LIMIT = 999
 
 DATADIR = 'containers'
+DIRTY_DIR = 'containers_dirty'
+
+LISTING_INDEX_SCRIPT = '''
+    CREATE INDEX IF NOT EXISTS ix_object_deleted_policy_name
+    ON object (deleted, storage_policy_index, name);
+'''
+
+#: SQL of listing queries; see ContainerBroker._get_listing_query
+LISTING_QUERIES = {}
+#: SQL of delimiter listing queries; see ContainerBroker._list_rollup
+ROLLUP_QUERIES = {}
 
 POLICY_STAT_TABLE_CREATE = '''
     CREATE TABLE policy_stat (
@@ -135,11 +149,69 @@ CONTAINER_STAT_VIEW_SCRIPT = '''
 '''
 
 
+def get_dirty_journal(db_file):
+    """
+    Find the dirty container journal a container DB is tracked in.  Each
+    device has a journal per container partition, at
+    <device>/containers_dirty/<partition>, listing the hashes of the
+    containers in the partition whose stats may have changed since the
+    container updater last looked at them.
+
+    :param db_file: path to a container DB
+    :returns: a tuple of (journal path, container hash), or (None, None) if
+              the DB is not in a device's containers directory
+    """
+    hash_dir = os.path.dirname(db_file)
+    part_dir = os.path.dirname(os.path.dirname(hash_dir))
+    datadir = os.path.dirname(part_dir)
+    if os.path.basename(datadir) != DATADIR:
+        return None, None
+    return (os.path.join(os.path.dirname(datadir), DIRTY_DIR,
+                         os.path.basename(part_dir)),
+            os.path.basename(hash_dir))
+
+
+def add_to_dirty_journal(journal, hsh, timeout=10):
+    """
+    Add a container hash to a dirty container journal.
+
+    :param journal: path to the journal
+    :param hsh: the container hash
+    :param timeout: seconds to wait for the journal lock
+    """
+    def _append():
+        with lock_file(journal, timeout, append=True, unlink=False) as fp:
+            fp.write(hsh + '\n')
+
+    try:
+        _append()
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        mkdirs(os.path.dirname(journal))
+        _append()
+
+
+def pop_dirty_journal(journal, timeout=10):
+    """
+    Read and remove a dirty container journal.
+
+    :param journal: path to the journal
+    :param timeout: seconds to wait for the journal lock
+    :returns: the set of container hashes in the journal
+    """
+    if not os.path.exists(journal):
+        return set()
+    with lock_file(journal, timeout, unlink=True) as fp:
+        return set(line.strip() for line in fp if line.strip())
+
+
 class ContainerBroker(DatabaseBroker):
     """Encapsulates working with a container database."""
     db_type = 'container'
     db_contains_type = 'object'
     db_reclaim_timestamp = 'created_at'
+    _object_has_policy = False
 
     @property
     def storage_policy_index(self):
@@ -191,7 +263,7 @@ class ContainerBroker(DatabaseBroker):
                 SELECT RAISE(FAIL, 'UPDATE not allowed; DELETE and INSERT');
             END;
 
-        """ + POLICY_STAT_TRIGGER_SCRIPT)
+        """ + LISTING_INDEX_SCRIPT + POLICY_STAT_TRIGGER_SCRIPT)
 
     def create_container_info_table(self, conn, put_timestamp,
                                     storage_policy_index):
@@ -247,13 +319,81 @@ class ContainerBroker(DatabaseBroker):
 
     def get_db_version(self, conn):
         if self._db_version == -1:
+            indexes = set(row[0] for row in conn.execute('''
+                SELECT name FROM sqlite_master
+                WHERE name IN ('ix_object_deleted_name',
+                               'ix_object_deleted_policy_name') '''))
             self._db_version = 0
-            for row in conn.execute('''
-                    SELECT name FROM sqlite_master
-                    WHERE name = 'ix_object_deleted_name' '''):
+            if 'ix_object_deleted_name' in indexes:
                 self._db_version = 1
+                if 'ix_object_deleted_policy_name' in indexes:
+                    self._db_version = 2
         return self._db_version
 
+    def _has_storage_policy_index(self, conn):
+        """
+        Check if the object table has the storage_policy_index column; it
+        only goes missing from DBs older than storage policies, and is added
+        to them by _migrate_add_storage_policy.
+        """
+        if not self._object_has_policy:
+            self._object_has_policy = any(
+                row[1] == 'storage_policy_index'
+                for row in conn.execute('PRAGMA table_info(object)'))
+        return self._object_has_policy
+
+    def add_listing_index(self):
+        """
+        Add the (deleted, storage_policy_index, name) index that listings
+        use to a DB made before it existed.  Building the index reads the
+        whole object table with the DB locked, so the container replicator
+        does this, if configured to, rather than a listing request.
+
+        The (deleted, name) index is still needed by merge_items, which
+        looks rows up by name alone, so every object update maintains both.
+
+        :returns: True if the index was added, False otherwise
+        """
+        with self.get() as conn:
+            if self.get_db_version(conn) != 1 or \
+                    not self._has_storage_policy_index(conn):
+                return False
+            conn.executescript(LISTING_INDEX_SCRIPT)
+            self._db_version = 2
+        return True
+
+    def _get_listing_query(self, conn, marker_op, has_end_marker,
+                           has_policy):
+        """
+        Get the SQL for a page of a listing.  There are only a few shapes of
+        query, and handing sqlite the very same text for each means it can
+        reuse the statements it has already prepared on the connection.
+
+        :param marker_op: comparison of names to the marker, '>' or '>=', or
+                          None if there is no marker
+        :param has_end_marker: whether names are limited by an end marker
+        :param has_policy: whether to filter by storage_policy_index
+        :returns: the query; its arguments are the storage policy index if
+                  has_policy, the marker if marker_op, the end marker if
+                  has_end_marker, and the limit
+        """
+        key = (self.get_db_version(conn) >= 1, marker_op, has_end_marker,
+               has_policy)
+        query = LISTING_QUERIES.get(key)
+        if query is None:
+            clauses = ['deleted = 0' if key[0] else '+deleted = 0']
+            if has_policy:
+                clauses.append('storage_policy_index = ?')
+            if marker_op:
+                clauses.append('name %s ?' % marker_op)
+            if has_end_marker:
+                clauses.append('name < ?')
+            query = LISTING_QUERIES[key] = (
+                'SELECT name, created_at, size, content_type, etag '
+                'FROM object WHERE %s ORDER BY name LIMIT ?' %
+                ' AND '.join(clauses))
+        return query
+
     def _newid(self, conn):
         conn.execute('''
             UPDATE container_stat
@@ -274,21 +414,36 @@ class ContainerBroker(DatabaseBroker):
                 status_changed_at = ?
             WHERE delete_timestamp < ? """, (timestamp, timestamp, timestamp))
 
-    def _commit_puts_load(self, item_list, entry):
-        """See :func:`swift.common.db.DatabaseBroker._commit_puts_load`"""
-        data = pickle.loads(entry.decode('base64'))
+    def mark_dirty(self):
+        """
+        Add the container to its device's dirty container journal, so the
+        container updater knows to look at it.
+        """
+        journal, hsh = get_dirty_journal(self.db_file)
+        if not journal:
+            return
+        try:
+            add_to_dirty_journal(journal, hsh, self.pending_timeout)
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('ERROR marking %s dirty'), self.db_file)
+
+    def make_record_from_pickle(self, data):
+        """
+        See :func:`swift.common.db.DatabaseBroker.make_record_from_pickle`
+        """
         (name, timestamp, size, content_type, etag, deleted) = data[:6]
         if len(data) > 6:
             storage_policy_index = data[6]
         else:
             storage_policy_index = 0
-        item_list.append({'name': name,
-                          'created_at': timestamp,
-                          'size': size,
-                          'content_type': content_type,
-                          'etag': etag,
-                          'deleted': deleted,
-                          'storage_policy_index': storage_policy_index})
+        return {'name': name,
+                'created_at': timestamp,
+                'size': size,
+                'content_type': content_type,
+                'etag': etag,
+                'deleted': deleted,
+                'storage_policy_index': storage_policy_index}
 
     def empty(self):
         """
@@ -583,52 +738,41 @@ class ContainerBroker(DatabaseBroker):
             delimiter = '/'
         elif delimiter and not prefix:
             prefix = ''
+        if prefix:
+            prefix_end = prefix_end_marker(prefix)
+            if prefix_end and (not end_marker or prefix_end < end_marker):
+                end_marker = prefix_end
         orig_marker = marker
         with self.get() as conn:
+            has_policy = self._has_storage_policy_index(conn)
+            if delimiter and can_rollup(delimiter):
+                return self._list_rollup(
+                    conn, limit, marker, end_marker, prefix, delimiter, path,
+                    storage_policy_index, has_policy)
             results = []
             while len(results) < limit:
-                query = '''SELECT name, created_at, size, content_type, etag
-                           FROM object WHERE'''
                 query_args = []
-                if end_marker:
-                    query += ' name < ? AND'
-                    query_args.append(end_marker)
+                if has_policy:
+                    query_args.append(storage_policy_index)
                 if delim_force_gte:
-                    query += ' name >= ? AND'
+                    marker_op = '>='
                     query_args.append(marker)
                     # Always set back to False
                     delim_force_gte = False
                 elif marker and marker >= prefix:
-                    query += ' name > ? AND'
+                    marker_op = '>'
                     query_args.append(marker)
                 elif prefix:
-                    query += ' name >= ? AND'
+                    marker_op = '>='
                     query_args.append(prefix)
-                if self.get_db_version(conn) < 1:
-                    query += ' +deleted = 0'
                 else:
-                    query += ' deleted = 0'
-                orig_tail_query = '''
-                    ORDER BY name LIMIT ?
-                '''
-                orig_tail_args = [limit - len(results)]
-                # storage policy filter
-                policy_tail_query = '''
-                    AND storage_policy_index = ?
-                ''' + orig_tail_query
-                policy_tail_args = [storage_policy_index] + orig_tail_args
-                tail_query, tail_args = \
-                    policy_tail_query, policy_tail_args
-                try:
-                    curs = conn.execute(query + tail_query,
-                                        tuple(query_args + tail_args))
-                except sqlite3.OperationalError as err:
-                    if 'no such column: storage_policy_index' not in str(err):
-                        raise
-                    tail_query, tail_args = \
-                        orig_tail_query, orig_tail_args
-                    curs = conn.execute(query + tail_query,
-                                        tuple(query_args + tail_args))
+                    marker_op = None
+                if end_marker:
+                    query_args.append(end_marker)
+                query_args.append(limit - len(results))
+                curs = conn.execute(
+                    self._get_listing_query(conn, marker_op, bool(end_marker),
+                                            has_policy), query_args)
                 curs.row_factory = None
 
                 if prefix is None:
@@ -675,6 +819,111 @@ class ContainerBroker(DatabaseBroker):
                     break
             return results
 
+    def iter_objects(self, limit, marker, end_marker, prefix, delimiter,
+                     path=None, storage_policy_index=0,
+                     batch_size=LISTING_BATCH_SIZE):
+        """
+        Iterate over the same objects as list_objects_iter, listing
+        batch_size of them at a time.  The first rows can be used before the
+        rest are read, and the DB is left alone between batches.
+
+        :param batch_size: max number of rows to list at a time
+        """
+        while limit > 0:
+            count = min(limit, batch_size)
+            batch = self.list_objects_iter(
+                count, marker, end_marker, prefix, delimiter, path,
+                storage_policy_index=storage_policy_index)
+            for row in batch:
+                yield row
+            if len(batch) < count:
+                break
+            limit -= count
+            marker = batch[-1][0]
+
+    def _list_rollup(self, conn, limit, marker, end_marker, prefix,
+                     delimiter, path, storage_policy_index, has_policy):
+        """
+        The part of list_objects_iter for listings with a delimiter.  Names
+        are scanned as usual up to the first common prefix, then listed with
+        get_rollup_query so that runs of common prefixes take one query
+        rather than one each, until the names run plain again.
+        """
+        where = 'deleted = 0' if self.get_db_version(conn) >= 1 \
+            else '+deleted = 0'
+        if has_policy:
+            where += ' AND storage_policy_index = :policy'
+        after_delimiter = chr(ord(delimiter) + 1)
+        # listings of a path skip the names under a subdirectory, even one
+        # right at the start of the path
+        min_end = 0 if path is not None else 1
+        params = {'prefix': prefix, 'delimiter': delimiter,
+                  'after_delimiter': after_delimiter, 'after_name': '\x01',
+                  'min_end': min_end, 'end_marker': end_marker,
+                  'policy': storage_policy_index,
+                  'max_plain': ROLLUP_MAX_PLAIN}
+        orig_marker = marker
+        if marker and marker >= prefix:
+            marker_op = '>'
+        else:
+            marker_op, marker = '>=', prefix
+        results = []
+        rollup = False
+        while len(results) < limit:
+            count = limit - len(results)
+            if rollup:
+                key = (where, marker_op, bool(end_marker))
+                query = ROLLUP_QUERIES.get(key)
+                if query is None:
+                    query = ROLLUP_QUERIES[key] = get_rollup_query(
+                        'object', ('name', 'created_at', 'size',
+                                   'content_type', 'etag'),
+                        where, marker_op, bool(end_marker))
+                params['marker'] = marker
+                params['limit'] = count
+                curs = conn.execute(query, params)
+            else:
+                query_args = [storage_policy_index] if has_policy else []
+                query_args.append(marker)
+                if end_marker:
+                    query_args.append(end_marker)
+                query_args.append(count)
+                curs = conn.execute(
+                    self._get_listing_query(conn, marker_op, bool(end_marker),
+                                            has_policy), query_args)
+            curs.row_factory = None
+            rowcount = plain = 0
+            for row in curs:
+                rowcount += 1
+                name = row[0]
+                if not name.startswith(prefix):
+                    curs.close()
+                    return results
+                end = name.find(delimiter, len(prefix))
+                if end < min_end:
+                    plain += 1
+                    marker_op, marker = '>', name
+                    if name != path:
+                        results.append(row)
+                    continue
+                plain = 0
+                marker_op, marker = '>=', name[:end] + after_delimiter
+                if path is not None:
+                    if len(name) == end + len(delimiter):
+                        results.append(row)
+                elif name[:end + 1] != orig_marker:
+                    results.append([name[:end + 1], '0', 0, None, ''])
+                if not rollup:
+                    curs.close()
+                    rollup = True
+                    break
+            else:
+                if rollup and plain >= ROLLUP_MAX_PLAIN:
+                    rollup = False
+                elif rowcount < count:
+                    break
+        return results
+
     def merge_items(self, item_list, source=None):
         """
         Merge items into the object table.
@@ -736,6 +985,7 @@ class ContainerBroker(DatabaseBroker):
                       rec['content_type'], rec['etag'], rec['deleted'],
                       rec['storage_policy_index'])
                      for rec in to_add.itervalues()))
+                to_report.append(True)
             if source:
                 # for replication we rely on the remote end sending merges in
                 # order with no gaps to increment sync_points
@@ -751,14 +1001,17 @@ class ContainerBroker(DatabaseBroker):
                     ''', (sync_point, source))
             conn.commit()
 
+        to_report = []
         with self.get() as conn:
             try:
-                return _really_merge_items(conn)
+                _really_merge_items(conn)
             except sqlite3.OperationalError as err:
                 if 'no such column: storage_policy_index' not in str(err):
                     raise
                 self._migrate_add_storage_policy(conn)
-                return _really_merge_items(conn)
+                _really_merge_items(conn)
+        if to_report:
+            self.mark_dirty()
 
     def get_reconciler_sync(self):
         with self.get() as conn:
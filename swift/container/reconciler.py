@@ -21,9 +21,10 @@ from eventlet import GreenPile, GreenPool, Timeout
 
 from swift.common import constraints
 from swift.common.daemon import Daemon
+from swift.common.http import HTTP_METHOD_NOT_ALLOWED
 from swift.common.direct_client import (
     direct_head_container, direct_delete_container_object,
-    direct_put_container_object, ClientException)
+    direct_put_container_object, direct_update_container, ClientException)
 from swift.common.internal_client import InternalClient, UnexpectedResponse
 from swift.common.utils import get_logger, split_path, quorum_size, \
     FileLikeIter, Timestamp, last_modified_date_to_timestamp, \
@@ -320,6 +321,50 @@ def direct_delete_container_entry(container_ring, account_name, container_name,
     pool.waitall()
 
 
+def direct_delete_container_entries(container_ring, account_name,
+                                    container_name, entries, headers=None):
+    """
+    Talk directly to the primary container servers to delete a batch of
+    object listings from one container, with one UPDATE request per server.
+    Container servers that do not support UPDATE get a DELETE per listing.
+    Does not talk to object servers; use this only when the container
+    entries do not actually have corresponding objects.
+
+    :param entries: list of (object name, x-timestamp) tuples
+    """
+    items = [{'name': obj, 'created_at': x_timestamp, 'size': 0,
+              'content_type': 'application/deleted', 'etag': 'noetag',
+              'deleted': 1} for obj, x_timestamp in entries]
+
+    def _delete_entries(node, part):
+        try:
+            direct_update_container(node, part, account_name,
+                                    container_name, items, headers=headers)
+        except ClientException as err:
+            if err.http_status != HTTP_METHOD_NOT_ALLOWED:
+                return
+            for obj, x_timestamp in entries:
+                obj_headers = dict(headers or {})
+                obj_headers['X-Timestamp'] = x_timestamp
+                try:
+                    direct_delete_container_object(
+                        node, part, account_name, container_name, obj,
+                        headers=obj_headers)
+                except (ClientException, Timeout, socket.error):
+                    pass
+        except (Timeout, socket.error):
+            pass
+
+    pool = GreenPool()
+    part, nodes = container_ring.get_nodes(account_name, container_name)
+    for node in nodes:
+        pool.spawn_n(_delete_entries, node, part)
+
+    # As with direct_delete_container_entry, anything that failed is retried
+    # on the next reconciler loop.
+    pool.waitall()
+
+
 class ContainerReconciler(Daemon):
     """
     Move objects that are in the wrong storage policy.
@@ -336,6 +381,8 @@ class ContainerReconciler(Daemon):
         self.swift = InternalClient(conf_path,
                                     'Swift Container Reconciler',
                                     request_tries)
+        self.pop_queue_batch_size = int(conf.get('pop_queue_batch_size', 100))
+        self._pending_pops = defaultdict(list)
         self.stats = defaultdict(int)
         self.last_stat_time = time.time()
 
@@ -371,15 +418,41 @@ class ContainerReconciler(Daemon):
 
         N.B. q_ts will normally be the same time as q_record except when
         an object was manually re-enqued.
+
+        With a pop_queue_batch_size greater than one the queue entry is only
+        removed once enough entries from the container have been popped, or
+        flush_pop_queue is called.
         """
         q_path = '/%s/%s/%s' % (MISPLACED_OBJECTS_ACCOUNT, container, obj)
         x_timestamp = slightly_later_timestamp(max(q_record, q_ts))
         self.stats_log('pop_queue', 'remove %r (%f) from the queue (%s)',
                        q_path, q_ts, x_timestamp)
-        headers = {'X-Timestamp': x_timestamp}
-        direct_delete_container_entry(
+        if self.pop_queue_batch_size <= 1:
+            headers = {'X-Timestamp': x_timestamp}
+            direct_delete_container_entry(
+                self.swift.container_ring, MISPLACED_OBJECTS_ACCOUNT,
+                container, obj, headers=headers)
+            return
+        pending = self._pending_pops[container]
+        pending.append((obj, x_timestamp))
+        if len(pending) >= self.pop_queue_batch_size:
+            self.flush_pop_queue(container)
+
+    def flush_pop_queue(self, container):
+        """
+        Remove the queue entries popped from the given container that have
+        not been removed yet.
+
+        :param container: the misplaced objects container
+        """
+        entries = self._pending_pops.pop(container, None)
+        if not entries:
+            return
+        self.logger.debug('removing %d entries from the queue container %s',
+                          len(entries), container)
+        direct_delete_container_entries(
             self.swift.container_ring, MISPLACED_OBJECTS_ACCOUNT,
-            container, obj, headers=headers)
+            container, entries)
 
     def throw_tombstones(self, account, container, obj, timestamp,
                          policy_index, path):
@@ -724,6 +797,7 @@ class ContainerReconciler(Daemon):
                     self.pop_queue(container, raw_obj['name'],
                                    obj_info['q_ts'],
                                    obj_info['q_record'])
+            self.flush_pop_queue(container)
             self.log_stats()
             self.logger.debug('finished container %s', container)
 
@@ -29,7 +29,8 @@ from swift.common.exceptions import DeviceUnavailable
 from swift.common.http import is_success
 from swift.common.db import DatabaseAlreadyExists
 from swift.common.utils import (json, Timestamp, hash_path,
-                                storage_directory, quorum_size)
+                                storage_directory, quorum_size,
+                                config_true_value)
 
 
 class ContainerReplicator(db_replicator.Replicator):
@@ -38,6 +39,13 @@ class ContainerReplicator(db_replicator.Replicator):
     datadir = DATADIR
     default_port = 6001
 
+    def __init__(self, conf, logger=None):
+        super(ContainerReplicator, self).__init__(conf, logger=logger)
+        self.add_listing_index = config_true_value(
+            conf.get('add_listing_index', 'no'))
+        self.listing_index_max_rows = int(
+            conf.get('listing_index_max_rows', 100000))
+
     def report_up_to_date(self, full_info):
         reported_key_map = {
             'reported_put_timestamp': 'put_timestamp',
@@ -185,6 +193,14 @@ class ContainerReplicator(db_replicator.Replicator):
         return low_sync
 
     def _post_replicate_hook(self, broker, info, responses):
+        # Building the index holds the DB's write lock while it reads the
+        # whole object table, so it is only done for DBs small enough that
+        # object updates to them don't time out meanwhile.
+        if self.add_listing_index and (
+                not self.listing_index_max_rows or
+                info['max_row'] <= self.listing_index_max_rows) and \
+                broker.add_listing_index():
+            self.logger.debug('Added listing index to %s', broker.db_file)
         if info['account'] == MISPLACED_OBJECTS_ACCOUNT:
             return
         point = broker.get_reconciler_sync()
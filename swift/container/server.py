@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import os
 import time
 import traceback
@@ -24,10 +25,12 @@ from eventlet import Timeout
 import swift.common.db
 from swift.container.backend import ContainerBroker, DATADIR
 from swift.container.replicator import ContainerReplicatorRpc
+from swift.common.db_replicator import load_replicate_args
 from swift.common.db import DatabaseAlreadyExists
 from swift.common.container_sync_realms import ContainerSyncRealms
 from swift.common.request_helpers import get_param, get_listing_content_type, \
-    split_and_validate_path, is_sys_or_user_meta
+    split_and_validate_path, is_sys_or_user_meta, set_listing_body, \
+    LISTING_SERIALIZE_BATCH
 from swift.common.utils import get_logger, hash_path, public, \
     Timestamp, storage_directory, validate_sync_to, \
     config_true_value, json, timing_stats, replication, \
@@ -388,6 +391,67 @@ class ContainerController(BaseStorageServer):
                                     headers={'x-backend-storage-policy-index':
                                              broker.storage_policy_index})
 
+    @public
+    @timing_stats()
+    def UPDATE(self, req):
+        """
+        Handle HTTP UPDATE request: a JSON list of object rows, as taken by
+        ContainerBroker.merge_items, to be merged into the container in one
+        go.  Used by object servers to batch up their container updates.
+        """
+        drive, part, account, container = split_and_validate_path(req, 4)
+        req_timestamp = valid_timestamp(req)
+        if self.mount_check and not check_mount(self.root, drive):
+            return HTTPInsufficientStorage(drive=drive, request=req)
+        obj_policy_index = self.get_and_validate_policy_index(req) or 0
+        try:
+            items = json.load(req.environ['wsgi.input'])
+            if not isinstance(items, list):
+                raise ValueError('Expected a list of object rows')
+            items = [self._validate_update_item(item, obj_policy_index)
+                     for item in items]
+        except (ValueError, TypeError, KeyError) as err:
+            return HTTPBadRequest(body=str(err), content_type='text/plain',
+                                  request=req)
+        broker = self._get_container_broker(drive, part, account, container)
+        if account.startswith(self.auto_create_account_prefix) and \
+                not os.path.exists(broker.db_file):
+            try:
+                broker.initialize(req_timestamp.internal, obj_policy_index)
+            except DatabaseAlreadyExists:
+                pass
+        if not os.path.exists(broker.db_file):
+            return HTTPNotFound(request=req)
+        if items:
+            broker.merge_items(items)
+        return HTTPAccepted(request=req)
+
+    def _validate_update_item(self, item, policy_index):
+        """
+        Check and normalize an object row from an UPDATE request body.
+
+        :param item: dict with the keys of an object row
+        :param policy_index: storage policy index for rows without one
+        :returns: the object row to merge
+        :raises ValueError: if the row is not valid
+        """
+        name = item['name']
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if not name or not check_utf8(name):
+            raise ValueError('Invalid object name %r' % (name,))
+        deleted = int(item.get('deleted', 0))
+        if deleted not in (0, 1):
+            raise ValueError('Invalid deleted value %r' % (deleted,))
+        return {'name': name,
+                'created_at': Timestamp(item['created_at']).internal,
+                'size': int(item['size']),
+                'content_type': item['content_type'],
+                'etag': item['etag'],
+                'deleted': deleted,
+                'storage_policy_index': int(
+                    item.get('storage_policy_index', policy_index))}
+
     @public
     @timing_stats(sample_rate=0.1)
     def HEAD(self, req):
@@ -465,7 +529,7 @@ class ContainerController(BaseStorageServer):
         resp_headers = gen_resp_headers(info, is_deleted=is_deleted)
         if is_deleted:
             return HTTPNotFound(request=req, headers=resp_headers)
-        container_list = broker.list_objects_iter(
+        container_list = broker.iter_objects(
             limit, marker, end_marker, prefix, delimiter, path,
             storage_policy_index=info['storage_policy_index'])
         return self.create_listing(req, out_content_type, info, resp_headers,
@@ -477,19 +541,62 @@ class ContainerController(BaseStorageServer):
             if value and (key.lower() in self.save_headers or
                           is_sys_or_user_meta('container', key)):
                 resp_headers[key] = value
-        ret = Response(request=req, headers=resp_headers,
-                       content_type=out_content_type, charset='utf-8')
+        container_list = iter(container_list)
         if out_content_type == 'application/json':
-            ret.body = json.dumps([self.update_data_record(record)
-                                   for record in container_list])
+            body = self._json_listing(container_list)
         elif out_content_type.endswith('/xml'):
-            doc = Element('container', name=container.decode('utf-8'))
-            for obj in container_list:
+            body = self._xml_listing(container_list, container)
+        else:
+            first = next(container_list, None)
+            if first is None:
+                return HTTPNoContent(request=req, headers=resp_headers)
+            body = ('%s\n' % rec[0] for rec in
+                    itertools.chain([first], container_list))
+        ret = Response(request=req, headers=resp_headers,
+                       content_type=out_content_type, charset='utf-8')
+        set_listing_body(ret, body)
+        return ret
+
+    def _json_listing(self, container_list):
+        """
+        Serialize a listing to JSON a batch of records at a time.
+
+        :param container_list: iterator of the records
+        """
+        yield '['
+        separator = ''
+        while True:
+            batch = [self.update_data_record(record) for record in
+                     itertools.islice(container_list,
+                                      LISTING_SERIALIZE_BATCH)]
+            if not batch:
+                break
+            yield separator + json.dumps(batch)[1:-1]
+            separator = ', '
+        yield ']'
+
+    def _xml_listing(self, container_list, container):
+        """
+        Serialize a listing to XML a batch of records at a time.
+
+        :param container_list: iterator of the records
+        :param container: name of the container
+        """
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        name = container.decode('utf-8')
+        # the empty document, '<container name="..." />'
+        empty = tostring(Element('container', name=name), encoding='utf-8')
+        start = empty[:-len(' />')] + '>'
+        started = False
+        while True:
+            doc = Element('container', name=name)
+            for obj in itertools.islice(container_list,
+                                        LISTING_SERIALIZE_BATCH):
                 record = self.update_data_record(obj)
                 if 'subdir' in record:
-                    name = record['subdir'].decode('utf-8')
-                    sub = SubElement(doc, 'subdir', name=name)
-                    SubElement(sub, 'name').text = name
+                    subdir = record['subdir'].decode('utf-8')
+                    sub = SubElement(doc, 'subdir', name=subdir)
+                    SubElement(sub, 'name').text = subdir
                 else:
                     obj_element = SubElement(doc, 'object')
                     for field in ["name", "hash", "bytes", "content_type",
@@ -499,14 +606,15 @@ class ContainerController(BaseStorageServer):
                     for field in sorted(record):
                         SubElement(obj_element, field).text = str(
                             record[field]).decode('utf-8')
-            ret.body = tostring(doc, encoding='UTF-8').replace(
-                "<?xml version='1.0' encoding='UTF-8'?>",
-                '<?xml version="1.0" encoding="UTF-8"?>', 1)
-        else:
-            if not container_list:
-                return HTTPNoContent(request=req, headers=resp_headers)
-            ret.body = '\n'.join(rec[0] for rec in container_list) + '\n'
-        return ret
+            if not len(doc):
+                break
+            if not started:
+                yield start
+                started = True
+            # just the records, without the start and end tags
+            yield tostring(doc, encoding='utf-8')[
+                len(start):-len('</container>')]
+        yield '</container>' if started else empty
 
     @public
     @replication
@@ -520,7 +628,7 @@ class ContainerController(BaseStorageServer):
         if self.mount_check and not check_mount(self.root, drive):
             return HTTPInsufficientStorage(drive=drive, request=req)
         try:
-            args = json.load(req.environ['wsgi.input'])
+            args = load_replicate_args(req)
         except ValueError as err:
             return HTTPBadRequest(body=str(err), content_type='text/plain')
         ret = self.replicator_rpc.dispatch(post_args, args)
@@ -25,14 +25,16 @@ from tempfile import mkstemp
 from eventlet import spawn, patcher, Timeout
 
 import swift.common.db
-from swift.container.backend import ContainerBroker, DATADIR
+from swift.container.backend import ContainerBroker, DATADIR, DIRTY_DIR, \
+    pop_dirty_journal
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
 from swift.common.ring import Ring
 from swift.common.utils import get_logger, config_true_value, ismount, \
-    dump_recon_cache, quorum_size, Timestamp
+    dump_recon_cache, quorum_size, Timestamp, json
 from swift.common.daemon import Daemon
-from swift.common.http import is_success, HTTP_INTERNAL_SERVER_ERROR
+from swift.common.http import is_success, HTTP_INTERNAL_SERVER_ERROR, \
+    HTTP_METHOD_NOT_ALLOWED
 
 
 class ContainerUpdater(Daemon):
@@ -50,6 +52,12 @@ class ContainerUpdater(Daemon):
         self.slowdown = float(conf.get('slowdown', 0.01))
         self.node_timeout = int(conf.get('node_timeout', 3))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
+        self.full_sweep_interval = float(conf.get('full_sweep_interval',
+                                                  86400))
+        self.last_full_sweep = 0
+        self.account_update_batch_size = int(
+            conf.get('account_update_batch_size', 1))
+        self.pending_reports = {}
         self.no_changes = 0
         self.successes = 0
         self.failures = 0
@@ -98,6 +106,32 @@ class ContainerUpdater(Daemon):
         shuffle(paths)
         return paths
 
+    def get_dirty_paths(self):
+        """
+        Get paths to the partitions on each drive to be processed that have
+        containers marked dirty since they were last processed.
+
+        :returns: a list of paths
+        """
+        paths = []
+        for device in self._listdir(self.devices):
+            dev_path = os.path.join(self.devices, device)
+            if self.mount_check and not ismount(dev_path):
+                self.logger.warn(_('%s is not mounted'), device)
+                continue
+            dirty_path = os.path.join(dev_path, DIRTY_DIR)
+            if not os.path.exists(dirty_path):
+                continue
+            for partition in self._listdir(dirty_path):
+                paths.append(os.path.join(dev_path, DATADIR, partition))
+        shuffle(paths)
+        return paths
+
+    def _get_journal(self, path):
+        """Get the dirty container journal for a partition path."""
+        datadir, partition = os.path.split(path)
+        return os.path.join(os.path.dirname(datadir), DIRTY_DIR, partition)
+
     def _load_suppressions(self, filename):
         try:
             with open(filename, 'r') as tmpfile:
@@ -111,14 +145,64 @@ class ContainerUpdater(Daemon):
         finally:
             os.unlink(filename)
 
+    def _load_account_reports(self, filename):
+        """
+        Hold the container reports a sweep process left in a file, along
+        with those of the other processes, sending each account's reports
+        once account_update_batch_size of them have been gathered.
+        """
+        try:
+            with open(filename, 'r') as tmpfile:
+                for line in tmpfile:
+                    dbfile, info = json.loads(line)
+                    info = dict(
+                        (key, value.encode('utf-8')
+                         if isinstance(value, unicode) else value)
+                        for key, value in info.iteritems())
+                    broker = ContainerBroker(dbfile.encode('utf-8'),
+                                             logger=self.logger)
+                    self.queue_account_report(broker, info)
+        except Exception:
+            self.logger.exception(
+                _('ERROR with loading account reports from %s: ') % filename)
+        finally:
+            os.unlink(filename)
+
+    def spool_account_reports(self, tmpfile):
+        """
+        Write the container reports being held to a file rather than send
+        them, so the process that started this one can send them along
+        with the reports for the same accounts from other partitions.
+
+        :param tmpfile: file to write the reports to
+        """
+        for reports in self.pending_reports.itervalues():
+            for broker, info in reports:
+                print >>tmpfile, json.dumps([broker.db_file, dict(
+                    (key, info[key]) for key in (
+                        'account', 'container', 'put_timestamp',
+                        'delete_timestamp', 'object_count', 'bytes_used',
+                        'storage_policy_index'))])
+        self.pending_reports = {}
+
     def run_forever(self, *args, **kwargs):
         """
         Run the updator continuously.
         """
         time.sleep(random() * self.interval)
         while True:
-            self.logger.info(_('Begin container update sweep'))
             begin = time.time()
+            full_sweep = \
+                begin - self.last_full_sweep >= self.full_sweep_interval
+            if full_sweep:
+                self.logger.info(_('Begin container update sweep'))
+                paths = self.get_paths()
+                sweep = self.container_sweep
+            else:
+                self.logger.info(
+                    _('Begin container update sweep of dirty containers'))
+                paths = self.get_dirty_paths()
+                sweep = self.dirty_container_sweep
             now = time.time()
             expired_suppressions = \
                 [a for a, u in self.account_suppressions.iteritems()
@@ -128,27 +212,35 @@ class ContainerUpdater(Daemon):
             pid2filename = {}
             # read from account ring to ensure it's fresh
             self.get_account_ring().get_nodes('')
-            for path in self.get_paths():
+            for path in paths:
                 while len(pid2filename) >= self.concurrency:
                     pid = os.wait()[0]
                     try:
-                        self._load_suppressions(pid2filename[pid])
+                        self._load_suppressions(pid2filename[pid][0])
+                        self._load_account_reports(pid2filename[pid][1])
                     finally:
                         del pid2filename[pid]
                 fd, tmpfilename = mkstemp()
                 os.close(fd)
+                fd, reportsfilename = mkstemp()
+                os.close(fd)
                 pid = os.fork()
                 if pid:
-                    pid2filename[pid] = tmpfilename
+                    pid2filename[pid] = (tmpfilename, reportsfilename)
                 else:
                     signal.signal(signal.SIGTERM, signal.SIG_DFL)
                     patcher.monkey_patch(all=False, socket=True)
                     self.no_changes = 0
                     self.successes = 0
                     self.failures = 0
+                    self.pending_reports = {}
                     self.new_account_suppressions = open(tmpfilename, 'w')
                     forkbegin = time.time()
-                    self.container_sweep(path)
+                    sweep(path)
+                    # reports for accounts with containers in other
+                    # partitions are sent from here along with theirs
+                    with open(reportsfilename, 'w') as reportsfile:
+                        self.spool_account_reports(reportsfile)
                     elapsed = time.time() - forkbegin
                     self.logger.debug(
                         _('Container update sweep of %(path)s completed: '
@@ -161,14 +253,23 @@ class ContainerUpdater(Daemon):
             while pid2filename:
                 pid = os.wait()[0]
                 try:
-                    self._load_suppressions(pid2filename[pid])
+                    self._load_suppressions(pid2filename[pid][0])
+                    self._load_account_reports(pid2filename[pid][1])
                 finally:
                     del pid2filename[pid]
+            self.flush_account_reports()
             elapsed = time.time() - begin
             self.logger.info(_('Container update sweep completed: %.02fs'),
                              elapsed)
-            dump_recon_cache({'container_updater_sweep': elapsed},
-                             self.rcache, self.logger)
+            if full_sweep:
+                self.last_full_sweep = begin
+                dump_recon_cache({'container_updater_sweep': elapsed},
+                                 self.rcache, self.logger)
+            else:
+                dump_recon_cache({'container_updater_dirty_sweep': elapsed,
+                                  'container_updater_dirty_partitions':
+                                  len(paths)},
+                                 self.rcache, self.logger)
             if elapsed < self.interval:
                 time.sleep(self.interval - elapsed)
 
@@ -184,6 +285,7 @@ class ContainerUpdater(Daemon):
         self.failures = 0
         for path in self.get_paths():
             self.container_sweep(path)
+        self.flush_account_reports()
         elapsed = time.time() - begin
         self.logger.info(_(
             'Container update single threaded sweep completed: '
@@ -200,12 +302,26 @@ class ContainerUpdater(Daemon):
 
         :param path: path to walk
         """
+        # every container in the partition is about to be looked at
+        pop_dirty_journal(self._get_journal(path))
         for root, dirs, files in os.walk(path):
             for file in files:
                 if file.endswith('.db'):
                     self.process_container(os.path.join(root, file))
                     time.sleep(self.slowdown)
 
+    def dirty_container_sweep(self, path):
+        """
+        Process the container DBs in a partition that were marked dirty.
+
+        :param path: path to the partition
+        """
+        for hsh in pop_dirty_journal(self._get_journal(path)):
+            dbfile = os.path.join(path, hsh[-3:], hsh, hsh + '.db')
+            if os.path.exists(dbfile):
+                self.process_container(dbfile)
+                time.sleep(self.slowdown)
+
     def process_container(self, dbfile):
         """
         Process a container, and update the information in the account.
@@ -220,48 +336,150 @@ class ContainerUpdater(Daemon):
         if Timestamp(info['put_timestamp']) <= 0:
             return
         if self.account_suppressions.get(info['account'], 0) > time.time():
+            # look again once the suppression is over
+            broker.mark_dirty()
             return
         if info['put_timestamp'] > info['reported_put_timestamp'] or \
                 info['delete_timestamp'] > info['reported_delete_timestamp'] \
                 or info['object_count'] != info['reported_object_count'] or \
                 info['bytes_used'] != info['reported_bytes_used']:
-            container = '/%s/%s' % (info['account'], info['container'])
-            part, nodes = self.get_account_ring().get_nodes(info['account'])
-            events = [spawn(self.container_report, node, part, container,
-                            info['put_timestamp'], info['delete_timestamp'],
-                            info['object_count'], info['bytes_used'],
-                            info['storage_policy_index'])
-                      for node in nodes]
-            successes = 0
-            for event in events:
-                if is_success(event.wait()):
-                    successes += 1
-            if successes >= quorum_size(len(events)):
-                self.logger.increment('successes')
-                self.successes += 1
-                self.logger.debug(
-                    _('Update report sent for %(container)s %(dbfile)s'),
-                    {'container': container, 'dbfile': dbfile})
-                broker.reported(info['put_timestamp'],
-                                info['delete_timestamp'], info['object_count'],
-                                info['bytes_used'])
-            else:
-                self.logger.increment('failures')
-                self.failures += 1
-                self.logger.debug(
-                    _('Update report failed for %(container)s %(dbfile)s'),
-                    {'container': container, 'dbfile': dbfile})
-                self.account_suppressions[info['account']] = until = \
-                    time.time() + self.account_suppression_time
-                if self.new_account_suppressions:
-                    print >>self.new_account_suppressions, \
-                        info['account'], until
+            if self.account_update_batch_size > 1:
+                self.queue_account_report(broker, info)
+                return
+            self.report_container(broker, info)
             # Only track timing data for attempted updates:
             self.logger.timing_since('timing', start_time)
         else:
             self.logger.increment('no_changes')
             self.no_changes += 1
 
+    def report_container(self, broker, info):
+        """
+        Report a container's info to each of its account's servers.
+
+        :param broker: ContainerBroker of the container
+        :param info: the container's info, as from broker.get_info()
+        """
+        container = '/%s/%s' % (info['account'], info['container'])
+        part, nodes = self.get_account_ring().get_nodes(info['account'])
+        events = [spawn(self.container_report, node, part, container,
+                        info['put_timestamp'], info['delete_timestamp'],
+                        info['object_count'], info['bytes_used'],
+                        info['storage_policy_index'])
+                  for node in nodes]
+        successes = 0
+        for event in events:
+            if is_success(event.wait()):
+                successes += 1
+        if successes >= quorum_size(len(events)):
+            self._report_succeeded(broker, info)
+        else:
+            self._report_failed(broker, info)
+            self._suppress_account(info['account'])
+
+    def _report_succeeded(self, broker, info):
+        self.logger.increment('successes')
+        self.successes += 1
+        self.logger.debug(
+            _('Update report sent for /%(account)s/%(container)s '
+              '%(dbfile)s'),
+            {'account': info['account'], 'container': info['container'],
+             'dbfile': broker.db_file})
+        broker.reported(info['put_timestamp'], info['delete_timestamp'],
+                        info['object_count'], info['bytes_used'])
+
+    def _report_failed(self, broker, info):
+        self.logger.increment('failures')
+        self.failures += 1
+        self.logger.debug(
+            _('Update report failed for /%(account)s/%(container)s '
+              '%(dbfile)s'),
+            {'account': info['account'], 'container': info['container'],
+             'dbfile': broker.db_file})
+        broker.mark_dirty()
+
+    def _suppress_account(self, account):
+        self.account_suppressions[account] = until = \
+            time.time() + self.account_suppression_time
+        if self.new_account_suppressions:
+            print >>self.new_account_suppressions, account, until
+
+    def queue_account_report(self, broker, info):
+        """
+        Hold a container's report until account_update_batch_size reports
+        for its account have been gathered, from any partition, then send
+        them all at once.
+
+        :param broker: ContainerBroker of the container
+        :param info: the container's info, as from broker.get_info()
+        """
+        reports = self.pending_reports.setdefault(info['account'], [])
+        reports.append((broker, info))
+        if len(reports) >= self.account_update_batch_size:
+            self.flush_account_reports(info['account'])
+
+    def flush_account_reports(self, account=None):
+        """
+        Send the container reports held by queue_account_report.
+
+        :param account: only send the reports for this account; all held
+                        reports are sent if None
+        """
+        if account is None:
+            accounts = self.pending_reports.keys()
+        else:
+            accounts = [account]
+        for account in accounts:
+            reports = self.pending_reports.pop(account, None)
+            if not reports:
+                continue
+            if self.account_suppressions.get(account, 0) > time.time():
+                # held since before a report for the account failed
+                for broker, info in reports:
+                    broker.mark_dirty()
+            else:
+                self.report_account_batch(account, reports)
+
+    def report_account_batch(self, account, reports):
+        """
+        Report the info of several containers in one account to each of the
+        account's servers with one UPDATE request per server.  If any server
+        does not support UPDATE, the containers are reported one by one.
+
+        :param account: account name
+        :param reports: list of (broker, info) tuples for the containers
+        """
+        start_time = time.time()
+        rows = [{'name': info['container'],
+                 'put_timestamp': info['put_timestamp'],
+                 'delete_timestamp': info['delete_timestamp'],
+                 'object_count': info['object_count'],
+                 'bytes_used': info['bytes_used'],
+                 'storage_policy_index': info['storage_policy_index']}
+                for broker, info in reports]
+        part, nodes = self.get_account_ring().get_nodes(account)
+        events = [spawn(self.account_batch_report, node, part, account, rows)
+                  for node in nodes]
+        statuses = [event.wait() for event in events]
+        if HTTP_METHOD_NOT_ALLOWED in statuses:
+            for broker, info in reports:
+                if self.account_suppressions.get(account, 0) > time.time():
+                    broker.mark_dirty()
+                else:
+                    self.report_container(broker, info)
+            return
+        successes = len([status for status in statuses
+                         if is_success(status)])
+        if successes >= quorum_size(len(events)):
+            self.logger.increment('batches')
+            for broker, info in reports:
+                self._report_succeeded(broker, info)
+        else:
+            for broker, info in reports:
+                self._report_failed(broker, info)
+            self._suppress_account(account)
+        self.logger.timing_since('timing', start_time)
+
     def container_report(self, node, part, container, put_timestamp,
                          delete_timestamp, count, bytes,
                          storage_policy_index):
@@ -307,3 +525,44 @@ class ContainerUpdater(Daemon):
                 return HTTP_INTERNAL_SERVER_ERROR
             finally:
                 conn.close()
+
+    def account_batch_report(self, node, part, account, rows):
+        """
+        Report the info of several containers to an account server.
+
+        :param node: node dictionary from the account ring
+        :param part: partition the account is on
+        :param account: account name
+        :param rows: list of container row dicts, each with the keys name,
+                     put_timestamp, delete_timestamp, object_count,
+                     bytes_used and storage_policy_index
+        """
+        body = json.dumps(rows)
+        with ConnectionTimeout(self.conn_timeout):
+            try:
+                headers = {
+                    'X-Account-Override-Deleted': 'yes',
+                    'Content-Type': 'application/json',
+                    'Content-Length': str(len(body)),
+                    'user-agent': self.user_agent}
+                conn = http_connect(
+                    node['ip'], node['port'], node['device'], part,
+                    'UPDATE', '/' + account, headers=headers)
+            except (Exception, Timeout):
+                self.logger.exception(_(
+                    'ERROR account update failed with '
+                    '%(ip)s:%(port)s/%(device)s (will retry later): '), node)
+                return HTTP_INTERNAL_SERVER_ERROR
+        with Timeout(self.node_timeout):
+            try:
+                conn.send(body)
+                resp = conn.getresponse()
+                resp.read()
+                return resp.status
+            except (Exception, Timeout):
+                if self.logger.getEffectiveLevel() <= logging.DEBUG:
+                    self.logger.exception(
+                        _('Exception with %(ip)s:%(port)s/%(device)s'), node)
+                return HTTP_INTERNAL_SERVER_ERROR
+            finally:
+                conn.close()
@@ -34,17 +34,22 @@ import cPickle as pickle
 import errno
 import fcntl
 import os
+import struct
 import time
 import uuid
 import hashlib
 import logging
+import sys
+import threading
 import traceback
 import xattr
+from binascii import hexlify, unhexlify
 from os.path import basename, dirname, exists, getmtime, join, splitext
 from random import shuffle
 from tempfile import mkstemp
 from contextlib import contextmanager
 from collections import defaultdict
+from Queue import Queue, Empty
 
 from eventlet import Timeout
 from eventlet.hubs import trampoline
@@ -71,7 +76,11 @@ from functools import partial
 
 PICKLE_PROTOCOL = 2
 ONE_WEEK = 604800
-HASH_FILE = 'hashes.pkl'
+HASH_FILE = 'hashes.bin'
+HASH_FILE_MAGIC = 'SWHS'
+HASH_FILE_VERSION = 1
+HASH_INVALIDATIONS_FILE = 'hashes.invalid'
+LEGACY_HASH_FILE = 'hashes.pkl'
 METADATA_KEY = 'user.swift.metadata'
 DROP_CACHE_WINDOW = 1024 * 1024
 # These are system-set metadata keys that cannot be changed with a POST.
@@ -339,33 +348,251 @@ def hash_suffix(path, reclaim_age):
     return md5.hexdigest()
 
 
+def _pack_digest(hexdigest):
+    if len(hexdigest) != 32:
+        raise ValueError('Invalid suffix hash %r' % (hexdigest,))
+    return unhexlify(hexdigest)
+
+
+def serialize_hashes(hashes):
+    """
+    Pack a partition's suffix hashes into the compact form kept in its
+    hashes file: a magic string, version and the number of suffixes,
+    followed by one record per suffix of the suffix's length and name, a
+    type byte and the binary MD5 digest(s).  The type is 0 for an
+    invalidated suffix (no digest), 1 for a single digest, or 2 for a dict
+    of digests keyed by fragment index (preceded by their count, each with
+    its index, -1 meaning None).
+
+    :param hashes: dict of suffix hashes, as returned by get_hashes
+    :returns: string of packed hashes
+    """
+    packed = [struct.pack('!4sBI', HASH_FILE_MAGIC, HASH_FILE_VERSION,
+                          len(hashes))]
+    for suffix, hash_ in sorted(hashes.items()):
+        packed.append(chr(len(suffix)) + suffix)
+        if hash_ is None:
+            packed.append('\x00')
+        elif isinstance(hash_, dict):
+            packed.append(struct.pack('!BH', 2, len(hash_)))
+            for frag_index, frag_hash in sorted(hash_.items()):
+                if frag_index is None:
+                    frag_index = -1
+                packed.append(struct.pack('!h', frag_index) +
+                              _pack_digest(frag_hash))
+        else:
+            packed.append('\x01' + _pack_digest(hash_))
+    return ''.join(packed)
+
+
+def deserialize_hashes(packed):
+    """
+    Unpack suffix hashes packed by serialize_hashes.
+
+    :param packed: string of packed hashes
+    :returns: dict of suffix hashes
+    :raises ValueError: if packed is not a complete set of packed hashes
+    """
+    try:
+        magic, version, count = struct.unpack_from('!4sBI', packed)
+    except struct.error:
+        raise ValueError('Truncated hashes file')
+    if magic != HASH_FILE_MAGIC or version != HASH_FILE_VERSION:
+        raise ValueError('Unknown hashes file format %r %r' % (
+            magic, version))
+    hashes = {}
+    offset = 9
+    try:
+        for _junk in xrange(count):
+            size = ord(packed[offset])
+            suffix = packed[offset + 1:offset + 1 + size]
+            offset += 1 + size
+            hash_type = packed[offset]
+            offset += 1
+            if hash_type == '\x00':
+                hashes[suffix] = None
+            elif hash_type == '\x01':
+                hashes[suffix] = hexlify(packed[offset:offset + 16])
+                offset += 16
+            elif hash_type == '\x02':
+                frag_count, = struct.unpack_from('!H', packed, offset)
+                offset += 2
+                hashes[suffix] = frag_hashes = {}
+                for _junk in xrange(frag_count):
+                    frag_index, = struct.unpack_from('!h', packed, offset)
+                    if frag_index < 0:
+                        frag_index = None
+                    frag_hashes[frag_index] = hexlify(
+                        packed[offset + 2:offset + 18])
+                    offset += 18
+            else:
+                raise ValueError('Unknown suffix hash type %r' % hash_type)
+    except (IndexError, struct.error):
+        offset = len(packed) + 1
+    if offset != len(packed) or len(hashes) != count:
+        raise ValueError('Invalid hashes file')
+    return hashes
+
+
+def read_hashes(partition_dir):
+    """
+    Read the suffix hashes of a partition from its hashes file.
+
+    :param partition_dir: absolute path of partition
+    :returns: dict of suffix hashes
+    :raises IOError: if the hashes file can't be read
+    :raises ValueError: if the hashes file is not valid
+    """
+    with open(join(partition_dir, HASH_FILE), 'rb') as fp:
+        return deserialize_hashes(fp.read())
+
+
+def write_hashes(partition_dir, hashes):
+    """
+    Write the suffix hashes of a partition to its hashes file.  The file is
+    written to a temporary file first, synced to disk, then moved into
+    place.  Any legacy pickled hashes file is removed, as it could only be
+    out of date from then on.
+
+    :param partition_dir: absolute path of partition
+    :param hashes: dict of suffix hashes
+    """
+    packed = serialize_hashes(hashes)
+    fd, tmppath = mkstemp(dir=partition_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(packed)
+        fp.flush()
+        fsync(fd)
+        renamer(tmppath, join(partition_dir, HASH_FILE))
+    remove_file(join(partition_dir, LEGACY_HASH_FILE))
+
+
 def invalidate_hash(suffix_dir):
     """
     Invalidates the hash for a suffix_dir in the partition's hashes file.
 
+    Rather than rewriting the hashes file, the suffix is appended to the
+    partition's invalidations journal, which has a lock of its own.  The
+    journal is folded into the hashes file by the next get_hashes call.
+
     :param suffix_dir: absolute path to suffix dir whose hash needs
                        invalidating
     """
 
     suffix = basename(suffix_dir)
     partition_dir = dirname(suffix_dir)
-    hashes_file = join(partition_dir, HASH_FILE)
-    if not os.path.exists(hashes_file):
+    if not (os.path.exists(join(partition_dir, HASH_FILE)) or
+            os.path.exists(join(partition_dir, LEGACY_HASH_FILE))):
         return
+    invalidations_file = join(partition_dir, HASH_INVALIDATIONS_FILE)
+    with lock_path(partition_dir, name=HASH_INVALIDATIONS_FILE):
+        with open(invalidations_file, 'ab') as inv_fh:
+            inv_fh.write(suffix + '\n')
+
+
+def consolidate_hashes(partition_dir):
+    """
+    Load the partition's hashes file and apply the invalidations journal to
+    it, writing the hashes file back out and emptying the journal if there
+    was anything in it.  A partition that still only has a legacy pickled
+    hashes file has it converted.
+
+    :param partition_dir: absolute path of partition whose hashes to load
+    :returns: dict of suffix hashes, with invalidated suffixes set to None
+    :raises: whatever opening or reading the hashes file raises
+    """
+    invalidations_file = join(partition_dir, HASH_INVALIDATIONS_FILE)
     with lock_path(partition_dir):
         try:
-            with open(hashes_file, 'rb') as fp:
+            hashes = read_hashes(partition_dir)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            with open(join(partition_dir, LEGACY_HASH_FILE), 'rb') as fp:
                 hashes = pickle.load(fp)
-            if suffix in hashes and not hashes[suffix]:
-                return
-        except Exception:
-            return
-        hashes[suffix] = None
-        write_pickle(hashes, hashes_file, partition_dir, PICKLE_PROTOCOL)
+            write_hashes(partition_dir, hashes)
+        with lock_path(partition_dir, name=HASH_INVALIDATIONS_FILE):
+            try:
+                with open(invalidations_file, 'rb') as inv_fh:
+                    suffixes = inv_fh.read().split()
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                suffixes = []
+            if suffixes:
+                hashes.update((suffix, None) for suffix in suffixes)
+                write_hashes(partition_dir, hashes)
+                with open(invalidations_file, 'wb'):
+                    pass
+    return hashes
+
+
+def hash_suffixes(partition_dir, suffixes, reclaim_age=ONE_WEEK,
+                  threads=1, hash_suffix_func=None):
+    """
+    Hash the given suffix dirs of a partition, up to threads at a time.
+
+    get_hashes always runs outside of the eventlet hub (in the diskfile
+    ThreadPool or eventlet's tpool), so the suffixes are shared out between
+    plain threads, which run concurrently as they wait on the disk.
+
+    :param partition_dir: absolute path of partition the suffixes are in
+    :param suffixes: list of suffixes to hash
+    :param reclaim_age: age at which to remove tombstones
+    :param threads: maximum number of suffix dirs to hash at once
+    :param hash_suffix_func: function to hash a single suffix dir with,
+                             defaults to hash_suffix
+    :returns: list of (suffix, hash) tuples; the hash is None if the suffix
+              dir no longer exists, and suffixes that could not be hashed
+              are logged and left out
+    """
+    hash_suffix_func = hash_suffix_func or hash_suffix
+    results = []
+
+    def hash_one(suffix):
+        try:
+            results.append((suffix, hash_suffix_func(
+                join(partition_dir, suffix), reclaim_age)))
+        except PathNotDir:
+            results.append((suffix, None))
+        except OSError:
+            logging.exception(_('Error hashing suffix'))
+
+    threads = min(threads, len(suffixes))
+    if threads <= 1:
+        for suffix in suffixes:
+            hash_one(suffix)
+        return results
+
+    queue = Queue()
+    for suffix in suffixes:
+        queue.put(suffix)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                suffix = queue.get(block=False)
+            except Empty:
+                break
+            try:
+                hash_one(suffix)
+            except BaseException:
+                errors.append(sys.exc_info())
+
+    workers = [threading.Thread(target=worker) for _junk in xrange(threads)]
+    for thr in workers:
+        thr.daemon = True
+        thr.start()
+    for thr in workers:
+        thr.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
 
 
 def get_hashes(partition_dir, recalculate=None, do_listdir=False,
-               reclaim_age=ONE_WEEK):
+               reclaim_age=ONE_WEEK, threads=1, hash_suffix_func=None):
     """
     Get a list of hashes for the suffix dir.  do_listdir causes it to mistrust
     the hash cache for suffix existence at the (unexpectedly high) cost of a
@@ -375,6 +602,9 @@ def get_hashes(partition_dir, recalculate=None, do_listdir=False,
     :param recalculate: list of suffixes which should be recalculated when got
     :param do_listdir: force existence check for all hashes in the partition
     :param reclaim_age: age at which to remove tombstones
+    :param threads: number of suffix dirs to rehash concurrently
+    :param hash_suffix_func: function to hash a single suffix dir with,
+                             defaults to hash_suffix
 
     :returns: tuple of (number of suffix dirs hashed, dictionary of hashes)
     """
@@ -390,8 +620,7 @@ def get_hashes(partition_dir, recalculate=None, do_listdir=False,
         recalculate = []
 
     try:
-        with open(hashes_file, 'rb') as fp:
-            hashes = pickle.load(fp)
+        hashes = consolidate_hashes(partition_dir)
         mtime = getmtime(hashes_file)
     except Exception:
         do_listdir = True
@@ -402,26 +631,24 @@ def get_hashes(partition_dir, recalculate=None, do_listdir=False,
                 hashes.setdefault(suff, None)
         modified = True
     hashes.update((suffix, None) for suffix in recalculate)
-    for suffix, hash_ in hashes.items():
-        if not hash_:
-            suffix_dir = join(partition_dir, suffix)
-            try:
-                hashes[suffix] = hash_suffix(suffix_dir, reclaim_age)
-                hashed += 1
-            except PathNotDir:
-                del hashes[suffix]
-            except OSError:
-                logging.exception(_('Error hashing suffix'))
-            modified = True
+    suffixes = [suffix for suffix, hash_ in hashes.items() if not hash_]
+    if suffixes:
+        modified = True
+    for suffix, hash_ in hash_suffixes(partition_dir, suffixes, reclaim_age,
+                                       threads, hash_suffix_func):
+        if hash_ is None:
+            del hashes[suffix]
+        else:
+            hashes[suffix] = hash_
+            hashed += 1
     if modified:
         with lock_path(partition_dir):
             if force_rewrite or not exists(hashes_file) or \
                     getmtime(hashes_file) == mtime:
-                write_pickle(
-                    hashes, hashes_file, partition_dir, PICKLE_PROTOCOL)
+                write_hashes(partition_dir, hashes)
                 return hashed, hashes
         return get_hashes(partition_dir, recalculate, do_listdir,
-                          reclaim_age)
+                          reclaim_age, threads, hash_suffix_func)
     else:
         return hashed, hashes
 
@@ -577,7 +804,6 @@ class DiskFileManager(object):
 
     # module level functions dropped to implementation specific
     hash_cleanup_listdir = strip_self(hash_cleanup_listdir)
-    _get_hashes = strip_self(get_hashes)
     invalidate_hash = strip_self(invalidate_hash)
     get_ondisk_files = strip_self(get_ondisk_files)
     quarantine_renamer = strip_self(quarantine_renamer)
@@ -597,6 +823,7 @@ class DiskFileManager(object):
         threads_per_disk = int(conf.get('threads_per_disk', '0'))
         self.threadpools = defaultdict(
             lambda: ThreadPool(nthreads=threads_per_disk))
+        self.suffix_hash_threads = int(conf.get('suffix_hash_threads', 1))
 
         self.use_splice = False
         self.pipe_size = None
@@ -756,6 +983,11 @@ class DiskFileManager(object):
                                  partition, account, container, obj,
                                  policy=policy, **kwargs)
 
+    def _get_hashes(self, partition_path, recalculate=None, do_listdir=False,
+                    reclaim_age=ONE_WEEK):
+        return get_hashes(partition_path, recalculate, do_listdir,
+                          reclaim_age, threads=self.suffix_hash_threads)
+
     def get_hashes(self, device, partition, suffixes, policy):
         dev_path = self.get_dev_path(device)
         if not dev_path:
@@ -1068,13 +1300,17 @@ class DiskFileReader(object):
     def can_zero_copy_send(self):
         return self._use_splice
 
-    def zero_copy_send(self, wsockfd):
+    def zero_copy_send(self, wsockfd, timeout=None, timeout_exc=Timeout):
         """
         Does some magic with splice() and tee() to move stuff from disk to
         network without ever touching userspace.
 
         :param wsockfd: file descriptor (integer) of the socket out which to
                         send data
+        :param timeout: seconds to wait each time the socket is not writable
+                        before giving up; None waits forever
+        :param timeout_exc: exception raised when timeout expires
+        :returns: the number of bytes sent
         """
         # Note: if we ever add support for zero-copy ranged GET responses,
         # we'll have to make this conditional.
@@ -1145,7 +1381,8 @@ class DiskFileReader(object):
                         bytes_in_pipe -= res[0]
                     except IOError as exc:
                         if exc.errno == errno.EWOULDBLOCK:
-                            trampoline(wsockfd, write=True)
+                            trampoline(wsockfd, write=True, timeout=timeout,
+                                       timeout_exc=timeout_exc)
                         else:
                             raise
 
@@ -1170,6 +1407,7 @@ class DiskFileReader(object):
             os.close(hash_wpipe)
             os.close(md5_sockfd)
             self.close()
+        return self._bytes_read
 
     def app_iter_range(self, start, stop):
         """Returns an iterator over the data file for range (start, stop)"""
@@ -2338,49 +2576,7 @@ class ECDiskFileManager(DiskFileManager):
         get_hashes is the call to hash_suffix routes to a method _hash_suffix
         on this instance.
         """
-        reclaim_age = reclaim_age or self.reclaim_age
-        hashed = 0
-        hashes_file = join(partition_path, HASH_FILE)
-        modified = False
-        force_rewrite = False
-        hashes = {}
-        mtime = -1
-
-        if recalculate is None:
-            recalculate = []
-
-        try:
-            with open(hashes_file, 'rb') as fp:
-                hashes = pickle.load(fp)
-            mtime = getmtime(hashes_file)
-        except Exception:
-            do_listdir = True
-            force_rewrite = True
-        if do_listdir:
-            for suff in os.listdir(partition_path):
-                if len(suff) == 3:
-                    hashes.setdefault(suff, None)
-            modified = True
-        hashes.update((suffix, None) for suffix in recalculate)
-        for suffix, hash_ in hashes.items():
-            if not hash_:
-                suffix_dir = join(partition_path, suffix)
-                try:
-                    hashes[suffix] = self._hash_suffix(suffix_dir, reclaim_age)
-                    hashed += 1
-                except PathNotDir:
-                    del hashes[suffix]
-                except OSError:
-                    logging.exception(_('Error hashing suffix'))
-                modified = True
-        if modified:
-            with lock_path(partition_path):
-                if force_rewrite or not exists(hashes_file) or \
-                        getmtime(hashes_file) == mtime:
-                    write_pickle(
-                        hashes, hashes_file, partition_path, PICKLE_PROTOCOL)
-                    return hashed, hashes
-            return self._get_hashes(partition_path, recalculate, do_listdir,
-                                    reclaim_age)
-        else:
-            return hashed, hashes
+        return get_hashes(partition_path, recalculate, do_listdir,
+                          reclaim_age or self.reclaim_age,
+                          threads=self.suffix_hash_threads,
+                          hash_suffix_func=self._hash_suffix)
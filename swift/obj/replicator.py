@@ -71,6 +71,7 @@ class ObjectReplicator(Daemon):
         self.ring_check_interval = int(conf.get('ring_check_interval', 15))
         self.next_check = time.time() + self.ring_check_interval
         self.reclaim_age = int(conf.get('reclaim_age', 86400 * 7))
+        self.suffix_hash_threads = int(conf.get('suffix_hash_threads', 1))
         self.partition_times = []
         self.run_pause = int(conf.get('run_pause', 30))
         self.rsync_timeout = int(conf.get('rsync_timeout', 900))
@@ -323,7 +324,8 @@ class ObjectReplicator(Daemon):
             hashed, local_hash = tpool_reraise(
                 get_hashes, job['path'],
                 do_listdir=(self.replication_count % 10) == 0,
-                reclaim_age=self.reclaim_age)
+                reclaim_age=self.reclaim_age,
+                threads=self.suffix_hash_threads)
             self.suffix_hash += hashed
             self.logger.update_stats('suffix.hashes', hashed)
             attempts_left = len(job['nodes'])
@@ -368,7 +370,8 @@ class ObjectReplicator(Daemon):
                     hashed, recalc_hash = tpool_reraise(
                         get_hashes,
                         job['path'], recalculate=suffixes,
-                        reclaim_age=self.reclaim_age)
+                        reclaim_age=self.reclaim_age,
+                        threads=self.suffix_hash_threads)
                     self.logger.update_stats('suffix.hashes', hashed)
                     local_hash = recalc_hash
                     suffixes = [suffix for suffix in local_hash if
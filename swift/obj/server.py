@@ -27,7 +27,8 @@ import math
 from swift import gettext_ as _
 from hashlib import md5
 
-from eventlet import sleep, wsgi, Timeout
+from eventlet import sleep, wsgi, Timeout, spawn_after
+from eventlet.event import Event
 
 from swift.common.utils import public, get_logger, \
     config_true_value, timing_stats, replication, \
@@ -41,10 +42,10 @@ from swift.common.exceptions import ConnectionTimeout, DiskFileQuarantined, \
     DiskFileDeviceUnavailable, DiskFileExpired, ChunkReadTimeout, \
     DiskFileXattrNotSupported
 from swift.obj import ssync_receiver
-from swift.common.http import is_success
+from swift.common.http import is_success, HTTP_METHOD_NOT_ALLOWED
 from swift.common.base_storage_server import BaseStorageServer
 from swift.common.request_helpers import get_name_and_placement, \
-    is_user_meta, is_sys_or_user_meta
+    is_user_meta, is_sys_or_user_meta, get_container_update_row
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPCreated, \
     HTTPInternalServerError, HTTPNoContent, HTTPNotFound, \
     HTTPPreconditionFailed, HTTPRequestTimeout, HTTPUnprocessableEntity, \
@@ -94,6 +95,31 @@ class EventletPlungerString(str):
         return wsgi.MINIMUM_CHUNK_SIZE + 1
 
 
+class ContainerUpdateBatch(object):
+    """
+    Object rows waiting to be sent to one container on one container server
+    in a single UPDATE request.
+
+    :param headers: headers of the first update in the batch
+    """
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.items = []
+        self.sent = False
+        self.result = Event()
+
+    def wait(self):
+        """
+        Wait for the batch to be sent.
+
+        :returns: True if the container server merged the batch, False if it
+                  failed, or None if the container server does not accept
+                  batched updates
+        """
+        return self.result.wait()
+
+
 class ObjectController(BaseStorageServer):
     """Implements the WSGI application for the Swift Object Server."""
 
@@ -141,6 +167,11 @@ class ObjectController(BaseStorageServer):
             (conf.get('expiring_objects_account_name') or 'expiring_objects')
         self.expiring_objects_container_divisor = \
             int(conf.get('expiring_objects_container_divisor') or 86400)
+        self.container_update_batch_delay = float(
+            conf.get('container_update_batch_delay', 0))
+        self.container_update_batch_size = int(
+            conf.get('container_update_batch_size', 100))
+        self._container_update_batches = {}
         # Initialization was successful, so now apply the network chunk size
         # parameter as the default read / write buffer size for the network
         # sockets.
@@ -183,6 +214,8 @@ class ObjectController(BaseStorageServer):
             conf.get('replication_failure_threshold') or 100)
         self.replication_failure_ratio = float(
             conf.get('replication_failure_ratio') or 1.0)
+        self.replication_updates_concurrency = max(1, int(
+            conf.get('replication_updates_concurrency') or 1))
 
     def get_diskfile(self, device, partition, account, container, obj,
                      policy, **kwargs):
@@ -215,36 +248,138 @@ class ObjectController(BaseStorageServer):
         :param policy: the associated BaseStoragePolicy instance
         """
         headers_out['user-agent'] = 'object-server %s' % os.getpid()
-        full_path = '/%s/%s/%s' % (account, container, obj)
         if all([host, partition, contdevice]):
-            try:
-                with ConnectionTimeout(self.conn_timeout):
-                    ip, port = host.rsplit(':', 1)
-                    conn = http_connect(ip, port, contdevice, partition, op,
-                                        full_path, headers_out)
-                with Timeout(self.node_timeout):
-                    response = conn.getresponse()
-                    response.read()
-                    if is_success(response.status):
-                        return
-                    else:
-                        self.logger.error(_(
-                            'ERROR Container update failed '
-                            '(saving for async update later): %(status)d '
-                            'response from %(ip)s:%(port)s/%(dev)s'),
-                            {'status': response.status, 'ip': ip, 'port': port,
-                             'dev': contdevice})
-            except (Exception, Timeout):
-                self.logger.exception(_(
-                    'ERROR container update failed with '
-                    '%(ip)s:%(port)s/%(dev)s (saving for async update later)'),
-                    {'ip': ip, 'port': port, 'dev': contdevice})
+            sent = None
+            if self.container_update_batch_delay > 0:
+                sent = self._batch_container_update(
+                    op, account, container, obj, host, partition,
+                    contdevice, headers_out)
+            if sent is None:
+                sent = self._send_container_update(
+                    op, account, container, obj, host, partition,
+                    contdevice, headers_out)
+            if sent:
+                return
         data = {'op': op, 'account': account, 'container': container,
                 'obj': obj, 'headers': headers_out}
         timestamp = headers_out['x-timestamp']
         self._diskfile_router[policy].pickle_async_update(
             objdevice, account, container, obj, data, timestamp, policy)
 
+    def _send_container_update(self, op, account, container, obj, host,
+                               partition, contdevice, headers_out):
+        """
+        Sends a single container update.
+
+        :returns: True if the container server accepted the update
+        """
+        full_path = '/%s/%s/%s' % (account, container, obj)
+        try:
+            with ConnectionTimeout(self.conn_timeout):
+                ip, port = host.rsplit(':', 1)
+                conn = http_connect(ip, port, contdevice, partition, op,
+                                    full_path, headers_out)
+            with Timeout(self.node_timeout):
+                response = conn.getresponse()
+                response.read()
+                if is_success(response.status):
+                    return True
+                else:
+                    self.logger.error(_(
+                        'ERROR Container update failed '
+                        '(saving for async update later): %(status)d '
+                        'response from %(ip)s:%(port)s/%(dev)s'),
+                        {'status': response.status, 'ip': ip, 'port': port,
+                         'dev': contdevice})
+        except (Exception, Timeout):
+            self.logger.exception(_(
+                'ERROR container update failed with '
+                '%(ip)s:%(port)s/%(dev)s (saving for async update later)'),
+                {'ip': ip, 'port': port, 'dev': contdevice})
+        return False
+
+    def _batch_container_update(self, op, account, container, obj, host,
+                                partition, contdevice, headers_out):
+        """
+        Adds a container update to the batch for its container on the given
+        container server, and waits for the batch to be sent.  A batch is
+        sent container_update_batch_delay seconds after its first update,
+        or as soon as it has container_update_batch_size updates.
+
+        :returns: True if the container server merged the batch, False if it
+                  failed, or None if the update should be sent on its own
+        """
+        item = get_container_update_row(op, obj, headers_out)
+        if item is None:
+            return None
+        key = (host, partition, contdevice, account, container)
+        batch = self._container_update_batches.get(key)
+        if batch is None:
+            batch = ContainerUpdateBatch(HeaderKeyDict(headers_out))
+            self._container_update_batches[key] = batch
+            spawn_after(self.container_update_batch_delay,
+                        self._send_container_update_batch, key, batch)
+        batch.items.append(item)
+        if len(batch.items) >= self.container_update_batch_size:
+            self._send_container_update_batch(key, batch)
+        return batch.wait()
+
+    def _send_container_update_batch(self, key, batch):
+        """
+        Sends a batch of container updates as one UPDATE request, and wakes
+        up everyone waiting on it.
+
+        :param key: tuple of (host, partition, device, account, container)
+                    the batch is for
+        :param batch: the ContainerUpdateBatch to send
+        """
+        if batch.sent:
+            return
+        batch.sent = True
+        if self._container_update_batches.get(key) is batch:
+            del self._container_update_batches[key]
+        host, partition, contdevice, account, container = key
+        body = json.dumps(batch.items)
+        headers = {
+            'X-Timestamp': batch.items[0]['created_at'],
+            'X-Backend-Storage-Policy-Index':
+            batch.items[0]['storage_policy_index'],
+            'x-trans-id': batch.headers.get('x-trans-id', '-'),
+            'user-agent': batch.headers['user-agent'],
+            'Content-Type': 'application/json',
+            'Content-Length': len(body)}
+        result = False
+        try:
+            with ConnectionTimeout(self.conn_timeout):
+                ip, port = host.rsplit(':', 1)
+                conn = http_connect(ip, port, contdevice, partition,
+                                    'UPDATE', '/%s/%s' % (account, container),
+                                    headers)
+            with Timeout(self.node_timeout):
+                conn.send(body)
+                response = conn.getresponse()
+                response.read()
+            if is_success(response.status):
+                result = True
+            elif response.status == HTTP_METHOD_NOT_ALLOWED:
+                # container server from before batched updates
+                result = None
+            else:
+                self.logger.error(_(
+                    'ERROR Container update batch of %(count)d failed '
+                    '(saving for async update later): %(status)d '
+                    'response from %(ip)s:%(port)s/%(dev)s'),
+                    {'count': len(batch.items), 'status': response.status,
+                     'ip': ip, 'port': port, 'dev': contdevice})
+        except (Exception, Timeout):
+            self.logger.exception(_(
+                'ERROR container update batch of %(count)d failed with '
+                '%(ip)s:%(port)s/%(dev)s (saving for async update later)'),
+                {'count': len(batch.items), 'ip': ip, 'port': port,
+                 'dev': contdevice})
+        finally:
+            batch.result.send(result)
+
     def container_update(self, op, account, container, obj, request,
                          headers_out, objdevice, policy):
         """
@@ -881,7 +1016,11 @@ class ObjectController(BaseStorageServer):
     @replication
     @timing_stats(sample_rate=0.1)
     def SSYNC(self, request):
-        return Response(app_iter=ssync_receiver.Receiver(self, request)())
+        receiver = ssync_receiver.Receiver(self, request)
+        resp = Response(app_iter=receiver())
+        if receiver.pipelined:
+            resp.headers['X-Backend-Ssync-Pipeline'] = 'True'
+        return resp
 
     def __call__(self, env, start_response):
         """WSGI Application entry point for the Swift Object Server."""
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import urllib
+from cStringIO import StringIO
 
 import eventlet
 import eventlet.wsgi
@@ -58,6 +59,10 @@ class Receiver(object):
         3. Updates: Sender sends the object information requested.
 
         4. Close down: Release semaphore lock, etc.
+
+    A sender that sends the `X-Backend-Ssync-Pipeline` header is sent the
+    hashes wanted in the missing check as they are found, and is told so
+    with the same header in the response; see :py:meth:`missing_check`.
     """
 
     def __init__(self, app, request):
@@ -66,6 +71,8 @@ class Receiver(object):
         self.device = None
         self.partition = None
         self.fp = None
+        self.pipelined = utils.config_true_value(
+            request.headers.get('X-Backend-Ssync-Pipeline'))
         # We default to dropping the connection in case there is any exception
         # raised during processing because otherwise the sender could send for
         # quite some time before realizing it was all in vain.
@@ -216,6 +223,13 @@ class Receiver(object):
         The collection and then response is so the sender doesn't
         have to read while it writes to ensure network buffers don't
         fill up and block everything.
+
+        A pipelined sender reads the response from before it sends its
+        first `hash timestamp` line, so it is instead sent
+        `:MISSING_CHECK: START` at step 2 and each hash wanted as soon as
+        it is found. Hashes it has sent that are still buffered for the
+        receiver to check no longer hold up the start of the UPDATES step.
+        A sender must never ask for this unless it reads while it writes.
         """
         with exceptions.MessageTimeout(
                 self.app.client_timeout, 'missing_check start'):
@@ -223,6 +237,8 @@ class Receiver(object):
         if line.strip() != ':MISSING_CHECK: START':
             raise Exception(
                 'Looking for :MISSING_CHECK: START got %r' % line[:1024])
+        if self.pipelined:
+            yield ':MISSING_CHECK: START\r\n'
         object_hashes = []
         while True:
             with exceptions.MessageTimeout(
@@ -249,10 +265,14 @@ class Receiver(object):
                 else:
                     want = df.timestamp < timestamp
             if want:
-                object_hashes.append(object_hash)
-        yield ':MISSING_CHECK: START\r\n'
-        yield '\r\n'.join(object_hashes)
-        yield '\r\n'
+                if self.pipelined:
+                    yield object_hash + '\r\n'
+                else:
+                    object_hashes.append(object_hash)
+        if not self.pipelined:
+            yield ':MISSING_CHECK: START\r\n'
+            yield '\r\n'.join(object_hashes)
+            yield '\r\n'
         yield ':MISSING_CHECK: END\r\n'
         for data in self._ensure_flush():
             yield data
@@ -294,14 +314,29 @@ class Receiver(object):
         thresholds) so the sender knows the whole was not entirely a
         success. This is so the sender knows if it can remove an out
         of place partition, for example.
+
+        Up to replication_updates_concurrency subrequests are routed at
+        once. A PUT subrequest is only routed alongside others if its body
+        fits in network_chunk_size, as it has to be read in whole before
+        the next subrequest can be read.
         """
         with exceptions.MessageTimeout(
                 self.app.client_timeout, 'updates start'):
             line = self.fp.readline(self.app.network_chunk_size)
         if line.strip() != ':UPDATES: START':
             raise Exception('Looking for :UPDATES: START got %r' % line[:1024])
-        successes = 0
-        failures = 0
+        concurrency = self.app.replication_updates_concurrency
+        pool = eventlet.GreenPool(concurrency)
+        counts = {'successes': 0, 'failures': 0}
+
+        def route_subreq(subreq):
+            resp = subreq.get_response(self.app)
+            if http.is_success(resp.status_int) or \
+                    resp.status_int == http.HTTP_NOT_FOUND:
+                counts['successes'] += 1
+            else:
+                counts['failures'] += 1
+
         while True:
             with exceptions.MessageTimeout(
                     self.app.client_timeout, 'updates line'):
@@ -333,6 +368,7 @@ class Receiver(object):
                 if header == 'content-length':
                     content_length = int(value)
             # Establish subrequest body, if needed.
+            inline = concurrency == 1
             if method == 'DELETE':
                 if content_length not in (None, 0):
                     raise Exception(
@@ -357,6 +393,11 @@ class Receiver(object):
                         yield chunk
                 subreq.environ['wsgi.input'] = utils.FileLikeIter(
                     subreq_iter())
+                if content_length > self.app.network_chunk_size:
+                    inline = True
+                elif not inline:
+                    subreq.environ['wsgi.input'] = StringIO(
+                        subreq.environ['wsgi.input'].read())
             else:
                 raise Exception('Invalid subrequest method %s' % method)
             subreq.headers['X-Backend-Storage-Policy-Index'] = int(self.policy)
@@ -365,29 +406,37 @@ class Receiver(object):
                 subreq.headers['X-Backend-Replication-Headers'] = \
                     ' '.join(replication_headers)
             # Route subrequest and translate response.
-            resp = subreq.get_response(self.app)
-            if http.is_success(resp.status_int) or \
-                    resp.status_int == http.HTTP_NOT_FOUND:
-                successes += 1
+            if inline:
+                route_subreq(subreq)
+                # The subreq may have failed, but we want to read the rest of
+                # the body from the remote side so we can continue on with
+                # the next subreq.
+                for junk in subreq.environ['wsgi.input']:
+                    pass
             else:
-                failures += 1
-            if failures >= self.app.replication_failure_threshold and (
-                    not successes or
-                    float(failures) / successes >
-                    self.app.replication_failure_ratio):
-                raise Exception(
-                    'Too many %d failures to %d successes' %
-                    (failures, successes))
-            # The subreq may have failed, but we want to read the rest of the
-            # body from the remote side so we can continue on with the next
-            # subreq.
-            for junk in subreq.environ['wsgi.input']:
-                pass
-        if failures:
+                pool.spawn_n(route_subreq, subreq)
+            self._check_failures(counts)
+        pool.waitall()
+        self._check_failures(counts)
+        if counts['failures']:
             raise swob.HTTPInternalServerError(
                 'ERROR: With :UPDATES: %d failures to %d successes' %
-                (failures, successes))
+                (counts['failures'], counts['successes']))
         yield ':UPDATES: START\r\n'
         yield ':UPDATES: END\r\n'
         for data in self._ensure_flush():
             yield data
+
+    def _check_failures(self, counts):
+        """
+        Raises an Exception to hang up the request if too many of the
+        subrequests routed so far have failed.
+        """
+        successes, failures = counts['successes'], counts['failures']
+        if failures >= self.app.replication_failure_threshold and (
+                not successes or
+                float(failures) / successes >
+                self.app.replication_failure_ratio):
+            raise Exception(
+                'Too many %d failures to %d successes' %
+                (failures, successes))
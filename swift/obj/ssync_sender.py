@@ -13,11 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import socket
 import urllib
 from itertools import ifilter
+
+import eventlet
+import eventlet.queue
+
 from swift.common import bufferedhttp
 from swift.common import exceptions
 from swift.common import http
+from swift.common.utils import config_true_value
 
 
 class Sender(object):
@@ -49,6 +55,13 @@ class Sender(object):
         # be sync'ed; each entry is an object hash
         self.send_list = []
         self.failures = 0
+        # Set when the receiver sends the hashes it wants as it finds them,
+        # rather than all at once at the end of the missing check.
+        self.pipelined = False
+        # When pipelined, the hashes are read into this queue by the reader
+        # greenthread while updates sends them.
+        self.wanted = None
+        self.reader = None
 
     def __call__(self):
         """
@@ -131,6 +144,7 @@ class Sender(object):
                                       int(self.job['policy']))
             self.connection.putheader('X-Backend-Ssync-Frag-Index',
                                       self.node['index'])
+            self.connection.putheader('X-Backend-Ssync-Pipeline', 'True')
             self.connection.endheaders()
         with exceptions.MessageTimeout(
                 self.daemon.node_timeout, 'connect receive'):
@@ -139,6 +153,8 @@ class Sender(object):
                 raise exceptions.ReplicationException(
                     'Expected status %s; got %s' %
                     (http.HTTP_OK, self.response.status))
+            self.pipelined = config_true_value(
+                self.response.getheader('X-Backend-Ssync-Pipeline'))
 
     def readline(self):
         """
@@ -192,12 +208,38 @@ class Sender(object):
 
         Full documentation of this can be found at
         :py:meth:`.Receiver.missing_check`.
+
+        If the receiver is pipelined, it sends the hashes it wants while it
+        is still reading our list, so they are read by a greenthread of
+        their own from before the list is sent. Otherwise both sides could
+        block writing into full network buffers. :meth:`updates` then sends
+        the hashes as they come.
         """
         # First, send our list.
         with exceptions.MessageTimeout(
                 self.daemon.node_timeout, 'missing_check start'):
             msg = ':MISSING_CHECK: START\r\n'
             self.connection.send('%x\r\n%s\r\n' % (len(msg), msg))
+        if self.pipelined and self.remote_check_objs is None:
+            self.wanted = eventlet.queue.Queue()
+            self.reader = eventlet.spawn(self._read_wanted)
+        try:
+            self._send_hashes()
+        except (Exception, exceptions.Timeout):
+            if self.reader is not None:
+                self.reader.kill()
+            raise
+        if self.reader is None:
+            # Now, retrieve the list of what they want.
+            self._wait_for_wanted()
+            for object_hash in self._iter_wanted():
+                self.send_list.append(object_hash)
+
+    def _send_hashes(self):
+        """
+        Sends the hashes we have, and their timestamps, followed by the end
+        of our side of the MISSING_CHECK step.
+        """
         hash_gen = self.df_mgr.yield_hashes(
             self.job['device'], self.job['partition'],
             self.job['policy'], self.suffixes,
@@ -218,7 +260,12 @@ class Sender(object):
                 self.daemon.node_timeout, 'missing_check end'):
             msg = ':MISSING_CHECK: END\r\n'
             self.connection.send('%x\r\n%s\r\n' % (len(msg), msg))
-        # Now, retrieve the list of what they want.
+
+    def _wait_for_wanted(self):
+        """
+        Reads up to the start of the receiver's side of the MISSING_CHECK
+        step.
+        """
         while True:
             with exceptions.MessageTimeout(
                     self.daemon.http_timeout, 'missing_check start wait'):
@@ -231,6 +278,12 @@ class Sender(object):
             elif line:
                 raise exceptions.ReplicationException(
                     'Unexpected response: %r' % line[:1024])
+
+    def _iter_wanted(self):
+        """
+        Reads the hashes the receiver wants up to the end of the
+        MISSING_CHECK step.
+        """
         while True:
             with exceptions.MessageTimeout(
                     self.daemon.http_timeout, 'missing_check line wait'):
@@ -242,7 +295,43 @@ class Sender(object):
                 break
             parts = line.split()
             if parts:
-                self.send_list.append(parts[0])
+                yield parts[0]
+
+    def _read_wanted(self):
+        """
+        Puts the hashes the receiver wants on the wanted queue, followed by
+        None, or the error that stopped them.
+
+        The response is read while our list and then updates are sent, so
+        the receiver never blocks on sending hashes while we block on
+        sending to it.
+        """
+        try:
+            self._wait_for_wanted()
+            for object_hash in self._iter_wanted():
+                self.wanted.put(object_hash)
+        except (Exception, exceptions.MessageTimeout) as err:
+            self.wanted.put(err)
+        else:
+            self.wanted.put(None)
+
+    def _iter_send_list(self):
+        """
+        Yields the hashes to send, as the reader greenthread gets them if the
+        receiver is pipelined.
+        """
+        if self.wanted is None:
+            for object_hash in self.send_list:
+                yield object_hash
+            return
+        while True:
+            object_hash = self.wanted.get()
+            if object_hash is None:
+                return
+            if isinstance(object_hash, BaseException):
+                raise object_hash
+            self.send_list.append(object_hash)
+            yield object_hash
 
     def updates(self):
         """
@@ -257,27 +346,12 @@ class Sender(object):
                 self.daemon.node_timeout, 'updates start'):
             msg = ':UPDATES: START\r\n'
             self.connection.send('%x\r\n%s\r\n' % (len(msg), msg))
-        for object_hash in self.send_list:
-            try:
-                df = self.df_mgr.get_diskfile_from_hash(
-                    self.job['device'], self.job['partition'], object_hash,
-                    self.job['policy'], frag_index=self.job.get('frag_index'))
-            except exceptions.DiskFileNotExist:
-                continue
-            url_path = urllib.quote(
-                '/%s/%s/%s' % (df.account, df.container, df.obj))
-            try:
-                df.open()
-                # EC reconstructor may have passed a callback to build
-                # an alternative diskfile...
-                df = self.job.get('sync_diskfile_builder', lambda *args: df)(
-                    self.job, self.node, df.get_metadata())
-            except exceptions.DiskFileDeleted as err:
-                self.send_delete(url_path, err.timestamp)
-            except exceptions.DiskFileError:
-                pass
-            else:
-                self.send_put(url_path, df)
+        try:
+            for object_hash in self._iter_send_list():
+                self.send_update(object_hash)
+        finally:
+            if self.reader is not None:
+                self.reader.kill()
         with exceptions.MessageTimeout(
                 self.daemon.node_timeout, 'updates end'):
             msg = ':UPDATES: END\r\n'
@@ -308,6 +382,31 @@ class Sender(object):
                 raise exceptions.ReplicationException(
                     'Unexpected response: %r' % line[:1024])
 
+    def send_update(self, object_hash):
+        """
+        Sends a PUT or DELETE subrequest for the object with the given hash.
+        """
+        try:
+            df = self.df_mgr.get_diskfile_from_hash(
+                self.job['device'], self.job['partition'], object_hash,
+                self.job['policy'], frag_index=self.job.get('frag_index'))
+        except exceptions.DiskFileNotExist:
+            return
+        url_path = urllib.quote(
+            '/%s/%s/%s' % (df.account, df.container, df.obj))
+        try:
+            df.open()
+            # EC reconstructor may have passed a callback to build
+            # an alternative diskfile...
+            df = self.job.get('sync_diskfile_builder', lambda *args: df)(
+                self.job, self.node, df.get_metadata())
+        except exceptions.DiskFileDeleted as err:
+            self.send_delete(url_path, err.timestamp)
+        except exceptions.DiskFileError:
+            pass
+        else:
+            self.send_put(url_path, df)
+
     def send_delete(self, url_path, timestamp):
         """
         Sends a DELETE subrequest with the given information.
@@ -331,11 +430,50 @@ class Sender(object):
         msg = '\r\n'.join(msg) + '\r\n\r\n'
         with exceptions.MessageTimeout(self.daemon.node_timeout, 'send_put'):
             self.connection.send('%x\r\n%s\r\n' % (len(msg), msg))
-        for chunk in df.reader():
+        reader = df.reader()
+        checker = getattr(reader, 'can_zero_copy_send', None)
+        if df.content_length and checker and checker():
+            self.zero_copy_send_put(reader, df.content_length)
+            return
+        for chunk in reader:
             with exceptions.MessageTimeout(
                     self.daemon.node_timeout, 'send_put chunk'):
                 self.connection.send('%x\r\n%s\r\n' % (len(chunk), chunk))
 
+    def zero_copy_send_put(self, reader, content_length):
+        """
+        Sends the body of a PUT subrequest as one chunk, moving it from
+        disk to the socket with splice() instead of through userspace.
+
+        The chunk length is announced up front, so if the reader does not
+        send exactly content_length bytes the stream can no longer be
+        framed and the whole SSYNC request is abandoned.
+        """
+        sock = self.connection.sock
+        # Cork so the chunk header and the start of the body share frames.
+        if hasattr(socket, 'TCP_CORK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            with exceptions.MessageTimeout(
+                    self.daemon.node_timeout, 'send_put chunk'):
+                self.connection.send('%x\r\n' % content_length)
+            # Only raised if the socket stays unwritable, never as a timer.
+            timeout_exc = exceptions.MessageTimeout(
+                self.daemon.node_timeout, 'send_put zero copy')
+            timeout_exc.cancel()
+            sent = reader.zero_copy_send(
+                sock.fileno(), timeout=self.daemon.node_timeout,
+                timeout_exc=timeout_exc)
+            if sent != content_length:
+                raise exceptions.ReplicationException(
+                    'Sent %d of %d bytes' % (sent, content_length))
+            with exceptions.MessageTimeout(
+                    self.daemon.node_timeout, 'send_put chunk'):
+                self.connection.send('\r\n')
+        finally:
+            if hasattr(socket, 'TCP_CORK'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
     def disconnect(self):
         """
         Closes down the connection to the object server once done
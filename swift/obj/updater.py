@@ -18,21 +18,24 @@ import os
 import signal
 import sys
 import time
+from collections import defaultdict
 from swift import gettext_ as _
 from random import random
 
-from eventlet import spawn, patcher, Timeout
+from eventlet import spawn, patcher, Timeout, GreenPool, GreenPile
 
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
+from swift.common.request_helpers import get_container_update_row
 from swift.common.ring import Ring
 from swift.common.utils import get_logger, renamer, write_pickle, \
-    dump_recon_cache, config_true_value, ismount
+    dump_recon_cache, config_true_value, ismount, json, ratelimit_sleep
 from swift.common.daemon import Daemon
-from swift.common.storage_policy import split_policy_string, PolicyError
+from swift.common.storage_policy import split_policy_string, PolicyError, \
+    POLICIES
 from swift.obj.diskfile import get_tmp_dir, ASYNCDIR_BASE
 from swift.common.http import is_success, HTTP_NOT_FOUND, \
-    HTTP_INTERNAL_SERVER_ERROR
+    HTTP_INTERNAL_SERVER_ERROR, HTTP_METHOD_NOT_ALLOWED, HTTP_BAD_REQUEST
 
 
 class ObjectUpdater(Daemon):
@@ -50,6 +53,10 @@ class ObjectUpdater(Daemon):
         self.slowdown = float(conf.get('slowdown', 0.01))
         self.node_timeout = int(conf.get('node_timeout', 10))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
+        self.concurrent_updates = int(conf.get('concurrent_updates', 0))
+        self.update_batch_size = int(conf.get('update_batch_size', 100))
+        self.objects_per_second = float(conf.get('objects_per_second', 0))
+        self.report_interval = float(conf.get('report_interval', 300))
         self.successes = 0
         self.failures = 0
         self.recon_cache_path = conf.get('recon_cache_path',
@@ -95,6 +102,8 @@ class ObjectUpdater(Daemon):
                 else:
                     signal.signal(signal.SIGTERM, signal.SIG_DFL)
                     patcher.monkey_patch(all=False, socket=True)
+                    # the device sweeps running at once share the budget
+                    self.objects_per_second /= self.concurrency
                     self.successes = 0
                     self.failures = 0
                     forkbegin = time.time()
@@ -146,6 +155,21 @@ class ObjectUpdater(Daemon):
 
         :param device: path to device
         """
+        if self.concurrent_updates > 0:
+            return self.concurrent_object_sweep(device)
+        for update_path, policy in self._iter_async_pendings(device):
+            self.process_object_update(update_path, device, policy)
+            time.sleep(self.slowdown)
+
+    def _iter_async_pendings(self, device):
+        """
+        Walk the async pending dirs for all policies on the device, removing
+        async pendings superseded by a newer one for the same object.
+
+        :param device: path to device
+        :returns: a generator of (update_path, policy) for the newest async
+                  pending of each object
+        """
         start_time = time.time()
         # loop through async pending dirs for all policies
         for asyncdir in self._listdir(device):
@@ -184,26 +208,85 @@ class ObjectUpdater(Daemon):
                         self.logger.increment("unlinks")
                         os.unlink(update_path)
                     else:
-                        self.process_object_update(update_path, device,
-                                                   policy)
                         last_obj_hash = obj_hash
-                    time.sleep(self.slowdown)
+                        yield update_path, policy
                 try:
                     os.rmdir(prefix_path)
                 except OSError:
                     pass
             self.logger.timing_since('timing', start_time)
 
-    def process_object_update(self, update_path, device, policy):
+    def concurrent_object_sweep(self, device):
         """
-        Process the object information to be updated and update.
+        Walk the async pendings on the device like object_sweep, but keep up
+        to concurrent_updates batches of updates in flight at once.  Async
+        pendings are grouped by container partition and sent to each
+        container server in batches of up to update_batch_size, and read at
+        no more than objects_per_second instead of sleeping slowdown seconds
+        after each one.
+
+        :param device: path to device
+        """
+        pool = GreenPool(self.concurrent_updates)
+        batches = defaultdict(list)
+        max_buffered = self.update_batch_size * self.concurrent_updates
+        buffered = 0
+        running_time = 0
+        start_failures = self.failures
+        start_time = last_report = time.time()
+        for update_path, policy in self._iter_async_pendings(device):
+            running_time = ratelimit_sleep(running_time,
+                                           self.objects_per_second)
+            update = self._load_update(update_path, device)
+            if update is None:
+                continue
+            part = self.get_container_ring().get_part(
+                update['account'], update['container'])
+            key = (int(policy), part)
+            batches[key].append((update_path, update))
+            buffered += 1
+            if len(batches[key]) >= self.update_batch_size or \
+                    buffered >= max_buffered:
+                if len(batches[key]) < self.update_batch_size:
+                    # many partitions with a few updates each; make room
+                    key = max(batches, key=lambda k: len(batches[k]))
+                batch = batches.pop(key)
+                buffered -= len(batch)
+                pool.spawn_n(self.process_update_batch, device,
+                             POLICIES.get_by_index(key[0]), key[1], batch)
+            if time.time() - last_report >= self.report_interval:
+                self._report_progress(device, start_time,
+                                      buffered + pool.running())
+                last_report = time.time()
+        for (policy_index, part), batch in batches.items():
+            pool.spawn_n(self.process_update_batch, device,
+                         POLICIES.get_by_index(policy_index), part, batch)
+        pool.waitall()
+        dump_recon_cache(
+            {'object_updater_backlog': {
+                os.path.basename(device): self.failures - start_failures}},
+            self.rcache, self.logger)
+
+    def _report_progress(self, device, start_time, pending):
+        self.logger.info(
+            _('Object update sweep of %(device)s in progress: '
+              '%(elapsed).02fs, %(success)s successes, %(fail)s failures, '
+              '%(pending)s pending'),
+            {'device': os.path.basename(device),
+             'elapsed': time.time() - start_time,
+             'success': self.successes, 'fail': self.failures,
+             'pending': pending})
+
+    def _load_update(self, update_path, device):
+        """
+        Load an async pending, quarantining it if it can not be read.
 
         :param update_path: path to pickled object update file
         :param device: path to device
-        :param policy: storage policy of object update
+        :returns: the object update dict, or None
         """
         try:
-            update = pickle.load(open(update_path, 'rb'))
+            return pickle.load(open(update_path, 'rb'))
         except Exception:
             self.logger.exception(
                 _('ERROR Pickle problem, quarantining %s'), update_path)
@@ -211,16 +294,31 @@ class ObjectUpdater(Daemon):
             target_path = os.path.join(device, 'quarantined', 'objects',
                                        os.path.basename(update_path))
             renamer(update_path, target_path, fsync=False)
+
+    def _get_update_headers(self, update, policy):
+        headers_out = update['headers'].copy()
+        headers_out['user-agent'] = 'object-updater %s' % os.getpid()
+        headers_out.setdefault('X-Backend-Storage-Policy-Index',
+                               str(int(policy)))
+        return headers_out
+
+    def process_object_update(self, update_path, device, policy):
+        """
+        Process the object information to be updated and update.
+
+        :param update_path: path to pickled object update file
+        :param device: path to device
+        :param policy: storage policy of object update
+        """
+        update = self._load_update(update_path, device)
+        if update is None:
             return
         successes = update.get('successes', [])
         part, nodes = self.get_container_ring().get_nodes(
             update['account'], update['container'])
         obj = '/%s/%s/%s' % \
               (update['account'], update['container'], update['obj'])
-        headers_out = update['headers'].copy()
-        headers_out['user-agent'] = 'object-updater %s' % os.getpid()
-        headers_out.setdefault('X-Backend-Storage-Policy-Index',
-                               str(int(policy)))
+        headers_out = self._get_update_headers(update, policy)
         events = [spawn(self.object_update,
                         node, part, update['op'], obj, headers_out)
                   for node in nodes if node['id'] not in successes]
@@ -233,6 +331,15 @@ class ObjectUpdater(Daemon):
                 new_successes = True
             else:
                 success = False
+        self._finish_update(update_path, update, device, policy, obj,
+                            success, successes, new_successes)
+
+    def _finish_update(self, update_path, update, device, policy, obj,
+                       success, successes, new_successes):
+        """
+        Remove an async pending whose update has reached every container
+        server, or record the container servers it has reached so far.
+        """
         if success:
             self.successes += 1
             self.logger.increment('successes')
@@ -250,6 +357,116 @@ class ObjectUpdater(Daemon):
                 write_pickle(update, update_path, os.path.join(
                     device, get_tmp_dir(policy)))
 
+    def process_update_batch(self, device, policy, part, batch):
+        """
+        Send the updates for a container partition to its container servers,
+        with one UPDATE request per container and server.
+
+        :param device: path to device
+        :param policy: storage policy of the object updates
+        :param part: partition that holds the containers
+        :param batch: list of (update_path, update) tuples
+        """
+        nodes = self.get_container_ring().get_part_nodes(part)
+        containers = defaultdict(list)
+        for update_path, update in batch:
+            containers[update['account'], update['container']].append(
+                (update_path, update))
+        for (account, container), updates in containers.items():
+            pile = GreenPile(len(nodes))
+            for node in nodes:
+                pile.spawn(self.container_batch_update, node, part, account,
+                           container, updates, policy)
+            node_results = list(pile)
+            for i, (update_path, update) in enumerate(updates):
+                successes = update.get('successes', [])
+                success = True
+                new_successes = False
+                for node, results in zip(nodes, node_results):
+                    if node['id'] in successes:
+                        continue
+                    if results[i]:
+                        successes.append(node['id'])
+                        new_successes = True
+                    else:
+                        success = False
+                obj = '/%s/%s/%s' % (account, container, update['obj'])
+                self._finish_update(update_path, update, device, policy, obj,
+                                    success, successes, new_successes)
+
+    def container_batch_update(self, node, part, account, container, updates,
+                               policy):
+        """
+        Send the updates for one container that a container server has not
+        had yet in one UPDATE request.  Updates go one by one to container
+        servers that do not support UPDATE, for updates that can not be
+        sent as an object row, and when the container server rejects the
+        UPDATE as a bad request, so one bad row can not hold back the rest.
+
+        :param node: node dictionary from the container ring
+        :param part: partition that holds the container
+        :param account: account name
+        :param container: container name
+        :param updates: list of (update_path, update) tuples
+        :param policy: storage policy of the object updates
+        :returns: a list of booleans, True for each update the container
+                  server has
+        """
+        results = [node['id'] in update.get('successes', [])
+                   for update_path, update in updates]
+        rows = []
+        row_indexes = []
+        singles = []
+        for i, (update_path, update) in enumerate(updates):
+            if results[i]:
+                continue
+            row = get_container_update_row(
+                update['op'], update['obj'],
+                self._get_update_headers(update, policy))
+            if row is None:
+                singles.append(i)
+            else:
+                rows.append(row)
+                row_indexes.append(i)
+        if rows:
+            body = json.dumps(rows)
+            headers_out = {
+                'X-Timestamp': rows[0]['created_at'],
+                'X-Backend-Storage-Policy-Index': str(int(policy)),
+                'user-agent': 'object-updater %s' % os.getpid(),
+                'Content-Type': 'application/json',
+                'Content-Length': str(len(body))}
+            path = '/%s/%s' % (account, container)
+            status = HTTP_INTERNAL_SERVER_ERROR
+            try:
+                with ConnectionTimeout(self.conn_timeout):
+                    conn = http_connect(node['ip'], node['port'],
+                                        node['device'], part, 'UPDATE', path,
+                                        headers_out)
+                with Timeout(self.node_timeout):
+                    conn.send(body)
+                    resp = conn.getresponse()
+                    resp.read()
+                    status = resp.status
+            except (Exception, Timeout):
+                self.logger.exception(_('ERROR with remote server '
+                                        '%(ip)s:%(port)s/%(device)s'), node)
+            if status in (HTTP_METHOD_NOT_ALLOWED, HTTP_BAD_REQUEST):
+                singles.extend(row_indexes)
+            else:
+                self.logger.increment('batches')
+                for i in row_indexes:
+                    results[i] = (is_success(status) or
+                                  status == HTTP_NOT_FOUND)
+        for i in sorted(singles):
+            update = updates[i][1]
+            obj = '/%s/%s/%s' % (account, container, update['obj'])
+            success, node_id = self.object_update(
+                node, part, update['op'], obj,
+                self._get_update_headers(update, policy))
+            results[i] = success is True
+        return results
+
     def object_update(self, node, part, op, obj, headers_out):
         """
         Perform the object update to the container
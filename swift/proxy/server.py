@@ -106,13 +106,19 @@ class Application(object):
             config_true_value(conf.get('allow_account_management', 'no'))
         self.object_post_as_copy = \
             config_true_value(conf.get('object_post_as_copy', 'true'))
-        self.container_ring = container_ring or Ring(swift_dir,
-                                                     ring_name='container')
-        self.account_ring = account_ring or Ring(swift_dir,
-                                                 ring_name='account')
+        ring_kwargs = {}
+        if config_true_value(conf.get('ring_precompute_part_nodes', 'no')):
+            ring_kwargs['precompute_part_nodes'] = True
+        handoff_cache_size = int(conf.get('ring_handoff_cache_size', 0))
+        if handoff_cache_size > 0:
+            ring_kwargs['handoff_cache_size'] = handoff_cache_size
+        self.container_ring = container_ring or Ring(
+            swift_dir, ring_name='container', **ring_kwargs)
+        self.account_ring = account_ring or Ring(
+            swift_dir, ring_name='account', **ring_kwargs)
         # ensure rings are loaded for all configured storage policies
         for policy in POLICIES:
-            policy.load_ring(swift_dir)
+            policy.load_ring(swift_dir, **ring_kwargs)
         self.obj_controller_router = ObjectControllerRouter()
         self.memcache = memcache
         mimetypes.init(mimetypes.knownfiles +
@@ -0,0 +1,331 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An in-process Swift cluster for benchmarking.
+
+A real :class:`swift.proxy.server.Application` is run in front of account,
+container and object servers, each listening on its own local socket and
+sharing a single devices root (tmpfs when available).  Two object storage
+policies are configured: a replicated default policy and an erasure coded
+policy, so that the same workload can be compared across policy types.
+"""
+
+import errno
+import logging
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import eventlet
+import eventlet.wsgi
+import xattr
+
+from swift.account import server as account_server
+from swift.common import storage_policy, utils
+from swift.common.bufferedhttp import http_connect_raw
+from swift.common.ring import RingBuilder
+from swift.common.storage_policy import StoragePolicy, ECStoragePolicy, \
+    StoragePolicyCollection
+from swift.common.wsgi import monkey_patch_mimetools
+from swift.container import server as container_server
+from swift.obj import server as object_server, mem_server
+from swift.proxy import server as proxy_server
+
+
+TMPFS_ROOT = '/dev/shm'
+REPLICATED_POLICY = 0
+EC_POLICY = 1
+
+
+class BenchMemcache(object):
+    """
+    Process local stand-in for memcached, so the proxy caches account and
+    container info the same way it would in a real deployment.
+    """
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, time=0, **kwargs):
+        self.store[key] = value
+        return True
+
+    def incr(self, key, delta=1, time=0):
+        self.store[key] = self.store.get(key, 0) + delta
+        return self.store[key]
+
+    def decr(self, key, delta=1, time=0):
+        return self.incr(key, delta=-delta, time=time)
+
+    def delete(self, key):
+        self.store.pop(key, None)
+        return True
+
+
+def bench_logger(name):
+    """
+    Get a logger that discards everything but errors.
+
+    :param name: server name to use in log lines
+    :returns: a :class:`swift.common.utils.LogAdapter`
+    """
+    logger = logging.getLogger('swift.bench.%s' % name)
+    logger.propagate = False
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.ERROR)
+    logger.statsd_client = None
+    return utils.LogAdapter(logger, name)
+
+
+def supports_xattr(path):
+    """
+    Check whether user extended attributes can be set under ``path``; tmpfs
+    only grew support for them in Linux 6.6.
+    """
+    probe = os.path.join(path, '.xattr_probe')
+    try:
+        with open(probe, 'w') as fp:
+            xattr.setxattr(fp.fileno(), 'user.swift.bench', '1')
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        try:
+            os.unlink(probe)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def make_devices_root(devices=None):
+    """
+    Create the directory that will hold all device directories.
+
+    :param devices: parent directory to use, defaults to tmpfs when it is
+                    available and supports xattrs, else the system tempdir
+    :returns: path of a new, empty directory
+    """
+    if devices:
+        return mkdtemp(dir=devices, prefix='swift-bench-')
+    if os.path.isdir(TMPFS_ROOT):
+        root = mkdtemp(dir=TMPFS_ROOT, prefix='swift-bench-')
+        if supports_xattr(root):
+            return root
+        rmtree(root, ignore_errors=True)
+    return mkdtemp(prefix='swift-bench-')
+
+
+class InProcessCluster(object):
+    """
+    A proxy plus account, container and object servers running as green
+    threads in the current process.
+
+    :param devices: parent directory for the devices root, see
+                    :func:`make_devices_root`
+    :param in_memory: use :mod:`swift.obj.mem_server` for object servers
+    :param part_power: part power of every ring
+    :param replicas: replica count for account, container and replicated
+                     object rings
+    :param ec_type: PyECLib ec_type of the erasure coded policy
+    :param ec_ndata: number of data fragments of the erasure coded policy
+    :param ec_nparity: number of parity fragments of the erasure coded policy
+    :param ec_segment_size: segment size of the erasure coded policy
+    :param conf: extra config applied to every server
+    """
+
+    def __init__(self, devices=None, in_memory=False, part_power=10,
+                 replicas=3, ec_type='jerasure_rs_vand', ec_ndata=4,
+                 ec_nparity=2, ec_segment_size=1048576, conf=None):
+        self.devices_parent = devices
+        self.in_memory = in_memory
+        self.part_power = part_power
+        self.replicas = replicas
+        self.ec_type = ec_type
+        self.ec_ndata = ec_ndata
+        self.ec_nparity = ec_nparity
+        self.ec_segment_size = ec_segment_size
+        self.extra_conf = dict(conf or {})
+        self.root = None
+        self.proxy = None
+        self.proxy_port = None
+        self.account_servers = []
+        self.container_servers = []
+        self.object_servers = []
+        self._coros = []
+        self._orig = None
+
+    def _build_ring(self, name, replicas, listeners, device_prefix):
+        builder = RingBuilder(self.part_power, replicas, 1)
+        for i, lis in enumerate(listeners):
+            builder.add_dev({'id': i, 'region': 1, 'zone': i,
+                             'ip': '127.0.0.1',
+                             'port': lis.getsockname()[1],
+                             'device': '%s%d' % (device_prefix, i),
+                             'weight': 100, 'meta': ''})
+        builder.rebalance(seed=1)
+        builder.get_ring().save(
+            os.path.join(self.root, '%s.ring.gz' % name))
+
+    def start(self):
+        """
+        Create rings and devices, then start every server.
+        """
+        monkey_patch_mimetools()
+        self._orig = (utils.HASH_PATH_PREFIX, utils.HASH_PATH_SUFFIX,
+                      storage_policy._POLICIES)
+        utils.HASH_PATH_PREFIX, utils.HASH_PATH_SUFFIX = '', 'bench'
+        storage_policy._POLICIES = StoragePolicyCollection([
+            StoragePolicy(REPLICATED_POLICY, 'replicated', True),
+            ECStoragePolicy(EC_POLICY, 'ec', ec_type=self.ec_type,
+                            ec_ndata=self.ec_ndata,
+                            ec_nparity=self.ec_nparity,
+                            ec_segment_size=self.ec_segment_size)])
+
+        self.root = make_devices_root(self.devices_parent)
+        num_obj = max(self.replicas, self.ec_ndata + self.ec_nparity)
+        acc_lis = [eventlet.listen(('127.0.0.1', 0))
+                   for _ in range(self.replicas)]
+        con_lis = [eventlet.listen(('127.0.0.1', 0))
+                   for _ in range(self.replicas)]
+        obj_lis = [eventlet.listen(('127.0.0.1', 0)) for _ in range(num_obj)]
+        pro_lis = eventlet.listen(('127.0.0.1', 0))
+        self.proxy_port = pro_lis.getsockname()[1]
+        for prefix, count in (('a', len(acc_lis)), ('c', len(con_lis)),
+                              ('o', len(obj_lis))):
+            for i in range(count):
+                utils.mkdirs(os.path.join(self.root, '%s%d' % (prefix, i),
+                                          'tmp'))
+        self._build_ring('account', self.replicas, acc_lis, 'a')
+        self._build_ring('container', self.replicas, con_lis, 'c')
+        self._build_ring('object', self.replicas, obj_lis, 'o')
+        self._build_ring('object-%d' % EC_POLICY,
+                         self.ec_ndata + self.ec_nparity, obj_lis, 'o')
+
+        conf = {'devices': self.root, 'swift_dir': self.root,
+                'mount_check': 'false', 'allow_account_management': 'true',
+                'account_autocreate': 'true', 'client_timeout': '60',
+                'node_timeout': '60', 'conn_timeout': '5'}
+        conf.update(self.extra_conf)
+        obj_mod = mem_server if self.in_memory else object_server
+        self.account_servers = [
+            account_server.AccountController(
+                conf, logger=bench_logger('account%d' % i))
+            for i in range(len(acc_lis))]
+        self.container_servers = [
+            container_server.ContainerController(
+                conf, logger=bench_logger('container%d' % i))
+            for i in range(len(con_lis))]
+        self.object_servers = [
+            obj_mod.ObjectController(
+                conf, logger=bench_logger('object%d' % i))
+            for i in range(len(obj_lis))]
+        memcache = BenchMemcache()
+        self.proxy = proxy_server.Application(
+            conf, memcache=memcache, logger=bench_logger('proxy'))
+
+        def proxy_app(env, start_response):
+            env['swift.cache'] = memcache
+            return self.proxy(env, start_response)
+
+        eventlet.wsgi.HttpProtocol.default_request_version = 'HTTP/1.0'
+        eventlet.wsgi.HttpProtocol.log_request = lambda *a: None
+        nl = utils.NullLogger()
+        servers = [(pro_lis, proxy_app)]
+        servers.extend(zip(acc_lis, self.account_servers))
+        servers.extend(zip(con_lis, self.container_servers))
+        servers.extend(zip(obj_lis, self.object_servers))
+        self._coros = [eventlet.spawn(eventlet.wsgi.server, lis, app, nl)
+                       for lis, app in servers]
+
+    def stop(self):
+        """
+        Kill all servers and remove the devices root.
+        """
+        for coro in self._coros:
+            coro.kill()
+        self._coros = []
+        if self.root:
+            rmtree(self.root, ignore_errors=True)
+            self.root = None
+        if self._orig:
+            (utils.HASH_PATH_PREFIX, utils.HASH_PATH_SUFFIX,
+             storage_policy._POLICIES) = self._orig
+            self._orig = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def request(self, method, path, headers=None, body=None,
+                query_string=None, chunk_size=65536):
+        """
+        Make a request to the proxy.
+
+        :param method: HTTP method
+        :param path: request path, e.g. ``/v1/AUTH_bench/c/o``
+        :param headers: dict of request headers
+        :param body: string or iterable of strings to send as request body
+        :param query_string: query string, without the leading ``?``
+        :param chunk_size: read size used to drain the response body
+        :returns: tuple of (status, number of response body bytes)
+        """
+        headers = dict(headers or {})
+        if isinstance(body, basestring):
+            headers.setdefault('Content-Length', str(len(body)))
+            body = [body] if body else []
+        elif body is None:
+            body = []
+            if method in ('PUT', 'POST'):
+                headers.setdefault('Content-Length', '0')
+        conn = http_connect_raw('127.0.0.1', self.proxy_port, method, path,
+                                headers=headers, query_string=query_string)
+        try:
+            for chunk in body:
+                conn.send(chunk)
+            resp = conn.getresponse()
+            received = 0
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                received += len(chunk)
+            return resp.status, received
+        finally:
+            conn.close()
+
+    def container_brokers(self, account, container):
+        """
+        Get a broker for each replica of a container, for seeding listings
+        without going through the proxy.
+
+        :param account: account name
+        :param container: container name
+        :returns: list of :class:`swift.container.backend.ContainerBroker`
+        """
+        part, nodes = self.proxy.container_ring.get_nodes(account, container)
+        brokers = []
+        for node in nodes:
+            server = self.container_servers[node['id']]
+            brokers.append(server._get_container_broker(
+                node['device'], part, account, container))
+        return brokers
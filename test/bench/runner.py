@@ -0,0 +1,696 @@
+# Copyright (c) 2015 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Repeatable benchmarks for Swift.
+
+Each scenario reports operations per second plus latency percentiles, and
+the whole run is written out as JSON so that the results of two commits can
+be compared with ``--compare``::
+
+    python -m test.bench -o before.json
+    git checkout my-branch
+    python -m test.bench -o after.json
+    python -m test.bench --compare before.json after.json
+"""
+
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from hashlib import md5
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import eventlet
+
+import swift
+from swift.common.ring import RingBuilder
+from swift.account.backend import AccountBroker
+from swift.common.utils import normalize_timestamp
+from swift.container.backend import ContainerBroker
+
+from test.bench.cluster import InProcessCluster, REPLICATED_POLICY, \
+    EC_POLICY
+
+
+FORMAT_VERSION = 1
+ACCOUNT = 'AUTH_bench'
+POLICY_NAMES = {REPLICATED_POLICY: 'replicated', EC_POLICY: 'ec'}
+
+# list of (group, name, function); see :func:`scenario`
+SCENARIOS = []
+
+
+def scenario(group, needs_cluster=True):
+    """
+    Decorator registering a benchmark scenario.
+
+    The decorated function is called with a :class:`BenchContext` and must
+    return a list of result dicts, usually built with :func:`measure`.
+
+    :param group: name used to select the scenario with ``--scenario``
+    :param needs_cluster: whether the scenario drives the in-process cluster
+    """
+    def decorator(func):
+        func.needs_cluster = needs_cluster
+        SCENARIOS.append((group, func.__name__, func))
+        return func
+    return decorator
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(0, min(rank, len(sorted_values)) - 1)]
+
+
+def summarize(name, latencies, elapsed, errors=0, nbytes=0, **extra):
+    """
+    Build a result dict from raw per-operation latencies.
+
+    :param name: dotted result name, e.g. ``object.small.put.replicated``
+    :param latencies: list of per-operation latencies in seconds
+    :param elapsed: wall clock time for all operations in seconds
+    :param errors: number of failed operations
+    :param nbytes: total payload bytes moved by the operations
+    :param extra: additional keys to include in the result
+    """
+    latencies = sorted(latencies)
+    ops = len(latencies)
+    result = {
+        'name': name,
+        'ops': ops,
+        'errors': errors,
+        'elapsed': elapsed,
+        'ops_per_sec': ops / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'mean': 1000.0 * sum(latencies) / ops if ops else 0.0,
+            'p50': 1000.0 * percentile(latencies, 50),
+            'p99': 1000.0 * percentile(latencies, 99),
+            'max': 1000.0 * latencies[-1] if ops else 0.0,
+        },
+    }
+    if nbytes:
+        result['bytes'] = nbytes
+        result['bytes_per_sec'] = nbytes / elapsed if elapsed else 0.0
+    result.update(extra)
+    return result
+
+
+def measure(name, func, count, concurrency=1, **extra):
+    """
+    Run ``func(i)`` for ``i`` in ``range(count)`` with up to ``concurrency``
+    calls in flight and summarize the results.
+
+    ``func`` returns a tuple of (status, payload bytes); any status outside
+    the 2xx range counts as an error.  Extra keyword arguments are included
+    in the result.
+    """
+    latencies = []
+    state = {'errors': 0, 'bytes': 0}
+
+    def run_one(i):
+        start = time.time()
+        status, nbytes = func(i)
+        latencies.append(time.time() - start)
+        if not 200 <= status < 300:
+            state['errors'] += 1
+        state['bytes'] += nbytes
+
+    pool = eventlet.GreenPool(max(1, concurrency))
+    start = time.time()
+    for i in xrange(count):
+        pool.spawn_n(run_one, i)
+    pool.waitall()
+    return summarize(name, latencies, time.time() - start,
+                     errors=state['errors'], nbytes=state['bytes'],
+                     concurrency=concurrency, **extra)
+
+
+class BenchContext(object):
+    """
+    State shared by scenarios during one benchmark run.
+
+    :param options: parsed command line options
+    :param cluster: running :class:`InProcessCluster`, or None
+    """
+
+    def __init__(self, options, cluster=None):
+        self.options = options
+        self.cluster = cluster
+        self._containers = set()
+
+    @property
+    def policies(self):
+        return [int(p) for p in self.options.policies.split(',')]
+
+    def path(self, container=None, obj=None):
+        parts = ['', 'v1', ACCOUNT]
+        if container is not None:
+            parts.append(container)
+        if obj is not None:
+            parts.append(obj)
+        return '/'.join(parts)
+
+    def ensure_container(self, container, policy=REPLICATED_POLICY):
+        if container not in self._containers:
+            status, _junk = self.cluster.request(
+                'PUT', self.path(container),
+                headers={'X-Storage-Policy': POLICY_NAMES[policy]})
+            if not 200 <= status < 300:
+                raise Exception('Unable to create container %s: %s' %
+                                (container, status))
+            self._containers.add(container)
+        return container
+
+
+def body_iter(size, chunk_size=65536):
+    chunk = 'x' * min(size, chunk_size)
+    remaining = size
+    while remaining > 0:
+        yield chunk[:remaining]
+        remaining -= len(chunk)
+
+
+@scenario('objects')
+def small_objects(ctx):
+    """
+    PUT, GET, HEAD and DELETE of small objects in each policy.
+    """
+    opts = ctx.options
+    results = []
+    payload = 'x' * opts.object_size
+    for policy in ctx.policies:
+        label = POLICY_NAMES[policy]
+        container = ctx.ensure_container('small-%s' % label, policy)
+
+        def name(i):
+            return ctx.path(container, 'o%08d' % i)
+
+        def put(i):
+            return ctx.cluster.request('PUT', name(i), body=payload)
+
+        def get(i):
+            return ctx.cluster.request('GET', name(i))
+
+        def head(i):
+            return ctx.cluster.request('HEAD', name(i))
+
+        def delete(i):
+            return ctx.cluster.request('DELETE', name(i))
+
+        for verb, func in (('put', put), ('get', get), ('head', head),
+                           ('delete', delete)):
+            results.append(measure(
+                'object.small.%s.%s' % (verb, label), func, opts.count,
+                opts.concurrency))
+    return results
+
+
+@scenario('large')
+def large_objects(ctx):
+    """
+    Streaming PUT and GET of large objects in each policy.
+    """
+    opts = ctx.options
+    results = []
+    for policy in ctx.policies:
+        label = POLICY_NAMES[policy]
+        container = ctx.ensure_container('large-%s' % label, policy)
+
+        def name(i):
+            return ctx.path(container, 'big%04d' % i)
+
+        def put(i):
+            status, _junk = ctx.cluster.request(
+                'PUT', name(i), body=body_iter(opts.large_object_size),
+                headers={'Content-Length': str(opts.large_object_size)})
+            return status, opts.large_object_size
+
+        def get(i):
+            return ctx.cluster.request('GET', name(i))
+
+        for verb, func in (('put', put), ('get', get)):
+            results.append(measure(
+                'object.large.%s.%s' % (verb, label), func,
+                opts.large_count, 1))
+    return results
+
+
+def seed_listing(ctx, container, rows, batch_size=10000):
+    """
+    Load ``rows`` object records straight into every replica of a container
+    DB; going through the proxy would take far longer than the benchmark.
+    Names are spread over 100 pseudo-directories so that delimiter listings
+    have something to roll up.
+    """
+    timestamp = normalize_timestamp(time.time())
+    etag = md5().hexdigest()
+    for broker in ctx.cluster.container_brokers(ACCOUNT, container):
+        for offset in xrange(0, rows, batch_size):
+            broker.merge_items([
+                {'name': 'd%02d/o%010d' % (i % 100, i),
+                 'created_at': timestamp, 'size': 0,
+                 'content_type': 'application/octet-stream', 'etag': etag,
+                 'deleted': 0, 'storage_policy_index': REPLICATED_POLICY}
+                for i in xrange(offset, min(offset + batch_size, rows))])
+
+
+@scenario('listing')
+def container_listings(ctx):
+    """
+    Container GETs against pre-seeded containers: first page, a page from
+    the middle of the namespace and a delimiter rollup.
+    """
+    opts = ctx.options
+    results = []
+    for rows in [int(r) for r in opts.listing_rows.split(',')]:
+        container = ctx.ensure_container('listing-%d' % rows)
+        seed_start = time.time()
+        seed_listing(ctx, container, rows)
+        seed_elapsed = time.time() - seed_start
+        middle = 'd%02d/o%010d' % ((rows // 2) % 100, rows // 2)
+        queries = (
+            ('first_page', 'format=json'),
+            ('marker_page', 'format=json&marker=%s' % middle),
+            ('delimiter', 'format=json&delimiter=/'),
+            ('prefix_delimiter', 'format=json&prefix=d42/&delimiter=/'),
+        )
+        for label, query in queries:
+
+            def get(i, query=query):
+                return ctx.cluster.request('GET', ctx.path(container),
+                                           query_string=query)
+
+            results.append(measure(
+                'container.listing.%d.%s' % (rows, label), get,
+                opts.listing_requests, 1, rows=rows,
+                seed_elapsed=seed_elapsed))
+    return results
+
+
+@scenario('broker', needs_cluster=False)
+def broker_listings(ctx):
+    """
+    ContainerBroker.list_objects_iter calls straight against a container DB
+    on local disk, without the HTTP and proxy overhead of the listing group.
+    """
+    opts = ctx.options
+    results = []
+    tempdir = mkdtemp()
+    try:
+        for rows in [int(r) for r in opts.listing_rows.split(',')]:
+            broker = ContainerBroker(
+                os.path.join(tempdir, 'listing-%d.db' % rows),
+                account=ACCOUNT, container='listing-%d' % rows)
+            broker.initialize(normalize_timestamp(time.time()),
+                              REPLICATED_POLICY)
+            etag = md5().hexdigest()
+            timestamp = normalize_timestamp(time.time())
+            for offset in xrange(0, rows, 10000):
+                broker.merge_items([
+                    {'name': 'd%02d/o%010d' % (i % 100, i),
+                     'created_at': timestamp, 'size': 0,
+                     'content_type': 'application/octet-stream',
+                     'etag': etag, 'deleted': 0,
+                     'storage_policy_index': REPLICATED_POLICY}
+                    for i in xrange(offset, min(offset + 10000, rows))])
+            # a tenth as many again, each in its own directory under m/
+            dirs = rows // 10
+            for offset in xrange(0, dirs, 10000):
+                broker.merge_items([
+                    {'name': 'm/%07d/o' % i,
+                     'created_at': timestamp, 'size': 0,
+                     'content_type': 'application/octet-stream',
+                     'etag': etag, 'deleted': 0,
+                     'storage_policy_index': REPLICATED_POLICY}
+                    for i in xrange(offset, min(offset + 10000, dirs))])
+            deep = 'd%02d/o%010d' % ((rows // 2) % 100, rows // 2)
+            queries = (
+                ('first_page', ('', None, None, None)),
+                ('deep_page', (deep, None, None, None)),
+                ('prefix', ('', None, 'd42/', None)),
+                ('prefix_tail', ('', None, 'd99/', None)),
+                ('delimiter', ('', None, '', '/')),
+                ('prefix_delimiter', ('', None, 'd42/', '/')),
+                ('many_dirs', ('', None, 'm/', '/')),
+            )
+            for label, (marker, end_marker, prefix, delimiter) in queries:
+
+                def listing(i, marker=marker, end_marker=end_marker,
+                            prefix=prefix, delimiter=delimiter):
+                    broker.list_objects_iter(
+                        10000, marker, end_marker, prefix, delimiter,
+                        storage_policy_index=REPLICATED_POLICY)
+                    return 200, 0
+
+                results.append(measure(
+                    'broker.listing.%d.%s' % (rows, label), listing,
+                    opts.listing_requests, 1, rows=rows))
+    finally:
+        rmtree(tempdir, ignore_errors=True)
+    return results
+
+
+@scenario('broker', needs_cluster=False)
+def account_broker_listings(ctx):
+    """
+    AccountBroker.list_containers_iter calls straight against an account DB
+    on local disk, for accounts with very many containers.
+    """
+    opts = ctx.options
+    results = []
+    tempdir = mkdtemp()
+    try:
+        for rows in [int(r) for r in opts.listing_rows.split(',')]:
+            broker = AccountBroker(
+                os.path.join(tempdir, 'account-%d.db' % rows),
+                account='listing-%d' % rows)
+            broker.initialize(normalize_timestamp(time.time()))
+            timestamp = normalize_timestamp(time.time())
+            for offset in xrange(0, rows, 10000):
+                broker.merge_items([
+                    {'name': 'c%02d-%010d' % (i % 100, i),
+                     'put_timestamp': timestamp, 'delete_timestamp': '0',
+                     'object_count': 0, 'bytes_used': 0, 'deleted': 0,
+                     'storage_policy_index': REPLICATED_POLICY}
+                    for i in xrange(offset, min(offset + 10000, rows))])
+            queries = (
+                ('first_page', ('', None, None, None)),
+                ('prefix', ('', None, 'c42-', None)),
+                ('delimiter', ('', None, '', '-')),
+                ('prefix_delimiter', ('', None, 'c42-', '-')),
+            )
+            for label, (marker, end_marker, prefix, delimiter) in queries:
+
+                def listing(i, marker=marker, end_marker=end_marker,
+                            prefix=prefix, delimiter=delimiter):
+                    broker.list_containers_iter(
+                        10000, marker, end_marker, prefix, delimiter)
+                    return 200, 0
+
+                results.append(measure(
+                    'broker.account_listing.%d.%s' % (rows, label), listing,
+                    opts.listing_requests, 1, rows=rows))
+    finally:
+        rmtree(tempdir, ignore_errors=True)
+    return results
+
+
+@scenario('account')
+def account_requests(ctx):
+    """
+    Account HEAD and listing through the proxy.
+    """
+    opts = ctx.options
+    for i in xrange(opts.account_containers):
+        ctx.ensure_container('acct-%06d' % i)
+
+    def head(i):
+        return ctx.cluster.request('HEAD', ctx.path())
+
+    def get(i):
+        return ctx.cluster.request('GET', ctx.path(),
+                                   query_string='format=json')
+
+    return [measure('account.head', head, opts.count, opts.concurrency),
+            measure('account.listing', get, opts.listing_requests, 1,
+                    rows=opts.account_containers)]
+
+
+def synthetic_builder(part_power, devices, replicas=3, regions=2, zones=5,
+                      devices_per_server=10):
+    """
+    Build a RingBuilder for a synthetic cluster of ``devices`` drives spread
+    evenly over regions, zones and servers, with a mix of drive weights.
+    """
+    builder = RingBuilder(part_power, replicas, 1)
+    per_zone = int(math.ceil(float(devices) / (regions * zones)))
+    for dev_id in xrange(devices):
+        zone_index, index = divmod(dev_id, per_zone)
+        region, zone = divmod(zone_index, zones)
+        server, device = divmod(index, devices_per_server)
+        builder.add_dev({
+            'id': dev_id, 'region': region, 'zone': zone,
+            'ip': '10.%d.%d.%d' % (region, zone, server), 'port': 6000,
+            'device': 'd%d' % device, 'weight': (2 + dev_id % 3) * 1000,
+            'meta': ''})
+    return builder
+
+
+@scenario('ring', needs_cluster=False)
+def ring_rebalance(ctx):
+    """
+    RingBuilder rebalances of a large synthetic cluster: the initial
+    balance, then growing the cluster, changing weights and removing
+    drives.
+    """
+    opts = ctx.options
+    builder = synthetic_builder(opts.ring_part_power, opts.ring_devices,
+                                opts.ring_replicas)
+    label = '%d.%d' % (opts.ring_part_power, opts.ring_devices)
+    results = []
+
+    def rebalance(name, seed):
+        start = time.time()
+        parts, balance = builder.rebalance(seed=seed)
+        elapsed = time.time() - start
+        results.append(summarize(
+            'ring.rebalance.%s.%s' % (label, name), [elapsed], elapsed,
+            part_power=opts.ring_part_power, devices=opts.ring_devices,
+            parts_moved=parts, balance=balance))
+
+    rebalance('initial', 1)
+    builder.pretend_min_part_hours_passed()
+    next_id = len(builder.devs)
+    for i in xrange(max(1, opts.ring_devices // 100)):
+        builder.add_dev({
+            'id': next_id + i, 'region': i % 2, 'zone': i % 5,
+            'ip': '10.255.%d.%d' % (i % 5, i // 50), 'port': 6000,
+            'device': 'd%d' % (i % 10), 'weight': 3000, 'meta': ''})
+    rebalance('add', 2)
+    builder.pretend_min_part_hours_passed()
+    for dev_id in xrange(0, opts.ring_devices, 97):
+        builder.set_dev_weight(dev_id, 1000)
+    rebalance('reweight', 3)
+    builder.pretend_min_part_hours_passed()
+    for dev_id in xrange(1, opts.ring_devices, 199):
+        builder.remove_dev(dev_id)
+    rebalance('remove', 4)
+    return results
+
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, _junk = proc.communicate()
+    except OSError:
+        return None
+    return out.strip() or None
+
+
+def run(options, groups):
+    """
+    Run the selected scenario groups and return the full report.
+    """
+    selected = [(group, name, func) for group, name, func in SCENARIOS
+                if group in groups]
+    cluster = None
+    if any(func.needs_cluster for _group, _name, func in selected):
+        cluster = InProcessCluster(
+            devices=options.devices, in_memory=options.in_memory,
+            ec_type=options.ec_type, ec_ndata=options.ec_ndata,
+            ec_nparity=options.ec_nparity)
+        cluster.start()
+    results = []
+    try:
+        ctx = BenchContext(options, cluster)
+        for group, name, func in selected:
+            print >>sys.stderr, 'running %s.%s' % (group, name)
+            for result in func(ctx):
+                result['group'] = group
+                print >>sys.stderr, format_result(result)
+                results.append(result)
+    finally:
+        if cluster:
+            cluster.stop()
+    return {
+        'format_version': FORMAT_VERSION,
+        'swift_version': swift.__version__,
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'options': dict((k, v) for k, v in vars(options).items()
+                        if k not in ('compare', 'output')),
+        'results': results,
+    }
+
+
+def format_result(result):
+    line = '  %-45s %10.1f ops/s  p50 %8.2fms  p99 %8.2fms' % (
+        result['name'], result['ops_per_sec'], result['latency_ms']['p50'],
+        result['latency_ms']['p99'])
+    if 'bytes_per_sec' in result:
+        line += '  %8.1f MiB/s' % (result['bytes_per_sec'] / 1048576.0)
+    if result['errors']:
+        line += '  (%d errors)' % result['errors']
+    return line
+
+
+def compare(old, new, threshold):
+    """
+    Compare two reports.
+
+    :param old: baseline report dict
+    :param new: report dict to check against the baseline
+    :param threshold: relative change (e.g. 0.1 for 10%) of ops/s or p99
+                      latency that counts as a regression
+    :returns: tuple of (list of output lines, list of regressed names)
+    """
+    old_results = dict((r['name'], r) for r in old['results'])
+    lines = ['%-45s %12s %12s %8s %10s' % (
+        'name', 'old ops/s', 'new ops/s', 'delta', 'p99 delta')]
+    regressions = []
+    for result in new['results']:
+        before = old_results.get(result['name'])
+        if not before:
+            continue
+        ops_delta = p99_delta = 0.0
+        if before['ops_per_sec']:
+            ops_delta = (result['ops_per_sec'] / before['ops_per_sec']) - 1
+        if before['latency_ms']['p99']:
+            p99_delta = (result['latency_ms']['p99'] /
+                         before['latency_ms']['p99']) - 1
+        flag = ''
+        if ops_delta < -threshold or p99_delta > threshold:
+            flag = '  REGRESSION'
+            regressions.append(result['name'])
+        lines.append('%-45s %12.1f %12.1f %+7.1f%% %+9.1f%%%s' % (
+            result['name'], before['ops_per_sec'], result['ops_per_sec'],
+            100 * ops_delta, 100 * p99_delta, flag))
+    return lines, regressions
+
+
+def main(argv=None):
+    groups = []
+    for group, _name, _func in SCENARIOS:
+        if group not in groups:
+            groups.append(group)
+    parser = OptionParser(usage='''
+%%prog [options]
+%%prog --compare OLD.json NEW.json
+
+Scenario groups: %s''' % ', '.join(groups))
+    parser.add_option('-o', '--output', help='Write the JSON report here '
+                      'instead of stdout')
+    parser.add_option('-s', '--scenario', action='append', dest='scenarios',
+                      help='Scenario group to run; may be given more than '
+                      'once (default: objects, large, listing, account; '
+                      'ring and broker are only run when asked for)')
+    parser.add_option('--compare', action='store_true', default=False,
+                      help='Compare two JSON reports instead of running')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='Relative change treated as a regression by '
+                      '--compare (default: %default)')
+    parser.add_option('-n', '--count', type='int', default=1000,
+                      help='Operations per small object or HEAD benchmark '
+                      '(default: %default)')
+    parser.add_option('-c', '--concurrency', type='int', default=10,
+                      help='Concurrent client requests (default: %default)')
+    parser.add_option('--object-size', type='int', default=4096,
+                      help='Small object size in bytes (default: %default)')
+    parser.add_option('--large-object-size', type='int',
+                      default=64 * 1048576,
+                      help='Large object size in bytes (default: %default)')
+    parser.add_option('--large-count', type='int', default=4,
+                      help='Number of large objects (default: %default)')
+    parser.add_option('--listing-rows', default='10000,1000000',
+                      help='Comma separated container sizes to list '
+                      '(default: %default)')
+    parser.add_option('--listing-requests', type='int', default=20,
+                      help='Requests per listing benchmark '
+                      '(default: %default)')
+    parser.add_option('--account-containers', type='int', default=100,
+                      help='Containers in the benchmark account before '
+                      'listing it (default: %default)')
+    parser.add_option('--ring-devices', type='int', default=10000,
+                      help='Devices in the synthetic ring benchmark '
+                      '(default: %default)')
+    parser.add_option('--ring-part-power', type='int', default=18,
+                      help='Part power of the synthetic ring benchmark '
+                      '(default: %default)')
+    parser.add_option('--ring-replicas', type='float', default=3,
+                      help='Replicas of the synthetic ring benchmark '
+                      '(default: %default)')
+    parser.add_option('--policies',
+                      default='%d,%d' % (REPLICATED_POLICY, EC_POLICY),
+                      help='Comma separated policy indexes to use for object '
+                      'benchmarks; 0 is replicated, 1 is EC '
+                      '(default: %default)')
+    parser.add_option('--devices', help='Parent directory for devices '
+                      '(default: tmpfs if usable, else the system tempdir)')
+    parser.add_option('--in-memory', action='store_true', default=False,
+                      help='Use the in-memory object server')
+    parser.add_option('--ec-type', default='jerasure_rs_vand',
+                      help='ec_type of the EC policy (default: %default)')
+    parser.add_option('--ec-ndata', type='int', default=4,
+                      help='Data fragments of the EC policy '
+                      '(default: %default)')
+    parser.add_option('--ec-nparity', type='int', default=2,
+                      help='Parity fragments of the EC policy '
+                      '(default: %default)')
+    options, args = parser.parse_args(argv)
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error('--compare needs exactly two report files')
+        reports = []
+        for path in args:
+            with open(path) as fp:
+                reports.append(json.load(fp))
+        lines, regressions = compare(reports[0], reports[1],
+                                     options.threshold)
+        print '\n'.join(lines)
+        return 1 if regressions else 0
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+
+    selected = options.scenarios or ['objects', 'large', 'listing',
+                                     'account']
+    unknown = set(selected) - set(groups)
+    if unknown:
+        parser.error('unknown scenario group(s): %s' %
+                     ', '.join(sorted(unknown)))
+    report = run(options, selected)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(data + '\n')
+    else:
+        print data
+    return 0
@@ -26,6 +26,7 @@ from test.probe.common import ECProbeTest
 from swift.common import direct_client
 from swift.common.storage_policy import EC_POLICY
 from swift.common.manager import Manager
+from swift.obj.diskfile import HASH_FILE
 
 from swiftclient import client
 
@@ -90,7 +91,7 @@ class TestReconstructorPropDurable(ECProbeTest):
                     os.remove(durable)
                     break
         try:
-            os.remove(os.path.join(part_dir, 'hashes.pkl'))
+            os.remove(os.path.join(part_dir, HASH_FILE))
         except OSError as e:
             if e.errno != errno.ENOENT:
                 raise
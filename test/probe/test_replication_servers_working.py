@@ -21,7 +21,7 @@ import time
 import shutil
 
 from swiftclient import client
-from swift.obj.diskfile import get_data_dir
+from swift.obj.diskfile import get_data_dir, HASH_FILE
 
 from test.probe.common import ReplProbeTest
 from swift.common.utils import readconf
@@ -82,9 +82,9 @@ class TestReplicatorFunctions(ReplProbeTest):
         # Delete all directories and files from this node (device).
         # Wait 60 seconds and check replication results.
         # Delete directories and files in objects storage without
-        # deleting file "hashes.pkl".
+        # deleting the hashes file.
         # Check, that files not replicated.
-        # Delete file "hashes.pkl".
+        # Delete the hashes file.
         # Check, that all files were replicated.
         path_list = []
         data_dir = get_data_dir(self.policy)
@@ -146,7 +146,7 @@ class TestReplicatorFunctions(ReplProbeTest):
                         raise
                     time.sleep(1)
 
-            # Check behavior by deleting hashes.pkl file
+            # Check behavior by deleting the hashes file
             for directory in os.listdir(os.path.join(test_node, data_dir)):
                 for input_dir in os.listdir(os.path.join(
                         test_node, data_dir, directory)):
@@ -174,7 +174,7 @@ class TestReplicatorFunctions(ReplProbeTest):
 
             for directory in os.listdir(os.path.join(test_node, data_dir)):
                 os.remove(os.path.join(
-                    test_node, data_dir, directory, 'hashes.pkl'))
+                    test_node, data_dir, directory, HASH_FILE))
 
             # We will keep trying these tests until they pass for up to 60s
             begin = time.time()
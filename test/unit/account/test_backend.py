@@ -30,6 +30,8 @@ import itertools
 from contextlib import contextmanager
 import random
 
+import mock
+
 from swift.account.backend import AccountBroker
 from swift.common.utils import Timestamp
 from test.unit import patch_policies, with_tempdir
@@ -525,6 +527,102 @@ class TestAccountBroker(unittest.TestCase):
         self.assertEqual(len(listing), 2)
         self.assertEqual([row[0] for row in listing], ['b-a', 'b-b'])
 
+    def test_list_containers_delimited(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(Timestamp('1').internal)
+        names = ['-', '-a', 'a', 'a-', 'a-b', 'a-b-c', 'a-c', 'a.', 'b',
+                 'b-', 'b-0', 'b-1', 'b.', 'b0', 'c-a-b', 'c-b', 'c.-', 'd']
+        for name in names:
+            broker.put_container(name, Timestamp(time()).internal, 0, 0, 0,
+                                 POLICIES.default.idx)
+
+        def expected(limit, marker, end_marker, prefix, delimiter):
+            listing = []
+            for name in sorted(names):
+                if marker and name <= marker or \
+                        not name.startswith(prefix) or \
+                        end_marker and name >= end_marker:
+                    continue
+                end = name.find(delimiter, len(prefix))
+                if end > 0:
+                    name = name[:end + 1]
+                if name != marker and name not in listing:
+                    listing.append(name)
+            return listing[:limit]
+
+        for max_plain in (1, 2, 16):
+            for limit in range(1, 14):
+                for marker in ('', 'a', 'a-', 'a-b', 'b-', 'b-0', 'c', 'zz'):
+                    for end_marker in (None, 'b-1', 'c-b'):
+                        for prefix in ('', 'a', 'a-', 'b', 'c'):
+                            for delimiter in ('-', '.'):
+                                args = (limit, marker, end_marker, prefix,
+                                        delimiter)
+                                with mock.patch(
+                                        'swift.account.backend.'
+                                        'ROLLUP_MAX_PLAIN', max_plain):
+                                    listing = broker.list_containers_iter(
+                                        *args)
+                                self.assertEqual(
+                                    [r[0] for r in listing],
+                                    expected(*args), args)
+        self.assertEqual(
+            broker.list_containers_iter(3, 'b', None, 'b', '-'),
+            [['b-', 0, 0, 1], ('b.', 0, 0, 0), ('b0', 0, 0, 0)])
+        with mock.patch('swift.account.backend.can_rollup',
+                        return_value=False):
+            self.assertEqual(
+                [r[0] for r in broker.list_containers_iter(
+                    10, '', None, '', '-')],
+                expected(10, '', None, '', '-'))
+
+    def test_listing_queries_reused(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(Timestamp('1').internal)
+        for name in ('a-1', 'a-2', 'b', 'c-1', 'c-2', 'd'):
+            broker.put_container(name, Timestamp(time()).internal, 0, 0, 0,
+                                 POLICIES.default.idx)
+        listing_queries = {}
+        rollup_queries = {}
+        with mock.patch('swift.account.backend.LISTING_QUERIES',
+                        listing_queries), \
+                mock.patch('swift.account.backend.ROLLUP_QUERIES',
+                           rollup_queries):
+            for i in range(2):
+                self.assertEqual(
+                    [r[0] for r in broker.list_containers_iter(
+                        10, '', None, '', '-')],
+                    ['a-', 'b', 'c-', 'd'])
+                self.assertEqual(
+                    [r[0] for r in broker.list_containers_iter(
+                        10, 'a-1', None, 'a-', None)],
+                    ['a-2'])
+        self.assertEqual(set(listing_queries), set([
+            (True, '>=', False), (True, '>', True)]))
+        self.assertEqual(len(rollup_queries), 1)
+
+    def test_iter_containers(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(Timestamp('1').internal)
+        for i in range(20):
+            broker.put_container('c%02d' % i, Timestamp(time()).internal,
+                                 0, 0, 0, POLICIES.default.idx)
+            broker.put_container('d%02d-x' % i, Timestamp(time()).internal,
+                                 0, 0, 0, POLICIES.default.idx)
+        for args in ((100, '', None, None, ''), (100, 'c05', 'd10', '', '-'),
+                     (13, '', None, 'd', '-'), (40, 'c19', None, '', '-')):
+            listing = broker.list_containers_iter(*args)
+            with mock.patch.object(broker, 'list_containers_iter',
+                                   wraps=broker.list_containers_iter) \
+                    as mock_list:
+                self.assertEqual(
+                    list(broker.iter_containers(*args, batch_size=3)),
+                    listing)
+            self.assertEqual(mock_list.call_count,
+                             min(len(listing), args[0]) // 3 + 1)
+            self.assertTrue(all(call[0][0] <= 3
+                                for call in mock_list.call_args_list))
+
     def test_chexor(self):
         broker = AccountBroker(':memory:', account='a')
         broker.initialize(Timestamp('1').internal)
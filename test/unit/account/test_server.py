@@ -63,10 +63,11 @@ class TestAccountController(unittest.TestCase):
         req.content_length = 0
         resp = server_handler.OPTIONS(req)
         self.assertEquals(200, resp.status_int)
-        for verb in 'OPTIONS GET POST PUT DELETE HEAD REPLICATE'.split():
+        for verb in 'OPTIONS GET POST PUT DELETE HEAD REPLICATE ' \
+                'UPDATE'.split():
             self.assertTrue(
                 verb in resp.headers['Allow'].split(', '))
-        self.assertEquals(len(resp.headers['Allow'].split(', ')), 7)
+        self.assertEquals(len(resp.headers['Allow'].split(', ')), 8)
         self.assertEquals(resp.headers['Server'],
                           (server_handler.server_type + '/' + swift_version))
 
@@ -943,6 +944,45 @@ class TestAccountController(unittest.TestCase):
             dom.firstChild.firstChild.nextSibling.attributes['name'].value,
             '"<word-')
 
+    def test_GET_streamed_listing(self):
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
+                                                  'HTTP_X_TIMESTAMP': '0'})
+        req.get_response(self.controller)
+        broker = self.controller._get_account_broker('sda1', 'p', 'a')
+        broker.merge_items([
+            {'name': 'c%04d' % i, 'put_timestamp': normalize_timestamp(1),
+             'delete_timestamp': '0', 'object_count': i, 'bytes_used': 2 * i,
+             'deleted': 0, 'storage_policy_index': POLICIES.default.idx}
+            for i in range(3000)])
+        expected = [{'name': 'c%04d' % i, 'count': i, 'bytes': 2 * i}
+                    for i in range(3000)]
+        req = Request.blank('/sda1/p/a?format=json',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 200)
+        # too big to send whole, so it is sent on a chunk at a time
+        self.assertEqual(resp.content_length, None)
+        self.assertEqual(resp.body, simplejson.dumps(expected))
+
+        req = Request.blank('/sda1/p/a?format=xml',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.content_length, None)
+        dom = xml.dom.minidom.parseString(resp.body)
+        self.assertEqual(
+            [n.firstChild.nodeValue
+             for n in dom.getElementsByTagName('name')],
+            [c['name'] for c in expected])
+
+        # while a short listing is sent whole
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.content_length, len(resp.body))
+        self.assertEqual(resp.body.splitlines(),
+                         [c['name'] for c in expected])
+
     def test_GET_limit_marker_plain(self):
         req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
                                                   'HTTP_X_TIMESTAMP': '0'})
@@ -1523,6 +1563,106 @@ class TestAccountController(unittest.TestCase):
         resp = req.get_response(self.controller)
         self.assertEqual(resp.status_int, 404)
 
+    def test_UPDATE(self):
+        req = Request.blank(
+            '/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
+                                  'HTTP_X_TIMESTAMP': normalize_timestamp(1)})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 201)
+        policy = random.choice(list(POLICIES))
+        rows = [{'name': 'c%d' % i,
+                 'put_timestamp': normalize_timestamp(2),
+                 'delete_timestamp': normalize_timestamp(0),
+                 'object_count': i, 'bytes_used': i * 10}
+                for i in range(3)]
+        rows.append({'name': 'gone',
+                     'put_timestamp': normalize_timestamp(2),
+                     'delete_timestamp': normalize_timestamp(3),
+                     'object_count': 0, 'bytes_used': 0})
+        req = Request.blank(
+            '/sda1/p/a', environ={'REQUEST_METHOD': 'UPDATE'},
+            headers={'X-Backend-Storage-Policy-Index': policy.idx},
+            body=simplejson.dumps(rows))
+        with mock.patch('swift.account.backend.AccountBroker.put_record') \
+                as mock_put_record:
+            resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 202)
+        # all rows go straight into the DB in one merge
+        self.assertFalse(mock_put_record.called)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.headers['x-account-container-count'], '3')
+        self.assertEqual(resp.headers['x-account-object-count'], '3')
+        self.assertEqual(resp.headers['x-account-bytes-used'], '30')
+        self.assertEqual(
+            resp.headers['x-account-storage-policy-%s-object-count' %
+                         policy.name], '3')
+        req = Request.blank('/sda1/p/a?format=json',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEqual([c['name'] for c in simplejson.loads(resp.body)],
+                         ['c0', 'c1', 'c2'])
+
+    def test_UPDATE_errors(self):
+        req = Request.blank(
+            '/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
+                                  'HTTP_X_TIMESTAMP': normalize_timestamp(1)})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 201)
+        row = {'name': 'c', 'put_timestamp': normalize_timestamp(2),
+               'delete_timestamp': normalize_timestamp(0),
+               'object_count': 1, 'bytes_used': 10}
+        for body in ('not json', simplejson.dumps(row),
+                     simplejson.dumps([dict(row, name='')]),
+                     simplejson.dumps([dict(row, name='c/d')]),
+                     simplejson.dumps([dict(row, object_count='x')]),
+                     simplejson.dumps([dict(row, put_timestamp='x')]),
+                     simplejson.dumps([{'name': 'c'}])):
+            req = Request.blank('/sda1/p/a',
+                                environ={'REQUEST_METHOD': 'UPDATE'},
+                                body=body)
+            resp = req.get_response(self.controller)
+            self.assertEqual(resp.status_int, 400, body)
+        req = Request.blank('/sda1/p/a/c',
+                            environ={'REQUEST_METHOD': 'UPDATE'},
+                            body=simplejson.dumps([row]))
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 400)
+        # no such account
+        req = Request.blank('/sda1/p/b', environ={'REQUEST_METHOD': 'UPDATE'},
+                            body=simplejson.dumps([row]))
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 404)
+        # deleted account
+        req = Request.blank(
+            '/sda1/p/a', environ={'REQUEST_METHOD': 'DELETE',
+                                  'HTTP_X_TIMESTAMP': normalize_timestamp(2)})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 204)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'UPDATE'},
+                            body=simplejson.dumps([row]))
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 404)
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'UPDATE'},
+                            headers={'X-Account-Override-Deleted': 'yes'},
+                            body=simplejson.dumps([row]))
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 202)
+
+    def test_UPDATE_auto_create(self):
+        row = {'name': 'c', 'put_timestamp': normalize_timestamp(2),
+               'delete_timestamp': normalize_timestamp(0),
+               'object_count': 1, 'bytes_used': 10}
+        req = Request.blank('/sda1/p/.a',
+                            environ={'REQUEST_METHOD': 'UPDATE'},
+                            body=simplejson.dumps([row]))
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 202)
+        req = Request.blank('/sda1/p/.a', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 204)
+        self.assertEqual(resp.headers['x-account-container-count'], '1')
+
     def test_content_type_on_HEAD(self):
         Request.blank('/sda1/p/a',
                       headers={'X-Timestamp': normalize_timestamp(1)},
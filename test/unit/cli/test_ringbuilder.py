@@ -22,8 +22,9 @@ import unittest
 import uuid
 
 from swift.cli import ringbuilder
-from swift.common import exceptions
-from swift.common.ring import RingBuilder
+from swift.common import exceptions, utils
+from swift.common.ring import RingBuilder, Ring
+from swift.common.ring.ring import get_ring_format_version
 
 
 class RunSwiftRingBuilderMixin(object):
@@ -1692,6 +1693,58 @@ class TestCommands(unittest.TestCase, RunSwiftRingBuilderMixin):
         argv = ["", self.tmpfile, "write_ring"]
         self.assertRaises(SystemExit, ringbuilder.main, argv)
 
+    def test_write_ring_format_version(self):
+        self.create_sample_ring()
+        ring_file = self.tmpfile + '.ring.gz'
+        self.addCleanup(os.remove, ring_file)
+        argv = ["", self.tmpfile, "rebalance"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        self.assertEquals(get_ring_format_version(ring_file), 1)
+
+        argv = ["", self.tmpfile, "write_ring", "--format-version", "2"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        self.assertEquals(get_ring_format_version(ring_file), 2)
+
+        # the format of an existing ring file is kept by default
+        argv = ["", self.tmpfile, "write_ring"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        self.assertEquals(get_ring_format_version(ring_file), 2)
+        argv = ["", self.tmpfile, "pretend_min_part_hours_passed"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        argv = ["", self.tmpfile, "rebalance", "--force"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        self.assertEquals(get_ring_format_version(ring_file), 2)
+
+        argv = ["", self.tmpfile, "rebalance", "--force",
+                "--format-version", "1"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        self.assertEquals(get_ring_format_version(ring_file), 1)
+
+        argv = ["", self.tmpfile, "write_ring", "--format-version", "3"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        self.assertEquals(get_ring_format_version(ring_file), 1)
+
+    def test_write_builder_from_v2_ring(self):
+        self.create_sample_ring()
+        ring_file = self.tmpfile + '.ring.gz'
+        self.addCleanup(os.remove, ring_file)
+        argv = ["", self.tmpfile, "rebalance", "--format-version", "2"]
+        self.assertRaises(SystemExit, ringbuilder.main, argv)
+        orig = RingBuilder.load(self.tmpfile)
+        os.remove(self.tmpfile)
+        _orig_hash_path_suffix = utils.HASH_PATH_SUFFIX
+        utils.HASH_PATH_SUFFIX = 'endcap'
+        try:
+            self.assertEquals(Ring(ring_file).replica_count, 3)
+            argv = ["", ring_file, "write_builder", "1"]
+            ringbuilder.main(argv)
+        finally:
+            utils.HASH_PATH_SUFFIX = _orig_hash_path_suffix
+        builder_file = self.tmpfile + '.builder'
+        self.addCleanup(os.remove, builder_file)
+        builder = RingBuilder.load(builder_file)
+        self.assertEquals(builder._replica2part2dev, orig._replica2part2dev)
+
     def test_write_builder(self):
         # Test builder file already exists
         self.create_sample_ring()
@@ -28,6 +28,7 @@ from shutil import rmtree
 from swift.common import exceptions
 from swift.common import ring
 from swift.common.ring.builder import MAX_BALANCE
+from swift.common.ring.utils import tiers_for_dev
 
 
 class TestRingBuilder(unittest.TestCase):
@@ -1467,6 +1468,70 @@ class TestRingBuilder(unittest.TestCase):
                            key=operator.itemgetter('id'))
         self.assertEqual(part_devs, [rb.devs[0], rb.devs[1]])
 
+    def test_dispersion_checks(self):
+        rb = ring.RingBuilder(8, 3, 1)
+        dev_id = 0
+        for region in range(2):
+            for zone in range(3):
+                for device in ('sda', 'sdb'):
+                    rb.add_dev({'id': dev_id, 'region': region,
+                                'zone': zone, 'weight': 1,
+                                'ip': '127.0.0.%d' % zone, 'port': 10000,
+                                'device': device})
+                    dev_id += 1
+        rb.set_dev_weight(11, 0)
+        tfd = dict((dev['id'], tiers_for_dev(dev)) for dev in rb.devs)
+        checks = rb._dispersion_checks(
+            tfd, rb._build_max_replicas_by_tier())
+        # regions may hold two replicas each, zones just one; servers and
+        # devices need no checks of their own
+        self.assertEqual(
+            checks,
+            [([(0,)] * 6 + [(1,)] * 5 + [None], 2),
+             ([(0, 0)] * 2 + [(0, 1)] * 2 + [(0, 2)] * 2 +
+              [(1, 0)] * 2 + [(1, 1)] * 2 + [(1, 2), None], 1)])
+
+        # with more zones than replicas everything fits in one region
+        rb.set_replicas(2)
+        self.assertEqual(
+            [max_replicas for _junk, max_replicas in rb._dispersion_checks(
+                tfd, rb._build_max_replicas_by_tier())], [1])
+
+        # nothing to check when every device could hold every replica
+        rb = ring.RingBuilder(8, 1, 1)
+        rb.add_dev({'id': 0, 'region': 0, 'zone': 0, 'weight': 1,
+                    'ip': '127.0.0.1', 'port': 10000, 'device': 'sda'})
+        self.assertEqual(rb._dispersion_checks(
+            {0: tiers_for_dev(rb.devs[0])},
+            rb._build_max_replicas_by_tier()), [])
+
+    def test_rebalance_large_cluster_layout(self):
+        # lots of servers per zone, which used to make gathering quadratic
+        # in the number of tiers
+        rb = ring.RingBuilder(10, 3, 1)
+        dev_id = 0
+        for zone in range(3):
+            for server in range(40):
+                for device in ('sda', 'sdb'):
+                    rb.add_dev({'id': dev_id, 'region': 0, 'zone': zone,
+                                'weight': 1 + dev_id % 2,
+                                'ip': '10.0.%d.%d' % (zone, server),
+                                'port': 10000, 'device': device})
+                    dev_id += 1
+        rb.rebalance(seed=1)
+        rb.validate()
+        self.assertEqual(rb.dispersion, 0.0)
+        for dev_id in range(0, 240, 7):
+            rb.set_dev_weight(dev_id, 3)
+        for dev_id in range(3, 240, 31):
+            rb.remove_dev(dev_id)
+        rb.pretend_min_part_hours_passed()
+        rb.rebalance(seed=2)
+        rb.validate()
+        self.assertEqual(rb.dispersion, 0.0)
+        for dev_id in range(3, 240, 31):
+            self.assertEqual(rb.devs[dev_id], None)
+
     def test_dispersion_with_zero_weight_devices(self):
         rb = ring.RingBuilder(8, 3.0, 0)
         # add two devices to a single server in a single zone
@@ -1531,6 +1596,87 @@ class TestRingBuilder(unittest.TestCase):
             (0, 0, '127.0.0.1:10000', 1): [0, 128, 128, 0],
         })
 
+    def test_incremental_dispersion_graph(self):
+        rb = ring.RingBuilder(8, 3, 1)
+        dev_id = 0
+        for zone in range(2):
+            for server in range(3):
+                for device in ('sda', 'sdb'):
+                    rb.add_dev({'id': dev_id, 'region': 0, 'zone': zone,
+                                'weight': 1, 'ip': '10.0.%d.%d' % (
+                                    zone, server),
+                                'port': 10000, 'device': device})
+                    dev_id += 1
+        rb.rebalance(seed=1)
+        self.assertTrue(rb._dispersion_state)
+
+        def check_full_recount():
+            full = ring.RingBuilder(8, 3, 1)
+            full.copy_from(rb.to_dict())
+            full._dispersion_state = None
+            full._build_dispersion_graph()
+            self.assertEqual(dict(rb._dispersion_graph),
+                             dict(full._dispersion_graph))
+            self.assertEqual(rb.dispersion, full.dispersion)
+
+        # only the partitions that moved get counted again
+        counted = []
+        orig_count_dispersion = rb._count_dispersion
+
+        def count_dispersion(replica2part2dev, parts, *args):
+            counted.append(parts)
+            return orig_count_dispersion(replica2part2dev, parts, *args)
+
+        rb.set_dev_weight(0, 3)
+        rb.set_dev_weight(7, 2)
+        rb.pretend_min_part_hours_passed()
+        with mock.patch.object(rb, '_count_dispersion', count_dispersion):
+            rb.rebalance(seed=2)
+        self.assertEqual(len(counted), 2)
+        self.assertTrue(0 < len(counted[0]) < rb.parts)
+        self.assertEqual(counted[0], counted[1])
+        check_full_recount()
+
+        # the state survives a trip through the builder file
+        copy = ring.RingBuilder(8, 3, 1)
+        copy.copy_from(rb.to_dict())
+        self.assertEqual(copy._dispersion_state, rb._dispersion_state)
+
+        # a device changing tiers means everything gets counted again
+        rb.set_dev_weight(3, 2)
+        rb.devs[5]['ip'] = '10.0.0.9'
+        rb.pretend_min_part_hours_passed()
+        del counted[:]
+        with mock.patch.object(rb, '_count_dispersion', count_dispersion):
+            rb.rebalance(seed=3)
+        self.assertEqual(len(counted), 1)
+        self.assertEqual(counted[0], None)
+        check_full_recount()
+
+    def test_dispersion_graph_partial_replicas(self):
+        rb = ring.RingBuilder(8, 2.5, 1)
+        for dev_id in range(3):
+            rb.add_dev({'id': dev_id, 'region': 0, 'zone': dev_id,
+                        'weight': 1, 'ip': '127.0.0.1', 'port': 10000,
+                        'device': 'sd%s' % 'abc'[dev_id]})
+        rb.rebalance(seed=1)
+        # partitions past the end of the partial replica still count
+        self.assertEqual(set(rb._dispersion_graph), set([
+            (0,), (0, 0), (0, 1), (0, 2),
+            (0, 0, '127.0.0.1:10000'), (0, 1, '127.0.0.1:10000'),
+            (0, 2, '127.0.0.1:10000'),
+            (0, 0, '127.0.0.1:10000', 0), (0, 1, '127.0.0.1:10000', 1),
+            (0, 2, '127.0.0.1:10000', 2)]))
+        self.assertEqual(rb._dispersion_graph[(0,)], [0, 0, 128, 128])
+        for zone in range(3):
+            counts = rb._dispersion_graph[(0, zone)]
+            self.assertEqual(counts[2:], [0, 0])
+            self.assertEqual(sum(counts), 256)
+            self.assertEqual(counts[1],
+                             rb._dispersion_graph[
+                                 (0, zone, '127.0.0.1:10000', zone)][1])
+        self.assertEqual(rb.dispersion, 0.0)
+
 
 if __name__ == '__main__':
     unittest.main()
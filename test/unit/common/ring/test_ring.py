@@ -15,6 +15,7 @@
 
 import array
 import cPickle as pickle
+import mock
 import os
 import sys
 import unittest
@@ -112,6 +113,83 @@ class TestRingData(unittest.TestCase):
             with open(ring_fname2) as ring2:
                 self.assertEqual(ring1.read(), ring2.read())
 
+    def test_roundtrip_serialization_v2(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        rd = ring.RingData(
+            [array.array('H', [0, 1, 0, 1]), array.array('H', [0, 1, 0, 1]),
+             array.array('H', [1, 0])],
+            [{'id': 0, 'zone': 0}, {'id': 1, 'zone': 1}], 30)
+        rd.save(ring_fname, format_version=2)
+        with open(ring_fname) as f:
+            self.assertEqual(f.read(6), 'R1NG\x00\x02')
+        self.assertEqual(ring.ring.get_ring_format_version(ring_fname), 2)
+        rd2 = ring.RingData.load(ring_fname)
+        self.assert_ring_data_equal(rd, rd2)
+        for part2dev_id in rd2._replica2part2dev_id:
+            self.assertTrue(isinstance(part2dev_id, array.array))
+
+        rd3 = ring.RingData.load(ring_fname, mmap_file=True)
+        self.assertEquals(rd3.devs, rd.devs)
+        self.assertEquals(rd3._part_shift, rd._part_shift)
+        self.assertEquals([list(p) for p in rd3._replica2part2dev_id],
+                          [[0, 1, 0, 1], [0, 1, 0, 1], [1, 0]])
+        for part2dev_id in rd3._replica2part2dev_id:
+            self.assertFalse(isinstance(part2dev_id, array.array))
+
+        # mapped rows can be written back out in either format
+        rd3.save(ring_fname + '.v1')
+        self.assert_ring_data_equal(rd, ring.RingData.load(ring_fname + '.v1'))
+        rd3.save(ring_fname, format_version=2)
+        self.assert_ring_data_equal(rd, ring.RingData.load(ring_fname))
+
+    def test_v2_alignment(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        for i in range(9):
+            rd = ring.RingData(
+                [array.array('H', [0, 1, 0, 1])],
+                [{'id': 0, 'zone': 0, 'meta': 'x' * i}], 30)
+            rd.save(ring_fname, format_version=2)
+            with open(ring_fname) as f:
+                data = f.read()
+            self.assertEqual(len(data) % 8, 0)
+            self.assertEqual(data[-8:], array.array(
+                'H', [0, 1, 0, 1]).tostring())
+            rd2 = ring.RingData.load(ring_fname, mmap_file=True)
+            self.assertEquals(rd2.devs, rd.devs)
+            self.assertEquals(list(rd2._replica2part2dev_id[0]), [0, 1, 0, 1])
+
+    def test_v2_byteorder(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        # what a host of the other byte order would have written
+        part2dev_id = array.array('H', [0, 1, 258, 1])
+        part2dev_id.byteswap()
+        rd = ring.RingData(
+            [part2dev_id], [{'id': 0, 'zone': 0}, {'id': 1, 'zone': 1}], 30)
+        other = 'big' if sys.byteorder == 'little' else 'little'
+        with mock.patch.object(ring.ring.sys, 'byteorder', other):
+            rd.save(ring_fname, format_version=2)
+        with open(ring_fname) as f:
+            self.assertTrue(('"byteorder": "%s"' % other) in f.read())
+        for mmap_file in (True, False):
+            rd2 = ring.RingData.load(ring_fname, mmap_file=mmap_file)
+            self.assertEquals(list(rd2._replica2part2dev_id[0]),
+                              [0, 1, 258, 1])
+
+    def test_format_versions(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        rd = ring.RingData(
+            [array.array('H', [0, 1, 0, 1])],
+            [{'id': 0, 'zone': 0}, {'id': 1, 'zone': 1}], 30)
+        rd.save(ring_fname)
+        self.assertEqual(ring.ring.get_ring_format_version(ring_fname), 1)
+        with closing(GzipFile(ring_fname, 'wb')) as f:
+            pickle.dump(rd, f)
+        self.assertEqual(ring.ring.get_ring_format_version(ring_fname), 0)
+        self.assertRaises(ValueError, rd.save, ring_fname, format_version=3)
+        with open(ring_fname, 'wb') as f:
+            f.write('R1NG\x00\x03')
+        self.assertRaises(Exception, ring.RingData.load, ring_fname)
+
     def test_permissions(self):
         ring_fname = os.path.join(self.testdir, 'stat.ring.gz')
         rd = ring.RingData(
@@ -432,6 +510,194 @@ class TestRing(TestRingBase):
                           enumerate([self.intended_devs[0],
                           self.intended_devs[3]])])
 
+    def test_get_parts_many(self):
+        names = [('a',), ('a1',), ('a4',), ('a', 'c1'), ('a', 'c0'),
+                 ('a', 'c3'), ('a', 'c', 'o1'), ('a', 'c', 'o2')]
+        self.assertEquals(self.ring.get_parts_many(names),
+                          [self.ring.get_part(*name) for name in names])
+        self.assertEquals(self.ring.get_parts_many(names),
+                          [0, 0, 1, 0, 3, 2, 1, 2])
+        self.assertEquals(self.ring.get_parts_many([]), [])
+        self.assertEquals(self.ring.get_parts_many(iter(names[:1])), [0])
+
+    def test_get_part_nodes_many(self):
+        parts = [0, 1, 2, 3, 1]
+        self.assertEquals(self.ring.get_part_nodes_many(parts),
+                          [(0, 3), (1, 4), (0, 3), (1, 4), (1, 4)])
+        for part, dev_ids in zip(parts,
+                                 self.ring.get_part_nodes_many(parts)):
+            self.assertEquals(
+                [dict(self.ring.devs[dev_id], index=i)
+                 for i, dev_id in enumerate(dev_ids)],
+                self.ring.get_part_nodes(part))
+        self.assertEquals(self.ring.get_part_nodes_many([2]), [(0, 3)])
+        self.assertEquals(self.ring.get_part_nodes_many([]), [])
+
+    def test_get_part_nodes_many_partial_replica(self):
+        self.ring._replica2part2dev_id = [
+            array.array('H', [0, 1, 0, 1]),
+            array.array('H', [3, 4, 3, 4]),
+            array.array('H', [1, 3])]
+        parts = [0, 1, 2, 3]
+        self.assertEquals(self.ring.get_part_nodes_many(parts),
+                          [(0, 3, 1), (1, 4, 3), (0, 3), (1, 4)])
+        for part, dev_ids in zip(parts,
+                                 self.ring.get_part_nodes_many(parts)):
+            self.assertEquals(
+                [node['id'] for node in self.ring.get_part_nodes(part)],
+                list(dev_ids))
+
+    def test_get_many_reloads(self):
+        os.utime(self.testgz, (time() - 300, time() - 300))
+        self.ring = ring.Ring(self.testdir, reload_time=0.001,
+                              ring_name='whatever')
+        self.intended_replica2part2dev_id[2] = array.array(
+            'H', [4, 3, 4, 3])
+        ring.RingData(
+            self.intended_replica2part2dev_id,
+            self.intended_devs, self.intended_part_shift).save(self.testgz)
+        sleep(0.1)
+        self.assertEquals(self.ring.get_part_nodes_many([0, 1]),
+                          [(0, 4), (1, 3)])
+
+    def _build_big_ring(self):
+        rb = ring.RingBuilder(8, 3, 1)
+        next_dev_id = 0
+        for zone in xrange(1, 10):
+            for server in xrange(1, 5):
+                for device in xrange(1, 4):
+                    rb.add_dev({'id': next_dev_id,
+                                'ip': '1.2.%d.%d' % (zone, server),
+                                'port': 1234, 'zone': zone, 'region': 0,
+                                'weight': 1.0})
+                    next_dev_id += 1
+        rb.rebalance(seed=1)
+        rb.get_ring().save(self.testgz)
+
+    def test_precompute_part_nodes(self):
+        self._build_big_ring()
+        plain = ring.Ring(self.testdir, ring_name='whatever')
+        self.assertEquals(plain._part2dev_ids, None)
+        r = ring.Ring(self.testdir, ring_name='whatever',
+                      precompute_part_nodes=True)
+        self.assertEquals(len(r._part2dev_ids), r.partition_count)
+        self.assertTrue(isinstance(r._part2dev_ids, tuple))
+        for part in xrange(r.partition_count):
+            self.assertEquals(r.get_part_nodes(part),
+                              plain.get_part_nodes(part))
+            self.assertEquals(list(r.get_more_nodes(part)),
+                              list(plain.get_more_nodes(part)))
+        self.assertEquals(r.get_nodes('a', 'c', 'o'),
+                          plain.get_nodes('a', 'c', 'o'))
+        parts = range(r.partition_count)
+        self.assertEquals(r.get_part_nodes_many(parts),
+                          plain.get_part_nodes_many(parts))
+        self.assertEquals(r.get_part_nodes(r.partition_count), [])
+        # callers get their own copies of the node dicts
+        r.get_part_nodes(0)[0]['ip'] = 'mutated'
+        self.assertNotEquals(r.get_part_nodes(0)[0]['ip'], 'mutated')
+
+    def test_precompute_part_nodes_rebuilt_on_reload(self):
+        os.utime(self.testgz, (time() - 300, time() - 300))
+        r = ring.Ring(self.testdir, reload_time=0.001, ring_name='whatever',
+                      precompute_part_nodes=True)
+        self.assertEquals([n['id'] for n in r.get_part_nodes(0)], [0, 3])
+        self.intended_replica2part2dev_id[2] = array.array(
+            'H', [4, 3, 4, 3])
+        ring.RingData(
+            self.intended_replica2part2dev_id,
+            self.intended_devs, self.intended_part_shift).save(self.testgz)
+        sleep(0.1)
+        self.assertEquals([n['id'] for n in r.get_part_nodes(0)], [0, 4])
+        self.assertEquals(r._part2dev_ids, ((0, 4), (1, 3), (0, 4), (1, 3)))
+
+    def test_v2_ring(self):
+        self._build_big_ring()
+        v1 = ring.Ring(self.testdir, ring_name='whatever')
+        ring.RingData.load(self.testgz).save(self.testgz, format_version=2)
+        v2 = ring.Ring(self.testdir, ring_name='whatever')
+        self.assertEquals(ring.ring.get_ring_format_version(self.testgz), 2)
+        self.assertEquals(v2.partition_count, v1.partition_count)
+        self.assertEquals(v2.replica_count, v1.replica_count)
+        self.assertEquals(v2.devs, v1.devs)
+        for part in xrange(v1.partition_count):
+            self.assertEquals(v2.get_part_nodes(part),
+                              v1.get_part_nodes(part))
+        self.assertEquals(list(v2.get_more_nodes(6)),
+                          list(v1.get_more_nodes(6)))
+        parts = range(v1.partition_count)
+        self.assertEquals(v2.get_part_nodes_many(parts),
+                          v1.get_part_nodes_many(parts))
+        v2 = ring.Ring(self.testdir, ring_name='whatever',
+                       precompute_part_nodes=True)
+        self.assertEquals(v2.get_part_nodes_many(parts),
+                          v1.get_part_nodes_many(parts))
+
+    def test_v2_ring_reload(self):
+        os.utime(self.testgz, (time() - 300, time() - 300))
+        ring.RingData.load(self.testgz).save(self.testgz, format_version=2)
+        os.utime(self.testgz, (time() - 300, time() - 300))
+        r = ring.Ring(self.testdir, reload_time=0.001, ring_name='whatever')
+        self.assertEquals([n['id'] for n in r.get_part_nodes(0)], [0, 3])
+        self.intended_replica2part2dev_id[2] = array.array(
+            'H', [4, 3, 4, 3])
+        ring.RingData(
+            self.intended_replica2part2dev_id,
+            self.intended_devs, self.intended_part_shift).save(
+                self.testgz, format_version=2)
+        sleep(0.1)
+        self.assertEquals([n['id'] for n in r.get_part_nodes(0)], [0, 4])
+
+    def test_handoff_cache(self):
+        self._build_big_ring()
+        plain = ring.Ring(self.testdir, ring_name='whatever')
+        r = ring.Ring(self.testdir, ring_name='whatever',
+                      handoff_cache_size=4)
+        self.assertEquals(plain._handoff_cache, None)
+        # a partially consumed sequence is extended by later callers
+        first = r.get_more_nodes(6).next()
+        self.assertEquals(first, plain.get_more_nodes(6).next())
+        self.assertEquals(len(r._handoff_cache.mapping[(6,)][4].nodes), 1)
+        self.assertEquals(list(r.get_more_nodes(6)),
+                          list(plain.get_more_nodes(6)))
+        self.assertEquals(list(r.get_more_nodes(6)),
+                          list(plain.get_more_nodes(6)))
+        # two interleaved consumers see the same sequence
+        it1, it2 = r.get_more_nodes(7), r.get_more_nodes(7)
+        seen1, seen2 = [], []
+        for _ in range(5):
+            seen1.append(it1.next())
+            seen2.append(it2.next())
+        seen2.extend(it2)
+        seen1.extend(it1)
+        self.assertEquals(seen1, list(plain.get_more_nodes(7)))
+        self.assertEquals(seen2, seen1)
+        # the cache is bounded
+        for part in xrange(r.partition_count):
+            self.assertEquals(list(r.get_more_nodes(part)),
+                              list(plain.get_more_nodes(part)))
+        self.assertEquals(len(r._handoff_cache.mapping), 4)
+
+    def test_handoff_cache_invalidated_on_reload(self):
+        self._build_big_ring()
+        os.utime(self.testgz, (time() - 300, time() - 300))
+        r = ring.Ring(self.testdir, reload_time=0.001, ring_name='whatever',
+                      handoff_cache_size=10)
+        before = list(r.get_more_nodes(6))
+        self.assertEquals(len(r._handoff_cache.mapping), 1)
+        ring_data = ring.RingData.load(self.testgz)
+        ring_data._replica2part2dev_id.reverse()
+        ring_data._replica2part2dev_id[0] = array.array(
+            'H', [(d + 1) % 108 for d in ring_data._replica2part2dev_id[0]])
+        ring_data.save(self.testgz)
+        sleep(0.1)
+        after = list(r.get_more_nodes(6))
+        self.assertNotEquals(after, before)
+        self.assertEquals(
+            after, list(ring.Ring(self.testdir,
+                                  ring_name='whatever').get_more_nodes(6)))
+        self.assertEquals(len(r._handoff_cache.mapping), 1)
+
     def add_dev_to_ring(self, new_dev):
         self.ring.devs.append(new_dev)
         self.ring._rebuild_tier_data()
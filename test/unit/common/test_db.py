@@ -21,6 +21,7 @@ from tempfile import mkdtemp
 from shutil import rmtree, copy
 from uuid import uuid4
 import cPickle as pickle
+from StringIO import StringIO
 
 import simplejson
 import sqlite3
@@ -28,6 +29,7 @@ import itertools
 import time
 import random
 from mock import patch, MagicMock
+from nose import SkipTest
 
 from eventlet.timeout import Timeout
 
@@ -36,7 +38,9 @@ from swift.common.constraints import \
     MAX_META_VALUE_LENGTH, MAX_META_COUNT, MAX_META_OVERALL_SIZE
 from swift.common.db import chexor, dict_factory, get_db_connection, \
     DatabaseBroker, DatabaseConnectionError, DatabaseAlreadyExists, \
-    GreenDBConnection, PICKLE_PROTOCOL
+    GreenDBConnection, PICKLE_PROTOCOL, PENDING_MAX_ENTRY, \
+    pack_pending_entry, iter_pending_entries, prefix_end_marker, \
+    can_rollup, get_rollup_query
 from swift.common.utils import normalize_timestamp, mkdirs, json, Timestamp
 from swift.common.exceptions import LockTimeout
 from swift.common.swob import HTTPException
@@ -180,6 +184,132 @@ class TestGetDBConnection(unittest.TestCase):
                                   mock_db_cmd.call_count))
 
 
+class TestPrefixEndMarker(unittest.TestCase):
+
+    def test_prefix_end_marker(self):
+        self.assertEqual(prefix_end_marker('a'), 'b')
+        self.assertEqual(prefix_end_marker('pre/'), 'pre0')
+        self.assertEqual(prefix_end_marker('a\xff'), 'b')
+        self.assertEqual(prefix_end_marker('\xce\xa9'), '\xce\xaa')
+        self.assertEqual(prefix_end_marker('\xff\xff'), None)
+        for prefix in ('a', 'a\xff', 'pre/'):
+            end = prefix_end_marker(prefix)
+            for name in (prefix, prefix + '\x00', prefix + '\xff\xff'):
+                self.assertTrue(name < end)
+
+
+class TestRollupQuery(unittest.TestCase):
+
+    def test_can_rollup(self):
+        self.assertTrue(can_rollup('/'))
+        self.assertTrue(can_rollup('~'))
+        self.assertFalse(can_rollup('\x7f'))
+        self.assertFalse(can_rollup('\xfe'))
+        with patch('sqlite3.sqlite_version_info', (3, 8, 2)):
+            self.assertFalse(can_rollup('/'))
+
+    def test_get_rollup_query(self):
+        if not can_rollup('/'):
+            raise SkipTest('sqlite too old for rollup queries')
+        conn = sqlite3.connect(':memory:')
+        conn.text_factory = str
+        conn.execute('CREATE TABLE t (name TEXT, deleted INTEGER)')
+        omega = u'\u03a9'.encode('utf-8')
+        names = ['a', 'a/b', 'a/c', omega + '/x', omega + '/y',
+                 omega + omega + '/x/y', omega + omega + '/z', 'z']
+        conn.executemany('INSERT INTO t VALUES (?, ?)',
+                         [(name, name == 'z') for name in names])
+        query = get_rollup_query('t', ('name',), 'deleted = 0', '>=', True)
+        params = {'prefix': '', 'delimiter': '/', 'after_delimiter': '0',
+                  'after_name': '\x01', 'min_end': 1, 'marker': '',
+                  'end_marker': '\xff', 'max_plain': 16, 'limit': 10}
+        self.assertEqual(
+            [r[0] for r in conn.execute(query, params)],
+            ['a', 'a/b', omega + '/x', omega + omega + '/x/y'])
+        params.update(prefix=omega, marker=omega, limit=2)
+        self.assertEqual(
+            [r[0] for r in conn.execute(query, params)],
+            [omega + '/x', omega + omega + '/x/y'])
+        params.update(prefix=omega + omega, marker=omega + omega,
+                      end_marker=omega + omega + '/z')
+        self.assertEqual(
+            [r[0] for r in conn.execute(query, params)],
+            [omega + omega + '/x/y'])
+
+
+class TestIterPendingEntries(unittest.TestCase):
+
+    def test_mixed_entries(self):
+        records = [('o%d' % i, ':' * i, '\x00' * i) for i in range(20)]
+        pending = ''
+        expected = []
+        for i, record in enumerate(records):
+            entry = pickle.dumps(record, protocol=PICKLE_PROTOCOL)
+            if i % 3:
+                pending += pack_pending_entry(entry)
+                expected.append((True, entry, len(pending)))
+            else:
+                pending += ':' + entry.encode('base64')
+                expected.append((False, entry.encode('base64'),
+                                 len(pending)))
+        for chunk_size in (1, 2, 7, 64, 65536):
+            self.assertEqual(
+                list(iter_pending_entries(StringIO(pending), chunk_size)),
+                expected)
+        # reading from part way into the file
+        offset = expected[9][2]
+        fp = StringIO(pending)
+        fp.seek(offset)
+        self.assertEqual(list(iter_pending_entries(fp, 5, offset)),
+                         expected[10:])
+
+    def test_bad_entries(self):
+        entry = pickle.dumps(('o', 1), protocol=PICKLE_PROTOCOL)
+        binary = pack_pending_entry(entry)
+        for chunk_size in (1, 3, 65536):
+            self.assertEqual(list(iter_pending_entries(
+                StringIO('junk::abc' + binary + binary[:-1]), chunk_size)),
+                [(False, 'junk', 4), (False, 'abc', 9),
+                 (True, entry, 9 + len(binary)),
+                 (None, binary[:-1], 9 + 2 * len(binary) - 1)])
+            self.assertEqual(list(iter_pending_entries(
+                StringIO(binary[:3]), chunk_size)), [(None, binary[:3], 3)])
+        self.assertEqual(list(iter_pending_entries(StringIO(''))), [])
+
+    def test_corrupt_entries_in_the_middle(self):
+        entries = [pickle.dumps(('o%d' % i, '\x00' * i),
+                                protocol=PICKLE_PROTOCOL) for i in range(6)]
+        binaries = [pack_pending_entry(entry) for entry in entries]
+        # a torn write: a header, then only part of its pickle
+        torn = binaries[1][:-4]
+        # a garbled pickle, so its checksum is wrong
+        garbled = binaries[2][:-2] + 'xx'
+        # a garbled length, that would swallow every later entry
+        huge = binaries[3][:1] + '\x00\x00\xff\xff' + binaries[3][5:]
+        longer = binaries[4][:1] + '\x00\x00\x00\xff' + binaries[4][5:]
+        pending = ''.join([binaries[0], torn, garbled, huge, longer,
+                           binaries[5]])
+        for chunk_size in (1, 7, 65536):
+            got = list(iter_pending_entries(StringIO(pending), chunk_size))
+            self.assertEqual([(binary, entry) for binary, entry, end in got
+                              if binary], [(True, entries[0]),
+                                           (True, entries[5])])
+            self.assertEqual(got[-1][2], len(pending))
+            # nothing is lost but the bad entries
+            self.assertEqual(''.join(entry for binary, entry, end in got
+                                     if binary is None),
+                             ''.join([torn, garbled, huge, longer]))
+            self.assertEqual(''.join(
+                entry for binary, entry, end in got if binary),
+                entries[0] + entries[5])
+
+    def test_max_entry(self):
+        entry = 'x' * (PENDING_MAX_ENTRY + 1)
+        pending = pack_pending_entry(entry) + pack_pending_entry('ok')
+        self.assertEqual(list(iter_pending_entries(StringIO(pending)))[-1],
+                         (True, 'ok', len(pending)))
+
+
 class ExampleBroker(DatabaseBroker):
     """
     Concrete enough implementation of a DatabaseBroker.
@@ -883,6 +1013,26 @@ class TestDatabaseBroker(unittest.TestCase):
         self.assertEquals(broker.get_items_since(3, 2), [])
         self.assertEquals(broker.get_items_since(999, 2), [])
 
+    def test_get_item_rows_since(self):
+        broker = DatabaseBroker(':memory:')
+        broker.db_type = 'test'
+        broker.db_contains_type = 'test'
+
+        def _initialize(conn, timestamp, **kwargs):
+            conn.execute('CREATE TABLE test (one TEXT, two INTEGER)')
+            conn.execute('INSERT INTO test (one, two) VALUES ("1", 1)')
+            conn.execute('INSERT INTO test (one, two) VALUES ("2", 2)')
+            conn.execute('INSERT INTO test (one, two) VALUES ("3", 3)')
+            conn.commit()
+        broker._initialize = _initialize
+        broker.initialize(normalize_timestamp('1'))
+        self.assertEquals(broker.get_item_rows_since(-1, 10),
+                          (['one', 'two'], [('1', 1), ('2', 2), ('3', 3)]))
+        self.assertEquals(broker.get_item_rows_since(1, 1),
+                          (['one', 'two'], [('2', 2)]))
+        self.assertEquals(broker.get_item_rows_since(3, 2),
+                          (['one', 'two'], []))
+
     def test_get_sync(self):
         broker = DatabaseBroker(':memory:')
         broker.db_type = 'test'
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import unittest
 from contextlib import contextmanager
 import os
@@ -25,13 +26,18 @@ from shutil import rmtree, copy
 from tempfile import mkdtemp, NamedTemporaryFile
 import mock
 import simplejson
+import zlib
+from StringIO import StringIO
+
+import eventlet
+from eventlet.semaphore import Semaphore
 
 from swift.container.backend import DATADIR
 from swift.common import db_replicator
 from swift.common.utils import (normalize_timestamp, hash_path,
                                 storage_directory)
 from swift.common.exceptions import DriveNotMounted
-from swift.common.swob import HTTPException
+from swift.common.swob import HTTPException, Request
 
 from test import unit
 from test.unit.common.test_db import ExampleBroker
@@ -301,6 +307,47 @@ class TestDBReplicator(unittest.TestCase):
         conn.request = other_req
         self.assertEquals(conn.replicate(1, 2, 3), None)
 
+    def test_repl_connection_framed(self):
+        node = {'replication_ip': '127.0.0.1', 'replication_port': 80,
+                'device': 'sdb1'}
+        conn = db_replicator.ReplConnection(node, '1234567890', 'abcdefg',
+                                            logging.getLogger())
+        sent = []
+        headers = {}
+        conn.putrequest = lambda method, path: sent.append((method, path))
+        conn.putheader = headers.__setitem__
+        conn.endheaders = lambda: None
+        conn.send = sent.append
+
+        class Resp(object):
+            def read(self):
+                return 'data'
+        resp = Resp()
+        conn.getresponse = lambda *args: resp
+        frames = [db_replicator.encode_frame(['x']),
+                  db_replicator.encode_frame(['y'])]
+        self.assertEquals(
+            conn.replicate_framed(['op', 'id'], iter(frames), timeout=1),
+            resp)
+        self.assertEquals(resp.data, 'data')
+        self.assertEquals(headers, {
+            'Content-Type': db_replicator.FRAMED_CONTENT_TYPE,
+            'Transfer-Encoding': 'chunked'})
+        self.assertEquals(sent[0], ('REPLICATE', '/sdb1/1234567890/abcdefg'))
+        self.assertEquals(sent[-1], '0\r\n\r\n')
+        body = ''
+        for chunk in sent[1:-1]:
+            size, chunk = chunk.split('\r\n', 1)
+            self.assertEquals(int(size, 16), len(chunk) - 2)
+            body += chunk[:-2]
+        self.assertEquals(list(db_replicator.iter_frames(StringIO(body))),
+                          [['op', 'id'], ['x'], ['y']])
+
+        def bad_frames():
+            yield frames[0]
+            raise Exception('blah')
+        self.assertEquals(conn.replicate_framed(['op'], bad_frames()), None)
+
     def test_rsync_file(self):
         replicator = TestReplicator({})
         with _mock_process(-1):
@@ -502,10 +549,12 @@ class TestDBReplicator(unittest.TestCase):
                                            'tmp'))
             self.assertTrue(time.time() - replicator.reclaim_age >= mtime)
 
-        def mock_spawn_n(fn, part, object_file, node_id):
+        def mock_replicate_object(part, object_file, node_id):
             self.assertEquals('123', part)
             self.assertEquals('/srv/node/sda/c.db', object_file)
             self.assertEquals(1, node_id)
+            replicated.append(object_file)
+        replicated = []
 
         self._patch(patch.object, db_replicator, 'whataremyips',
                     lambda *args: ['1.1.1.1'])
@@ -514,7 +563,8 @@ class TestDBReplicator(unittest.TestCase):
                     mock_unlink_older_than)
         self._patch(patch.object, db_replicator, 'roundrobin_datadirs',
                     lambda *args: [('123', '/srv/node/sda/c.db', 1)])
-        self._patch(patch.object, replicator.cpool, 'spawn_n', mock_spawn_n)
+        self._patch(patch.object, replicator, '_replicate_object',
+                    mock_replicate_object)
 
         with patch('swift.common.db_replicator.os',
                    new=mock.MagicMock(wraps=os)) as mock_os:
@@ -524,6 +574,176 @@ class TestDBReplicator(unittest.TestCase):
                 os.path.join(replicator.root,
                              replicator.ring.devs[0]['device'],
                              replicator.datadir))
+        self.assertEquals(['/srv/node/sda/c.db'], replicated)
+
+    def test_run_once_per_device_pools(self):
+        db_replicator.ring = FakeRingWithNodes()
+        replicator = TestReplicator({'concurrency': 5, 'mount_check': 'no',
+                                     'devices': '/srv/node'})
+        for dev in replicator.ring.devs:
+            dev.update(replication_ip=dev['ip'], replication_port=1000)
+        devices = []
+
+        def mock_replicate_device(datadir, node_id, semaphore):
+            devices.append((datadir, node_id, semaphore.balance))
+            db_file = '%s/%s.db' % (datadir, node_id)
+            replicator._synced[db_file] = (replicator._sweep, 0, 0)
+            if node_id == 1:
+                replicator._failed[db_file] = replicator._sweep
+
+        self._patch(patch.object, db_replicator, 'whataremyips',
+                    lambda *args: ['1.1.1.1', '1.1.1.2'])
+        self._patch(patch.object, db_replicator, 'unlink_older_than',
+                    lambda *args: None)
+        self._patch(patch.object, db_replicator.os.path, 'isdir',
+                    lambda *args: True)
+        self._patch(patch.object, replicator, '_replicate_device',
+                    mock_replicate_device)
+        replicator._synced['/gone.db'] = (replicator._sweep, 0, 0)
+        replicator._failed['/gone.db'] = replicator._sweep
+        replicator.run_once()
+        # the concurrency is shared among the devices
+        self.assertEquals(sorted(devices), [
+            ('/srv/node/sdb/containers', 1, 2),
+            ('/srv/node/sdb/containers', 2, 2)])
+        self.assertTrue(replicator._full_sweep)
+        # the dbs the full sweep didn't come across are forgotten
+        self.assertEquals(sorted(replicator._synced), [
+            '/srv/node/sdb/containers/1.db',
+            '/srv/node/sdb/containers/2.db'])
+        self.assertEquals(replicator._failed.keys(),
+                          ['/srv/node/sdb/containers/1.db'])
+
+        del devices[:]
+        replicator.per_device_concurrency = 3
+        replicator.run_once()
+        self.assertFalse(replicator._full_sweep)
+        self.assertEquals(sorted(devices), [
+            ('/srv/node/sdb/containers', 1, 3),
+            ('/srv/node/sdb/containers', 2, 3)])
+
+        # a device never gets more than all of the workers
+        del devices[:]
+        replicator.per_device_concurrency = 10
+        replicator.run_once()
+        self.assertEquals(sorted(devices), [
+            ('/srv/node/sdb/containers', 1, 5),
+            ('/srv/node/sdb/containers', 2, 5)])
+
+    def test_prioritize(self):
+        db_replicator.ring = FakeRingWithNodes()
+        replicator = TestReplicator({})
+        tempdir = mkdtemp()
+        try:
+            db_file = os.path.join(tempdir, 'hash.db')
+            with open(db_file, 'w') as fp:
+                fp.write('db')
+            replicator._full_sweep = False
+            # never synced
+            self.assertEquals(replicator._prioritize('0', db_file, 1), 1)
+            node_ids = (1, 2, 3)
+            replicator._synced[db_file] = (
+                0, hash((replicator._stat_key(db_file), node_ids)), 0)
+            # unchanged since it last synced
+            self.assertEquals(replicator._prioritize('0', db_file, 1), None)
+            replicator._full_sweep = True
+            self.assertEquals(replicator._prioritize('0', db_file, 1), 2)
+            replicator._full_sweep = False
+            # handoff
+            self.assertEquals(replicator._prioritize('0', db_file, 4), 0)
+            # the ring changed
+            replicator._synced[db_file] = (
+                0, hash((replicator._stat_key(db_file), (1, 2, 4))), 0)
+            self.assertEquals(replicator._prioritize('0', db_file, 1), 1)
+            replicator._synced[db_file] = (
+                0, hash((replicator._stat_key(db_file), node_ids)), 0)
+            # the db changed
+            with open(db_file + '.pending', 'w') as fp:
+                fp.write('row')
+            self.assertEquals(replicator._prioritize('0', db_file, 1), 1)
+            replicator._synced[db_file] = (
+                0, hash((replicator._stat_key(db_file), node_ids)), 0)
+            self.assertEquals(replicator._prioritize('0', db_file, 1), None)
+            # failed last time
+            replicator._failed[db_file] = 0
+            self.assertEquals(replicator._prioritize('0', db_file, 1), 0)
+        finally:
+            rmtree(tempdir)
+
+    def test_replicate_device_order(self):
+        replicator = TestReplicator({})
+        priorities = {'a': 1, 'b': None, 'c': 0, 'd': 2, 'e': 0, 'f': 1}
+        walked = []
+        replicated = []
+
+        def mock_roundrobin_datadirs(dirs):
+            for name in 'abcdef':
+                walked.append(name)
+                yield '0', '%s/%s.db' % (dirs[0][0], name), dirs[0][1]
+
+        def mock_replicate_object(part, object_file, node_id):
+            replicated.append((os.path.basename(object_file)[0],
+                               len(walked)))
+
+        self._patch(patch.object, db_replicator, 'roundrobin_datadirs',
+                    mock_roundrobin_datadirs)
+        self._patch(patch.object, replicator, '_prioritize',
+                    lambda part, object_file, node_id:
+                    priorities[os.path.basename(object_file)[0]])
+        self._patch(patch.object, replicator, '_replicate_object',
+                    mock_replicate_object)
+        replicator._replicate_device('/srv/node/sda/containers', 1,
+                                     Semaphore(1))
+        replicator.cpool.waitall()
+        self.assertEquals(''.join(name for name, _junk in replicated),
+                          'ceafd')
+        self.assertEquals(replicator.stats['skip'], 1)
+
+        # only the DBs in the window are put in order, and replication
+        # starts while the device is still being walked
+        del walked[:]
+        del replicated[:]
+        replicator.priority_window = 2
+        replicator._replicate_device('/srv/node/sda/containers', 1,
+                                     Semaphore(1))
+        replicator.cpool.waitall()
+        self.assertEquals(''.join(name for name, _junk in replicated),
+                          'caefd')
+        self.assertTrue(replicated[0][1] < 6)
+
+    def test_replicate_device_concurrency(self):
+        replicator = TestReplicator({'concurrency': 3})
+        in_flight = collections.defaultdict(int)
+        most_in_flight = collections.defaultdict(int)
+
+        def mock_replicate_object(part, object_file, node_id):
+            in_flight[node_id] += 1
+            in_flight['all'] += 1
+            for key in (node_id, 'all'):
+                most_in_flight[key] = max(most_in_flight[key],
+                                          in_flight[key])
+            eventlet.sleep(0.001)
+            in_flight[node_id] -= 1
+            in_flight['all'] -= 1
+
+        self._patch(patch.object, db_replicator, 'roundrobin_datadirs',
+                    lambda dirs: [('0', '%s/%d.db' % (dirs[0][0], i),
+                                   dirs[0][1]) for i in range(10)])
+        self._patch(patch.object, replicator, '_prioritize',
+                    lambda part, object_file, node_id: 1)
+        self._patch(patch.object, replicator, '_replicate_object',
+                    mock_replicate_object)
+        device_pool = eventlet.GreenPool()
+        for node_id in (1, 2, 3, 4):
+            device_pool.spawn_n(replicator._replicate_device,
+                                '/srv/node/sd%d/containers' % node_id,
+                                node_id, Semaphore(2))
+        device_pool.waitall()
+        replicator.cpool.waitall()
+        # each device gets no more than its share, and all of them together
+        # no more than the replicator's concurrency
+        self.assertEquals(most_in_flight.pop('all'), 3)
+        self.assertTrue(max(most_in_flight.values()) <= 2)
 
     def test_usync(self):
         fake_http = ReplHttp()
@@ -542,6 +762,12 @@ class TestDBReplicator(unittest.TestCase):
         self.assertFalse(
             replicator._usync_db(0, FakeBroker(), fake_http, '12345', '67890'))
 
+    def test_sync_method(self):
+        self.assertEqual(TestReplicator({}).sync_method, 'rsync')
+        self.assertEqual(
+            TestReplicator({'sync_method': 'http'}).sync_method, 'http')
+        self.assertRaises(ValueError, TestReplicator, {'sync_method': 'ssync'})
+
     def test_stats(self):
         # I'm not sure how to test that this logs the right thing,
         # but we can at least make sure it gets covered.
@@ -933,6 +1159,32 @@ class TestDBReplicator(unittest.TestCase):
         rpc.merge_items(fake_broker, args)
         self.assertEquals(fake_broker.args, args)
 
+    def test_merge_item_rows(self):
+        rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
+        broker = mock.MagicMock()
+        frames = iter([[['ROWID', 'name'], [[1, 'a'], [2, 'b']]],
+                       [['ROWID', 'name'], []],
+                       [['ROWID', 'name'], [[3, 'c']]]])
+        resp = rpc.merge_item_rows(broker, ['id', frames])
+        self.assertEquals(resp.status_int, 202)
+        self.assertEquals(broker.merge_items.call_args_list, [
+            call([{'ROWID': 1, 'name': 'a'}, {'ROWID': 2, 'name': 'b'}],
+                 'id'),
+            call([{'ROWID': 3, 'name': 'c'}], 'id')])
+
+        def bad_frames():
+            yield [['ROWID', 'name'], [[4, 'd']]]
+            raise ValueError('Frame truncated')
+        broker.reset_mock()
+        resp = rpc.merge_item_rows(broker, ['id', bad_frames()])
+        self.assertEquals(resp.status_int, 400)
+        # the frames before the bad one are merged
+        self.assertEquals(broker.merge_items.call_args_list, [
+            call([{'ROWID': 4, 'name': 'd'}], 'id')])
+        for args in (['id'], ['id', [1]]):
+            resp = rpc.merge_item_rows(broker, args)
+            self.assertEquals(resp.status_int, 400)
+
     def test_merge_syncs(self):
         rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
         fake_broker = FakeBroker()
@@ -1160,6 +1412,52 @@ class TestDBReplicator(unittest.TestCase):
                       replicator.logger))
 
 
+class TestFrames(unittest.TestCase):
+
+    def test_round_trip(self):
+        objs = [['merge_item_rows', 'id'],
+                [['ROWID', 'name'], [[1, u'\u2603'], [2, 'o']]], []]
+        body = ''.join(db_replicator.encode_frame(obj) for obj in objs)
+        self.assertEquals(list(db_replicator.iter_frames(StringIO(body))),
+                          objs)
+        self.assertEquals(list(db_replicator.iter_frames(StringIO(''))), [])
+
+    def test_bad_frames(self):
+        frame = db_replicator.encode_frame(['x'] * 100)
+        for body in (frame[:2], frame[:-1],
+                     frame[:4] + 'x' * (len(frame) - 4)):
+            frames = db_replicator.iter_frames(StringIO(frame + body))
+            self.assertEquals(frames.next(), ['x'] * 100)
+            self.assertRaises(ValueError, frames.next)
+        with mock.patch.object(db_replicator, 'MAX_FRAME_SIZE',
+                               len(frame) - 5):
+            frames = db_replicator.iter_frames(StringIO(frame))
+            self.assertRaises(ValueError, frames.next)
+        frame = zlib.compress('not json')
+        frames = db_replicator.iter_frames(
+            StringIO(db_replicator.struct.pack('!I', len(frame)) + frame))
+        self.assertRaises(ValueError, frames.next)
+
+    def test_load_replicate_args(self):
+        req = Request.blank('/sda/0/hash', body='["sync", 1]')
+        self.assertEquals(db_replicator.load_replicate_args(req),
+                          ['sync', 1])
+        body = ''.join(db_replicator.encode_frame(obj)
+                       for obj in (['op', 'id'], [1], [2]))
+        req = Request.blank(
+            '/sda/0/hash', body=body,
+            headers={'Content-Type': db_replicator.FRAMED_CONTENT_TYPE})
+        args = db_replicator.load_replicate_args(req)
+        self.assertEquals(args[:2], ['op', 'id'])
+        self.assertEquals(list(args[2]), [[1], [2]])
+        for body in ('', db_replicator.encode_frame({'op': 'id'})):
+            req = Request.blank(
+                '/sda/0/hash', body=body,
+                headers={'Content-Type': db_replicator.FRAMED_CONTENT_TYPE})
+            self.assertRaises(ValueError, db_replicator.load_replicate_args,
+                              req)
+
+
 class TestReplToNode(unittest.TestCase):
     def setUp(self):
         db_replicator.ring = FakeRing()
@@ -1278,6 +1576,22 @@ def attach_fake_replication_rpc(rpc, replicate_hook=None):
                 replicate_hook(op, *sync_args)
             return resp
 
+        def replicate_framed(self, args, frames, timeout=None):
+            frames = list(frames)
+            print 'REPLICATE: %s, %r, %d frames' % (self.path, args,
+                                                    len(frames))
+            replicate_args = self.path.lstrip('/').split('/')
+            req = Request.blank(
+                self.path,
+                body=db_replicator.encode_frame(args) + ''.join(frames),
+                headers={'Content-Type': db_replicator.FRAMED_CONTENT_TYPE})
+            swob_response = rpc.dispatch(
+                replicate_args, db_replicator.load_replicate_args(req))
+            resp = FakeHTTPResponse(swob_response)
+            if replicate_hook:
+                replicate_hook(args[0], *args[1:])
+            return resp
+
     return FakeReplConnection
 
 
@@ -371,6 +371,45 @@ class TestDirectClient(unittest.TestCase):
 
         self.assertEqual(rv, None)
 
+    def test_direct_update_container(self):
+        items = [{'name': self.obj, 'created_at': '1', 'size': 0,
+                  'content_type': 'application/deleted', 'etag': 'noetag',
+                  'deleted': 1}]
+        body = json.dumps(items)
+
+        with mocked_http_conn(202) as conn:
+            rv = direct_client.direct_update_container(
+                self.node, self.part, self.account, self.container, items,
+                headers={'x-foo': 'bar'})
+            self.assertEqual(conn.method, 'UPDATE')
+            self.assertEqual(conn.path, self.container_path)
+            self.assert_('x-timestamp' in conn.req_headers)
+            self.assertEqual('bar', conn.req_headers.get('x-foo'))
+            self.assertEqual(conn.req_headers['content-type'],
+                             'application/json')
+            self.assertEqual(conn.req_headers['content-length'],
+                             str(len(body)))
+            self.assertEqual(conn.etag.hexdigest(), md5(body).hexdigest())
+
+        self.assertEqual(rv, None)
+
+    def test_direct_update_container_error(self):
+        with mocked_http_conn(405) as conn:
+            try:
+                direct_client.direct_update_container(
+                    self.node, self.part, self.account, self.container, [],
+                    headers={'X-Timestamp': '1'})
+            except ClientException as err:
+                pass
+            else:
+                self.fail('ClientException not raised')
+
+            self.assertEqual(conn.method, 'UPDATE')
+            self.assertEqual(conn.req_headers['x-timestamp'], '1')
+
+        self.assertEqual(err.http_status, 405)
+        self.assert_('UPDATE' in str(err))
+
     def test_direct_put_container_object_error(self):
         with mocked_http_conn(500) as conn:
             try:
@@ -16,11 +16,12 @@
 """Tests for swift.common.request_helpers"""
 
 import unittest
-from swift.common.swob import Request, HTTPException
+from swift.common.swob import Request, Response, HTTPException
 from swift.common.storage_policy import POLICIES, EC_POLICY, REPL_POLICY
 from swift.common.request_helpers import is_sys_meta, is_user_meta, \
     is_sys_or_user_meta, strip_sys_meta_prefix, strip_user_meta_prefix, \
-    remove_items, copy_header_subset, get_name_and_placement
+    remove_items, copy_header_subset, get_name_and_placement, \
+    iter_listing_chunks, set_listing_body
 
 from test.unit import patch_policies
 
@@ -158,3 +159,33 @@ class TestRequestHelpers(unittest.TestCase):
         self.assertEqual(suffix_parts, '')  # still false-y
         self.assertEqual(policy, POLICIES[1])
         self.assertEqual(policy.policy_type, REPL_POLICY)
+
+    def test_iter_listing_chunks(self):
+        parts = ['ab', 'c', 'def', 'g', '', 'hijk', 'l']
+        self.assertEqual(list(iter_listing_chunks(parts, 3)),
+                         ['abc', 'def', 'ghijk', 'l'])
+        self.assertEqual(list(iter_listing_chunks(parts, 100)),
+                         ['abcdefghijkl'])
+        self.assertEqual(list(iter_listing_chunks(['abc'], 3)), ['abc', ''])
+        self.assertEqual(list(iter_listing_chunks([], 3)), [''])
+
+    def test_set_listing_body(self):
+        resp = Response()
+        set_listing_body(resp, iter(['ab', 'c']), 4)
+        self.assertEqual(resp.content_length, 3)
+        self.assertEqual(resp.body, 'abc')
+
+        resp = Response()
+        set_listing_body(resp, iter([]), 4)
+        self.assertEqual(resp.content_length, 0)
+        self.assertEqual(resp.body, '')
+
+        def parts():
+            yield 'abcd'
+            yield 'e'
+            raise Exception('listing read too far')
+
+        resp = Response()
+        set_listing_body(resp, parts(), 4)
+        self.assertEqual(resp.content_length, None)
+        self.assertEqual(next(iter(resp.app_iter)), 'abcd')
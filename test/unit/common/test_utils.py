@@ -763,6 +763,21 @@ class TestUtils(unittest.TestCase):
         finally:
             shutil.rmtree(tmpdir)
 
+    def test_lock_path_name(self):
+        tmpdir = mkdtemp()
+        try:
+            with utils.lock_path(tmpdir, 0.1, name='foo'):
+                # a different name is a different lock
+                with utils.lock_path(tmpdir, 0.1):
+                    pass
+                with utils.lock_path(tmpdir, 0.1, name='bar'):
+                    pass
+                self.assertRaises(LockTimeout, utils.lock_path(
+                    tmpdir, 0.1, name='foo').__enter__)
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, '.lock-foo')))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_lock_path_num_sleeps(self):
         tmpdir = mkdtemp()
         num_short_calls = [0]
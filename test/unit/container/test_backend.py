@@ -28,13 +28,15 @@ import sqlite3
 import pickle
 import json
 
-from swift.container.backend import ContainerBroker
+from swift.container.backend import ContainerBroker, get_dirty_journal, \
+    pop_dirty_journal
+from swift.common.db import GreenDBCursor
 from swift.common.utils import Timestamp
 from swift.common.storage_policy import POLICIES
 
 import mock
 
-from test.unit import patch_policies, with_tempdir
+from test.unit import patch_policies, with_tempdir, debug_logger
 from test.unit.common.test_db import TestExampleBroker
 
 
@@ -1456,6 +1458,371 @@ class TestContainerBroker(unittest.TestCase):
         }
         self.assertEqual(broker.get_policy_stats(), expected)
 
+    def test_listing_index(self):
+        if isinstance(self, ContainerBrokerMigrationMixin):
+            # older schemas only get the index from add_listing_index
+            return
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 2)
+            self.assertTrue(broker._has_storage_policy_index(conn))
+        # only older DBs need it added
+        self.assertFalse(broker.add_listing_index())
+
+    @with_tempdir
+    def test_add_listing_index(self, tempdir):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        db_path = os.path.join(tempdir, 'container.db')
+        broker = ContainerBroker(db_path, account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        for i in range(3):
+            broker.put_object('o%d' % i, ts.next(), 0, 'c', 'e', 0)
+        with broker.get() as conn:
+            conn.execute('DROP INDEX IF EXISTS ix_object_deleted_policy_name')
+            conn.commit()
+        broker = ContainerBroker(db_path, account='a', container='c')
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 1)
+        self.assertEqual(
+            [r[0] for r in broker.list_objects_iter(10, '', None, None, '')],
+            ['o0', 'o1', 'o2'])
+        self.assertTrue(broker.add_listing_index())
+        self.assertFalse(broker.add_listing_index())
+        broker = ContainerBroker(db_path, account='a', container='c')
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 2)
+            plan = ' '.join(str(row[-1]) for row in conn.execute(
+                'EXPLAIN QUERY PLAN ' +
+                broker._get_listing_query(conn, '>', True, True),
+                (0, '', 'z', 10)))
+        self.assertTrue('ix_object_deleted_policy_name' in plan, plan)
+        self.assertEqual(
+            [r[0] for r in broker.list_objects_iter(10, '', None, None, '')],
+            ['o0', 'o1', 'o2'])
+
+    def test_listing_queries_reused(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        for name in ('a/1', 'a/2', 'b', 'c/1', 'c/2', 'd'):
+            broker.put_object(name, Timestamp(time()).internal, 0, 'c', 'e')
+        listing_queries = {}
+        with mock.patch('swift.container.backend.LISTING_QUERIES',
+                        listing_queries), \
+                mock.patch('swift.container.backend.can_rollup',
+                           return_value=False), \
+                mock.patch.object(broker, '_has_storage_policy_index',
+                                  wraps=broker._has_storage_policy_index) \
+                as mock_has_policy:
+            for i in range(2):
+                self.assertEqual(
+                    [r[0] for r in broker.list_objects_iter(
+                        10, '', None, '', '/')],
+                    ['a/', 'b', 'c/', 'd'])
+                self.assertEqual(
+                    [r[0] for r in broker.list_objects_iter(
+                        10, 'a/1', None, 'a/', None)],
+                    ['a/2'])
+        # each listing checks the schema just the once
+        self.assertEqual(mock_has_policy.call_count, 4)
+        self.assertEqual(set(listing_queries), set([
+            (True, None, False, True), (True, '>=', False, True),
+            (True, '>', False, True), (True, '>', True, True)]))
+
+    def test_list_objects_prefix_end(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        top = u'\U0010ffff'.encode('utf-8')
+        names = sorted(['a', 'a' + top, 'a' + top + 'z', 'a~', 'b', top,
+                        top + top])
+        for name in names:
+            broker.put_object(name, Timestamp(time()).internal, 0, 'c', 'e')
+        for prefix in ('a', 'a' + top, top, top + top, top[:2]):
+            self.assertEqual(
+                [r[0] for r in broker.list_objects_iter(
+                    10, '', None, prefix, None)],
+                [n for n in names if n.startswith(prefix)])
+        self.assertEqual(
+            [r[0] for r in broker.list_objects_iter(
+                10, '', 'a' + top + 'z', 'a', None)], ['a', 'a~', 'a' + top])
+
+    def test_list_objects_rollup(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        names = ['/', '/a', '//b', 'a', 'a/', 'a/b', 'a/b/c', 'a/c', 'a0',
+                 'b-c', 'b-c-d', 'b/', 'b/c/d/e', 'b0', 'c', 'c/d',
+                 'c/d/e/f', 'c0/x', 'd-/']
+        for name in names:
+            broker.put_object(name, Timestamp(time()).internal, 0, 'c', 'e')
+        broker.delete_object('b/', Timestamp(time()).internal)
+
+        def listing(*args):
+            with mock.patch('swift.container.backend.can_rollup',
+                            return_value=False):
+                expected = broker.list_objects_iter(*args)
+            for max_plain in (1, 2, 16):
+                with mock.patch('swift.container.backend.ROLLUP_MAX_PLAIN',
+                                max_plain):
+                    self.assertEqual(broker.list_objects_iter(*args),
+                                     expected, 'mismatch for %r with %d' %
+                                     (args, max_plain))
+            return [r[0] for r in expected]
+
+        self.assertEqual(listing(100, '', None, '', '/'),
+                         ['/', '//b', '/a', 'a', 'a/', 'a0', 'b-c', 'b-c-d',
+                          'b/', 'b0', 'c', 'c/', 'c0/', 'd-/'])
+        self.assertEqual(listing(100, '', None, 'a/', '/'),
+                         ['a/', 'a/b', 'a/b/', 'a/c'])
+        self.assertEqual(listing(100, '', None, 'b', '-'),
+                         ['b-', 'b/c/d/e', 'b0'])
+        self.assertEqual(listing(100, '', None, None, '/', 'c'),
+                         ['c/d'])
+        self.assertEqual(listing(100, '', None, None, '/', 'a'),
+                         ['a/b', 'a/c'])
+        for limit in range(1, 14):
+            for marker in ('', 'a', 'a/', 'a/b', 'b-', 'b/', 'c/d', 'zz'):
+                for end_marker in (None, 'b/c', 'c0'):
+                    for prefix in ('', 'a', 'a/', 'b', 'c/'):
+                        for delimiter in ('/', '-'):
+                            listing(limit, marker, end_marker, prefix,
+                                    delimiter)
+                    for path in ('', 'a', 'c', 'c/d'):
+                        # the old listing loop skips names just past a
+                        # subdirectory of the path, like 'a0' after 'a/b'
+                        prefix = path and path + '/'
+                        with mock.patch(
+                                'swift.container.backend.ROLLUP_MAX_PLAIN',
+                                limit % 3 + 1):
+                            listed = broker.list_objects_iter(
+                                limit, marker, end_marker, None, None, path)
+                        self.assertEqual(
+                            [r[0] for r in listed],
+                            [n for n in sorted(names)
+                             if n.startswith(prefix) and n > marker and
+                             n != 'b/' and n != prefix and
+                             (not end_marker or n < end_marker) and
+                             '/' not in n[len(prefix):-1]][:limit])
+
+    def test_iter_objects(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        for i in range(20):
+            broker.put_object('o%02d' % i, Timestamp(time()).internal, 0,
+                              'c', 'e')
+            broker.put_object('d%02d/o' % i, Timestamp(time()).internal, 0,
+                              'c', 'e')
+        for args in ((100, '', None, None, ''), (100, 'd05', 'o10', '', '/'),
+                     (13, '', None, 'd', '/'), (40, 'd19/', None, '', '/'),
+                     (100, '', None, None, None, 'd03')):
+            listing = broker.list_objects_iter(*args)
+            with mock.patch.object(broker, 'list_objects_iter',
+                                   wraps=broker.list_objects_iter) \
+                    as mock_list:
+                self.assertEqual(
+                    list(broker.iter_objects(*args, batch_size=3)), listing)
+            self.assertEqual(mock_list.call_count, len(listing) // 3 + 1)
+            self.assertTrue(all(call[0][0] <= 3
+                                for call in mock_list.call_args_list))
+
+    def test_list_objects_rollup_queries(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        for i in range(50):
+            for j in range(3):
+                broker.put_object('d%02d/o%d' % (i, j),
+                                  Timestamp(time()).internal, 0, 'c', 'e')
+        rollup_queries = {}
+        with mock.patch('swift.container.backend.ROLLUP_QUERIES',
+                        rollup_queries), \
+                mock.patch.object(GreenDBCursor, 'execute',
+                                  autospec=True,
+                                  side_effect=GreenDBCursor.execute) \
+                as mock_execute:
+            listing = broker.list_objects_iter(100, 'd10/', None, '', '/')
+        self.assertEqual([r[0] for r in listing],
+                         ['d%02d/' % i for i in range(11, 50)])
+        # one query lists every common prefix
+        self.assertEqual(
+            [call[0][1] for call in mock_execute.call_args_list
+             if 'WITH RECURSIVE' in call[0][1]],
+            rollup_queries.values())
+        with broker.get() as conn:
+            plan = conn.execute(
+                'EXPLAIN QUERY PLAN ' + rollup_queries.values()[0],
+                {'prefix': '', 'delimiter': '/', 'after_delimiter': '0',
+                 'after_name': '\x01', 'min_end': 1, 'marker': 'd10/',
+                 'max_plain': 16, 'policy': 0, 'limit': 100}).fetchall()
+        self.assertFalse([r for r in plan if 'SCAN object' in r[-1]], plan)
+
+    @with_tempdir
+    def test_binary_pending_entries(self, tempdir):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        db_path = os.path.join(tempdir, 'container.db')
+        broker = ContainerBroker(db_path, account='a', container='c',
+                                 logger=debug_logger())
+        broker.initialize(ts.next(), 0)
+        broker.put_object('o:1', ts.next(), 1, 'c', 'e', 0)
+        with open(broker.pending_file, 'rb') as fp:
+            pending = fp.read()
+        self.assertTrue(pending.startswith('\x00'))
+        self.assertFalse('=' in pending)
+        broker.put_object('o:2', ts.next(), 2, 'c', 'e', 0)
+        # a partly written entry is logged and the rest still committed,
+        # including the entries after it
+        with open(broker.pending_file, 'ab') as fp:
+            fp.write(pending[:-2])
+        broker.put_object('o:3', ts.next(), 4, 'c', 'e', 0)
+        broker._commit_puts_stale_ok()
+        self.assertEqual(os.path.getsize(broker.pending_file), 0)
+        self.assertEqual(
+            [o[0] for o in broker.list_objects_iter(10, '', None, None, '')],
+            ['o:1', 'o:2', 'o:3'])
+        self.assertEqual(broker.get_info()['bytes_used'], 7)
+        self.assertEqual(
+            len(broker.logger.get_lines_for_level('error')), 1)
+
+    @with_tempdir
+    def test_chunked_pending_commit(self, tempdir):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        db_path = os.path.join(tempdir, 'container.db')
+        broker = ContainerBroker(db_path, account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        for i in range(10):
+            broker.put_object('o%d' % i, ts.next(), i, 'c', 'e', 0)
+        merged = []
+        real_merge_items = broker.merge_items
+
+        def fake_merge_items(item_list):
+            if len(merged) == 2:
+                raise Exception('boom')
+            merged.append([item['name'] for item in item_list])
+            real_merge_items(item_list)
+
+        with mock.patch('swift.common.db.PENDING_COMMIT_BATCH', 3), \
+                mock.patch.object(broker, 'merge_items', fake_merge_items):
+            self.assertRaises(Exception, broker._commit_puts_stale_ok)
+        self.assertEqual(merged, [['o0', 'o1', 'o2'], ['o3', 'o4', 'o5']])
+        self.assertTrue(os.path.exists(broker.pending_checkpoint_file))
+        self.assertTrue(os.path.getsize(broker.pending_file) > 0)
+
+        # the next commit carries on from where the last one got to
+        merged = []
+        with mock.patch('swift.common.db.PENDING_COMMIT_BATCH', 3), \
+                mock.patch.object(broker, 'merge_items', merged.append):
+            broker._commit_puts_stale_ok()
+        self.assertEqual([[item['name'] for item in item_list]
+                          for item_list in merged],
+                         [['o6', 'o7', 'o8'], ['o9']])
+        for item_list in merged:
+            real_merge_items(item_list)
+        self.assertFalse(os.path.exists(broker.pending_checkpoint_file))
+        self.assertEqual(os.path.getsize(broker.pending_file), 0)
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 10)
+        self.assertEqual(info['bytes_used'], sum(range(10)))
+
+        # a checkpoint past the end of the file is not trusted
+        broker.put_object('o10', ts.next(), 10, 'c', 'e', 0)
+        with open(broker.pending_checkpoint_file, 'wb') as fp:
+            fp.write('99999')
+        broker._commit_puts_stale_ok()
+        self.assertEqual(broker.get_info()['object_count'], 11)
+        self.assertFalse(os.path.exists(broker.pending_checkpoint_file))
+
+    @with_tempdir
+    def test_chunked_pending_commit_releases_lock(self, tempdir):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        db_path = os.path.join(tempdir, 'container.db')
+        broker = ContainerBroker(db_path, account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        broker.pending_timeout = 0.1
+        for i in range(10):
+            broker.put_object('o%d' % i, ts.next(), i, 'c', 'e', 0)
+        merged = []
+        real_merge_items = broker.merge_items
+
+        def fake_merge_items(item_list):
+            merged.append([item['name'] for item in item_list])
+            real_merge_items(item_list)
+
+        writes = ['o10']
+
+        def fake_sleep(*args):
+            # another writer gets the lock between batches
+            if writes:
+                broker.put_object(writes.pop(), ts.next(), 10, 'c', 'e', 0)
+
+        with mock.patch('swift.common.db.PENDING_COMMIT_BATCH', 3), \
+                mock.patch('swift.common.db.sleep', fake_sleep), \
+                mock.patch.object(broker, 'merge_items', fake_merge_items):
+            broker._commit_puts_stale_ok()
+        # past what was pending to start with, the rest goes in one go
+        self.assertEqual(merged, [['o0', 'o1', 'o2'], ['o3', 'o4', 'o5'],
+                                  ['o6', 'o7', 'o8'], ['o9', 'o10']])
+        self.assertFalse(os.path.exists(broker.pending_checkpoint_file))
+        self.assertEqual(os.path.getsize(broker.pending_file), 0)
+        self.assertEqual(broker.get_info()['object_count'], 11)
+
+    @with_tempdir
+    def test_dirty_journal(self, tempdir):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        hsh = 'a3a1d6a6c7e3ae4f4e8ffd0b5c69a4ab'
+        db_path = os.path.join(tempdir, 'sda1', 'containers', '7', hsh[-3:],
+                               hsh, hsh + '.db')
+        journal = os.path.join(tempdir, 'sda1', 'containers_dirty', '7')
+        self.assertEqual(get_dirty_journal(db_path), (journal, hsh))
+        self.assertEqual(
+            get_dirty_journal(os.path.join(tempdir, 'container.db')),
+            (None, None))
+        self.assertEqual(pop_dirty_journal(journal), set())
+
+        broker = ContainerBroker(db_path, account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        self.assertEqual(pop_dirty_journal(journal), set([hsh]))
+        self.assertFalse(os.path.exists(journal))
+
+        # only the first pending update marks the container
+        broker.put_object('o1', ts.next(), 1, 'text/plain', 'etag')
+        broker.put_object('o2', ts.next(), 1, 'text/plain', 'etag')
+        with open(journal) as fp:
+            self.assertEqual(fp.read(), hsh + '\n')
+        os.unlink(journal)
+        # and merging the rows marks it again
+        broker.get_info()
+        self.assertEqual(pop_dirty_journal(journal), set([hsh]))
+        broker.get_info()
+        self.assertFalse(os.path.exists(journal))
+
+        # replicated rows that change nothing do not mark it
+        broker.merge_items([{'name': 'o1', 'created_at': '1', 'size': 2,
+                             'content_type': 'text/plain', 'etag': 'etag',
+                             'deleted': 0}])
+        self.assertFalse(os.path.exists(journal))
+        broker.merge_items([{'name': 'o3', 'created_at': ts.next(),
+                             'size': 2, 'content_type': 'text/plain',
+                             'etag': 'etag', 'deleted': 0}])
+        self.assertEqual(pop_dirty_journal(journal), set([hsh]))
+
+        broker.update_put_timestamp(ts.next())
+        self.assertEqual(pop_dirty_journal(journal), set([hsh]))
+        broker.merge_timestamps(ts.next(), ts.next(), '0')
+        self.assertEqual(pop_dirty_journal(journal), set([hsh]))
+        broker.delete_db(ts.next())
+        self.assertEqual(pop_dirty_journal(journal), set([hsh]))
+
+    @with_tempdir
+    def test_dirty_journal_errors_logged(self, tempdir):
+        hsh = 'a3a1d6a6c7e3ae4f4e8ffd0b5c69a4ab'
+        db_path = os.path.join(tempdir, 'sda1', 'containers', '7', hsh[-3:],
+                               hsh, hsh + '.db')
+        broker = ContainerBroker(db_path, account='a', container='c',
+                                 logger=debug_logger())
+        with mock.patch('swift.container.backend.add_to_dirty_journal',
+                        side_effect=OSError(13, 'Permission denied')):
+            broker.initialize(Timestamp(1).internal, 0)
+        self.assertEqual(len(broker.logger.get_lines_for_level('error')), 1)
+        self.assertTrue(os.path.exists(db_path))
+
 
 class TestCommonContainerBroker(TestExampleBroker):
 
@@ -576,6 +576,63 @@ class TestReconcilerUtils(unittest.TestCase):
         self.assertEqual(rv, None)
         self.assertEqual(len(mock_direct_delete.mock_calls), 3)
 
+    def test_direct_delete_container_entries(self):
+        mock_path = 'swift.common.direct_client.http_connect'
+        connect_args = []
+
+        def test_connect(ipaddr, port, device, partition, method, path,
+                         headers=None, query_string=None):
+            connect_args.append({
+                'ipaddr': ipaddr, 'port': port, 'device': device,
+                'partition': partition, 'method': method, 'path': path,
+                'headers': headers, 'query_string': query_string})
+
+        entries = [('o1', Timestamp(1).internal),
+                   ('o2', Timestamp(2).internal)]
+        fake_hc = fake_http_connect(202, 202, 202, give_connect=test_connect)
+        with mock.patch(mock_path, fake_hc):
+            reconciler.direct_delete_container_entries(
+                self.fake_ring, 'a', 'c', entries)
+
+        self.assertEqual(len(connect_args), 3)
+        for args in connect_args:
+            self.assertEqual(args['method'], 'UPDATE')
+            self.assertEqual(args['path'], '/a/c')
+
+    def test_direct_delete_container_entries_falls_back_on_405(self):
+        mock_update = mock.MagicMock()
+        mock_update.side_effect = [
+            None,
+            ClientException('Container Server too old', http_status=405),
+            socket.error(errno.ECONNREFUSED, os.strerror(errno.ECONNREFUSED)),
+        ]
+        mock_delete = mock.MagicMock()
+        entries = [('o1', Timestamp(1).internal),
+                   ('o2', Timestamp(2).internal)]
+        with contextlib.nested(
+                mock.patch('swift.container.reconciler.'
+                           'direct_update_container', mock_update),
+                mock.patch('swift.container.reconciler.'
+                           'direct_delete_container_object', mock_delete)):
+            rv = reconciler.direct_delete_container_entries(
+                self.fake_ring, 'a', 'c', entries)
+        self.assertEqual(rv, None)
+        self.assertEqual(len(mock_update.mock_calls), 3)
+        items = mock_update.mock_calls[0][1][4]
+        self.assertEqual(items, [
+            {'name': 'o1', 'created_at': Timestamp(1).internal, 'size': 0,
+             'content_type': 'application/deleted', 'etag': 'noetag',
+             'deleted': 1},
+            {'name': 'o2', 'created_at': Timestamp(2).internal, 'size': 0,
+             'content_type': 'application/deleted', 'etag': 'noetag',
+             'deleted': 1}])
+        # only the server that did not know UPDATE gets single deletes
+        self.assertEqual(len(mock_delete.mock_calls), 2)
+        for call, (obj, x_timestamp) in zip(mock_delete.mock_calls, entries):
+            self.assertEqual(call[1][2:5], ('a', 'c', obj))
+            self.assertEqual(call[2]['headers'],
+                             {'X-Timestamp': x_timestamp})
+
     def test_add_to_reconciler_queue(self):
         mock_path = 'swift.common.direct_client.http_connect'
         connect_args = []
@@ -724,6 +781,7 @@ class TestReconciler(unittest.TestCase):
         items = {
             'direct_get_container_policy_index': mock_oldest_spi,
             'direct_delete_container_entry': mock.DEFAULT,
+            'direct_delete_container_entries': mock.DEFAULT,
         }
 
         mock_time_iter = itertools.count(self.start_interval)
@@ -733,8 +791,46 @@ class TestReconciler(unittest.TestCase):
             with mock.patch('time.time', mock_time_iter.next):
                 self.reconciler.run_once()
 
-        return [c[1][1:4] for c in
-                mocks['direct_delete_container_entry'].mock_calls]
+        deleted = [c[1][1:4] for c in
+                   mocks['direct_delete_container_entry'].mock_calls]
+        for c in mocks['direct_delete_container_entries'].mock_calls:
+            account, container, entries = c[1][1:4]
+            deleted.extend((account, container, obj) for obj, _ in entries)
+        return deleted
+
+    def test_pop_queue_batched(self):
+        self.reconciler.pop_queue_batch_size = 2
+        with mock.patch.multiple(
+                reconciler, direct_delete_container_entry=mock.DEFAULT,
+                direct_delete_container_entries=mock.DEFAULT) as mocks:
+            for i in range(3):
+                self.reconciler.pop_queue('3600', 'o%d' % i, 3600.0 + i,
+                                          3600.0 + i)
+            self.assertEqual(
+                len(mocks['direct_delete_container_entries'].mock_calls), 1)
+            self.reconciler.flush_pop_queue('3600')
+            self.reconciler.flush_pop_queue('3600')
+        self.assertFalse(mocks['direct_delete_container_entry'].mock_calls)
+        calls = mocks['direct_delete_container_entries'].mock_calls
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([c[1][3] for c in calls], [
+            [('o0', Timestamp(3600, offset=1).internal),
+             ('o1', Timestamp(3601, offset=1).internal)],
+            [('o2', Timestamp(3602, offset=1).internal)]])
+        self.assertEqual(self.reconciler.stats['pop_queue'], 3)
+
+    def test_pop_queue_unbatched(self):
+        self.reconciler.pop_queue_batch_size = 1
+        with mock.patch.multiple(
+                reconciler, direct_delete_container_entry=mock.DEFAULT,
+                direct_delete_container_entries=mock.DEFAULT) as mocks:
+            self.reconciler.pop_queue('3600', 'o', 3600.0, 3600.0)
+            self.reconciler.flush_pop_queue('3600')
+        self.assertFalse(mocks['direct_delete_container_entries'].mock_calls)
+        calls = mocks['direct_delete_container_entry'].mock_calls
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][2]['headers'],
+                         {'X-Timestamp': Timestamp(3600, offset=1).internal})
 
     def test_invalid_queue_name(self):
         self._mock_listing({
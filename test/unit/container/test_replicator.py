@@ -26,8 +26,10 @@ from swift.common import db_replicator
 from swift.container import replicator, backend, server
 from swift.container.reconciler import (
     MISPLACED_OBJECTS_ACCOUNT, get_reconciler_container_name)
-from swift.common.utils import Timestamp
+from swift.common.utils import Timestamp, json
 from swift.common.storage_policy import POLICIES
+from swift.common.swob import HTTPBadRequest, HTTPServerError, \
+    HTTPNotFound
 
 from test.unit.common import test_db_replicator
 from test.unit import patch_policies
@@ -250,6 +252,325 @@ class TestReplicatorSync(test_db_replicator.TestReplicatorSync):
                              "mismatch remote %s %r != %r" % (
                                  k, remote_info[k], v))
 
+    def _setup_framed_sync(self, local_rows):
+        ts = (Timestamp(t).internal for t in
+              itertools.count(int(time.time())))
+        broker = self._get_broker('a', 'c', node_index=0)
+        broker.initialize(ts.next(), POLICIES.default.idx)
+        remote_broker = self._get_broker('a', 'c', node_index=1)
+        remote_broker.initialize(ts.next(), POLICIES.default.idx)
+        # enough rows in common that the remote isn't rsynced over
+        for i in range(local_rows * 2):
+            timestamp = ts.next()
+            for db in (broker, remote_broker):
+                db.put_object('o_%s' % i, timestamp, 0, 'content-type',
+                              'etag',
+                              storage_policy_index=int(POLICIES.default))
+        for i in range(local_rows):
+            broker.put_object('o_missing_%s' % i, ts.next(), 0,
+                              'content-type', 'etag',
+                              storage_policy_index=int(POLICIES.default))
+            broker.delete_object('o_deleted_%s' % i, ts.next(),
+                                 storage_policy_index=int(POLICIES.default))
+        return broker, remote_broker
+
+    def test_sync_remote_missing_rows_framed(self):
+        broker, remote_broker = self._setup_framed_sync(10)
+        daemon = replicator.ContainerReplicator(
+            {'stream_diffs': 'yes', 'per_diff': 3})
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        with mock.patch.object(self.rpc, 'merge_item_rows',
+                               wraps=self.rpc.merge_item_rows) as mock_merge:
+            success = daemon._repl_to_node(node, broker, part, info)
+        self.assertTrue(success)
+        self.assertEqual(1, daemon.stats['diff'])
+        self.assertEqual(0, daemon.stats['diff_capped'])
+        self.assertEqual(1, mock_merge.call_count)
+        self.assertEqual(
+            set(item['name'] for item in
+                remote_broker.get_items_since(-1, 100)),
+            set(item['name'] for item in broker.get_items_since(-1, 100)))
+        self.assertEqual(sorted(remote_broker.list_objects_iter(
+            100, '', None, None, '')), sorted(broker.list_objects_iter(
+                100, '', None, None, '')))
+        self.assertEqual(remote_broker.get_info()['object_count'], 30)
+        self.assertEqual(
+            remote_broker.get_sync(info['id']), info['max_row'])
+        self.assertEqual(
+            broker.get_sync(remote_broker.get_info()['id'],
+                            incoming=False), info['max_row'])
+
+    def test_sync_remote_framed_capped(self):
+        broker, remote_broker = self._setup_framed_sync(10)
+        daemon = replicator.ContainerReplicator(
+            {'stream_diffs': 'yes', 'per_diff': 3, 'max_diffs': 2})
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        self.assertFalse(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(1, daemon.stats['diff_capped'])
+        # the remote took the rows of the batches sent
+        self.assertEqual(remote_broker.get_sync(info['id']), 6)
+        # and the next pass picks up from there
+        info = broker.get_replication_info()
+        daemon = replicator.ContainerReplicator(
+            {'stream_diffs': 'yes', 'per_diff': 17, 'max_diffs': 2})
+        self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(remote_broker.get_sync(info['id']), info['max_row'])
+        self.assertEqual(len(remote_broker.get_items_since(-1, 100)), 40)
+
+    def test_sync_remote_framed_refused(self):
+        broker, remote_broker = self._setup_framed_sync(5)
+        daemon = replicator.ContainerReplicator(
+            {'stream_diffs': 'yes', 'per_diff': 3})
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        # like a server that can't parse framed requests
+        with mock.patch.object(self.rpc, 'merge_item_rows',
+                               return_value=HTTPBadRequest()), \
+                mock.patch.object(self.rpc, 'merge_items',
+                                  wraps=self.rpc.merge_items) as mock_merge:
+            self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(7, mock_merge.call_count)
+        self.assertEqual(remote_broker.get_sync(info['id']), info['max_row'])
+
+        # other errors fail the sync
+        broker.put_object('o_more', Timestamp(time.time()).internal, 0,
+                          'content-type', 'etag',
+                          storage_policy_index=int(POLICIES.default))
+        info = broker.get_replication_info()
+        with mock.patch.object(self.rpc, 'merge_item_rows',
+                               return_value=HTTPServerError()):
+            self.assertFalse(daemon._repl_to_node(node, broker, part, info))
+
+    def _setup_snapshot(self, rows):
+        ts = (Timestamp(t).internal for t in
+              itertools.count(int(time.time())))
+        broker = self._get_broker('a', 'c', node_index=0)
+        broker.initialize(ts.next(), POLICIES.default.idx)
+        broker.update_metadata({'X-Container-Meta-Test': ('v', ts.next())})
+        for i in range(rows):
+            broker.put_object('o_%s' % i, ts.next(), 0, 'content-type',
+                              'etag',
+                              storage_policy_index=int(POLICIES.default))
+            broker.delete_object('o_deleted_%s' % i, ts.next(),
+                                 storage_policy_index=int(POLICIES.default))
+        broker.merge_syncs([{'remote_id': 'other', 'sync_point': 3}])
+        remote_broker = self._get_broker('a', 'c', node_index=1)
+        return broker, remote_broker
+
+    def test_sync_remote_missing_snapshot(self):
+        broker, remote_broker = self._setup_snapshot(5)
+        daemon = replicator.ContainerReplicator(
+            {'sync_method': 'http', 'per_diff': 3})
+        daemon._rsync_file = mock.MagicMock()
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(1, daemon.stats['snapshot'])
+        self.assertEqual(0, daemon.stats['rsync'])
+        self.assertFalse(daemon._rsync_file.called)
+        self.assertTrue(os.path.exists(remote_broker.db_file))
+        local_info = broker.get_info()
+        remote_info = remote_broker.get_info()
+        for k, v in local_info.items():
+            if k == 'id':
+                continue
+            self.assertEqual(remote_info[k], v,
+                             "mismatch remote %s %r != %r" % (
+                                 k, remote_info[k], v))
+        self.assertEqual(remote_broker.metadata, broker.metadata)
+        self.assertEqual(
+            sorted((item['name'], item['deleted']) for item in
+                   remote_broker.get_items_since(-1, 100)),
+            sorted((item['name'], item['deleted']) for item in
+                   broker.get_items_since(-1, 100)))
+        self.assertEqual(remote_broker.get_sync(info['id']), info['max_row'])
+        self.assertEqual(remote_broker.get_sync('other'), 3)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.root, node['device'], 'tmp', info['id'] + '.snapshot')))
+        # the container updater is told about the new db
+        journal, hsh = backend.get_dirty_journal(remote_broker.db_file)
+        self.assertEqual(backend.pop_dirty_journal(journal), set([hsh]))
+
+    def test_rpc_merge_snapshot_db_made_while_streaming(self):
+        broker, remote_broker = self._setup_snapshot(5)
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        columns, rows = broker.get_item_rows_since(-1, 100)
+        put_timestamp = broker.get_info()['put_timestamp']
+
+        def frames():
+            yield [columns, rows[:3]]
+            # say an object server made the db and put an object in it
+            remote_broker.initialize(put_timestamp, int(POLICIES.default))
+            remote_broker.put_object(
+                'o_remote', Timestamp(time.time()).internal, 0,
+                'content-type', 'etag',
+                storage_policy_index=int(POLICIES.default))
+            yield [columns, rows[3:]]
+            yield {'syncs': broker.get_syncs()}
+
+        resp = self.rpc.merge_snapshot(
+            node['device'], remote_broker.db_file,
+            [info['id'], info, frames()])
+        self.assertEqual(resp.status_int, 204)
+        remote_id = remote_broker.get_info()['id']
+        # the db was not replaced; the snapshot was merged into it
+        self.assertNotEqual(remote_id, info['id'])
+        self.assertEqual(
+            sorted(item['name'] for item in
+                   remote_broker.get_items_since(-1, 100)),
+            sorted(['o_remote'] + [item['name'] for item in
+                                   broker.get_items_since(-1, 100)]))
+        self.assertEqual(remote_broker.get_sync(info['id']), info['max_row'])
+        self.assertEqual(remote_broker.get_sync('other'), 3)
+        self.assertEqual(remote_broker.metadata, broker.metadata)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.root, node['device'], 'tmp', info['id'] + '.snapshot')))
+        journal, hsh = backend.get_dirty_journal(remote_broker.db_file)
+        self.assertEqual(backend.pop_dirty_journal(journal), set([hsh]))
+
+    def test_sync_remote_snapshot_resumes(self):
+        broker, remote_broker = self._setup_snapshot(5)
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        # a snapshot that was cut short after the first two batches
+        columns, rows = broker.get_item_rows_since(-1, 6)
+        frames = iter([[columns, rows[:3]], [columns, rows[3:]]])
+        resp = self.rpc.merge_snapshot(
+            node['device'], remote_broker.db_file, [info['id'], info, frames])
+        self.assertEqual(resp.status_int, 400)
+        self.assertFalse(os.path.exists(remote_broker.db_file))
+        resp = self.rpc.snapshot_point(node['device'], remote_broker.db_file,
+                                       [info['id']])
+        self.assertEqual(json.loads(resp.body), {'point': 6})
+
+        daemon = replicator.ContainerReplicator(
+            {'sync_method': 'http', 'per_diff': 3})
+        with mock.patch.object(broker, 'get_item_rows_since',
+                               wraps=broker.get_item_rows_since) as mock_get:
+            self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual([c[0][0] for c in mock_get.call_args_list],
+                         [6, 9])
+        self.assertEqual(
+            sorted(item['name'] for item in
+                   remote_broker.get_items_since(-1, 100)),
+            sorted(item['name'] for item in broker.get_items_since(-1, 100)))
+        self.assertEqual(remote_broker.get_sync(info['id']), info['max_row'])
+
+    def test_sync_remote_snapshot_refused(self):
+        broker, remote_broker = self._setup_snapshot(2)
+        daemon = replicator.ContainerReplicator({'sync_method': 'http'})
+
+        def _rsync_file(db_file, remote_file, **kwargs):
+            remote_server, remote_path = remote_file.split('/', 1)
+            shutil.copy(db_file, os.path.join(self.root, remote_path))
+            return True
+        daemon._rsync_file = _rsync_file
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        # like a server from before snapshots
+        with mock.patch.object(self.rpc, 'merge_snapshot',
+                               return_value=HTTPNotFound()):
+            self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(1, daemon.stats['snapshot'])
+        self.assertEqual(1, daemon.stats['rsync'])
+        self.assertTrue(os.path.exists(remote_broker.db_file))
+
+    def test_rpc_merge_snapshot_conflict(self):
+        broker, remote_broker = self._setup_snapshot(1)
+        remote_broker.initialize(Timestamp(1).internal,
+                                 int(POLICIES.default))
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        resp = self.rpc.merge_snapshot(
+            node['device'], remote_broker.db_file,
+            [info['id'], info, iter([{'syncs': []}])])
+        self.assertEqual(resp.status_int, 409)
+
+    def test_sync_remote_missing_most_rows_http(self):
+        broker, remote_broker = self._setup_snapshot(10)
+        remote_broker.initialize(broker.get_info()['put_timestamp'],
+                                 int(POLICIES.default))
+        daemon = replicator.ContainerReplicator(
+            {'sync_method': 'http', 'per_diff': 3, 'max_diffs': 2})
+        daemon._rsync_file = mock.MagicMock()
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        with mock.patch.object(self.rpc, 'merge_item_rows',
+                               wraps=self.rpc.merge_item_rows) as mock_merge:
+            self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        # every row is streamed in one request rather than rsyncing the db
+        self.assertEqual(1, mock_merge.call_count)
+        self.assertFalse(daemon._rsync_file.called)
+        self.assertEqual(0, daemon.stats['remote_merge'])
+        self.assertEqual(0, daemon.stats['diff_capped'])
+        self.assertEqual(1, daemon.stats['diff'])
+        self.assertEqual(remote_broker.get_sync(info['id']), info['max_row'])
+        self.assertEqual(remote_broker.get_info()['object_count'], 10)
+
+    def test_run_once_skips_unchanged(self):
+        ts = (Timestamp(t).internal for t in
+              itertools.count(int(time.time())))
+        broker = self._get_broker('a', 'c', node_index=0)
+        broker.initialize(ts.next(), int(POLICIES.default))
+        broker.put_object('o', ts.next(), 0, 'content-type', 'etag',
+                          storage_policy_index=int(POLICIES.default))
+        part, node = self._get_broker_part_node(broker)
+        daemon = self._get_daemon(node, {'full_sweep_interval': 3600})
+
+        def run_once():
+            with mock.patch.object(self.rpc, 'dispatch',
+                                   wraps=self.rpc.dispatch) as mock_dispatch:
+                self._run_once(node, daemon=daemon)
+            return mock_dispatch.call_count
+
+        self.assertTrue(run_once())
+        self.assertEqual(2, daemon.stats['rsync'])
+        self.assertEqual(0, daemon.stats['skip'])
+        # nothing changed, so nothing is sent or even opened
+        self.assertEqual(0, run_once())
+        self.assertEqual(1, daemon.stats['skip'])
+        self.assertEqual(0, daemon.stats['attempted'])
+        # a change the peers don't need is looked at but not sent
+        broker.merge_syncs([{'remote_id': 'other', 'sync_point': 1}])
+        self.assertEqual(0, run_once())
+        self.assertEqual(1, daemon.stats['skip'])
+        self.assertEqual(1, daemon.stats['attempted'])
+        self.assertEqual(0, run_once())
+        self.assertEqual(0, daemon.stats['attempted'])
+        # a new row is sent
+        broker.put_object('o2', ts.next(), 0, 'content-type', 'etag',
+                          storage_policy_index=int(POLICIES.default))
+        self.assertTrue(run_once())
+        self.assertEqual(2, daemon.stats['diff'])
+        remote_broker = self._get_broker('a', 'c', node_index=1)
+        self.assertEqual(remote_broker.get_info()['object_count'], 2)
+        self.assertEqual(0, run_once())
+        # a full sweep syncs everything again
+        daemon.last_full_sweep -= 3600
+        self.assertTrue(run_once())
+        self.assertEqual(2, daemon.stats['no_change'])
+        self.assertEqual(0, run_once())
+
+    def test_run_once_retries_failed(self):
+        broker = self._get_broker('a', 'c', node_index=0)
+        broker.initialize(Timestamp(1).internal, int(POLICIES.default))
+        part, node = self._get_broker_part_node(broker)
+        daemon = self._get_daemon(node, {'full_sweep_interval': 3600})
+        with mock.patch.object(self.rpc, 'dispatch',
+                               return_value=HTTPServerError()):
+            self._run_once(node, daemon=daemon)
+        self.assertEqual(2, daemon.stats['failure'])
+        self.assertEqual([broker.db_file], daemon._failed.keys())
+        # not changed, but tried again
+        self._run_once(node, daemon=daemon)
+        self.assertEqual(2, daemon.stats['success'])
+        self.assertEqual({}, daemon._failed)
+        self._run_once(node, daemon=daemon)
+        self.assertEqual(1, daemon.stats['skip'])
+
     def test_sync_remote_can_not_keep_up(self):
         put_timestamp = time.time()
         # create "local" broker
@@ -993,6 +1314,44 @@ class TestReplicatorSync(test_db_replicator.TestReplicatorSync):
             daemon._post_replicate_hook(broker, info, [])
         self.assertEqual(0, len(calls))
 
+    def test_post_replicate_hook_adds_listing_index(self):
+        ts = (Timestamp(t).internal for t in
+              itertools.count(int(time.time())))
+        broker = self._get_broker('a', 'c', node_index=0)
+        broker.initialize(ts.next(), 0)
+        for i in range(3):
+            broker.put_object('o%d' % i, ts.next(), 0, 'text/plain',
+                              'etag', 0)
+        broker._commit_puts()
+        with broker.get() as conn:
+            conn.execute('DROP INDEX ix_object_deleted_policy_name')
+            conn.commit()
+
+        def check_hook(conf, expected_version):
+            db = self._get_broker('a', 'c', node_index=0)
+            info = db.get_replication_info()
+            daemon = replicator.ContainerReplicator(conf)
+            daemon._post_replicate_hook(db, info, [])
+            with db.get() as conn:
+                self.assertEqual(expected_version, db.get_db_version(conn))
+
+        # off by default
+        check_hook({}, 1)
+        # too big
+        check_hook({'add_listing_index': 'yes',
+                    'listing_index_max_rows': '2'}, 1)
+        check_hook({'add_listing_index': 'yes',
+                    'listing_index_max_rows': '3'}, 2)
+        broker = self._get_broker('a', 'c', node_index=0)
+        with broker.get() as conn:
+            self.assertEqual(1, len(conn.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE name = 'ix_object_deleted_policy_name'").fetchall()))
+            conn.execute('DROP INDEX ix_object_deleted_policy_name')
+            conn.commit()
+        # 0 is no limit
+        check_hook({'add_listing_index': 'yes',
+                    'listing_index_max_rows': '0'}, 2)
 
 if __name__ == '__main__':
     unittest.main()
@@ -309,10 +309,11 @@ class TestContainerController(unittest.TestCase):
         req.content_length = 0
         resp = server_handler.OPTIONS(req)
         self.assertEquals(200, resp.status_int)
-        for verb in 'OPTIONS GET POST PUT DELETE HEAD REPLICATE'.split():
+        for verb in 'OPTIONS GET POST PUT DELETE HEAD REPLICATE ' \
+                'UPDATE'.split():
             self.assertTrue(
                 verb in resp.headers['Allow'].split(', '))
-        self.assertEquals(len(resp.headers['Allow'].split(', ')), 7)
+        self.assertEquals(len(resp.headers['Allow'].split(', ')), 8)
         self.assertEquals(resp.headers['Server'],
                           (self.controller.server_type + '/' + swift_version))
 
@@ -917,6 +918,99 @@ class TestContainerController(unittest.TestCase):
         resp = req.get_response(self.controller)
         self.assertEquals(resp.status_int, 404)
 
+    def test_UPDATE(self):
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': '1'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+        items = [{'name': 'o1', 'created_at': '2', 'size': 3,
+                  'content_type': 'text/plain',
+                  'etag': 'd41d8cd98f00b204e9800998ecf8427e',
+                  'deleted': 0},
+                 {'name': u'o2\u2603', 'created_at': '3.5', 'size': 5,
+                  'content_type': 'text/plain',
+                  'etag': 'd41d8cd98f00b204e9800998ecf8427e',
+                  'deleted': 0},
+                 {'name': 'o3', 'created_at': '4', 'size': 0,
+                  'content_type': 'application/deleted', 'etag': 'noetag',
+                  'deleted': 1}]
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'UPDATE'},
+            headers={'X-Timestamp': '2',
+                     'X-Backend-Storage-Policy-Index': int(POLICIES.default)},
+            body=simplejson.dumps(items))
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 202)
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.headers['x-container-object-count'], '2')
+        self.assertEquals(resp.headers['x-container-bytes-used'], '8')
+        req = Request.blank('/sda1/p/a/c?format=json',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        listing = simplejson.loads(resp.body)
+        self.assertEquals([o['name'] for o in listing],
+                          ['o1', u'o2\u2603'])
+        self.assertEquals(listing[1]['last_modified'],
+                          '1970-01-01T00:00:03.500000')
+        # an empty batch is fine
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'UPDATE'},
+            headers={'X-Timestamp': '5'}, body='[]')
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 202)
+
+    def test_UPDATE_bad_body(self):
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': '1'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+        good = {'name': 'o', 'created_at': '2', 'size': 0,
+                'content_type': 'text/plain', 'etag': 'x', 'deleted': 0}
+        for body in ('not json', '{}', '[1]',
+                     simplejson.dumps([dict(good, name='')]),
+                     simplejson.dumps([dict(good, size='big')]),
+                     simplejson.dumps([dict(good, deleted=2)]),
+                     simplejson.dumps([dict(good, created_at='now')]),
+                     simplejson.dumps([{'name': 'o'}])):
+            req = Request.blank(
+                '/sda1/p/a/c', environ={'REQUEST_METHOD': 'UPDATE'},
+                headers={'X-Timestamp': '2'}, body=body)
+            resp = req.get_response(self.controller)
+            self.assertEquals(resp.status_int, 400, body)
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'UPDATE'},
+            body=simplejson.dumps([good]))
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 400)
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.headers['x-container-object-count'], '0')
+
+    def test_UPDATE_container_not_found(self):
+        body = simplejson.dumps([{'name': 'o', 'created_at': '2', 'size': 0,
+                                  'content_type': 'text/plain', 'etag': 'x',
+                                  'deleted': 0}])
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'UPDATE'},
+            headers={'X-Timestamp': '2'}, body=body)
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 404)
+        # auto-create accounts get their containers made on the fly
+        req = Request.blank(
+            '/sda1/p/.a/c', environ={'REQUEST_METHOD': 'UPDATE'},
+            headers={'X-Timestamp': '2',
+                     'X-Backend-Storage-Policy-Index': int(POLICIES.default)},
+            body=body)
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 202)
+        req = Request.blank('/sda1/p/.a/c', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 204)
+        self.assertEquals(resp.headers['x-container-object-count'], '1')
+
     def test_DELETE_obj_not_found(self):
         req = Request.blank(
             '/sda1/p/a/c/o',
@@ -1952,6 +2046,57 @@ class TestContainerController(unittest.TestCase):
         resp = req.get_response(self.controller)
         self.assertEquals(resp.status_int, 406)
 
+    def test_GET_streamed_listing(self):
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT',
+                                    'HTTP_X_TIMESTAMP': '0'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+        broker = self.controller._get_container_broker('sda1', 'p', 'a', 'c')
+        broker.merge_items([
+            {'name': 'd%d/o%04d' % (i % 2, i), 'created_at': '1',
+             'size': i, 'content_type': 'text/plain', 'etag': 'x',
+             'deleted': 0, 'storage_policy_index': broker.storage_policy_index}
+            for i in range(3000)])
+        expected = [self.controller.update_data_record(record)
+                    for record in broker.list_objects_iter(
+                        10000, '', None, None, None,
+                        storage_policy_index=broker.storage_policy_index)]
+        req = Request.blank('/sda1/p/a/c?format=json',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 200)
+        # too big to send whole, so it is sent on a chunk at a time
+        self.assertEquals(resp.content_length, None)
+        self.assertEquals(resp.body, simplejson.dumps(expected))
+
+        req = Request.blank('/sda1/p/a/c?format=xml',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.content_length, None)
+        dom = minidom.parseString(resp.body)
+        self.assertEquals(
+            [n.firstChild.nodeValue
+             for n in dom.getElementsByTagName('name')],
+            [record['name'] for record in expected])
+
+        # while a short listing is sent whole
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.content_length, len(resp.body))
+        self.assertEquals(resp.body.splitlines(),
+                          [record['name'] for record in expected])
+
+        req = Request.blank('/sda1/p/a/c?format=json&delimiter=/',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.content_length, len(resp.body))
+        self.assertEquals(simplejson.loads(resp.body),
+                          [{'subdir': 'd0/'}, {'subdir': 'd1/'}])
+
     def test_GET_limit(self):
         # make a container
         req = Request.blank(
@@ -20,8 +20,8 @@ import unittest
 from contextlib import closing
 from gzip import GzipFile
 from shutil import rmtree
-from tempfile import mkdtemp
-from test.unit import FakeLogger
+from tempfile import mkdtemp, mkstemp
+from test.unit import FakeLogger, mocked_http_conn
 
 from eventlet import spawn, Timeout, listen
 
@@ -29,7 +29,7 @@ from swift.common import utils
 from swift.container import updater as container_updater
 from swift.container.backend import ContainerBroker, DATADIR
 from swift.common.ring import RingData
-from swift.common.utils import normalize_timestamp
+from swift.common.utils import normalize_timestamp, json
 
 
 class TestContainerUpdater(unittest.TestCase):
@@ -255,6 +255,270 @@ class TestContainerUpdater(unittest.TestCase):
         self.assertEquals(info['reported_object_count'], 1)
         self.assertEquals(info['reported_bytes_used'], 3)
 
+    def test_dirty_container_sweep(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'interval': '1',
+            'concurrency': '1',
+            'node_timeout': '15',
+            'full_sweep_interval': '3600',
+        })
+        self.assertEqual(cu.full_sweep_interval, 3600)
+        self.assertEqual(cu.get_dirty_paths(), [])
+        brokers = []
+        for part, hsh in (('0', 'a83'), ('0', 'b49'), ('1', 'c12')):
+            hsh = hsh * 10 + 'ab'
+            db_path = os.path.join(self.sda1, DATADIR, part, hsh[-3:], hsh,
+                                   hsh + '.db')
+            cb = ContainerBroker(db_path, account='a', container='c' + hsh)
+            cb.initialize(normalize_timestamp(1), 0)
+            brokers.append(cb)
+        processed = []
+        with mock.patch.object(cu, 'process_container', processed.append):
+            cu.container_sweep(os.path.join(self.sda1, DATADIR, '0'))
+        self.assertEqual(sorted(processed), sorted(
+            [brokers[0].db_file, brokers[1].db_file]))
+        # a full sweep of a partition empties its dirty journal
+        self.assertEqual(cu.get_dirty_paths(),
+                         [os.path.join(self.sda1, DATADIR, '1')])
+
+        brokers[0].put_object('o', normalize_timestamp(2), 3, 'text/plain',
+                              '68b329da9893e34099c7d8ad5cb9c940')
+        # a dirty container that has gone away is skipped
+        gone = os.path.join(self.sda1, DATADIR, '1')
+        rmtree(gone)
+        self.assertEqual(sorted(cu.get_dirty_paths()), [
+            os.path.join(self.sda1, DATADIR, '0'), gone])
+        processed = []
+        with mock.patch.object(cu, 'process_container', processed.append):
+            for path in cu.get_dirty_paths():
+                cu.dirty_container_sweep(path)
+        self.assertEqual(processed, [brokers[0].db_file])
+        self.assertEqual(cu.get_dirty_paths(), [])
+
+    def test_process_container_failure_marks_dirty(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'interval': '1',
+            'concurrency': '1',
+            'node_timeout': '15',
+            'account_suppression_time': '60',
+        })
+        hsh = 'a83' * 10 + 'ab'
+        db_path = os.path.join(self.sda1, DATADIR, '0', hsh[-3:], hsh,
+                               hsh + '.db')
+        cb = ContainerBroker(db_path, account='a', container='c')
+        cb.initialize(normalize_timestamp(1), 0)
+        cb.put_object('o', normalize_timestamp(2), 3, 'text/plain',
+                      '68b329da9893e34099c7d8ad5cb9c940')
+        path = os.path.join(self.sda1, DATADIR, '0')
+        with mock.patch.object(cu, 'container_report', return_value=503):
+            cu.dirty_container_sweep(path)
+        self.assertEqual(cu.failures, 1)
+        # the failed container is looked at again next time
+        self.assertEqual(cu.get_dirty_paths(), [path])
+        # even while its account is suppressed
+        with mock.patch.object(cu, 'container_report') as mock_report:
+            cu.dirty_container_sweep(path)
+        self.assertFalse(mock_report.mock_calls)
+        self.assertEqual(cu.get_dirty_paths(), [path])
+
+        cu.account_suppressions = {}
+        with mock.patch.object(cu, 'container_report', return_value=201):
+            cu.dirty_container_sweep(path)
+        self.assertEqual(cu.successes, 1)
+        self.assertEqual(cu.get_dirty_paths(), [])
+        info = cb.get_info()
+        self.assertEqual(info['reported_object_count'], 1)
+
+    def _make_containers(self, names, part='0'):
+        brokers = []
+        for i, (account, container) in enumerate(names):
+            hsh = '%032x' % (0xabc + i)
+            db_path = os.path.join(self.sda1, DATADIR, part, hsh[-3:], hsh,
+                                   hsh + '.db')
+            cb = ContainerBroker(db_path, account=account,
+                                 container=container)
+            cb.initialize(normalize_timestamp(1), 0)
+            cb.put_object('o', normalize_timestamp(2), i + 1, 'text/plain',
+                          '68b329da9893e34099c7d8ad5cb9c940')
+            brokers.append(cb)
+        return brokers
+
+    def test_account_batch_reports(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'interval': '1',
+            'concurrency': '1',
+            'node_timeout': '15',
+            'account_update_batch_size': '2',
+        })
+        self.assertEqual(cu.account_update_batch_size, 2)
+        brokers = self._make_containers(
+            [('a', 'c1'), ('a', 'c2'), ('a', 'c3'), ('b', 'c1')])
+        reports = []
+
+        def fake_batch_report(node, part, account, rows):
+            reports.append((node['id'], account,
+                            sorted((row['name'], row['bytes_used'])
+                                   for row in rows)))
+            return 202
+
+        with mock.patch.object(cu, 'account_batch_report',
+                               fake_batch_report), \
+                mock.patch.object(cu, 'container_report') as mock_report:
+            cu.container_sweep(os.path.join(self.sda1, DATADIR, '0'))
+            # full batches are sent as soon as they are gathered
+            self.assertEqual(len(reports), 2)
+            cu.flush_account_reports()
+        self.assertFalse(mock_report.mock_calls)
+        self.assertEqual(cu.successes, 4)
+        self.assertEqual(cu.pending_reports, {})
+        # one request per account server for each batch of containers
+        self.assertEqual(len(reports), 6)
+        self.assertEqual(sorted(len(rows) for node, account, rows in reports),
+                         [1, 1, 1, 1, 2, 2])
+        self.assertEqual(
+            sorted(set(row for node, account, rows in reports
+                       for row in rows if account == 'a')),
+            [('c1', 1), ('c2', 2), ('c3', 3)])
+        self.assertEqual(
+            [rows for node, account, rows in reports if account == 'b'],
+            [[('c1', 4)], [('c1', 4)]])
+        for cb in brokers:
+            info = cb.get_info()
+            self.assertEqual(info['reported_bytes_used'], info['bytes_used'])
+
+    def test_account_batch_report_failures(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'interval': '1',
+            'concurrency': '1',
+            'node_timeout': '15',
+            'account_update_batch_size': '10',
+            'account_suppression_time': '60',
+        })
+        brokers = self._make_containers([('a', 'c1'), ('a', 'c2')])
+        path = os.path.join(self.sda1, DATADIR, '0')
+        with mock.patch.object(cu, 'account_batch_report',
+                               return_value=503):
+            cu.container_sweep(path)
+            cu.flush_account_reports()
+        self.assertEqual(cu.failures, 2)
+        self.assertTrue(cu.account_suppressions['a'] > 0)
+        self.assertEqual(cu.get_dirty_paths(), [path])
+        for cb in brokers:
+            self.assertEqual(cb.get_info()['reported_bytes_used'], 0)
+
+        # account servers that do not know UPDATE get one report per
+        # container instead
+        cu.account_suppressions = {}
+        with mock.patch.object(cu, 'account_batch_report',
+                               side_effect=[202, 405]), \
+                mock.patch.object(cu, 'container_report',
+                                  return_value=201) as mock_report:
+            cu.dirty_container_sweep(path)
+            cu.flush_account_reports()
+        self.assertEqual(len(mock_report.mock_calls), 4)
+        self.assertEqual(cu.successes, 2)
+        self.assertEqual(cu.get_dirty_paths(), [])
+        for cb in brokers:
+            info = cb.get_info()
+            self.assertEqual(info['reported_bytes_used'], info['bytes_used'])
+
+    def test_account_batch_reports_across_partitions(self):
+        conf = {
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'interval': '1',
+            'concurrency': '1',
+            'node_timeout': '15',
+            'account_update_batch_size': '10',
+        }
+        brokers = self._make_containers([('a', 'c1'), ('b', 'c1')]) + \
+            self._make_containers([('a', 'c2')], part='1')
+        reports = []
+
+        def fake_batch_report(node, part, account, rows):
+            reports.append((account, sorted(row['name'] for row in rows)))
+            return 202
+
+        # the reports for an account from every partition go in one batch
+        cu = container_updater.ContainerUpdater(conf)
+        with mock.patch.object(cu, 'account_batch_report',
+                               fake_batch_report):
+            cu.run_once()
+        self.assertEqual(sorted(reports), [
+            ('a', ['c1', 'c2']), ('a', ['c1', 'c2']),
+            ('b', ['c1']), ('b', ['c1'])])
+        for cb in brokers:
+            info = cb.get_info()
+            self.assertEqual(info['reported_bytes_used'], info['bytes_used'])
+
+        # as they do when each partition is swept by a process of its own
+        del reports[:]
+        for cb in brokers:
+            cb.put_object('o2', normalize_timestamp(3), 5, 'text/plain',
+                          '68b329da9893e34099c7d8ad5cb9c940')
+        cu = container_updater.ContainerUpdater(conf)
+        for part in ('0', '1'):
+            sweeper = container_updater.ContainerUpdater(conf)
+            with mock.patch.object(sweeper, 'account_batch_report',
+                                   fake_batch_report):
+                sweeper.container_sweep(
+                    os.path.join(self.sda1, DATADIR, part))
+            fd, tmpfilename = mkstemp()
+            with os.fdopen(fd, 'w') as tmpfile:
+                sweeper.spool_account_reports(tmpfile)
+            self.assertEqual(sweeper.pending_reports, {})
+            cu._load_account_reports(tmpfilename)
+            self.assertFalse(os.path.exists(tmpfilename))
+        self.assertEqual(reports, [])
+        with mock.patch.object(cu, 'account_batch_report',
+                               fake_batch_report):
+            cu.flush_account_reports()
+        self.assertEqual(sorted(reports), [
+            ('a', ['c1', 'c2']), ('a', ['c1', 'c2']),
+            ('b', ['c1']), ('b', ['c1'])])
+        for cb in brokers:
+            info = cb.get_info()
+            self.assertEqual(info['reported_bytes_used'], info['bytes_used'])
+            self.assertEqual(info['reported_object_count'], 2)
+
+    def test_account_batch_report(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+        })
+        node = {'ip': '1.2.3.4', 'port': 6002, 'device': 'sda1'}
+        rows = [{'name': 'c', 'put_timestamp': normalize_timestamp(1),
+                 'delete_timestamp': normalize_timestamp(0),
+                 'object_count': 1, 'bytes_used': 3,
+                 'storage_policy_index': 0}]
+        with mocked_http_conn(202) as fake_conn:
+            status = cu.account_batch_report(node, 5, 'a', rows)
+        self.assertEqual(status, 202)
+        req = fake_conn.requests[0]
+        self.assertEqual(req['method'], 'UPDATE')
+        self.assertEqual(req['path'], '/sda1/5/a')
+        self.assertEqual(req['headers']['Content-Type'], 'application/json')
+        self.assertEqual(req['headers']['Content-Length'],
+                         str(len(json.dumps(rows))))
+        self.assertEqual(req['headers']['X-Account-Override-Deleted'], 'yes')
+        with mocked_http_conn(Timeout()):
+            status = cu.account_batch_report(node, 5, 'a', rows)
+        self.assertEqual(status, 500)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -27,6 +27,7 @@ import tempfile
 import uuid
 import xattr
 import re
+import threading
 from collections import defaultdict
 from random import shuffle, randint
 from shutil import rmtree
@@ -49,7 +50,8 @@ from swift.common.splice import splice
 from swift.common.exceptions import DiskFileNotExist, DiskFileQuarantined, \
     DiskFileDeviceUnavailable, DiskFileDeleted, DiskFileNotOpen, \
     DiskFileError, ReplicationLockTimeout, DiskFileCollision, \
-    DiskFileExpired, SwiftException, DiskFileNoSpace, DiskFileXattrNotSupported
+    DiskFileExpired, SwiftException, DiskFileNoSpace, \
+    DiskFileXattrNotSupported, PathNotDir
 from swift.common.storage_policy import (
     POLICIES, get_policy_string, StoragePolicy, ECStoragePolicy,
     BaseStoragePolicy, REPL_POLICY, EC_POLICY)
@@ -3025,8 +3027,9 @@ class DiskFileMixin(BaseDiskFileTestMixin):
         with mock.patch("swift.obj.diskfile.drop_buffer_cache") as dbc:
             with mock.patch("swift.obj.diskfile.DROP_CACHE_WINDOW", 4095):
                 with open('/dev/null', 'w') as devnull:
-                    reader.zero_copy_send(devnull.fileno())
+                    sent = reader.zero_copy_send(devnull.fileno())
                 self.assertEqual(len(dbc.mock_calls), 5)
+        self.assertEqual(sent, 16385)
 
     def test_zero_copy_turns_off_when_md5_sockets_not_supported(self):
         if not self._system_can_zero_copy():
@@ -4059,15 +4062,69 @@ class TestSuffixHashes(unittest.TestCase):
             # sanity check hashes file
             part_path = os.path.join(self.devices, 'sda1',
                                      diskfile.get_data_dir(policy), '0')
-            hashes_file = os.path.join(part_path, diskfile.HASH_FILE)
-            with open(hashes_file, 'rb') as f:
-                self.assertEqual(hashes, pickle.load(f))
+            self.assertEqual(hashes, diskfile.read_hashes(part_path))
             # invalidate the hash
             with mock.patch('swift.obj.diskfile.lock_path') as mock_lock:
                 df_mgr.invalidate_hash(suffix_dir)
             self.assertTrue(mock_lock.called)
-            with open(hashes_file, 'rb') as f:
-                self.assertEqual({suffix: None}, pickle.load(f))
+            # the hashes file is left alone, the suffix goes in the journal
+            self.assertEqual(hashes, diskfile.read_hashes(part_path))
+            invalidations_file = os.path.join(
+                part_path, diskfile.HASH_INVALIDATIONS_FILE)
+            with open(invalidations_file, 'rb') as f:
+                self.assertEqual(suffix + '\n', f.read())
+            # until the next get_hashes folds it in
+            self.assertEqual({suffix: None},
+                             diskfile.consolidate_hashes(part_path))
+            self.assertEqual({suffix: None}, diskfile.read_hashes(part_path))
+            with open(invalidations_file, 'rb') as f:
+                self.assertEqual('', f.read())
+
+    def test_invalidate_hash_journal(self):
+        for policy in self.iter_policies():
+            df_mgr = self.df_router[policy]
+            suffixes = []
+            for obj in ('o1', 'o2', 'o3'):
+                df = df_mgr.get_diskfile('sda1', '0', 'a', 'c', obj,
+                                         policy=policy, frag_index=2)
+                df.delete(self.ts())
+                suffixes.append(os.path.basename(
+                    os.path.dirname(df._datadir)))
+            part_path = os.path.join(self.devices, 'sda1',
+                                     diskfile.get_data_dir(policy), '0')
+            hashes = df_mgr.get_hashes('sda1', '0', [], policy)
+            self.assertEqual(sorted(hashes), sorted(suffixes))
+            # lots of updates only append to the journal
+            with mock.patch('swift.obj.diskfile.write_hashes') as mock_wh:
+                for _junk in range(3):
+                    for suffix in suffixes:
+                        df_mgr.invalidate_hash(
+                            os.path.join(part_path, suffix))
+            self.assertFalse(mock_wh.called)
+            # get_hashes rehashes each invalidated suffix once
+            df = df_mgr.get_diskfile('sda1', '0', 'a', 'c', 'o1',
+                                     policy=policy, frag_index=2)
+            df.delete(self.ts())
+            _junk, new_hashes = df_mgr._get_hashes(part_path)
+            hashed, again = df_mgr._get_hashes(part_path)
+            self.assertEqual(hashed, 0)
+            self.assertEqual(new_hashes, again)
+            changed = [suffix for suffix in suffixes
+                       if hashes[suffix] != new_hashes[suffix]]
+            self.assertEqual(changed, suffixes[:1])
+
+    def test_invalidate_hash_legacy_file_exists(self):
+        for policy in self.iter_policies():
+            df_mgr = self.df_router[policy]
+            part_path = os.path.join(self.devices, 'sda1',
+                                     diskfile.get_data_dir(policy), '0')
+            os.makedirs(part_path)
+            with open(os.path.join(part_path, diskfile.LEGACY_HASH_FILE),
+                      'wb') as f:
+                pickle.dump({'abc': 'd41d8cd98f00b204e9800998ecf8427e'}, f)
+            df_mgr.invalidate_hash(os.path.join(part_path, 'abc'))
+            self.assertEqual({'abc': None},
+                             diskfile.consolidate_hashes(part_path))
 
     # invalidate_hash tests - error handling
 
@@ -4096,6 +4153,92 @@ class TestSuffixHashes(unittest.TestCase):
             hashes = df_mgr.get_hashes('sda1', '0', [], policy)
             self.assertTrue(suffix in hashes)
 
+    # hashes file format tests
+
+    def test_serialize_hashes(self):
+        for hashes in (
+                {},
+                {'abc': 'd41d8cd98f00b204e9800998ecf8427e',
+                 '012': None,
+                 'bad_name': '72018c5fbfae934e1f56069ad4425627'},
+                {'a43': {None: '72018c5fbfae934e1f56069ad4425627',
+                         2: 'b6dd6db937cb8748f50a5b6e4bc3b808'},
+                 'b23': {None: '12348c5fbfae934e1f56069ad4421234',
+                         1: '45676db937cb8748f50a5b6e4bc34567'},
+                 'c78': {},
+                 'fff': None}):
+            packed = diskfile.serialize_hashes(hashes)
+            self.assertEqual(hashes, diskfile.deserialize_hashes(packed))
+        # a whole replicated partition's worth of suffixes
+        hashes = dict(('%03x' % i, md5(str(i)).hexdigest())
+                      for i in range(4096))
+        packed = diskfile.serialize_hashes(hashes)
+        self.assertEqual(len(packed), 9 + 4096 * 21)
+        self.assertTrue(len(packed) < len(pickle.dumps(hashes, 2)))
+        self.assertEqual(hashes, diskfile.deserialize_hashes(packed))
+
+        self.assertRaises(ValueError, diskfile.serialize_hashes,
+                          {'abc': 'not a digest'})
+
+    def test_deserialize_hashes_errors(self):
+        packed = diskfile.serialize_hashes({
+            'abc': 'd41d8cd98f00b204e9800998ecf8427e',
+            'def': {None: '72018c5fbfae934e1f56069ad4425627',
+                    3: 'b6dd6db937cb8748f50a5b6e4bc3b808'}})
+        for i in range(len(packed)):
+            self.assertRaises(ValueError, diskfile.deserialize_hashes,
+                              packed[:i])
+        self.assertRaises(ValueError, diskfile.deserialize_hashes,
+                          packed + '\x00')
+        self.assertRaises(ValueError, diskfile.deserialize_hashes,
+                          'XXXX' + packed[4:])
+        self.assertRaises(ValueError, diskfile.deserialize_hashes,
+                          pickle.dumps({'abc': None}, 2))
+
+    def test_get_hashes_migrates_legacy_pickle(self):
+        for policy in self.iter_policies():
+            df_mgr = self.df_router[policy]
+            df = df_mgr.get_diskfile('sda1', '0', 'a', 'c', 'o',
+                                     policy=policy, frag_index=1)
+            df.delete(self.ts())
+            suffix = os.path.basename(os.path.dirname(df._datadir))
+            part_path = os.path.join(self.devices, 'sda1',
+                                     diskfile.get_data_dir(policy), '0')
+            _junk, hashes = df_mgr._get_hashes(part_path)
+            # turn the new hashes file back into an old one
+            os.unlink(os.path.join(part_path, diskfile.HASH_FILE))
+            legacy_file = os.path.join(part_path, diskfile.LEGACY_HASH_FILE)
+            with open(legacy_file, 'wb') as f:
+                pickle.dump(hashes, f, 2)
+            with mock.patch('swift.obj.diskfile.hash_suffix') as mock_hash:
+                with mock.patch.object(df_mgr, '_hash_suffix',
+                                       mock_hash, create=True):
+                    hashed, migrated = df_mgr._get_hashes(part_path)
+            self.assertFalse(mock_hash.called)
+            self.assertEqual(hashed, 0)
+            self.assertEqual(hashes, migrated)
+            self.assertEqual(hashes, diskfile.read_hashes(part_path))
+            self.assertFalse(os.path.exists(legacy_file))
+            self.assertTrue(suffix in migrated)
+
+    def test_get_hashes_bad_legacy_pickle(self):
+        for policy in self.iter_policies():
+            df_mgr = self.df_router[policy]
+            df = df_mgr.get_diskfile('sda1', '0', 'a', 'c', 'o',
+                                     policy=policy, frag_index=1)
+            df.delete(self.ts())
+            suffix = os.path.basename(os.path.dirname(df._datadir))
+            part_path = os.path.join(self.devices, 'sda1',
+                                     diskfile.get_data_dir(policy), '0')
+            legacy_file = os.path.join(part_path, diskfile.LEGACY_HASH_FILE)
+            with open(legacy_file, 'wb') as f:
+                f.write('asdf')
+            # the partition gets listed, and the old file cleaned up
+            _junk, hashes = df_mgr._get_hashes(part_path)
+            self.assertTrue(suffix in hashes)
+            self.assertEqual(hashes, diskfile.read_hashes(part_path))
+            self.assertFalse(os.path.exists(legacy_file))
+
     # get_hashes tests - hash_suffix behaviors
 
     def test_hash_suffix_one_tombstone(self):
@@ -4791,6 +4934,66 @@ class TestSuffixHashes(unittest.TestCase):
                                                        policy)
             self.assertEqual(hashes, expected, msg)
 
+    def test_get_hashes_suffix_hash_threads(self):
+        for policy in self.iter_policies():
+            df_mgr = self.df_router[policy]
+            for i in range(20):
+                df = df_mgr.get_diskfile(self.existing_device, '0', 'a', 'c',
+                                         'o%d' % i, policy=policy,
+                                         frag_index=4)
+                df.delete(self.ts())
+            part_path = os.path.join(self.devices, self.existing_device,
+                                     diskfile.get_data_dir(policy), '0')
+            _junk, expected = df_mgr._get_hashes(part_path)
+            os.unlink(os.path.join(part_path, diskfile.HASH_FILE))
+            df_mgr.suffix_hash_threads = 4
+            hashed, hashes = df_mgr._get_hashes(part_path)
+            self.assertEqual(hashes, expected)
+            self.assertEqual(hashed, len(expected))
+
+    def test_hash_suffixes_threads(self):
+        part_path = os.path.join(self.testdir, 'part')
+        os.makedirs(os.path.join(part_path, 'abc'))
+        hashed = []
+        lock = threading.Lock()
+        # hold up the first thread until another one comes along
+        concurrent = threading.Event()
+
+        def fake_hash_suffix(path, reclaim_age):
+            suffix = os.path.basename(path)
+            with lock:
+                hashed.append((suffix, threading.current_thread()))
+                if hashed[0][1] is not threading.current_thread():
+                    concurrent.set()
+            concurrent.wait(1)
+            if suffix == 'bad':
+                raise OSError(errno.EACCES, os.strerror(errno.EACCES))
+            if suffix == 'gone':
+                raise PathNotDir()
+            return suffix.upper()
+
+        suffixes = ['%03x' % i for i in range(50)] + ['bad', 'gone']
+        with mock.patch('swift.obj.diskfile.logging') as mock_logging:
+            results = diskfile.hash_suffixes(
+                part_path, suffixes, threads=4,
+                hash_suffix_func=fake_hash_suffix)
+        self.assertEqual(mock_logging.method_calls,
+                         [mock.call.exception('Error hashing suffix')])
+        self.assertEqual(sorted(suffixes), sorted(s for s, t in hashed))
+        self.assertTrue(
+            1 < len(set(t for s, t in hashed)) <= 4)
+        self.assertEqual(dict(results), dict(
+            [('%03x' % i, '%03X' % i) for i in range(50)] +
+            [('gone', None)]))
+
+        # anything else is raised in the calling thread
+        def broken_hash_suffix(path, reclaim_age):
+            raise ValueError('kaboom')
+
+        self.assertRaises(ValueError, diskfile.hash_suffixes, part_path,
+                          suffixes, threads=4,
+                          hash_suffix_func=broken_hash_suffix)
+
     def test_get_hashes_modified_recursive_retry(self):
         for policy in self.iter_policies():
             df_mgr = self.df_router[policy]
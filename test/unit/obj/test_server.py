@@ -3354,6 +3354,121 @@ class TestObjectController(unittest.TestCase):
             object_server.http_connect = orig_http_connect
             utils.HASH_PATH_PREFIX = _prefix
 
+    def _fake_batch_http_connect(self, statuses, requests):
+
+        class FakeConn(object):
+
+            def __init__(self, status, method, path, headers):
+                self.status = status
+                self.req = {'method': method, 'path': path,
+                            'headers': headers, 'body': ''}
+                requests.append(self.req)
+
+            def send(self, data):
+                self.req['body'] += data
+
+            def getresponse(self):
+                return self
+
+            def read(self):
+                return ''
+
+        statuses = iter(statuses)
+
+        def fake_http_connect(ip, port, device, partition, method, path,
+                              headers):
+            return FakeConn(next(statuses), method, path, headers)
+        return fake_http_connect
+
+    def _batched_updates(self, policy, statuses, num_updates=3):
+        self.object_controller.container_update_batch_delay = 0.01
+        requests = []
+        with mock.patch.object(object_server, 'http_connect',
+                               self._fake_batch_http_connect(statuses,
+                                                             requests)):
+            threads = []
+            for i in range(num_updates):
+                headers = {'x-timestamp': utils.Timestamp(i + 1).internal,
+                           'x-trans-id': 'tx%d' % i,
+                           'X-Backend-Storage-Policy-Index': int(policy)}
+                if i % 2:
+                    op = 'DELETE'
+                else:
+                    op = 'PUT'
+                    headers.update({'x-size': str(i),
+                                    'x-content-type': 'text/plain',
+                                    'x-etag': 'etag%d' % i})
+                threads.append(spawn(
+                    self.object_controller.async_update, op, 'a', 'c',
+                    'o%d' % i, '127.0.0.1:1234', 1, 'sdc1', headers, 'sda1',
+                    policy))
+            for thread in threads:
+                thread.wait()
+        self.assertEquals(self.object_controller._container_update_batches,
+                          {})
+        return requests
+
+    def test_async_update_batched(self):
+        policy = random.choice(list(POLICIES))
+        self._stage_tmp_dir(policy)
+        requests = self._batched_updates(policy, [202])
+        self.assertEquals(len(requests), 1)
+        req = requests[0]
+        self.assertEquals(req['method'], 'UPDATE')
+        self.assertEquals(req['path'], '/a/c')
+        self.assertEquals(req['headers']['X-Timestamp'],
+                          utils.Timestamp(1).internal)
+        self.assertEquals(req['headers']['x-trans-id'], 'tx0')
+        self.assertEquals(req['headers']['Content-Length'],
+                          len(req['body']))
+        self.assertEquals(json.loads(req['body']), [
+            {'name': 'o0', 'created_at': utils.Timestamp(1).internal,
+             'size': 0, 'content_type': 'text/plain', 'etag': 'etag0',
+             'deleted': 0, 'storage_policy_index': int(policy)},
+            {'name': 'o1', 'created_at': utils.Timestamp(2).internal,
+             'size': 0, 'content_type': 'application/deleted',
+             'etag': 'noetag', 'deleted': 1,
+             'storage_policy_index': int(policy)},
+            {'name': 'o2', 'created_at': utils.Timestamp(3).internal,
+             'size': 2, 'content_type': 'text/plain', 'etag': 'etag2',
+             'deleted': 0, 'storage_policy_index': int(policy)}])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.testdir, 'sda1', diskfile.get_async_dir(policy))))
+
+    def test_async_update_batch_size(self):
+        policy = random.choice(list(POLICIES))
+        self._stage_tmp_dir(policy)
+        self.object_controller.container_update_batch_size = 2
+        requests = self._batched_updates(policy, [202, 202], num_updates=3)
+        self.assertEquals([len(json.loads(r['body'])) for r in requests],
+                          [2, 1])
+
+    def test_async_update_batch_saves_on_failure(self):
+        policy = random.choice(list(POLICIES))
+        self._stage_tmp_dir(policy)
+        requests = self._batched_updates(policy, [503])
+        self.assertEquals(len(requests), 1)
+        async_dir = os.path.join(self.testdir, 'sda1',
+                                 diskfile.get_async_dir(policy))
+        pending = [f for d in os.listdir(async_dir)
+                   for f in os.listdir(os.path.join(async_dir, d))]
+        self.assertEquals(len(pending), 3)
+        error_lines = self.object_controller.logger.get_lines_for_level(
+            'error')
+        self.assertEquals(len(error_lines), 1)
+
+    def test_async_update_batch_falls_back_on_405(self):
+        policy = random.choice(list(POLICIES))
+        self._stage_tmp_dir(policy)
+        requests = self._batched_updates(policy, [405, 201, 204, 201])
+        self.assertEquals((requests[0]['method'], requests[0]['path']),
+                          ('UPDATE', '/a/c'))
+        self.assertEquals(
+            sorted((r['method'], r['path']) for r in requests[1:]),
+            [('DELETE', '/a/c/o1'), ('PUT', '/a/c/o0'), ('PUT', '/a/c/o2')])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.testdir, 'sda1', diskfile.get_async_dir(policy))))
+
     def test_container_update_no_async_update(self):
         policy = random.choice(list(POLICIES))
         given_args = []
@@ -659,6 +659,63 @@ class TestReceiver(unittest.TestCase):
         self.assertFalse(self.controller.logger.error.called)
         self.assertFalse(self.controller.logger.exception.called)
 
+    def test_MISSING_CHECK_pipelined(self):
+        self.controller.logger = mock.MagicMock()
+        req = swob.Request.blank(
+            '/sda1/1',
+            environ={'REQUEST_METHOD': 'SSYNC'},
+            headers={'X-Backend-Ssync-Pipeline': 'True'},
+            body=':MISSING_CHECK: START\r\n' +
+                 self.hash1 + ' ' + self.ts1 + '\r\n' +
+                 self.hash2 + ' ' + self.ts2 + '\r\n'
+                 ':MISSING_CHECK: END\r\n'
+                 ':UPDATES: START\r\n:UPDATES: END\r\n')
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.headers['X-Backend-Ssync-Pipeline'], 'True')
+        self.assertEqual(
+            self.body_lines(resp.body),
+            [':MISSING_CHECK: START',
+             self.hash1,
+             self.hash2,
+             ':MISSING_CHECK: END',
+             ':UPDATES: START', ':UPDATES: END'])
+        self.assertEqual(resp.status_int, 200)
+        self.assertFalse(self.controller.logger.error.called)
+        self.assertFalse(self.controller.logger.exception.called)
+
+    def test_MISSING_CHECK_pipelined_sends_each_hash_as_found(self):
+        self.controller.logger = mock.MagicMock()
+        req = swob.Request.blank(
+            '/sda1/1',
+            environ={'REQUEST_METHOD': 'SSYNC'},
+            headers={'X-Backend-Ssync-Pipeline': 'True'},
+            body=':MISSING_CHECK: START\r\n' +
+                 self.hash1 + ' ' + self.ts1 + '\r\n' +
+                 self.hash2 + ' ' + self.ts2 + '\r\n'
+                 ':MISSING_CHECK: END\r\n')
+        receiver = ssync_receiver.Receiver(self.controller, req)
+        receiver.fp = req.environ['wsgi.input']
+        receiver.device, receiver.partition = 'sda1', '1'
+        receiver.policy = POLICIES[0]
+        receiver.frag_index = None
+        receiver.diskfile_mgr = self.controller._diskfile_router[POLICIES[0]]
+        gen = receiver.missing_check()
+        self.assertEqual(gen.next(), ':MISSING_CHECK: START\r\n')
+        self.assertEqual(gen.next(), self.hash1 + '\r\n')
+        # the second hash hasn't been read yet
+        self.assertEqual(receiver.fp.readline(),
+                         self.hash2 + ' ' + self.ts2 + '\r\n')
+
+    def test_SSYNC_not_pipelined(self):
+        req = swob.Request.blank(
+            '/sda1/1',
+            environ={'REQUEST_METHOD': 'SSYNC'},
+            body=':MISSING_CHECK: START\r\n:MISSING_CHECK: END\r\n'
+                 ':UPDATES: START\r\n:UPDATES: END\r\n')
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 200)
+        self.assertNotIn('X-Backend-Ssync-Pipeline', resp.headers)
+
     def test_MISSING_CHECK_have_one_older(self):
         object_dir = utils.storage_directory(
             os.path.join(self.testdir, 'sda1',
@@ -1397,6 +1454,108 @@ class TestReceiver(unittest.TestCase):
                 'X-Backend-Replication-Headers': 'x-timestamp'})
             self.assertEqual(_requests, [])
 
+    def test_UPDATES_concurrent(self):
+        _requests = []
+        routing = []
+        max_routing = [0]
+
+        @server.public
+        def _PUT(request):
+            routing.append(request)
+            max_routing[0] = max(max_routing[0], len(routing))
+            request.read_body = request.environ['wsgi.input'].read()
+            eventlet.sleep(0.01)
+            routing.remove(request)
+            _requests.append(request)
+            return swob.HTTPOk()
+
+        @server.public
+        def _DELETE(request):
+            routing.append(request)
+            max_routing[0] = max(max_routing[0], len(routing))
+            eventlet.sleep(0.01)
+            routing.remove(request)
+            _requests.append(request)
+            return swob.HTTPOk()
+
+        self.controller.replication_updates_concurrency = 2
+        big_body = 'x' * (self.controller.network_chunk_size + 1)
+        with contextlib.nested(
+                mock.patch.object(self.controller, 'PUT', _PUT),
+                mock.patch.object(self.controller, 'DELETE', _DELETE)):
+            self.controller.logger = mock.MagicMock()
+            req = swob.Request.blank(
+                '/device/partition',
+                environ={'REQUEST_METHOD': 'SSYNC'},
+                body=':MISSING_CHECK: START\r\n:MISSING_CHECK: END\r\n'
+                     ':UPDATES: START\r\n'
+                     'PUT /a/c/o1\r\n'
+                     'Content-Length: 1\r\n'
+                     'X-Timestamp: 1364456113.00001\r\n'
+                     '\r\n'
+                     '1'
+                     'DELETE /a/c/o2\r\n'
+                     'X-Timestamp: 1364456113.00002\r\n'
+                     '\r\n'
+                     'PUT /a/c/o3\r\n'
+                     'Content-Length: 3\r\n'
+                     'X-Timestamp: 1364456113.00003\r\n'
+                     '\r\n'
+                     '123'
+                     'PUT /a/c/o4\r\n'
+                     'Content-Length: %d\r\n'
+                     'X-Timestamp: 1364456113.00004\r\n'
+                     '\r\n'
+                     '%s'
+                     ':UPDATES: END\r\n' % (len(big_body), big_body))
+            resp = req.get_response(self.controller)
+            body = resp.body
+        self.assertEqual(
+            self.body_lines(body),
+            [':MISSING_CHECK: START', ':MISSING_CHECK: END',
+             ':UPDATES: START', ':UPDATES: END'])
+        self.assertEqual(resp.status_int, 200)
+        self.assertFalse(self.controller.logger.exception.called)
+        self.assertFalse(self.controller.logger.error.called)
+        self.assertEqual(max_routing[0], 2)
+        self.assertEqual(
+            sorted((req.method, req.path, getattr(req, 'read_body', None))
+                   for req in _requests),
+            [('DELETE', '/device/partition/a/c/o2', None),
+             ('PUT', '/device/partition/a/c/o1', '1'),
+             ('PUT', '/device/partition/a/c/o3', '123'),
+             ('PUT', '/device/partition/a/c/o4', big_body)])
+
+    def test_UPDATES_concurrent_failures(self):
+        _requests = []
+
+        @server.public
+        def _DELETE(request):
+            _requests.append(request)
+            eventlet.sleep(0.01)
+            return swob.HTTPInternalServerError()
+
+        self.controller.replication_updates_concurrency = 4
+        with mock.patch.object(self.controller, 'DELETE', _DELETE):
+            self.controller.logger = mock.MagicMock()
+            req = swob.Request.blank(
+                '/device/partition',
+                environ={'REQUEST_METHOD': 'SSYNC'},
+                body=':MISSING_CHECK: START\r\n:MISSING_CHECK: END\r\n'
+                     ':UPDATES: START\r\n'
+                     'DELETE /a/c/o\r\n\r\n'
+                     'DELETE /a/c/o\r\n\r\n'
+                     ':UPDATES: END\r\n')
+            resp = req.get_response(self.controller)
+            body = resp.body
+        # failures are counted once every subrequest is done
+        self.assertEqual(
+            self.body_lines(body),
+            [':MISSING_CHECK: START', ':MISSING_CHECK: END',
+             ":ERROR: 500 'ERROR: With :UPDATES: 2 failures to 0 "
+             "successes'"])
+        self.assertEqual(len(_requests), 2)
+
     def test_UPDATES_subreq_does_not_read_all(self):
         # This tests that if a SSYNC subrequest fails and doesn't read
         # all the subrequest body that it will read and throw away the rest of
@@ -16,6 +16,7 @@
 import hashlib
 import os
 import shutil
+import socket
 import StringIO
 import tempfile
 import time
@@ -262,6 +263,7 @@ class TestSender(BaseTestSender):
                 mock.call('Transfer-Encoding', 'chunked'),
                 mock.call('X-Backend-Storage-Policy-Index', 1),
                 mock.call('X-Backend-Ssync-Frag-Index', 0),
+                mock.call('X-Backend-Ssync-Pipeline', 'True'),
             ],
             'endheaders': [mock.call()],
         }
@@ -271,6 +273,25 @@ class TestSender(BaseTestSender):
                               'connection method "%s" got %r not %r' % (
                                   method_name, mock_method.mock_calls,
                                   expected_calls))
+        self.assertFalse(self.sender.pipelined)
+
+    def test_connect_pipelined(self):
+        node = dict(replication_ip='1.2.3.4', replication_port=5678,
+                    device='sda1', index=0)
+        job = dict(partition='9', policy=POLICIES[1])
+        self.sender = ssync_sender.Sender(self.daemon, node, job, None)
+        self.sender.suffixes = ['abc']
+        with mock.patch(
+                'swift.obj.ssync_sender.bufferedhttp.BufferedHTTPConnection'
+        ) as mock_conn_class:
+            mock_conn = mock_conn_class.return_value
+            mock_resp = mock.MagicMock()
+            mock_resp.status = 200
+            mock_resp.getheader.return_value = 'True'
+            mock_conn.getresponse.return_value = mock_resp
+            self.sender.connect()
+        mock_resp.getheader.assert_called_once_with('X-Backend-Ssync-Pipeline')
+        self.assertTrue(self.sender.pipelined)
 
     def test_call(self):
         def patch_sender(sender):
@@ -814,6 +835,156 @@ class TestSender(BaseTestSender):
                          dict([('9d41d8cd98f00b204e9800998ecf0abc',
                                 '1380144470.00000')]))
 
+    def test_missing_check_pipelined(self):
+        def yield_hashes(device, partition, policy, suffixes=None, **kwargs):
+            yield (
+                '/srv/node/dev/objects/9/abc/'
+                '9d41d8cd98f00b204e9800998ecf0abc',
+                '9d41d8cd98f00b204e9800998ecf0abc',
+                '1380144470.00000')
+
+        self.sender.connection = FakeConnection()
+        self.sender.job = {
+            'device': 'dev',
+            'partition': '9',
+            'policy': POLICIES.legacy,
+        }
+        self.sender.suffixes = ['abc']
+        self.sender.pipelined = True
+        self.sender.response = FakeResponse(
+            chunk_body=(
+                ':MISSING_CHECK: START\r\n'
+                '0123abc\r\n'
+                '4567def\r\n'
+                ':MISSING_CHECK: END\r\n'
+                ':UPDATES: START\r\n'
+                ':UPDATES: END\r\n'))
+        self.sender.daemon._diskfile_mgr.yield_hashes = yield_hashes
+        self.sender.missing_check()
+        # the hashes wanted are read as updates are sent
+        self.assertEqual(self.sender.send_list, [])
+        self.assertNotEqual(self.sender.reader, None)
+        sent = []
+
+        def send_update(object_hash):
+            # the hash is only read once it's needed
+            self.assertEqual(self.sender.send_list, sent + [object_hash])
+            sent.append(object_hash)
+
+        self.sender.send_update = send_update
+        self.sender.updates()
+        self.assertEqual(sent, ['0123abc', '4567def'])
+        self.assertEqual(self.sender.send_list, ['0123abc', '4567def'])
+        self.assertTrue(self.sender.reader.dead)
+
+    def test_missing_check_pipelined_reads_while_sending(self):
+        hashes = ['%032x' % i for i in range(3)]
+
+        def yield_hashes(device, partition, policy, suffixes=None, **kwargs):
+            for object_hash in hashes:
+                yield ('/srv/node/dev/objects/9/abc/' + object_hash,
+                       object_hash, '1380144470.00000')
+
+        self.sender.job = {
+            'device': 'dev',
+            'partition': '9',
+            'policy': POLICIES.legacy,
+        }
+        self.sender.suffixes = ['abc']
+        self.sender.pipelined = True
+        self.sender.response = FakeResponse(
+            chunk_body=':MISSING_CHECK: START\r\n' + ''.join(
+                object_hash + '\r\n' for object_hash in hashes) +
+            ':MISSING_CHECK: END\r\n:UPDATES: START\r\n:UPDATES: END\r\n')
+        self.sender.daemon._diskfile_mgr.yield_hashes = yield_hashes
+        connection = FakeConnection()
+
+        def send(data):
+            # Like a receiver whose buffers are full, only take the next
+            # line once its answers to the lines before have been read.
+            lines_sent = len(connection.sent) - 1
+            for _junk in range(100):
+                if lines_sent <= 0 or self.sender.wanted.qsize() >= lines_sent:
+                    break
+                eventlet.sleep(0)
+            else:
+                raise exceptions.MessageTimeout(msg='blocked')
+            connection.sent.append(data)
+
+        connection.send = send
+        self.sender.connection = connection
+        self.sender.missing_check()
+        self.assertEqual(len(connection.sent), 5)
+        self.sender.send_update = mock.MagicMock()
+        self.sender.connection.send = lambda data: None
+        self.sender.updates()
+        self.assertEqual(self.sender.send_list, hashes)
+
+    def test_missing_check_pipelined_send_failure_kills_reader(self):
+        def yield_hashes(device, partition, policy, suffixes=None, **kwargs):
+            raise exceptions.ReplicationException('broken')
+            yield
+
+        self.sender.connection = FakeConnection()
+        self.sender.job = {
+            'device': 'dev',
+            'partition': '9',
+            'policy': POLICIES.legacy,
+        }
+        self.sender.suffixes = ['abc']
+        self.sender.pipelined = True
+        self.sender.response = FakeResponse(
+            chunk_body=':MISSING_CHECK: START\r\n')
+        self.sender.daemon._diskfile_mgr.yield_hashes = yield_hashes
+        self.assertRaises(exceptions.ReplicationException,
+                          self.sender.missing_check)
+        self.assertTrue(self.sender.reader.dead)
+
+    def test_missing_check_pipelined_with_obj_list(self):
+        def yield_hashes(device, partition, policy, suffixes=None, **kwargs):
+            yield (
+                '/srv/node/dev/objects/9/abc/'
+                '9d41d8cd98f00b204e9800998ecf0abc',
+                '9d41d8cd98f00b204e9800998ecf0abc',
+                '1380144470.00000')
+
+        self.sender.connection = FakeConnection()
+        self.sender.job = {
+            'device': 'dev',
+            'partition': '9',
+            'policy': POLICIES.legacy,
+        }
+        self.sender.suffixes = ['abc']
+        self.sender.pipelined = True
+        self.sender.remote_check_objs = ['9d41d8cd98f00b204e9800998ecf0abc']
+        self.sender.response = FakeResponse(
+            chunk_body=(
+                ':MISSING_CHECK: START\r\n'
+                '9d41d8cd98f00b204e9800998ecf0abc\r\n'
+                ':MISSING_CHECK: END\r\n'))
+        self.sender.daemon._diskfile_mgr.yield_hashes = yield_hashes
+        self.sender.missing_check()
+        # no updates are sent, so the whole list is read up front
+        self.assertEqual(self.sender.send_list,
+                         ['9d41d8cd98f00b204e9800998ecf0abc'])
+        self.assertEqual(self.sender.reader, None)
+
+    def test_updates_pipelined_early_disconnect(self):
+        self.sender.connection = FakeConnection()
+        self.sender.pipelined = True
+        self.sender.wanted = eventlet.queue.Queue()
+        self.sender.response = FakeResponse(
+            chunk_body=':MISSING_CHECK: START\r\n0123abc\r\n')
+        self.sender.reader = eventlet.spawn(self.sender._read_wanted)
+        self.sender.send_update = mock.MagicMock()
+        exc = None
+        try:
+            self.sender.updates()
+        except exceptions.ReplicationException as err:
+            exc = err
+        self.assertEqual(str(exc), 'Early disconnect')
+        self.sender.send_update.assert_called_once_with('0123abc')
+
     def test_missing_check_extra_line_parts(self):
         # check that sender tolerates extra parts in missing check
         # line responses to allow for protocol upgrades
@@ -1230,6 +1401,87 @@ class TestSender(BaseTestSender):
             '%(chunk_size)s\r\n'
             '%(body)s\r\n' % expected)
 
+    def _tcp_socketpair(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        wsock = socket.create_connection(listener.getsockname())
+        rsock = listener.accept()[0]
+        listener.close()
+        self.addCleanup(rsock.close)
+        self.addCleanup(wsock.close)
+        return rsock, wsock
+
+    def _make_zero_copy_reader(self, body, sent=None):
+        reader = mock.MagicMock()
+        reader.can_zero_copy_send.return_value = True
+
+        def fake_zero_copy_send(wsockfd, timeout=None, timeout_exc=None):
+            os.write(wsockfd, body)
+            return len(body) if sent is None else sent
+
+        reader.zero_copy_send.side_effect = fake_zero_copy_send
+        return reader
+
+    def test_send_put_zero_copy(self):
+        body = 'test'
+        df = self._make_open_diskfile(body=body)
+        expected = dict(df.get_metadata())
+        reader = self._make_zero_copy_reader(body)
+        rsock, wsock = self._tcp_socketpair()
+        self.sender.connection = FakeConnection()
+        self.sender.connection.sock = wsock
+        self.sender.daemon.node_timeout = 7
+        with mock.patch.object(df, 'reader', return_value=reader):
+            self.sender.send_put('/a/c/o', df)
+        self.assertEqual(
+            ''.join(self.sender.connection.sent),
+            '68\r\n'
+            'PUT /a/c/o\r\n'
+            'Content-Length: %(Content-Length)s\r\n'
+            'ETag: %(ETag)s\r\n'
+            'X-Timestamp: %(X-Timestamp)s\r\n'
+            '\r\n'
+            '\r\n'
+            '4\r\n'
+            '\r\n' % expected)
+        self.assertEqual(rsock.recv(1024), body)
+        self.assertEqual(len(reader.zero_copy_send.mock_calls), 1)
+        args, kwargs = reader.zero_copy_send.call_args
+        self.assertEqual(args, (wsock.fileno(),))
+        self.assertEqual(kwargs['timeout'], 7)
+        self.assertEqual(str(kwargs['timeout_exc']),
+                         '7 seconds: send_put zero copy')
+        if hasattr(socket, 'TCP_CORK'):
+            self.assertEqual(
+                wsock.getsockopt(socket.IPPROTO_TCP, socket.TCP_CORK), 0)
+
+    def test_send_put_zero_copy_short_send(self):
+        df = self._make_open_diskfile(body='test')
+        reader = self._make_zero_copy_reader('tes', sent=3)
+        rsock, wsock = self._tcp_socketpair()
+        self.sender.connection = FakeConnection()
+        self.sender.connection.sock = wsock
+        with mock.patch.object(df, 'reader', return_value=reader):
+            exc = None
+            try:
+                self.sender.send_put('/a/c/o', df)
+            except exceptions.ReplicationException as err:
+                exc = err
+        self.assertEqual(str(exc), 'Sent 3 of 4 bytes')
+        # The chunk was never terminated.
+        self.assertEqual(self.sender.connection.sent[-1], '4\r\n')
+
+    def test_send_put_zero_copy_empty_body(self):
+        df = self._make_open_diskfile(body='')
+        reader = self._make_zero_copy_reader('')
+        reader.__iter__.return_value = iter([])
+        self.sender.connection = FakeConnection()
+        with mock.patch.object(df, 'reader', return_value=reader):
+            self.sender.send_put('/a/c/o', df)
+        self.assertFalse(reader.zero_copy_send.called)
+        self.assertEqual(len(self.sender.connection.sent), 1)
+
     def test_disconnect_timeout(self):
         self.sender.connection = FakeConnection()
         self.sender.connection.send = lambda d: eventlet.sleep(1)
@@ -1255,7 +1507,7 @@ class TestSsync(BaseTestSender):
     """
 
     def make_fake_ssync_connect(self, sender, rx_obj_controller, device,
-                                partition, policy):
+                                partition, policy, pipelined=False):
         trace = []
 
         def add_trace(type, msg):
@@ -1265,6 +1517,8 @@ class TestSsync(BaseTestSender):
 
         def start_response(status, headers, exc_info=None):
             assert(status == '200 OK')
+            sender.pipelined = utils.config_true_value(
+                dict(headers).get('X-Backend-Ssync-Pipeline'))
 
         class FakeConnection:
             def __init__(self, trace):
@@ -1297,6 +1551,8 @@ class TestSsync(BaseTestSender):
             sender.connection = FakeConnection(trace)
             headers = {'Transfer-Encoding': 'chunked',
                        'X-Backend-Storage-Policy-Index': str(int(policy))}
+            if pipelined:
+                headers['X-Backend-Ssync-Pipeline'] = 'True'
             env = {'REQUEST_METHOD': 'SSYNC'}
             path = '/%s/%s' % (device, partition)
             req = Request.blank(path, environ=env, headers=headers)
@@ -1594,6 +1850,51 @@ class TestSsync(BaseTestSender):
         self._verify_ondisk_files(tx_objs, policy, rx_node_index)
         self._verify_tombstones(tx_tombstones, policy)
 
+    def test_handoff_fragment_revert_pipelined(self):
+        policy = POLICIES.default
+        rx_node_index = 0
+        tx_node_index = 1
+        tx_objs = {}
+        tx_tombstones = {}
+        tx_df_mgr = self.daemon._diskfile_router[policy]
+        for o_name in ('o1', 'o2', 'o3'):
+            tx_objs[o_name] = self._create_ondisk_files(
+                tx_df_mgr, o_name, policy, self.ts_iter.next(),
+                (rx_node_index,))
+        t4 = self.ts_iter.next()
+        tx_tombstones['o4'] = self._create_ondisk_files(
+            tx_df_mgr, 'o4', policy, t4, (tx_node_index,))
+        tx_tombstones['o4'][0].delete(t4)
+
+        suffixes = set()
+        for diskfiles in (tx_objs.values() + tx_tombstones.values()):
+            for df in diskfiles:
+                suffixes.add(os.path.basename(os.path.dirname(df._datadir)))
+
+        job = {'device': self.device,
+               'partition': self.partition,
+               'policy': policy,
+               'frag_index': rx_node_index,
+               'purge': True}
+        node = {'index': rx_node_index}
+        self.sender = ssync_sender.Sender(self.daemon, node, job, suffixes)
+        self.sender.connect = self.make_fake_ssync_connect(
+            self.sender, self.rx_controller, self.device, self.partition,
+            policy, pipelined=True)
+
+        success, in_sync_objs = self.sender()
+        self.assertTrue(success)
+        self.assertTrue(self.sender.pipelined)
+        self.assertEqual(4, len(in_sync_objs))
+        self.assertEqual(4, len(self.sender.send_list))
+        # each hash wanted was sent on its own
+        rx_lines = [msg for direction, msg in self.sender.connection.trace
+                    if direction == 'rx']
+        for object_hash in self.sender.send_list:
+            self.assertTrue(object_hash in rx_lines)
+        self._verify_ondisk_files(tx_objs, policy, rx_node_index)
+        self._verify_tombstones(tx_tombstones, policy)
+
     def test_fragment_sync(self):
         # check that a sync_only type job does call reconstructor to build a
         # diskfile to send, and continues making progress despite an error
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import cPickle as pickle
+import json
 import mock
 import os
 import unittest
@@ -485,6 +486,242 @@ class TestObjectUpdater(unittest.TestCase):
         self.assertEqual(daemon.logger.get_increment_counts(),
                          {'successes': 1, 'unlinks': 1, 'async_pendings': 1})
 
+    def _write_asyncs(self, policy, names):
+        ts = (normalize_timestamp(t) for t in itertools.count(int(time())))
+        conf = {'devices': self.devices_dir, 'mount_check': 'false',
+                'swift_dir': self.testdir}
+        dfmanager = DiskFileManager(conf, self.logger)
+        for account, container, obj in names:
+            headers_out = swob.HeaderKeyDict({
+                'x-size': 0,
+                'x-content-type': 'text/plain',
+                'x-etag': 'd41d8cd98f00b204e9800998ecf8427e',
+                'x-timestamp': ts.next(),
+                'X-Backend-Storage-Policy-Index': int(policy),
+            })
+            data = {'op': 'PUT', 'account': account, 'container': container,
+                    'obj': obj, 'headers': headers_out}
+            dfmanager.pickle_async_update(self.sda1, account, container, obj,
+                                          data, ts.next(), policy)
+        async_dir = os.path.join(self.sda1, get_async_dir(policy))
+        return [os.path.join(async_dir, prefix, f)
+                for prefix in os.listdir(async_dir)
+                for f in os.listdir(os.path.join(async_dir, prefix))]
+
+    def _concurrent_updater(self, **kwargs):
+        conf = {
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'recon_cache_path': self.testdir,
+            'concurrent_updates': '4',
+        }
+        conf.update(kwargs)
+        return object_updater.ObjectUpdater(conf, logger=self.logger)
+
+    def test_concurrent_object_sweep(self):
+        policy = random.choice(list(POLICIES))
+        paths = self._write_asyncs(policy, [
+            ('a', 'c', 'o1'), ('a', 'c', 'o2'), ('a', 'c', 'o3'),
+            ('a', 'c2', 'o1')])
+        daemon = self._concurrent_updater()
+        self.assertEqual(daemon.concurrent_updates, 4)
+        # one UPDATE per container per container server
+        with mocked_http_conn(*([202] * 6)) as fake_conn:
+            daemon.object_sweep(self.sda1)
+            self.assertRaises(StopIteration, fake_conn.code_iter.next)
+        ring = daemon.get_container_ring()
+        self.assertEqual(sorted(set((r['method'], r['path'])
+                                    for r in fake_conn.requests)),
+                         [('UPDATE', '/sda1/%d/a/c' % ring.get_part('a', 'c')),
+                          ('UPDATE',
+                           '/sda1/%d/a/c2' % ring.get_part('a', 'c2'))])
+        for req in fake_conn.requests:
+            self.assertEqual(req['headers']['X-Backend-Storage-Policy-Index'],
+                             str(int(policy)))
+            self.assertEqual(req['headers']['Content-Type'],
+                             'application/json')
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(daemon.logger.get_increment_counts(),
+                         {'successes': 4, 'unlinks': 4, 'batches': 6,
+                          'async_pendings': 4})
+        recon = json.load(open(os.path.join(self.testdir, 'object.recon')))
+        self.assertEqual(recon['object_updater_backlog'], {'sda1': 0})
+
+    def test_concurrent_object_sweep_batch_rows(self):
+        policy = random.choice(list(POLICIES))
+        self._write_asyncs(policy, [('a', 'c', 'o1'), ('a', 'c', 'o2')])
+        daemon = self._concurrent_updater()
+        batches = []
+
+        def fake_batch_update(node, part, account, container, updates,
+                              policy):
+            batches.append((node['id'], account, container,
+                            sorted(u['obj'] for p, u in updates)))
+            return [True] * len(updates)
+
+        with mock.patch.object(daemon, 'container_batch_update',
+                               fake_batch_update):
+            daemon.object_sweep(self.sda1)
+        self.assertEqual(sorted(batches), [
+            (0, 'a', 'c', ['o1', 'o2']),
+            (1, 'a', 'c', ['o1', 'o2']),
+            (2, 'a', 'c', ['o1', 'o2'])])
+
+        rows = []
+        with mocked_http_conn(202) as fake_conn:
+            with mock.patch.object(object_updater.json, 'dumps',
+                                   lambda r: rows.extend(r) or '[]'):
+                results = daemon.container_batch_update(
+                    {'id': 0, 'ip': '127.0.0.1', 'port': 1,
+                     'device': 'sda1'}, 0, 'a', 'c', [
+                        ('p1', {'op': 'PUT', 'obj': 'o1', 'headers': {
+                            'x-timestamp': '1', 'x-size': '3',
+                            'x-content-type': 'text/plain',
+                            'x-etag': 'etag'}}),
+                        ('p2', {'op': 'DELETE', 'obj': 'o2', 'headers': {
+                            'x-timestamp': '2'}}),
+                        ('p3', {'op': 'PUT', 'obj': 'o3', 'headers': {},
+                                'successes': [0]})], policy)
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual(len(fake_conn.requests), 1)
+        self.assertEqual(rows, [
+            {'name': 'o1', 'created_at': '1', 'size': 3,
+             'content_type': 'text/plain', 'etag': 'etag', 'deleted': 0,
+             'storage_policy_index': int(policy)},
+            {'name': 'o2', 'created_at': '2', 'size': 0,
+             'content_type': 'application/deleted', 'etag': 'noetag',
+             'deleted': 1, 'storage_policy_index': int(policy)}])
+
+    def test_concurrent_object_sweep_falls_back_on_405(self):
+        policy = random.choice(list(POLICIES))
+        paths = self._write_asyncs(policy, [('a', 'c', 'o1'),
+                                            ('a', 'c', 'o2')])
+        daemon = self._concurrent_updater()
+        requests = []
+
+        class FakeConn(object):
+
+            def __init__(self, method):
+                # a container server from before the UPDATE verb
+                self.status = 405 if method == 'UPDATE' else 201
+
+            def send(self, data):
+                pass
+
+            def getresponse(self):
+                return self
+
+            def read(self):
+                return ''
+
+        def fake_http_connect(ip, port, device, part, method, path,
+                              headers):
+            requests.append((method, path))
+            return FakeConn(method)
+
+        with mock.patch.object(object_updater, 'http_connect',
+                               fake_http_connect):
+            daemon.object_sweep(self.sda1)
+        self.assertEqual(sorted(requests),
+                         [('PUT', '/a/c/o1')] * 3 +
+                         [('PUT', '/a/c/o2')] * 3 +
+                         [('UPDATE', '/a/c')] * 3)
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(daemon.logger.get_increment_counts(),
+                         {'successes': 2, 'unlinks': 2,
+                          'async_pendings': 2})
+
+    def test_concurrent_object_sweep_falls_back_on_400(self):
+        policy = random.choice(list(POLICIES))
+        paths = self._write_asyncs(policy, [('a', 'c', 'o1'),
+                                            ('a', 'c', 'o2')])
+        daemon = self._concurrent_updater()
+        requests = []
+
+        class FakeConn(object):
+
+            def __init__(self, method, path):
+                # one bad row gets the whole UPDATE rejected
+                if method == 'UPDATE' or path == '/a/c/o2':
+                    self.status = 400
+                else:
+                    self.status = 201
+
+            def send(self, data):
+                pass
+
+            def getresponse(self):
+                return self
+
+            def read(self):
+                return ''
+
+        def fake_http_connect(ip, port, device, part, method, path,
+                              headers):
+            requests.append((method, path))
+            return FakeConn(method, path)
+
+        with mock.patch.object(object_updater, 'http_connect',
+                               fake_http_connect):
+            daemon.object_sweep(self.sda1)
+        self.assertEqual(sorted(requests),
+                         [('PUT', '/a/c/o1')] * 3 +
+                         [('PUT', '/a/c/o2')] * 3 +
+                         [('UPDATE', '/a/c')] * 3)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertEqual(daemon.logger.get_increment_counts(),
+                         {'successes': 1, 'unlinks': 1, 'failures': 1,
+                          'async_pendings': 2})
+
+    def test_concurrent_object_sweep_partial_failure(self):
+        policy = random.choice(list(POLICIES))
+        paths = self._write_asyncs(policy, [('a', 'c', 'o1'),
+                                            ('a', 'c', 'o2')])
+        daemon = self._concurrent_updater()
+        with mocked_http_conn(202, 503, 404):
+            daemon.object_sweep(self.sda1)
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(pickle.load(open(path)).get('successes'),
+                             [0, 2])
+        self.assertEqual(daemon.logger.get_increment_counts(),
+                         {'failures': 2, 'batches': 3, 'async_pendings': 2})
+        recon = json.load(open(os.path.join(self.testdir, 'object.recon')))
+        self.assertEqual(recon['object_updater_backlog'], {'sda1': 2})
+
+        # only the container server that missed them gets them next time
+        daemon.logger._clear()
+        with mocked_http_conn(202) as fake_conn:
+            daemon.object_sweep(self.sda1)
+        self.assertEqual(len(fake_conn.requests), 1)
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(daemon.logger.get_increment_counts(),
+                         {'successes': 2, 'unlinks': 2, 'batches': 1})
+
+    def test_concurrent_object_sweep_batch_size_and_rate(self):
+        policy = random.choice(list(POLICIES))
+        self._write_asyncs(policy, [('a', 'c', 'o%d' % i)
+                                    for i in range(5)])
+        daemon = self._concurrent_updater(update_batch_size='2',
+                                          objects_per_second='50')
+        batch_sizes = []
+
+        def fake_process_update_batch(device, policy, part, batch):
+            batch_sizes.append(len(batch))
+
+        with mock.patch.object(daemon, 'process_update_batch',
+                               fake_process_update_batch), \
+                mock.patch.object(object_updater, 'ratelimit_sleep',
+                                  return_value=0) as mock_ratelimit:
+            daemon.object_sweep(self.sda1)
+        self.assertEqual(sorted(batch_sizes), [1, 2, 2])
+        self.assertEqual(mock_ratelimit.mock_calls,
+                         [mock.call(0, 50.0)] * 5)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1116,6 +1116,34 @@ class TestProxyServerLoading(unittest.TestCase):
         for policy in POLICIES:
             self.assert_(policy.object_ring)
 
+    def test_ring_lookup_options(self):
+        ring_paths = [os.path.join(self.tempdir, name + '.ring.gz')
+                      for name in ['account', 'container'] +
+                      [policy.ring_name for policy in POLICIES]]
+        for ring_path in ring_paths:
+            write_fake_ring(ring_path)
+
+        app = proxy_server.Application({'swift_dir': self.tempdir},
+                                       FakeMemcache(),
+                                       logger=debug_logger('proxy-ut'))
+        for ring in [app.account_ring, app.container_ring] + [
+                app.get_object_ring(int(policy)) for policy in POLICIES]:
+            self.assertFalse(ring.precompute_part_nodes)
+            self.assertEqual(ring._part2dev_ids, None)
+            self.assertEqual(ring._handoff_cache, None)
+        for policy in POLICIES:
+            policy.object_ring = None
+
+        app = proxy_server.Application(
+            {'swift_dir': self.tempdir, 'ring_precompute_part_nodes': 'yes',
+             'ring_handoff_cache_size': '50'},
+            FakeMemcache(), logger=debug_logger('proxy-ut'))
+        for ring in [app.account_ring, app.container_ring] + [
+                app.get_object_ring(int(policy)) for policy in POLICIES]:
+            self.assertTrue(ring.precompute_part_nodes)
+            self.assertEqual(len(ring._part2dev_ids), ring.partition_count)
+            self.assertEqual(ring._handoff_cache.maxsize, 50)
+
 
 @patch_policies([StoragePolicy(0, 'zero', True,
                                object_ring=FakeRing(base_port=3000))])